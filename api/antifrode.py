@@ -0,0 +1,322 @@
+'''
+Modulo Python contenente il rilevatore di frodi sugli ingressi, da eseguire come processo separato dall'API
+(servizio worldfit_antifrode in docker-compose.yml). Legge in coda i nuovi ingressi della tabella Logs
+(per Id crescente, sull'indice della chiave primaria) e mantiene in memoria, per ogni pseudonimo di
+SmartCard, gli ultimi ingressi con palestra e timestamp. Per ogni ingresso segnala:
+- "viaggio_impossibile": la stessa tessera in due palestre troppo lontane per il tempo trascorso
+  (es. tessera prestata o clonata);
+- "troppi_ingressi": più di ANTIFRODE_MAX_INGRESSI ingressi nella finestra di ANTIFRODE_FINESTRA secondi.
+Il costo per ingresso è costante: ogni tessera conserva al massimo ANTIFRODE_MAX_INGRESSI+1 ingressi e le
+tessere meno recenti escono dalla memoria oltre ANTIFRODE_MAX_TESSERE. Le allerte vengono scritte nella
+tabella Allerte (una sola volta per tipo ed ingresso) oppure in un file JSONL. Esempi:
+
+    python antifrode.py
+    python antifrode.py --backfill --dal 2026-07-01 --al 2026-10-01 -o /tmp/allerte.jsonl
+
+Le distanze tra palestre usano le coordinate del file ANTIFRODE_COORDINATE (CSV con colonne
+id,latitudine,longitudine), se presente; altrimenti una stima da luogo e stato della palestra.
+'''
+from sqlalchemy import BigInteger, CHAR, DateTime, Integer, String, Index, select, insert, func
+from sqlalchemy.orm import Session, Mapped, mapped_column
+from db_handler import DB_handler, Base, Gestionale, LogsAndStats
+from registro_palestre import RegistroPalestre
+from collections import OrderedDict, deque
+from datetime import date, datetime, timedelta, timezone
+from typing import Optional
+from sys import stdout
+import argparse, csv, json, logging, math, os, time
+
+# Impostazione di Logging per stampare eventuali eccezioni nei Docker Logs
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler(stdout)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+logger.setLevel(logging.ERROR)
+
+VELOCITA_MASSIMA = float(os.getenv("ANTIFRODE_VELOCITA_MASSIMA", "200"))   # km/h oltre cui il viaggio è impossibile
+MAX_INGRESSI = int(os.getenv("ANTIFRODE_MAX_INGRESSI", "5"))               # ingressi ammessi nella finestra
+FINESTRA = float(os.getenv("ANTIFRODE_FINESTRA", "3600"))                  # secondi
+MAX_TESSERE = int(os.getenv("ANTIFRODE_MAX_TESSERE", "500000"))            # tessere in memoria (LRU)
+INTERVALLO = float(os.getenv("ANTIFRODE_INTERVALLO", "1"))                 # secondi tra due letture di Logs
+RIPRESA = float(os.getenv("ANTIFRODE_RIPRESA", "86400"))                   # secondi di Logs riletti all'avvio
+COORDINATE = os.getenv("ANTIFRODE_COORDINATE")
+# Distanze stimate (km) tra palestre senza coordinate: stesso luogo, stesso stato, stati diversi
+DISTANZA_STESSO_LUOGO = float(os.getenv("ANTIFRODE_DISTANZA_STESSO_LUOGO", "5"))
+DISTANZA_STESSO_STATO = float(os.getenv("ANTIFRODE_DISTANZA_STESSO_STATO", "50"))
+DISTANZA_STATI_DIVERSI = float(os.getenv("ANTIFRODE_DISTANZA_STATI_DIVERSI", "500"))
+# Gli Id di Logs vengono assegnati all'inserimento ma le transazioni possono concludersi in ordine diverso:
+# ogni lettura riparte da MARGINE_ID Id prima dell'ultimo letto, saltando quelli già elaborati
+MARGINE_ID = 1000
+RIGHE_PER_LETTURA = 5000
+
+def prendisegreto(secretFile: str) -> str:
+    """Funzione che prende un segreto dalla cartella dei docker secrets"""
+    try:
+        with open(os.path.join(os.getenv("SECRETS_DIR", "/run/secrets"), secretFile), "r") as f:
+            return f.read().strip()
+    except Exception as e:
+        logger.critical("Errore nella lettura del segreto, eccezione: %s", str(e))
+
+def carica_coordinate(percorso:str) -> dict:
+    '''Legge il file CSV id,latitudine,longitudine delle palestre; restituisce {id: (latitudine, longitudine)}'''
+    coordinate = {}
+    with open(percorso, newline="") as f:
+        for riga in csv.DictReader(f):
+            try:
+                coordinate[int(riga["id"])] = (float(riga["latitudine"]), float(riga["longitudine"]))
+            except (KeyError, TypeError, ValueError):
+                logger.error("Riga del file delle coordinate ignorata: %s", riga)
+    return coordinate
+
+def haversine(a:tuple, b:tuple) -> float:
+    '''Distanza in km tra due coordinate (latitudine, longitudine) in gradi'''
+    lat1, lon1, lat2, lon2 = map(math.radians, (*a, *b))
+    h = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * 6371 * math.asin(math.sqrt(h))
+
+class DistanzePalestre:
+    '''Distanze tra palestre, dalle coordinate se disponibili o stimate da luogo e stato del RegistroPalestre'''
+    def __init__(self, registro:RegistroPalestre, coordinate:dict | None = None):
+        self.registro = registro
+        self.coordinate = coordinate or {}
+        self._cache = {}
+
+    def _stimata(self, palestra_a:int, palestra_b:int) -> Optional[float]:
+        a, b = self.registro.palestra(palestra_a), self.registro.palestra(palestra_b)
+        if a is None or b is None or not a.stato or not b.stato:
+            return None
+        if a.stato.lower() != b.stato.lower():
+            return DISTANZA_STATI_DIVERSI
+        if a.luogo and b.luogo and a.luogo.lower() == b.luogo.lower():
+            return DISTANZA_STESSO_LUOGO
+        return DISTANZA_STESSO_STATO
+
+    def km(self, palestra_a:int, palestra_b:int) -> Optional[float]:
+        '''Distanza in km, 0 per la stessa palestra, None se una delle due palestre non è nota'''
+        if palestra_a == palestra_b:
+            return 0.0
+        chiave = (min(palestra_a, palestra_b), max(palestra_a, palestra_b))
+        if chiave not in self._cache:
+            if palestra_a in self.coordinate and palestra_b in self.coordinate:
+                self._cache[chiave] = haversine(self.coordinate[palestra_a], self.coordinate[palestra_b])
+            else:
+                # stime non memorizzate: il registro può ancora caricare una palestra appena aperta
+                return self._stimata(palestra_a, palestra_b)
+        return self._cache[chiave]
+
+class RilevatoreFrodi:
+    '''
+    Motore di rilevamento: elabora un ingresso alla volta e restituisce le allerte generate, come dizionari
+    con le colonne della tabella Allerte. Lo stesso motore è usato per la lettura in coda e per il backfill.
+    '''
+    def __init__(self, distanze:DistanzePalestre, velocita_massima:float = VELOCITA_MASSIMA,
+                 max_ingressi:int = MAX_INGRESSI, finestra:float = FINESTRA, max_tessere:int = MAX_TESSERE):
+        self.distanze = distanze
+        self.velocita_massima = velocita_massima
+        self.max_ingressi = max_ingressi
+        self.finestra = finestra
+        self.max_tessere = max_tessere
+        # Chiave: hash dello pseudonimo (un intero invece di una stringa di 344 caratteri).
+        # Valore: ultimi ingressi della tessera come tuple (timestamp in secondi, palestra, id del log)
+        self._tessere: OrderedDict[int, deque] = OrderedDict()
+        self.elaborati = 0
+
+    def elabora(self, log_id:int, smart_card_id:str, palestra_id:int, timestamp:datetime) -> list[dict]:
+        secondi = timestamp.replace(tzinfo=timezone.utc).timestamp()
+        chiave = hash(smart_card_id)
+        ingressi = self._tessere.get(chiave)
+        if ingressi is None:
+            ingressi = self._tessere[chiave] = deque(maxlen=self.max_ingressi + 1)
+            if len(self._tessere) > self.max_tessere:
+                self._tessere.popitem(last=False)
+        else:
+            self._tessere.move_to_end(chiave)
+            # Lo stesso passaggio scritto due volte (es. recupero di un file di spill) non è un nuovo ingresso
+            if any(s == secondi and p == palestra_id for s, p, _ in ingressi):
+                return []
+
+        self.elaborati += 1
+        allerte = []
+        # Gli ingressi di una tessera possono arrivare fuori ordine (passaggi registrati offline):
+        # il confronto usa il tempo trascorso in valore assoluto con tutti gli ingressi conservati
+        peggiore = None
+        for s, p, precedente in ingressi:
+            distanza = self.distanze.km(palestra_id, p)
+            if not distanza:
+                continue
+            ore = abs(secondi - s) / 3600
+            velocita = distanza / ore if ore > 0 else math.inf
+            if velocita > self.velocita_massima and (peggiore is None or velocita > peggiore[0]):
+                peggiore = (velocita, distanza, p, precedente, abs(secondi - s))
+        if peggiore is not None:
+            velocita, distanza, p, precedente, trascorsi = peggiore
+            allerte.append(self._allerta("viaggio_impossibile", log_id, smart_card_id, palestra_id, timestamp, precedente, p,
+                                         f"{distanza:.0f} km in {trascorsi / 60:.0f} minuti"))
+
+        ingressi.append((secondi, palestra_id, log_id))
+        nella_finestra = [precedente for s, _, precedente in ingressi if abs(secondi - s) <= self.finestra]
+        if len(nella_finestra) > self.max_ingressi:
+            allerte.append(self._allerta("troppi_ingressi", log_id, smart_card_id, palestra_id, timestamp, min(nella_finestra), None,
+                                         f"{len(nella_finestra)} ingressi in {self.finestra / 60:.0f} minuti"))
+        return allerte
+
+    @staticmethod
+    def _allerta(tipo:str, log_id:int, smart_card_id:str, palestra_id:int, timestamp:datetime,
+                 log_id_precedente:int | None, palestra_id_precedente:int | None, dettagli:str) -> dict:
+        return {"tipo": tipo, "smart_card_id": smart_card_id, "log_id": log_id, "palestra_id": palestra_id,
+                "timestamp": timestamp, "log_id_precedente": log_id_precedente,
+                "palestra_id_precedente": palestra_id_precedente, "dettagli": dettagli}
+
+class RegistroAllerte(DB_handler):
+    '''Classe per leggere gli ingressi di Logs e scrivere le allerte nel DB Log e statistiche'''
+
+    class Allerta(Base):
+        '''Mapped Class per interagire con la tabella delle allerte antifrode'''
+        __tablename__ = "Allerte"
+
+        id: Mapped[int] = mapped_column("Id", BigInteger().with_variant(Integer, "sqlite"), primary_key=True, autoincrement=True)
+        tipo: Mapped[str] = mapped_column("Tipo", String(30))
+        smart_card_id: Mapped[str] = mapped_column("SmartCardId", CHAR(344))
+        log_id: Mapped[int] = mapped_column("LogId", BigInteger)
+        palestra_id: Mapped[int] = mapped_column("PalestraId", Integer)
+        timestamp: Mapped[datetime] = mapped_column("Timestamp", DateTime)
+        log_id_precedente: Mapped[Optional[int]] = mapped_column("LogIdPrecedente", BigInteger)
+        palestra_id_precedente: Mapped[Optional[int]] = mapped_column("PalestraIdPrecedente", Integer)
+        dettagli: Mapped[Optional[str]] = mapped_column("Dettagli", String(1000))
+        rilevata: Mapped[datetime] = mapped_column("Rilevata", DateTime, server_default=func.now())
+
+        # Un'allerta per tipo ed ingresso: riletture e backfill non creano duplicati
+        __table_args__ = (Index("IdxAllerteTipoLog", "Tipo", "LogId", unique=True),
+                          Index("IdxAllerteSmartCardTimestamp", "SmartCardId", "Timestamp"))
+
+    def logs_dopo(self, log_id:int, limite:int = RIGHE_PER_LETTURA) -> list | None:
+        '''Ingressi con Id maggiore di quello indicato, in ordine di Id; None in caso di errore'''
+        Log = LogsAndStats.Log
+        try:
+            with self.engine.connect() as connection:
+                return connection.execute(select(Log.id, Log.smart_card_id, Log.palestra_id, Log.timestamp)
+                                          .where(Log.id > log_id).order_by(Log.id).limit(limite)).all()
+        except Exception as e:
+            logger.error("Errore nella lettura degli ingressi da Logs: %s", str(e))
+
+    def logs_intervallo(self, dal:datetime, al:datetime):
+        '''Generatore degli ingressi con Timestamp in [dal, al), in ordine di tempo (lettura in streaming)'''
+        Log = LogsAndStats.Log
+        with self.engine.connect() as connection:
+            risultato = connection.execution_options(stream_results=True, yield_per=RIGHE_PER_LETTURA).execute(
+                select(Log.id, Log.smart_card_id, Log.palestra_id, Log.timestamp)
+                .where(Log.timestamp >= dal, Log.timestamp < al).order_by(Log.timestamp, Log.id))
+            yield from risultato
+
+    def ultimo_log(self) -> int | None:
+        Log = LogsAndStats.Log
+        try:
+            with self.engine.connect() as connection:
+                return connection.execute(select(func.coalesce(func.max(Log.id), 0))).scalar()
+        except Exception as e:
+            logger.error("Errore nella lettura dell'ultimo Id di Logs: %s", str(e))
+
+    def inserisci(self, allerte:list[dict]) -> bool:
+        '''Scrive le allerte ignorando quelle già presenti (stesso tipo ed ingresso)'''
+        if not allerte:
+            return True
+        ignora = "OR IGNORE" if self.engine.dialect.name == "sqlite" else "IGNORE"
+        try:
+            # INSERT "bulk" ORM, come LogsAndStats.insert_batch: i dizionari usano i nomi degli attributi
+            with Session(self.engine) as session, session.begin():
+                session.execute(insert(self.Allerta).prefix_with(ignora), allerte)
+            return True
+        except Exception as e:
+            logger.error("Errore durante l'inserimento di %s allerte: %s", len(allerte), str(e))
+            return False
+
+class FileAllerte:
+    '''Destinazione alternativa alla tabella Allerte: un'allerta per riga in formato JSON'''
+    def __init__(self, percorso:str):
+        self.percorso = percorso
+
+    def inserisci(self, allerte:list[dict]) -> bool:
+        with open(self.percorso, "a") as f:
+            f.writelines(json.dumps({**a, "timestamp": a["timestamp"].isoformat()}) + "\n" for a in allerte)
+        return True
+
+def segui(rilevatore:RilevatoreFrodi, sorgente:RegistroAllerte, destinazione, ripresa:float = RIPRESA):
+    '''
+        Lettura in coda di Logs. All'avvio vengono rielaborati gli ingressi delle ultime "ripresa" secondi,
+        in modo da ricostruire lo stato delle tessere senza salvarlo (le allerte già scritte vengono ignorate).
+    '''
+    adesso = datetime.now(timezone.utc).replace(tzinfo=None)
+    ultimo = 0
+    for riga in sorgente.logs_intervallo(adesso - timedelta(seconds=ripresa), adesso + timedelta(days=1)):
+        destinazione.inserisci(rilevatore.elabora(*riga))
+        ultimo = max(ultimo, riga[0])
+    while not ultimo:
+        # Nessun ingresso recente: la lettura in coda parte dall'ultimo Id, non dall'inizio di Logs
+        ultimo = sorgente.ultimo_log()
+        if ultimo is None:
+            time.sleep(INTERVALLO)
+        elif ultimo == 0:
+            break
+    elaborati = deque(maxlen=MARGINE_ID * 10)
+    visti = set()
+    while True:
+        righe = sorgente.logs_dopo(max(0, ultimo - MARGINE_ID))
+        allerte = []
+        for log_id, smart_card_id, palestra_id, timestamp in righe or []:
+            if log_id in visti:
+                continue
+            if len(elaborati) == elaborati.maxlen:
+                visti.discard(elaborati[0])
+            elaborati.append(log_id)
+            visti.add(log_id)
+            ultimo = max(ultimo, log_id)
+            allerte.extend(rilevatore.elabora(log_id, smart_card_id, palestra_id, timestamp))
+        if allerte and not destinazione.inserisci(allerte):
+            for allerta in allerte:
+                logger.critical("Allerta non salvata: %s", allerta)
+        if not righe or len(righe) < RIGHE_PER_LETTURA:
+            time.sleep(INTERVALLO)
+
+def backfill(rilevatore:RilevatoreFrodi, sorgente:RegistroAllerte, destinazione, dal:datetime, al:datetime) -> int:
+    '''Rielabora gli ingressi di un intervallo passato con lo stesso motore; restituisce il numero di allerte'''
+    totale, allerte = 0, []
+    for riga in sorgente.logs_intervallo(dal, al):
+        allerte.extend(rilevatore.elabora(*riga))
+        if len(allerte) >= RIGHE_PER_LETTURA:
+            destinazione.inserisci(allerte)
+            totale += len(allerte)
+            allerte = []
+    destinazione.inserisci(allerte)
+    return totale + len(allerte)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rilevatore di frodi sugli ingressi registrati in Logs")
+    parser.add_argument('--backfill', action='store_true', help="Rielabora gli ingressi di un intervallo passato ed esce")
+    parser.add_argument('--dal', type=date.fromisoformat, help="[backfill] Primo giorno (AAAA-MM-GG)")
+    parser.add_argument('--al', type=date.fromisoformat, help="[backfill] Giorno successivo all'ultimo (AAAA-MM-GG), default oggi")
+    parser.add_argument('-o', '--output', help="File JSONL delle allerte, al posto della tabella Allerte")
+    args = parser.parse_args()
+    if args.backfill and args.dal is None:
+        parser.error("il backfill richiede --dal")
+
+    # Utente dedicato con lettura di Logs e scrittura di Allerte (vedi db/init/02-setup.sh);
+    # per il Gestionale vengono usate le credenziali dell'API
+    DATABASE_LS_URI = os.getenv("DATABASE_LS_URI") or \
+        f"mysql+pymysql://{os.getenv('DB_AF_USER')}:{prendisegreto('db_ls_antifrode_password')}@{os.getenv('DB_LS_HOST')}/{os.getenv('DB_LS_DATABASE')}"
+    DATABASE_GS_URI = os.getenv("DATABASE_GS_URI") or \
+        f"mysql+pymysql://{prendisegreto('db_gs_api_user')}:{prendisegreto('db_gs_api_password')}@{prendisegreto('db_gs_ip')}/{os.getenv('DB_GS_DATABASE')}"
+
+    registro = RegistroPalestre(Gestionale(DATABASE_GS_URI))
+    coordinate = carica_coordinate(COORDINATE) if COORDINATE and os.path.exists(COORDINATE) else {}
+    rilevatore = RilevatoreFrodi(DistanzePalestre(registro, coordinate))
+    sorgente = RegistroAllerte(DATABASE_LS_URI)
+    destinazione = FileAllerte(args.output) if args.output else sorgente
+
+    if args.backfill:
+        al = args.al or date.today() + timedelta(days=1)
+        allerte = backfill(rilevatore, sorgente, destinazione, datetime.combine(args.dal, datetime.min.time()),
+                           datetime.combine(al, datetime.min.time()))
+        print(f"Ingressi elaborati: {rilevatore.elaborati}, allerte: {allerte}")
+    else:
+        segui(rilevatore, sorgente, destinazione)
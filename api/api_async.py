@@ -0,0 +1,220 @@
+'''
+Modalità di servizio asincrona (ASGI) dell'API, alternativa a api_server.py con Gunicorn. Il protocollo
+con i tornelli (richieste, controlli, risposte firmate) è lo stesso: le funzioni di controllo, i segreti,
+la cache delle tessere ed il registro delle palestre vengono importati da api_server. Cambia l'attesa dei
+database: le interrogazioni al Gestionale usano driver asincroni (vedi db_handler_async.py) ed un worker
+serve molte richieste contemporaneamente invece di una per thread; le scritture di Logs e Statistiche
+sono accodate senza attese (CodaScrittureAsync). Avvio, con un worker per CPU:
+
+    uvicorn api_async:app --host 0.0.0.0 --port 8000 --workers 4
+'''
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+from contextlib import asynccontextmanager
+from api_server import timestampCheck, signatureCheck, valutaEsito, leggiPassaggio, \
+    finalHmac, preparaIngresso, analizzaBatch, completaBatch, richiestaSnapshot, BATCH_MAX_RECORD, METRICHE, \
+    DATABASE_GS_URI, DATABASE_LS_URI
+from cache_tessere import CacheTessere
+from coda_scritture import CodaScrittureAsync
+from db_handler_async import GestionaleAsync, LogsAndStatsAsync, chiudi_engine_async
+from metriche import cronometro, osserva, incrementa, registra_raccoglitore, conta_errori, avvia_servizio
+from datetime import datetime, date, timezone
+from sys import stdout
+import api_server
+import asyncio, logging, time
+
+# Impostazione di Logging per stampare eventuali eccezioni nei Docker Logs
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler(stdout)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+logger.setLevel(logging.ERROR)
+
+# Stesso router delle repliche di api_server: nodi, scadenza ed esclusioni condivise con le letture sincrone
+gestore_async = GestionaleAsync(DATABASE_GS_URI, api_server.router)
+magazziniere_async = LogsAndStatsAsync(DATABASE_LS_URI)
+# Cache delle tessere di api_server (se attiva): le letture sono su un file SQLite locale e restano sincrone,
+# eseguite in un thread (asyncio.to_thread) per non fermare l'event loop durante l'accesso al file
+cache = api_server.gestore if isinstance(api_server.gestore, CacheTessere) else None
+# La coda asincrona sostituisce quella sincrona di api_server, anche nelle metriche del worker
+coda = None
+if api_server.coda is not None:
+    coda = api_server.coda = CodaScrittureAsync(api_server.magazziniere, magazziniere_async)
+conta_errori(logging.getLogger("db_handler_async"), logger)
+
+# Richieste dei tornelli in corso nel worker (la concorrenza effettiva della modalità asincrona)
+in_corso = 0
+registra_raccoglitore(lambda: [("worldfit_richieste_in_corso", {}, in_corso)])
+
+async def verificaAccesso(idSmartCard:str, idPalestra:int, giorno:date):
+    '''Come CacheTessere.verifica_accesso, con l'interrogazione al Gestionale asincrona'''
+    esito = await asyncio.to_thread(cache.cerca, idSmartCard, idPalestra, giorno) if cache is not None else None
+    if esito is not None:
+        return esito
+    esito = await gestore_async.verifica_accesso(idSmartCard, idPalestra, giorno)
+    if cache is not None:
+        if esito is None:
+            # Gestionale in errore: servo voci scadute se entro la finestra di stale
+            return await asyncio.to_thread(cache.cerca, idSmartCard, idPalestra, giorno, stale=True)
+        await asyncio.to_thread(cache.memorizza, idSmartCard, idPalestra, esito)
+    return esito
+
+async def verificaAccessi(richieste:list) -> list:
+    '''
+        Come CacheTessere.verifica_accessi, con un solo lotto asincrono sul Gestionale per le richieste
+        non in cache. Le richieste di giorni precedenti non usano né aggiornano la cache.
+    '''
+    oggi = date.today()
+
+    def cercaInCache() -> list:
+        return [cache.cerca(idSmartCard, idPalestra, giorno) if cache is not None and giorno == oggi else None
+                for idSmartCard, idPalestra, giorno in richieste]
+
+    # Le letture e scritture della cache di tutto il lotto in un solo passaggio nel thread
+    esiti = await asyncio.to_thread(cercaInCache) if cache is not None else [None] * len(richieste)
+    mancanti = [i for i, esito in enumerate(esiti) if esito is None]
+    if not mancanti:
+        return esiti
+
+    risposte = await gestore_async.verifica_accessi([richieste[i] for i in mancanti])
+
+    def aggiornaCache():
+        for i, esito in zip(mancanti, risposte or [None] * len(mancanti)):
+            idSmartCard, idPalestra, giorno = richieste[i]
+            if cache is not None and giorno == oggi:
+                if esito is None:
+                    esito = cache.cerca(idSmartCard, idPalestra, giorno, stale=True)
+                else:
+                    cache.memorizza(idSmartCard, idPalestra, esito)
+            esiti[i] = esito
+
+    if cache is not None:
+        await asyncio.to_thread(aggiornaCache)
+    else:
+        aggiornaCache()
+    return esiti
+
+async def checkAsync(ricezione:float, idSmartCard:str, idPalestra:int, timestamp:int, signature:str) -> tuple[dict, str]:
+    '''Versione asincrona di api_server.check, con gli stessi controlli in cascata e gli stessi esiti'''
+    if not timestampCheck(ricezione, timestamp):
+        return None, "timestamp_scaduto"
+    if not signatureCheck(idSmartCard, idPalestra, timestamp, signature):
+        return None, "firma_errata"
+    with cronometro("worldfit_fase_secondi", fase="verifica_accesso"):
+        esito = await verificaAccesso(idSmartCard, idPalestra, date.today())
+    # valutaEsito può ricaricare il registro delle palestre dal Gestionale (palestra assente)
+    return await asyncio.to_thread(valutaEsito, esito)
+
+async def scrivi(logs:list, stats:list):
+    '''Accoda Logs e Statistiche; senza coda (CODA_SCRITTURE=0) li scrive subito in una transazione'''
+    if coda is not None:
+        for log, stat in zip(logs, stats):
+            coda.accoda(log, stat)
+    else:
+        await magazziniere_async.insert_batch(logs, stats)
+
+def richiestaTornello(route):
+    '''Decoratore delle route dei tornelli: registra durata ed esito (restituito insieme alla risposta) come api_server'''
+    async def gestisci(request:Request) -> Response:
+        global in_corso
+        inizio = time.perf_counter()
+        in_corso += 1
+        esito = "eccezione"
+        try:
+            risposta, esito = await route(request)
+            return risposta
+        finally:
+            in_corso -= 1
+            osserva("worldfit_richieste_secondi", time.perf_counter() - inizio, route=request.url.path, esito=esito)
+    return gestisci
+
+@richiestaTornello
+async def home(request:Request) -> tuple[Response, str]:
+    ricezione = datetime.now(tz=timezone.utc).timestamp()
+    data = await request.json()
+
+    try:
+        idSmartCard, idPalestra, timestamp, signature = leggiPassaggio(data)
+    except ValueError as e:
+        logger.error("Dati ricevuti incorretti: %s", str(e))
+        return JSONResponse({"valido": False,
+                             "signature": finalHmac(data["IDSmartCard"], data["Timestamp"])}), "dati_errati"
+
+    abbonamentoValido = False
+    info, esito = await checkAsync(ricezione, idSmartCard, idPalestra, timestamp, signature)
+    if info is not None:
+        abbonamentoValido = info["abbonamento_valido"]
+        if abbonamentoValido:
+            log, stat = preparaIngresso(info["cliente"], info["palestra"], idSmartCard, idPalestra, timestamp)
+            with cronometro("worldfit_fase_secondi", fase="scrittura"):
+                await scrivi([log], [stat])
+
+    return JSONResponse({"valido": abbonamentoValido,
+                         "signature": finalHmac(idSmartCard, timestamp)}), esito
+
+@richiestaTornello
+async def batch(request:Request) -> tuple[Response, str]:
+    '''Stesso protocollo di api_server.batch: le interrogazioni del lotto sul Gestionale vengono eseguite in parallelo'''
+    ricezione = datetime.now(tz=timezone.utc).timestamp()
+    data = await request.json()
+
+    records = data.get("Records") if isinstance(data, dict) else None
+    if not isinstance(records, list) or len(records) > BATCH_MAX_RECORD:
+        logger.error("Batch ricevuto incorretto")
+        return JSONResponse({"errore": f"Records deve essere una lista di al massimo {BATCH_MAX_RECORD} passaggi"},
+                            status_code=400), "dati_errati"
+
+    risultati, da_verificare, esiti_passaggi = analizzaBatch(records, ricezione)
+    esiti = None
+    if da_verificare:
+        with cronometro("worldfit_fase_secondi", fase="verifica_accessi"):
+            esiti = await verificaAccessi([(idSmartCard, idPalestra, giorno)
+                                           for _, idSmartCard, idPalestra, _, giorno, _ in da_verificare])
+    logs, stats = await asyncio.to_thread(completaBatch, risultati, da_verificare, esiti, esiti_passaggi)
+    if logs:
+        with cronometro("worldfit_fase_secondi", fase="scrittura_batch"):
+            await scrivi(logs, stats)
+
+    for esito, conteggio in esiti_passaggi.items():
+        incrementa("worldfit_passaggi_totale", conteggio, route="/batch", esito=esito)
+    return JSONResponse({"risultati": risultati}), "batch"
+
+@richiestaTornello
+async def snapshot(request:Request) -> tuple[Response, str]:
+    '''Stesso protocollo di api_server.snapshot: lettura dei file e calcolo dei delta fuori dall'event loop'''
+    ricezione = datetime.now(tz=timezone.utc).timestamp()
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    dati, esito, codice = await asyncio.to_thread(richiestaSnapshot, data, ricezione)
+    if dati is None:
+        return JSONResponse({"errore": esito}, status_code=codice), esito
+    return Response(dati, media_type="application/octet-stream"), esito
+
+@asynccontextmanager
+async def ciclo_di_vita(app:Starlette):
+    '''
+        Avvia la coda di scrittura nell'event loop del worker ed il listener interno delle metriche (come
+        gunicorn.conf.py per api_server); alla chiusura svuota la coda e chiude le connessioni
+    '''
+    if coda is not None:
+        coda.avvia_async()
+    if METRICHE:
+        avvia_servizio()
+    yield
+    if coda is not None:
+        await coda.chiudi_async()
+    await chiudi_engine_async()
+
+app = Starlette(routes=[Route("/", home, methods=["POST"]),
+                        Route("/batch", batch, methods=["POST"]),
+                        Route("/snapshot", snapshot, methods=["POST"])],
+                # Come @cross_origin() di flask_cors sulle route di api_server
+                middleware=[Middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])],
+                lifespan=ciclo_di_vita)
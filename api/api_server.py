@@ -1,12 +1,20 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g, Response
 from flask_cors import cross_origin
-from db_handler import Gestionale, LogsAndStats
-from privacy_modules import anonimizzatore, pseudonimizzatore, load_encrypt_key
+from db_handler import Gestionale, LogsAndStats, statistiche_pool
+from cache_tessere import CacheTessere, statistiche_cache
+from coda_scritture import CodaScritture
+from registro_palestre import RegistroPalestre
+from privacy_modules import anonimizzatore, pseudonimizzatore, load_encrypt_key, imposta_tabella_pseudonimi
+from tabella_pseudonimi import TabellaPseudonimi
+from snapshot_tessere import ArchivioSnapshot
+from repliche_gestionale import GestionaleReplicato
+from metriche import cronometro, osserva, incrementa, conta_errori, registra_raccoglitore
 from datetime import datetime, date, timezone
+from collections import Counter
 import hmac, re
 from hashlib import sha256
 from sys import stdout
-import os, logging
+import os, logging, time
 
 # Impostazione di Logging per stampare eventuali eccezioni nei Docker Logs
 logger = logging.getLogger(__name__)
@@ -16,10 +24,13 @@ handler.setFormatter(formatter)
 logger.addHandler(handler)
 logger.setLevel(logging.ERROR)
 
+# Cartella dei segreti: quella dei docker secrets, modificabile per l'esecuzione in locale (es. test di carico)
+SECRETS_DIR = os.getenv("SECRETS_DIR", "/run/secrets")
+
 def prendisegreto(secretFile: str) -> str:
     """Funzione che prende un segreto dalla cartella dei docker secrets"""
     try:
-        with open(f"/run/secrets/{secretFile}", "r") as f:
+        with open(os.path.join(SECRETS_DIR, secretFile), "r") as f:
             return f.read().strip()
     except Exception as e:
         logger.critical("Errore nella lettura del segreto, eccezione: %s", str(e))
@@ -32,14 +43,80 @@ DB_LS_HOST = os.getenv("DB_LS_HOST")
 DB_GS_HOST = prendisegreto("db_gs_ip")
 DB_LS_NAME = os.getenv("DB_LS_DATABASE")
 DB_GS_NAME = os.getenv("DB_GS_DATABASE")
-DATABASE_LS_URI = f"mysql+pymysql://{DB_LS_USER}:{DB_LS_PASS}@{DB_LS_HOST}/{DB_LS_NAME}"
-DATABASE_GS_URI = f"mysql+pymysql://{DB_GS_USER}:{DB_GS_PASS}@{DB_GS_HOST}/{DB_GS_NAME}"
+# Gli URI completi possono essere impostati da variabile d'ambiente (es. database SQLite in locale)
+DATABASE_LS_URI = os.getenv("DATABASE_LS_URI") or f"mysql+pymysql://{DB_LS_USER}:{DB_LS_PASS}@{DB_LS_HOST}/{DB_LS_NAME}"
+DATABASE_GS_URI = os.getenv("DATABASE_GS_URI") or f"mysql+pymysql://{DB_GS_USER}:{DB_GS_PASS}@{DB_GS_HOST}/{DB_GS_NAME}"
+# Repliche del Gestionale nella regione (vedi repliche_gestionale.py): indirizzi separati da virgole in DB_GS_REPLICHE,
+# con le stesse credenziali del principale, oppure URI complete separate da virgole in DATABASE_GS_REPLICHE_URI
+DATABASE_GS_REPLICHE_URI = [uri for uri in os.getenv("DATABASE_GS_REPLICHE_URI", "").split(",") if uri] or \
+    [f"mysql+pymysql://{DB_GS_USER}:{DB_GS_PASS}@{host}/{DB_GS_NAME}" for host in os.getenv("DB_GS_REPLICHE", "").split(",") if host]
 ENCRYPTKEY = load_encrypt_key(prendisegreto("encrypt_key"))
 ENCRYPTPAD = prendisegreto("pseudo_pad")
 API_KEY = prendisegreto("api_key")
 
+# Tabella opzionale di pseudonimi precalcolati (vedi tabella_pseudonimi.py)
+PSEUDONIMI_TABELLA = os.getenv("PSEUDONIMI_TABELLA")
+
+def caricaTabellaPseudonimi():
+    '''
+        Funzione che apre la tabella degli pseudonimi, se presente. Richiamata all'import e, con preload_app,
+        dal master di Gunicorn dopo averla costruita (vedi on_starting in gunicorn.conf.py)
+    '''
+    if PSEUDONIMI_TABELLA and os.path.exists(PSEUDONIMI_TABELLA):
+        try:
+            imposta_tabella_pseudonimi(TabellaPseudonimi(PSEUDONIMI_TABELLA, ENCRYPTKEY, ENCRYPTPAD))
+        except ValueError as e:
+            logger.error("Tabella degli pseudonimi ignorata: %s", str(e))
+
+caricaTabellaPseudonimi()
+
+# Gli handler dei database sono condivisi da tutte le richieste: gli engine ed i pool di connessioni
+# vengono creati una sola volta per worker (vedi ottieni_engine in db_handler). Le verifiche degli
+# accessi hanno una scadenza e, se sono configurate repliche, vengono distribuite tra i nodi
+gestore = GestionaleReplicato(DATABASE_GS_URI, DATABASE_GS_REPLICHE_URI)
+router = gestore.router
+# Registro in memoria delle palestre, con i fusi orari già risolti per l'anonimizzatore
+registro = RegistroPalestre(gestore)
+# Snapshot delle tessere valide per la validazione offline dei tornelli, disattivabile con SNAPSHOT_TESSERE=0
+archivio = ArchivioSnapshot(gestore, API_KEY) if os.getenv("SNAPSHOT_TESSERE", "1") == "1" else None
+# Cache delle tessere davanti al Gestionale, disattivabile con CACHE_TESSERE=0
+if os.getenv("CACHE_TESSERE", "1") == "1":
+    gestore = CacheTessere(gestore)
+magazziniere = LogsAndStats(DATABASE_LS_URI)
+# Coda di scrittura differita di Logs e Statistiche, disattivabile con CODA_SCRITTURE=0
+coda = CodaScritture(magazziniere) if os.getenv("CODA_SCRITTURE", "1") == "1" else None
+
+# Metriche: listener interno GET /metrics su METRICHE_BIND, avviato in ogni worker da gunicorn.conf.py
+# (porta separata da quella dei tornelli e non pubblicata), disattivabile con METRICHE=0
+METRICHE = os.getenv("METRICHE", "1") == "1"
+conta_errori(logger, *(logging.getLogger(modulo) for modulo in
+                       ("db_handler", "privacy_modules", "cache_tessere", "coda_scritture", "registro_palestre",
+                        "snapshot_tessere", "repliche_gestionale")))
+
+def metricheProcesso() -> list:
+    '''Funzione che restituisce le metriche istantanee del worker: pool di connessioni, nodi del Gestionale, cache tessere e coda di scrittura'''
+    valori = []
+    for uri, statistiche in statistiche_pool().items():
+        valori.append(("worldfit_pool_connessioni_in_uso", {"database": uri}, statistiche["in_uso"]))
+        valori.append(("worldfit_pool_attese", {"database": uri}, statistiche["attese"]))
+        valori.append(("worldfit_pool_attesa_secondi", {"database": uri}, statistiche["attese"] * statistiche["attesa_media"]))
+    for nodo, statistiche in router.statistiche().items():
+        valori.append(("worldfit_gestionale_nodo_disponibile", {"nodo": nodo}, int(statistiche["disponibile"])))
+        valori.append(("worldfit_gestionale_nodo_latenza_secondi", {"nodo": nodo}, statistiche["latenza"]))
+    for evento, conteggio in statistiche_cache().items():
+        valori.append(("worldfit_cache_tessere_eventi", {"evento": evento}, conteggio))
+    if coda is not None:
+        valori.append(("worldfit_coda_scritture_record", {}, coda.in_coda()))
+    return valori
+
+registra_raccoglitore(metricheProcesso)
+
 HEXDIGITS = '0123456789ABCDEF'
 SECONDI_ACCETTABILI = 20
+# Endpoint /batch: numero massimo di passaggi per richiesta e ritardo massimo (in secondi)
+# con cui un tornello può reinviare i passaggi registrati durante un'interruzione di rete
+BATCH_MAX_RECORD = int(os.getenv("BATCH_MAX_RECORD", "500"))
+SECONDI_OFFLINE = int(os.getenv("BATCH_SECONDI_OFFLINE", "86400"))
 
 def timestampCheck(ricezione: float, timestamp: int) -> bool:
     '''
@@ -52,9 +129,30 @@ def timestampCheck(ricezione: float, timestamp: int) -> bool:
     else:
         return False
 
-def signatureCheck(idSmartCard:str, idPalestra:int, timestamp:int, signature:str) -> bool:
-    '''Funzione che controlla la validità della firma ricevuta nella richiesta'''
-    string = idSmartCard + str(idPalestra) + str(timestamp)
+def timestampOfflineCheck(ricezione: float, timestamp: int) -> bool:
+    '''
+        Funzione che controlla il timestamp di un passaggio registrato offline dal tornello.
+        Il passaggio è accettato se avvenuto al massimo SECONDI_OFFLINE secondi prima della ricezione
+        (e non più di SECONDI_ACCETTABILI secondi nel futuro).
+    '''
+    return -SECONDI_ACCETTABILI <= ricezione - (timestamp/1000) <= SECONDI_OFFLINE
+
+def signatureCheck(idSmartCard:str, idPalestra:int, timestamp:int, signature:str, offline:bool = False) -> bool:
+    '''
+        Funzione che controlla la validità della firma ricevuta nella richiesta. I passaggi registrati
+        offline sono firmati su "offline" + IDSmartCard + IDPalestra + Timestamp: la firma di una
+        richiesta online intercettata non vale per reinviarla come offline (senza timestampCheck)
+    '''
+    string = ("offline" if offline else "") + idSmartCard + str(idPalestra) + str(timestamp)
+    check = hmac.new(key=API_KEY.encode('utf-8'),msg=string.encode('utf-8'),digestmod=sha256).hexdigest()
+    if check == signature:
+        return True
+    else:
+        return False
+
+def snapshotSignatureCheck(idPalestra:int, versione:int, timestamp:int, signature:str) -> bool:
+    '''Funzione che controlla la firma della richiesta di snapshot, calcolata su "snapshot" + IDPalestra + Versione + Timestamp'''
+    string = "snapshot" + str(idPalestra) + str(versione) + str(timestamp)
     check = hmac.new(key=API_KEY.encode('utf-8'),msg=string.encode('utf-8'),digestmod=sha256).hexdigest()
     if check == signature:
         return True
@@ -62,22 +160,75 @@ def signatureCheck(idSmartCard:str, idPalestra:int, timestamp:int, signature:str
         return False
 
 def check(gestore: Gestionale, ricezione:float,
-          idSmartCard:str, idPalestra:int, timestamp:int, signature:str) -> dict:
+          idSmartCard:str, idPalestra:int, timestamp:int, signature:str) -> tuple[dict, str]:
     '''
         Funzione che effettua in cascata tutti i controlli necessari 
         a verificare la validità della richiesta ricevuta. Se i controlli hanno
-        successo, restituisce un dizionario contenente un oggetto Cliente e Palestra.
-    '''
-    if timestampCheck(ricezione, timestamp):
-        if signatureCheck(idSmartCard, idPalestra, timestamp, signature):
-            # Verifico che la palestra esista
-            palestra = gestore.select_palestra(idPalestra)
-            if palestra is not None:
-                # Verifico che il cliente esista
-                cliente = gestore.select_client(idSmartCard)
-                if cliente is not None:
-                    return {"cliente": cliente, "palestra": palestra}
-    return None
+        successo, restituisce un dizionario contenente i dati di Cliente e Palestra
+        ed un flag che indica se il cliente ha un abbonamento valido oggi.
+        Insieme al dizionario (None se i controlli falliscono) restituisce l'esito per le metriche.
+    '''
+    if not timestampCheck(ricezione, timestamp):
+        return None, "timestamp_scaduto"
+    if not signatureCheck(idSmartCard, idPalestra, timestamp, signature):
+        return None, "firma_errata"
+    # Verifico con una sola interrogazione che palestra e cliente esistano
+    # e che il cliente abbia un abbonamento valido
+    with cronometro("worldfit_fase_secondi", fase="verifica_accesso"):
+        esito = gestore.verifica_accesso(idSmartCard, idPalestra, date.today())
+    return valutaEsito(esito)
+
+def valutaEsito(esito:Gestionale.EsitoAccesso) -> tuple[dict, str]:
+    '''
+        Funzione che converte l'EsitoAccesso del Gestionale (None se in errore) nel dizionario restituito
+        da check e nell'esito per le metriche
+    '''
+    if esito is None:
+        return None, "errore_db"
+    if esito.palestra is None or esito.cliente is None:
+        return None, "sconosciuto"
+    # Se il registro non è mai stato caricato uso i dati della palestra appena letti
+    palestra = registro.palestra(esito.palestra.id) or esito.palestra
+    return {"cliente": esito.cliente, "palestra": palestra,
+            "abbonamento_valido": esito.scadenza is not None}, "valido" if esito.scadenza is not None else "abbonamento_scaduto"
+
+def leggiPassaggio(data:dict) -> tuple[str, int, int, str]:
+    '''
+        Funzione che controlla e converte i campi di un passaggio ricevuto dal tornello,
+        sollevando ValueError se non sono nel formato richiesto
+    '''
+    idSmartCard = data["IDSmartCard"]
+    if not smartcardCorretto(idSmartCard):
+        raise ValueError("SmartCard ID non ha un formato accettabile")
+    idPalestra = int(data["IDPalestra"])
+    timestamp = int(data["Timestamp"])
+    signature = re.sub(r'\^[a-z0-9]\+\$/', '', data["Signature"])
+    return idSmartCard, idPalestra, timestamp, signature
+
+def richiestaSnapshot(data:dict, ricezione:float) -> tuple[bytes | None, str, int]:
+    '''
+        Funzione che controlla la richiesta di snapshot di un tornello (IDPalestra, Versione posseduta, 0 se
+        nessuna, Timestamp e Signature) e restituisce i dati da inviare (None in caso di errore),
+        l'esito per le metriche ed il codice HTTP della risposta
+    '''
+    if archivio is None:
+        return None, "disattivato", 404
+    try:
+        idPalestra = int(data["IDPalestra"])
+        versione = int(data.get("Versione") or 0)
+        timestamp = int(data["Timestamp"])
+        signature = str(data["Signature"])
+    except (KeyError, TypeError, ValueError, AttributeError) as e:
+        logger.error("Richiesta di snapshot incorretta: %s", str(e))
+        return None, "dati_errati", 400
+    if not timestampCheck(ricezione, timestamp):
+        return None, "timestamp_scaduto", 403
+    if not snapshotSignatureCheck(idPalestra, versione, timestamp, signature):
+        return None, "firma_errata", 403
+    risposta = archivio.risposta(versione)
+    if risposta is None:
+        return None, "non_disponibile", 503
+    return risposta[0], risposta[1], 200
 
 def smartcardCorretto(idSmartCard:str) -> bool:
     '''
@@ -94,27 +245,128 @@ def finalHmac(idSmartCard:str, timestamp:int):
     string = idSmartCard + str(timestamp)
     return hmac.new(key=API_KEY.encode('utf-8'),msg=string.encode('utf-8'),digestmod=sha256).hexdigest()
 
+def preparaIngresso(cliente, palestra, idSmartCard:str, idPalestra:int, timestamp:int) -> tuple[dict, dict]:
+    '''
+        Funzione che, per un ingresso con abbonamento valido, pseudonimizza la SmartCard ed anonimizza
+        i dati del cliente, restituendo i record per le tabelle Logs e Statistiche
+    '''
+    #conversione timestamp in datetime per il Database Logs e Statistiche
+    db_timestamp = datetime.fromtimestamp(timestamp=timestamp/1000,tz=timezone.utc)
+
+    #pseudonimizzazione id
+    with cronometro("worldfit_fase_secondi", fase="pseudonimizzatore"):
+        pseudoSmartID = pseudonimizzatore(idSmartCard,
+                                          encrypt_key=ENCRYPTKEY,
+                                          pseudo_pad=ENCRYPTPAD)
+
+    #anonimizzazione dati gestionale
+    with cronometro("worldfit_fase_secondi", fase="anonimizzatore"):
+        dati = anonimizzatore({
+        "cliente":cliente,
+        "palestra":palestra,
+        "timestamp":db_timestamp})
+
+    log = {"smart_card_id": pseudoSmartID,
+           "palestra_id": idPalestra,
+           "timestamp": db_timestamp}
+    stat = {"sesso": dati["sesso"],
+            "fascia_eta": dati["fascia_eta"],
+            "palestra_id": dati["palestra_id"],
+            "data_ingresso": dati["data_ingresso"],
+            "fascia_oraria": dati["fascia_oraria"]}
+    return log, stat
+
+
+def analizzaBatch(records:list, ricezione:float) -> tuple[list, list, Counter]:
+    '''
+        Funzione che controlla formato, timestamp e firma dei record di un batch. Restituisce i risultati
+        da inviare al tornello (per ora tutti non validi), i record da verificare sul Gestionale come tuple
+        (posizione, idSmartCard, idPalestra, timestamp, giorno, duplicato) ed il conteggio degli esiti
+    '''
+    risultati = []
+    da_verificare = []
+    visti = set()
+    esiti_passaggi = Counter()
+    for posizione, record in enumerate(records):
+        risultati.append({"valido": False, "signature": None})
+        try:
+            risultati[posizione]["signature"] = finalHmac(str(record["IDSmartCard"]), record["Timestamp"])
+            idSmartCard, idPalestra, timestamp, signature = leggiPassaggio(record)
+            offline = record.get("Offline") is True
+        except (KeyError, TypeError, ValueError) as e:
+            logger.error("Dati ricevuti incorretti nel record %s del batch: %s", posizione, str(e))
+            esiti_passaggi["dati_errati"] += 1
+            continue
+
+        if offline:
+            if not timestampOfflineCheck(ricezione, timestamp):
+                esiti_passaggi["timestamp_scaduto"] += 1
+                continue
+            # Il giorno del passaggio in UTC, come i timestamp (non quello del fuso orario del server)
+            giorno = datetime.fromtimestamp(timestamp/1000, tz=timezone.utc).date()
+        else:
+            if not timestampCheck(ricezione, timestamp):
+                esiti_passaggi["timestamp_scaduto"] += 1
+                continue
+            giorno = date.today()
+        if not signatureCheck(idSmartCard, idPalestra, timestamp, signature, offline):
+            esiti_passaggi["firma_errata"] += 1
+            continue
+        # Un record ripetuto (es. reinvio dello stesso passaggio) riceve lo stesso esito ma viene registrato una volta
+        chiave = (idSmartCard, idPalestra, timestamp)
+        da_verificare.append((posizione, idSmartCard, idPalestra, timestamp, giorno, chiave in visti))
+        visti.add(chiave)
+    return risultati, da_verificare, esiti_passaggi
+
+def completaBatch(risultati:list, da_verificare:list, esiti:list, esiti_passaggi:Counter) -> tuple[list, list]:
+    '''
+        Funzione che, dati gli EsitoAccesso del Gestionale per i record da verificare (None se in errore),
+        aggiorna risultati e conteggi e restituisce i record per le tabelle Logs e Statistiche
+    '''
+    if esiti is None:
+        esiti = [None] * len(da_verificare)
+    logs, stats = [], []
+    for (posizione, idSmartCard, idPalestra, timestamp, _, duplicato), esito in zip(da_verificare, esiti):
+        info, esito_passaggio = valutaEsito(esito)
+        esiti_passaggi[esito_passaggio] += 1
+        if info is None or not info["abbonamento_valido"]:
+            continue
+        risultati[posizione]["valido"] = True
+        if not duplicato:
+            log, stat = preparaIngresso(info["cliente"], info["palestra"], idSmartCard, idPalestra, timestamp)
+            logs.append(log)
+            stats.append(stat)
+    return logs, stats
+
 
 app = Flask(__name__)
 
+@app.before_request
+def inizioRichiesta():
+    g.inizio = time.perf_counter()
+
+@app.teardown_request
+def fineRichiesta(eccezione):
+    '''Registra durata ed esito delle richieste dei tornelli (le route impostano g.esito)'''
+    esito = g.get("esito")
+    if esito is not None:
+        if eccezione is not None:
+            esito = "eccezione"
+        osserva("worldfit_richieste_secondi", time.perf_counter() - g.inizio, route=request.path, esito=esito)
+
 @app.route("/", methods=["POST"])
 @cross_origin()
 def home():
     logger.debug("Connessione stabilita")
+    g.esito = "dati_errati"
     data = request.json
 
     # I timestamp vengono trattati tutti in timezone UTC
     ricezione = datetime.now(tz=timezone.utc).timestamp()
-    gestore = Gestionale(DATABASE_GS_URI)
 
     #controlla che i dati siano nel formato richiesto
     try:
-        idSmartCard = data["IDSmartCard"]
-        if not smartcardCorretto(idSmartCard):
-            raise ValueError("SmartCard ID non ha un formato accettabile")
-        idPalestra = int(data["IDPalestra"])
-        timestamp = int(data["Timestamp"])
-        signature = re.sub(r'\^[a-z0-9]\+\$/', '', data["Signature"])
+        idSmartCard, idPalestra, timestamp, signature = leggiPassaggio(data)
     except ValueError as e:
         logger.error("Dati ricevuti incorretti: %s", str(e))
         return jsonify({"valido": False,
@@ -123,47 +375,85 @@ def home():
     abbonamentoValido = False
     
     # Controllo la validità della richiesta e mi salvo le informazioni recuperate sul Cliente e Palestra
-    info = check(gestore, ricezione, idSmartCard, idPalestra, timestamp, signature)
+    info, g.esito = check(gestore, ricezione, idSmartCard, idPalestra, timestamp, signature)
     if info is not None:
         logger.debug("Check passed")
 
-        #fa richicesta a selet_abbonamenti,
         #se la smart card ricevuta ha un abbonamento valido associato continuano le operazioni
-        abbonamenti = gestore.select_abbonamenti(info["cliente"].id)
-        oggi = date.today()
-        for x in abbonamenti:
-            if x.valido_dal < oggi < x.valido_al:
-                abbonamentoValido = True
-                break
+        abbonamentoValido = info["abbonamento_valido"]
         if abbonamentoValido:
-            #conversione timestamp in datetime per il Database Logs e Statistiche
-            db_timestamp = datetime.fromtimestamp(timestamp=timestamp/1000,tz=timezone.utc)
-
-            #pseudonimizzazione id
-            pseudoSmartID = pseudonimizzatore(idSmartCard,
-                                              encrypt_key=ENCRYPTKEY,
-                                              pseudo_pad=ENCRYPTPAD)
-
-            #anonimizzazione dati gestionale
-            dati = anonimizzatore({
-            "cliente":info["cliente"],
-            "palestra":info["palestra"],
-            "timestamp":db_timestamp})
+            log, stat = preparaIngresso(info["cliente"], info["palestra"], idSmartCard, idPalestra, timestamp)
 
             #salvo logs e statistiche
-            magazziniere = LogsAndStats(DATABASE_LS_URI)
-            magazziniere.insert_log(smart_card_id=pseudoSmartID,
-                                    palestra_id=idPalestra,
-                                    timestamp=db_timestamp)
-            magazziniere.insert_stats(sesso=dati["sesso"],
-                                      fascia_eta=dati["fascia_eta"],
-                                      palestra_id=dati["palestra_id"],
-                                      data_ingresso=dati["data_ingresso"],
-                                      fascia_oraria=dati["fascia_oraria"])
+            with cronometro("worldfit_fase_secondi", fase="scrittura"):
+                if coda is not None:
+                    coda.accoda(log, stat)
+                else:
+                    magazziniere.insert_batch([log], [stat])
     
     logger.debug("Abbonamento Valido: %s", abbonamentoValido)
     return jsonify({"valido": abbonamentoValido,
                     "signature": finalHmac(idSmartCard, timestamp)})
 
+@app.route("/batch", methods=["POST"])
+@cross_origin()
+def batch():
+    '''
+        Endpoint per l'invio di più passaggi in una sola richiesta, da tornelli con più corsie o che
+        reinviano i passaggi registrati durante un'interruzione di rete. Il corpo è {"Records": [...]},
+        dove ogni record ha gli stessi campi (e la stessa firma) della richiesta singola più il flag
+        opzionale "Offline". I record online devono rispettare timestampCheck e vengono valutati con
+        gli abbonamenti di oggi; i record offline, firmati su "offline" + IDSmartCard + IDPalestra +
+        Timestamp, possono arrivare fino a SECONDI_OFFLINE secondi dopo il passaggio e vengono valutati
+        con gli abbonamenti del giorno (UTC) del passaggio. Un passaggio reinviato riceve di nuovo
+        il suo esito, ma viene registrato in Logs e Statistiche una volta sola.
+        La risposta contiene un esito firmato per ogni record, nello stesso ordine.
+    '''
+    g.esito = "dati_errati"
+    data = request.json
+    ricezione = datetime.now(tz=timezone.utc).timestamp()
+
+    records = data.get("Records") if isinstance(data, dict) else None
+    if not isinstance(records, list) or len(records) > BATCH_MAX_RECORD:
+        logger.error("Batch ricevuto incorretto")
+        return jsonify({"errore": f"Records deve essere una lista di al massimo {BATCH_MAX_RECORD} passaggi"}), 400
+
+    g.esito = "batch"
+    risultati, da_verificare, esiti_passaggi = analizzaBatch(records, ricezione)
+
+    # Clienti, palestre ed abbonamenti di tutti i record con un'interrogazione per tabella
+    esiti = None
+    if da_verificare:
+        with cronometro("worldfit_fase_secondi", fase="verifica_accessi"):
+            esiti = gestore.verifica_accessi([(idSmartCard, idPalestra, giorno)
+                                              for _, idSmartCard, idPalestra, _, giorno, _ in da_verificare])
+    logs, stats = completaBatch(risultati, da_verificare, esiti, esiti_passaggi)
+
+    # Logs e Statistiche del batch in una sola transazione; se il database non è disponibile
+    # i record passano dalla coda di scrittura, che li salva su disco e li riscrive in seguito
+    with cronometro("worldfit_fase_secondi", fase="scrittura_batch"):
+        if logs and not magazziniere.insert_batch(logs, stats) and coda is not None:
+            for log, stat in zip(logs, stats):
+                coda.accoda(log, stat)
+
+    for esito, conteggio in esiti_passaggi.items():
+        incrementa("worldfit_passaggi_totale", conteggio, route="/batch", esito=esito)
+    return jsonify({"risultati": risultati})
+
+@app.route("/snapshot", methods=["POST"])
+@cross_origin()
+def snapshot():
+    '''
+        Endpoint da cui i tornelli scaricano lo snapshot firmato delle tessere valide (vedi snapshot_tessere.py),
+        usato per decidere gli accessi durante le interruzioni di rete. Il corpo è {"IDPalestra", "Versione",
+        "Timestamp", "Signature"}: se la versione indicata è ancora conservata la risposta è il solo delta
+        verso l'ultima, altrimenti lo snapshot completo (application/octet-stream in entrambi i casi).
+    '''
+    ricezione = datetime.now(tz=timezone.utc).timestamp()
+    dati, g.esito, codice = richiestaSnapshot(request.get_json(silent=True), ricezione)
+    if dati is None:
+        return jsonify({"errore": g.esito}), codice
+    return Response(dati, mimetype="application/octet-stream")
+
 if __name__ == "__main__":
     app.run()
\ No newline at end of file
@@ -0,0 +1,230 @@
+'''
+Modulo Python contenente l'archiviatore degli ingressi in scadenza, da eseguire come processo separato
+dall'API (servizio worldfit_archivio in docker-compose.yml). L'evento Pulizia elimina le partizioni di Logs
+più vecchie di 3 mesi: prima della scadenza ogni giorno viene esportato in un segmento immutabile e compresso
+(formato in segmenti_logs.py) e registrato nella tabella ArchivioLogs. La procedura ManutenzionePartizioniLogs
+elimina solo le partizioni dei giorni registrati, oppure quelle scadute da più di ARCHIVIO_ATTESA giorni,
+in modo che la conservazione di Logs resti garantita anche senza archiviatore. A ogni passaggio:
+1. archivia i giorni che scadranno entro ARCHIVIO_ANTICIPO giorni, dal giorno successivo all'ultimo archiviato
+   (un giorno senza ingressi viene registrato senza segmento);
+2. unisce i segmenti giornalieri dei mesi completi in un segmento mensile: gli pseudonimi di una tessera
+   vengono scritti una sola volta per blocco, quindi i byte per ingresso diminuiscono;
+3. elimina i segmenti più vecchi di ARCHIVIO_MESI mesi.
+Gli ingressi archiviati si consultano con la modalità "archivio" di external/rsa_external_modules.py. Esempi:
+
+    python archivio_logs.py
+    python archivio_logs.py --una-volta
+'''
+from sqlalchemy import BigInteger, CHAR, Date, DateTime, Integer, String, select, update, func
+from sqlalchemy.orm import Session, Mapped, mapped_column
+from db_handler import DB_handler, Base, LogsAndStats
+from segmenti_logs import Segmento, scrivi_segmento, unisci_segmenti, nome_segmento, NOME_SEGMENTO
+from datetime import date, datetime, timedelta, timezone
+from itertools import groupby
+from typing import Optional
+from sys import stdout
+import argparse, calendar, glob, json, logging, os, time
+
+# Impostazione di Logging per stampare eventuali eccezioni nei Docker Logs
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler(stdout)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+logger.setLevel(logging.ERROR)
+
+CARTELLA = os.getenv("ARCHIVIO_DIR", "archivio")
+MESI_CONSERVAZIONE = int(os.getenv("ARCHIVIO_MESI_CONSERVAZIONE", "3"))   # conservazione di Logs (come l'evento Pulizia)
+ANTICIPO = int(os.getenv("ARCHIVIO_ANTICIPO", "7"))                       # giorni di anticipo sulla scadenza
+ATTESA = int(os.getenv("ARCHIVIO_ATTESA", "30"))                          # giorni scaduti conservati in attesa dell'archivio
+MESI_ARCHIVIO = int(os.getenv("ARCHIVIO_MESI", "24"))                     # conservazione dei segmenti
+INTERVALLO = float(os.getenv("ARCHIVIO_INTERVALLO", "3600"))              # secondi tra due passaggi
+RIGHE_PER_LETTURA = 5000
+
+def prendisegreto(secretFile: str) -> str:
+    """Funzione che prende un segreto dalla cartella dei docker secrets"""
+    try:
+        with open(os.path.join(os.getenv("SECRETS_DIR", "/run/secrets"), secretFile), "r") as f:
+            return f.read().strip()
+    except Exception as e:
+        logger.critical("Errore nella lettura del segreto, eccezione: %s", str(e))
+
+def sottrai_mesi(giorno:date, mesi:int) -> date:
+    '''Come DATE_SUB(giorno, INTERVAL mesi MONTH) di MySQL: il giorno oltre la fine del mese diventa l'ultimo'''
+    mese = giorno.year * 12 + giorno.month - 1 - mesi
+    anno, mese = divmod(mese, 12)
+    return date(anno, mese + 1, min(giorno.day, calendar.monthrange(anno, mese + 1)[1]))
+
+class RegistroArchivio(DB_handler):
+    '''Classe per leggere gli ingressi in scadenza di Logs e registrare i giorni archiviati nel DB Log e statistiche'''
+
+    class GiornoArchiviato(Base):
+        '''Mapped Class per interagire con la tabella dei giorni archiviati, letta da ManutenzionePartizioniLogs'''
+        __tablename__ = "ArchivioLogs"
+
+        giorno: Mapped[date] = mapped_column("Giorno", Date, primary_key=True)
+        righe: Mapped[int] = mapped_column("Righe", BigInteger().with_variant(Integer, "sqlite"))
+        segmento: Mapped[Optional[str]] = mapped_column("Segmento", String(64))
+        sha256: Mapped[Optional[str]] = mapped_column("Sha256", CHAR(64))
+        archiviato: Mapped[datetime] = mapped_column("Archiviato", DateTime, server_default=func.now())
+
+    def ultimo_giorno(self) -> date | None:
+        '''Ultimo giorno archiviato, date.min se nessuno; None in caso di errore'''
+        try:
+            with self.engine.connect() as connection:
+                return connection.execute(select(func.max(self.GiornoArchiviato.giorno))).scalar() or date.min
+        except Exception as e:
+            logger.error("Errore nella lettura dell'ultimo giorno archiviato: %s", str(e))
+
+    def giorni(self, dal:date, al:date) -> dict | None:
+        '''Giorni archiviati in [dal, al) con il nome del segmento (None se senza ingressi); None in caso di errore'''
+        Giorno = self.GiornoArchiviato
+        try:
+            with self.engine.connect() as connection:
+                return dict(connection.execute(select(Giorno.giorno, Giorno.segmento)
+                                               .where(Giorno.giorno >= dal, Giorno.giorno < al)).all())
+        except Exception as e:
+            logger.error("Errore nella lettura dei giorni archiviati: %s", str(e))
+
+    def logs_giorno(self, giorno:date):
+        '''
+            Generatore degli ingressi di un giorno nell'ordine dei segmenti (pseudonimo, timestamp, Id): su MySQL
+            legge la sola partizione del giorno seguendo l'indice IdxLogsSmartCardTimestamp, in streaming.
+            L'indice ordina per palestra gli ingressi di una tessera nello stesso secondo: questi (rari)
+            vengono riordinati per Id
+        '''
+        Log = LogsAndStats.Log
+        dal = datetime.combine(giorno, datetime.min.time())
+        with self.engine.connect() as connection:
+            risultato = connection.execution_options(stream_results=True, yield_per=RIGHE_PER_LETTURA).execute(
+                select(Log.smart_card_id, Log.palestra_id, Log.timestamp, Log.id)
+                .where(Log.timestamp >= dal, Log.timestamp < dal + timedelta(days=1))
+                .order_by(Log.smart_card_id, Log.timestamp, Log.palestra_id))
+            for _, righe in groupby(risultato, key=lambda riga: (riga[0], riga[2])):
+                yield from sorted(righe, key=lambda riga: riga[3])
+
+    def registra(self, giorno:date, righe:int, segmento:str | None, sha256:str | None) -> bool:
+        '''Registra un giorno archiviato: da questo momento la sua partizione di Logs può essere eliminata'''
+        try:
+            with Session(self.engine) as session, session.begin():
+                session.merge(self.GiornoArchiviato(giorno=giorno, righe=righe, segmento=segmento, sha256=sha256))
+            return True
+        except Exception as e:
+            logger.error("Errore nella registrazione del giorno archiviato %s: %s", giorno, str(e))
+            return False
+
+    def sposta(self, dal:date, al:date, segmento:str, sha256:str) -> bool:
+        '''Aggiorna il segmento dei giorni con ingressi in [dal, al) dopo l'unione in un segmento mensile'''
+        Giorno = self.GiornoArchiviato
+        try:
+            with self.engine.begin() as connection:
+                connection.execute(update(Giorno).where(Giorno.giorno >= dal, Giorno.giorno < al,
+                                                        Giorno.segmento.is_not(None))
+                                   .values(segmento=segmento, sha256=sha256))
+            return True
+        except Exception as e:
+            logger.error("Errore nell'aggiornamento dei giorni archiviati dal %s al %s: %s", dal, al, str(e))
+            return False
+
+def archivia_giorno(registro:RegistroArchivio, cartella:str, giorno:date) -> int | None:
+    '''Esporta un giorno di Logs in un segmento e lo registra; restituisce gli ingressi archiviati o None'''
+    nome = nome_segmento(giorno, giorno + timedelta(days=1))
+    percorso = os.path.join(cartella, nome)
+    try:
+        esito = scrivi_segmento(percorso, registro.logs_giorno(giorno), giorno, giorno + timedelta(days=1))
+    except Exception as e:
+        logger.error("Errore nell'archiviazione del giorno %s: %s", giorno, str(e))
+        return None
+    if not esito["righe"]:
+        os.remove(percorso)
+        nome, esito["sha256"] = None, None
+    return esito["righe"] if registro.registra(giorno, esito["righe"], nome, esito["sha256"]) else None
+
+def compatta(registro:RegistroArchivio, cartella:str, oggi:date) -> int:
+    '''Unisce i segmenti giornalieri dei mesi conclusi e interamente archiviati; restituisce i mesi uniti'''
+    mesi = {}
+    for percorso in glob.glob(os.path.join(cartella, "logs-*.wfla")):
+        if corrispondenza := NOME_SEGMENTO.match(os.path.basename(percorso)):
+            dal, al = (datetime.strptime(g, "%Y%m%d").date() for g in corrispondenza.groups())
+            if al - dal == timedelta(days=1):
+                mesi.setdefault(dal.replace(day=1), []).append(percorso)
+    uniti = 0
+    for inizio, giornalieri in sorted(mesi.items()):
+        fine = (inizio + timedelta(days=31)).replace(day=1)
+        archiviati = registro.giorni(inizio, fine)
+        # I giorni vengono archiviati in sequenza: il mese è completo se lo sono quelli dal primo archiviato
+        # (il primo mese dell'archivio può iniziare dopo il giorno 1)
+        if fine > oggi or not archiviati or len(archiviati) < (fine - max(inizio, min(archiviati))).days:
+            continue
+        nome = nome_segmento(inizio, fine)
+        segmenti = [Segmento(percorso) for percorso in sorted(giornalieri)]
+        try:
+            esito = unisci_segmenti(os.path.join(cartella, nome), segmenti)
+            # Le righe archiviate nel registro devono coincidere con quelle del segmento mensile
+            if esito["righe"] != sum(s.righe for s in segmenti):
+                raise ValueError(f"righe unite {esito['righe']} diverse da {sum(s.righe for s in segmenti)}")
+        except Exception as e:
+            logger.error("Errore nell'unione dei segmenti del mese %s: %s", f"{inizio:%Y-%m}", str(e))
+            continue
+        finally:
+            for segmento in segmenti:
+                segmento.close()
+        # I segmenti giornalieri vengono eliminati solo dopo aver aggiornato il registro: fino ad allora le
+        # ricerche ignorano quelli contenuti nel segmento mensile (segmenti_logs.Archivio)
+        if registro.sposta(inizio, fine, nome, esito["sha256"]):
+            for percorso in giornalieri:
+                os.remove(percorso)
+            uniti += 1
+    return uniti
+
+def elimina_scaduti(cartella:str, oggi:date, mesi:int = MESI_ARCHIVIO) -> int:
+    '''Elimina i segmenti con soli ingressi più vecchi di "mesi" mesi ed i file temporanei rimasti'''
+    limite = sottrai_mesi(oggi, mesi)
+    eliminati = 0
+    for percorso in glob.glob(os.path.join(cartella, "logs-*.wfla")):
+        corrispondenza = NOME_SEGMENTO.match(os.path.basename(percorso))
+        if corrispondenza and datetime.strptime(corrispondenza.group(2), "%Y%m%d").date() <= limite:
+            os.remove(percorso)
+            eliminati += 1
+    for percorso in glob.glob(os.path.join(cartella, "logs-*.wfla.*.tmp")):
+        os.remove(percorso)
+    return eliminati
+
+def esegui(registro:RegistroArchivio, cartella:str, oggi:date) -> dict | None:
+    '''Un passaggio dell'archiviatore; restituisce i contatori oppure None se il registro non è raggiungibile'''
+    ultimo = registro.ultimo_giorno()
+    if ultimo is None:
+        return None
+    limite = sottrai_mesi(oggi, MESI_CONSERVAZIONE)
+    # Alla prima esecuzione parte dal giorno più vecchio che la procedura può ancora conservare
+    giorno = max(ultimo + timedelta(days=1), limite - timedelta(days=ATTESA))
+    contatori = {"giorni": 0, "ingressi": 0}
+    while giorno < min(limite + timedelta(days=ANTICIPO), oggi):
+        righe = archivia_giorno(registro, cartella, giorno)
+        if righe is None:
+            break
+        contatori["giorni"] += 1
+        contatori["ingressi"] += righe
+        giorno += timedelta(days=1)
+    contatori["mesi_uniti"] = compatta(registro, cartella, oggi)
+    contatori["segmenti_eliminati"] = elimina_scaduti(cartella, oggi)
+    return contatori
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Archiviatore degli ingressi di Logs in scadenza")
+    parser.add_argument('--una-volta', action='store_true', help="Esegue un solo passaggio ed esce")
+    parser.add_argument('--cartella', default=CARTELLA, help="Cartella dei segmenti")
+    args = parser.parse_args()
+
+    # Utente dedicato con lettura di Logs e scrittura di ArchivioLogs (vedi db/init/02-setup.sh)
+    DATABASE_LS_URI = os.getenv("DATABASE_LS_URI") or \
+        f"mysql+pymysql://{os.getenv('DB_AR_USER')}:{prendisegreto('db_ls_archivio_password')}@{os.getenv('DB_LS_HOST')}/{os.getenv('DB_LS_DATABASE')}"
+    registro = RegistroArchivio(DATABASE_LS_URI)
+    os.makedirs(args.cartella, exist_ok=True)
+
+    while True:
+        contatori = esegui(registro, args.cartella, datetime.now(timezone.utc).date())
+        if args.una_volta:
+            print(json.dumps(contatori))
+            break
+        time.sleep(INTERVALLO)
@@ -0,0 +1,81 @@
+'''
+Micro-benchmark dell'anonimizzatore: confronta l'implementazione precedente (risoluzione del fuso orario
+e scansione delle fasce ad ogni ingresso) con quella attuale, sia con le palestre lette dal Gestionale
+sia con quelle del RegistroPalestre (fuso orario già risolto). Esempio di lancio dalla cartella api:
+
+    python benchmark/bench_anonimizzatore.py -n 100000
+'''
+import os, random, sys, time, argparse
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+from pytz import country_timezones, timezone, utc
+from db_handler import Gestionale
+from privacy_modules import anonimizzatore, fuso_orario, FASCEETA, FASCEORARIE, STATO_A_SIGLA
+from registro_palestre import InfoPalestra
+
+STATI = ["Italia", "Francia", "Germania", "Spagna", "Regno Unito", "Stati Uniti", "Giappone", "Atlantide"]
+
+def anonimizzatore_precedente(dati: dict) -> dict:
+    '''Copia dell'anonimizzatore prima dell'introduzione delle tabelle precalcolate'''
+    oggi = date.today()
+    data_nascita = dati['cliente'].data_nascita
+    compleanno = date(year=oggi.year, month=data_nascita.month, day=data_nascita.day)
+    if oggi >= compleanno:
+        eta = oggi.year - data_nascita.year
+    else:
+        eta = oggi.year - data_nascita.year - 1
+    for fascia in FASCEETA:
+        if eta in range(fascia[0],fascia[1]+1):
+            fascia_eta = f'{fascia[0]}-{fascia[1]}'
+            break
+    try:
+        sigla = STATO_A_SIGLA[dati['palestra'].stato.lower()]
+        tz = timezone(country_timezones[sigla.lower()][0])
+    except:
+        tz = utc
+    timestamp = dati['timestamp'].astimezone(tz)
+    for fascia in FASCEORARIE:
+        if timestamp.time().hour in range(fascia[0],fascia[1]+1):
+            fascia_oraria = f'{fascia[0]}-{fascia[1]}'
+            break
+    return {"sesso":dati["cliente"].sesso, "fascia_eta":fascia_eta, "palestra_id":dati["palestra"].id,
+            "data_ingresso":timestamp.date(), "fascia_oraria":fascia_oraria}
+
+def cronometra(funzione, ingressi) -> float:
+    '''Restituisce i microsecondi medi per chiamata'''
+    inizio = time.perf_counter()
+    for dati in ingressi:
+        funzione(dati)
+    return (time.perf_counter() - inizio) / len(ingressi) * 1e6
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--numero', type=int, default=100000, help="Numero di ingressi simulati")
+    args = parser.parse_args()
+
+    palestre = [Gestionale.DatiPalestra(i, stato) for i, stato in enumerate(STATI, start=1)]
+    registro = [InfoPalestra(p.id, p.stato, None, fuso_orario(p.stato)) for p in palestre]
+    adesso = datetime.now(dt_timezone.utc)
+    ingressi = []
+    for _ in range(args.numero):
+        # date di nascita non bisestili: l'implementazione precedente fallisce per i nati il 29 febbraio
+        nascita = date(random.randint(1940, 2015), random.randint(1, 12), random.randint(1, 28))
+        indice = random.randrange(len(palestre))
+        ingressi.append(({"cliente": Gestionale.DatiCliente(1, random.choice("MF"), nascita),
+                          "timestamp": adesso - timedelta(seconds=random.randint(0, 86400))},
+                         palestre[indice], registro[indice]))
+
+    da_gestionale = [{**dati, "palestra": palestra} for dati, palestra, _ in ingressi]
+    da_registro = [{**dati, "palestra": info} for dati, _, info in ingressi]
+    assert all(anonimizzatore_precedente(d) == anonimizzatore(d) == anonimizzatore(r)
+               for d, r in zip(da_gestionale[:1000], da_registro[:1000]))
+
+    risultati = {
+        "precedente": cronometra(anonimizzatore_precedente, da_gestionale),
+        "attuale (palestra dal Gestionale)": cronometra(anonimizzatore, da_gestionale),
+        "attuale (RegistroPalestre)": cronometra(anonimizzatore, da_registro),
+    }
+    print(f"Ingressi simulati: {args.numero}")
+    for nome, microsecondi in risultati.items():
+        print(f"{nome:>36}: {microsecondi:8.2f} µs/chiamata")
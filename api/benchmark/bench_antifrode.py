@@ -0,0 +1,48 @@
+'''
+Benchmark del rilevatore di frodi: ingressi elaborati al secondo e memoria per tessera, con palestre
+e tessere sintetiche (nessun database). Esempio di lancio dalla cartella api:
+
+    python benchmark/bench_antifrode.py -n 1000000 -t 100000
+'''
+import os, random, sys, time, argparse, tracemalloc
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from datetime import datetime, timedelta
+from antifrode import RilevatoreFrodi, DistanzePalestre
+
+class RegistroFinto:
+    '''Sostituto del RegistroPalestre senza Gestionale: nessuna palestra nota, le distanze usano le coordinate'''
+    def palestra(self, palestra_id:int):
+        return None
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--numero', type=int, default=1000000, help="Numero di ingressi simulati")
+    parser.add_argument('-t', '--tessere', type=int, default=100000, help="Numero di tessere distinte")
+    parser.add_argument('-p', '--palestre', type=int, default=200, help="Numero di palestre")
+    args = parser.parse_args()
+
+    coordinate = {i: (random.uniform(36, 47), random.uniform(6, 18)) for i in range(1, args.palestre + 1)}
+    # Pseudonimi della stessa lunghezza di quelli reali (344 caratteri base64)
+    tessere = [f"{i:0344d}" for i in range(args.tessere)]
+    inizio_giorno = datetime(2026, 1, 1)
+    ingressi = [(i, random.choice(tessere), random.randint(1, args.palestre),
+                 inizio_giorno + timedelta(seconds=i * 86400 * 30 / args.numero)) for i in range(args.numero)]
+
+    def esegui() -> tuple[RilevatoreFrodi, int, float]:
+        rilevatore = RilevatoreFrodi(DistanzePalestre(RegistroFinto(), coordinate), max_tessere=args.tessere)
+        allerte = 0
+        inizio = time.perf_counter()
+        for ingresso in ingressi:
+            allerte += len(rilevatore.elabora(*ingresso))
+        return rilevatore, allerte, time.perf_counter() - inizio
+
+    _, allerte, trascorso = esegui()
+    # Seconda esecuzione con tracemalloc (che rallenta l'elaborazione) per la sola memoria dello stato
+    tracemalloc.start()
+    rilevatore, _, _ = esegui()
+    memoria, _ = tracemalloc.get_traced_memory()
+
+    print(f"Ingressi: {args.numero}, tessere: {args.tessere}, allerte: {allerte}")
+    print(f"{args.numero / trascorso:,.0f} ingressi/s ({trascorso / args.numero * 1e6:.2f} µs/ingresso)")
+    print(f"Memoria dello stato: {memoria / 2**20:.1f} MB ({memoria / args.tessere:.0f} byte/tessera)")
@@ -0,0 +1,137 @@
+'''
+Benchmark dell'archivio freddo di Logs (segmenti_logs.py) con ingressi sintetici (pseudonimi casuali con la
+stessa lunghezza di quelli RSA): confronta i byte per ingresso e la latenza della ricerca di una tessera su
+tutto il periodo tra
+- la tabella Logs con lo stesso schema ed indici (SQLite temporaneo, oppure il database indicato con --uri,
+  es. un database MySQL vuoto dedicato alla prova);
+- i segmenti giornalieri, come scritti dall'archiviatore;
+- i segmenti mensili, dopo l'unione dei mesi completi.
+La latenza dei segmenti è misurata sia con i file già aperti sia aprendoli ad ogni ricerca. Esempio di
+lancio dalla cartella api:
+
+    python benchmark/bench_archivio.py --tessere 20000 --mesi 3 --ingressi 3000
+'''
+import os, random, sys, argparse, base64, tempfile, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from datetime import date, datetime, timedelta
+from sqlalchemy import create_engine, select, text
+from sqlalchemy.orm import Session
+from db_handler import LogsAndStats
+from segmenti_logs import Archivio, scrivi_segmento, unisci_segmenti, nome_segmento
+
+def percentile(valori:list, p:float) -> float:
+    return valori[min(len(valori) - 1, int(len(valori) * p / 100))]
+
+def cronometra_ricerche(cerca, pseudonimi:list) -> tuple[list, int]:
+    '''Latenze ordinate delle ricerche ed ingressi trovati in totale'''
+    latenze, trovati = [], 0
+    for pseudonimo in pseudonimi:
+        inizio = time.perf_counter()
+        trovati += len(list(cerca(pseudonimo)))
+        latenze.append(time.perf_counter() - inizio)
+    return sorted(latenze), trovati
+
+def dimensione_tabella(engine, percorso_sqlite:str | None) -> int:
+    if percorso_sqlite:
+        with engine.connect() as connection:
+            connection.execute(text("VACUUM"))
+        return os.path.getsize(percorso_sqlite)
+    with engine.connect() as connection:
+        connection.execute(text("ANALYZE TABLE `Logs`"))
+        return connection.execute(text("SELECT DATA_LENGTH + INDEX_LENGTH FROM INFORMATION_SCHEMA.TABLES "
+                                        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'Logs'")).scalar()
+
+def dimensione_segmenti(cartella:str) -> int:
+    return sum(os.path.getsize(os.path.join(cartella, nome)) for nome in os.listdir(cartella))
+
+def stampa(nome:str, byte:int, righe:int, latenze:list):
+    print(f"{nome:>31}: {byte / 2**20:8.1f} MB, {byte / righe:6.1f} byte/ingresso, ricerca p50 "
+          f"{percentile(latenze, 50) * 1000:.2f} ms, p99 {percentile(latenze, 99) * 1000:.2f} ms")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tessere', type=int, default=20000, help="Tessere (pseudonimi) distinte")
+    parser.add_argument('--mesi', type=int, default=3, help="Mesi di ingressi da archiviare")
+    parser.add_argument('--ingressi', type=int, default=3000, help="Ingressi al giorno")
+    parser.add_argument('--palestre', type=int, default=50, help="Palestre")
+    parser.add_argument('-n', '--ricerche', type=int, default=500, help="Ricerche di una tessera per scenario")
+    parser.add_argument('--uri', help="Database vuoto per la tabella Logs di confronto (default SQLite temporaneo)")
+    args = parser.parse_args()
+
+    cartella = tempfile.TemporaryDirectory(prefix="worldfit_archivio_")
+    percorso_sqlite = None if args.uri else os.path.join(cartella.name, "logs.sqlite3")
+    engine = create_engine(args.uri or f"sqlite:///{percorso_sqlite}")
+    LogsAndStats.Log.__table__.create(engine)
+    pseudonimi = [base64.urlsafe_b64encode(random.randbytes(256)).decode() for _ in range(args.tessere)]
+    # Frequenza di ingresso diversa per tessera: pochi clienti assidui, molti occasionali
+    pesi = [random.paretovariate(1.5) for _ in pseudonimi]
+
+    giornalieri, mensili = os.path.join(cartella.name, "giornalieri"), os.path.join(cartella.name, "mensili")
+    os.makedirs(giornalieri)
+    os.makedirs(mensili)
+    primo = date.today().replace(day=1)
+    for _ in range(args.mesi):
+        primo = (primo - timedelta(days=1)).replace(day=1)
+    giorno, righe, log_id = primo, 0, 0
+    inizio = time.perf_counter()
+    tempo_segmenti = 0.0
+    for _ in range(args.mesi):
+        fine_mese = (giorno + timedelta(days=31)).replace(day=1)
+        while giorno < fine_mese:
+            mezzanotte = datetime.combine(giorno, datetime.min.time())
+            # Passaggi distinti, come garantito dall'indice univoco IdxLogsSmartCardTimestamp
+            ingressi = list({(pseudonimo, random.randint(1, args.palestre), mezzanotte + timedelta(seconds=random.randrange(86400))): None
+                             for pseudonimo in random.choices(pseudonimi, pesi, k=args.ingressi)})
+            ingressi = [(*ingresso, log_id + i) for i, ingresso in enumerate(sorted(ingressi, key=lambda r: r[2]), 1)]
+            log_id += len(ingressi)
+            with Session(engine) as session, session.begin():
+                session.execute(LogsAndStats.Log.__table__.insert(), [
+                    {"Id": i, "SmartCardId": p, "PalestraId": g, "Timestamp": t} for p, g, t, i in ingressi])
+            inizio_segmento = time.perf_counter()
+            ingressi.sort(key=lambda r: (r[0], r[2], r[3]))
+            scrivi_segmento(os.path.join(giornalieri, nome_segmento(giorno, giorno + timedelta(days=1))),
+                            ingressi, giorno, giorno + timedelta(days=1))
+            tempo_segmenti += time.perf_counter() - inizio_segmento
+            righe += len(ingressi)
+            giorno += timedelta(days=1)
+    archivio = Archivio(giornalieri)
+    inizio_unione = time.perf_counter()
+    mesi = {}
+    for percorso, (dal, _) in archivio.intervalli().items():
+        mesi.setdefault(dal.replace(day=1), []).append(archivio.apri(percorso))
+    for mese, segmenti in sorted(mesi.items()):
+        unisci_segmenti(os.path.join(mensili, nome_segmento(mese, (mese + timedelta(days=31)).replace(day=1))), segmenti)
+    tempo_unione = time.perf_counter() - inizio_unione
+    archivio.close()
+    print(f"Ingressi: {righe:,} in {args.mesi} mesi ({args.tessere:,} tessere), generati in "
+          f"{time.perf_counter() - inizio:.1f} s; segmenti giornalieri scritti in {tempo_segmenti:.1f} s, "
+          f"unione mensile in {tempo_unione:.1f} s")
+
+    campione = random.choices(pseudonimi, pesi, k=args.ricerche)
+    Log = LogsAndStats.Log
+    with engine.connect() as connection:
+        def cerca_tabella(pseudonimo:str):
+            return connection.execute(select(Log.smart_card_id, Log.palestra_id, Log.timestamp, Log.id)
+                                      .where(Log.smart_card_id == pseudonimo).order_by(Log.timestamp)).all()
+        latenze, trovati_tabella = cronometra_ricerche(cerca_tabella, campione)
+    stampa("tabella Logs", dimensione_tabella(engine, percorso_sqlite), righe, latenze)
+
+    for nome, percorso in (("segmenti giornalieri", giornalieri), ("segmenti mensili", mensili)):
+        archivio = Archivio(percorso)
+        latenze, trovati = cronometra_ricerche(archivio.cerca, campione)
+        archivio.close()
+        assert trovati == trovati_tabella, f"{nome}: {trovati} ingressi trovati invece di {trovati_tabella}"
+        stampa(nome, dimensione_segmenti(percorso), righe, latenze)
+
+        def cerca_aprendo(pseudonimo:str):
+            nuovo = Archivio(percorso)
+            try:
+                return list(nuovo.cerca(pseudonimo))
+            finally:
+                nuovo.close()
+        latenze, _ = cronometra_ricerche(cerca_aprendo, campione)
+        stampa(f"{nome} (apertura)", dimensione_segmenti(percorso), righe, latenze)
+    print(f"Ingressi per ricerca: {trovati_tabella / args.ricerche:.1f} in media")
+    engine.dispose()
+    cartella.cleanup()
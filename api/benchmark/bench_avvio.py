@@ -0,0 +1,112 @@
+'''
+Benchmark dell'avvio dell'API con Gunicorn, con e senza preload_app (GUNICORN_PRELOAD), nello stesso
+ambiente locale di client_poc.py. Per ogni modalità riporta il tempo dall'avvio del processo alla prima
+risposta di un worker e la memoria dopo un breve carico: RSS, PSS (la memoria condivisa in copy-on-write
+è divisa tra i processi che la usano) e memoria privata di ogni worker, letti da /proc/<pid>/smaps_rollup.
+Riporta inoltre il tempo di import di api_server in un processo nuovo ed il costo, ora evitato all'avvio,
+della tabella degli stati di Babel. Esempio di lancio dalla cartella api:
+
+    python benchmark/bench_avvio.py --workers 4 -r 3
+'''
+import os, sys, argparse, json, statistics, subprocess, tempfile, time, urllib.error, urllib.request
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "external"))
+
+from client_poc import GeneratoreCarico, prepara_ambiente_locale, porta_libera, avvia_server, leggi_mix, CARTELLA_API
+
+def memoria(pid:int) -> dict:
+    '''Rss, Pss e memoria privata (kB) del processo indicato'''
+    valori = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for riga in f:
+            campo, _, resto = riga.partition(":")
+            if campo in ("Rss", "Pss", "Private_Clean", "Private_Dirty"):
+                valori[campo] = int(resto.split()[0])
+    return {"rss_mb": valori["Rss"] / 1024, "pss_mb": valori["Pss"] / 1024,
+            "privata_mb": (valori["Private_Clean"] + valori["Private_Dirty"]) / 1024}
+
+def figli(pid:int) -> list:
+    with open(f"/proc/{pid}/task/{pid}/children") as f:
+        return [int(figlio) for figlio in f.read().split()]
+
+def attendi_risposta(porta:int, timeout:float = 60) -> float:
+    '''
+        Attende la prima risposta di un worker (GET sulla route / dei tornelli, che risponde 405) e restituisce
+        l'istante in cui arriva
+    '''
+    limite = time.monotonic() + timeout
+    while time.monotonic() < limite:
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{porta}/", timeout=1):
+                return time.perf_counter()
+        except urllib.error.HTTPError:
+            return time.perf_counter()
+        except OSError:
+            time.sleep(0.01)
+    raise TimeoutError("Il server locale non risponde")
+
+def misura(preload:bool, args, tessere:dict, palestre:list, api_key:str) -> dict:
+    '''Avvia Gunicorn nella modalità indicata, misura il tempo alla prima risposta e la memoria dopo il carico'''
+    os.environ["GUNICORN_PRELOAD"] = "1" if preload else "0"
+    porta = porta_libera()
+    inizio = time.perf_counter()
+    processo = avvia_server("gunicorn", porta, args.workers)
+    try:
+        prima_risposta = attendi_risposta(porta) - inizio
+        GeneratoreCarico(f"http://127.0.0.1:{porta}", api_key, tessere, palestre, args.mix,
+                         args.workers * 4, 0, args.durata, 0, 1, 10).esegui()
+        workers = [memoria(pid) for pid in figli(processo.pid)]
+        master = memoria(processo.pid)
+    finally:
+        processo.terminate()
+        processo.wait(30)
+    return {"prima_risposta_s": prima_risposta,
+            "master": master,
+            "worker_rss_mb": statistics.mean(w["rss_mb"] for w in workers),
+            "worker_pss_mb": statistics.mean(w["pss_mb"] for w in workers),
+            "worker_privata_mb": statistics.mean(w["privata_mb"] for w in workers),
+            "totale_pss_mb": master["pss_mb"] + sum(w["pss_mb"] for w in workers)}
+
+def tempo_import(modulo:str, codice:str = "") -> float:
+    '''Secondi per importare il modulo indicato (ed eseguire il codice) in un processo Python nuovo'''
+    script = f"import time; t = time.perf_counter(); import {modulo}; {codice or 'pass'}; print(time.perf_counter() - t)"
+    risultato = subprocess.run([sys.executable, "-c", script], cwd=CARTELLA_API, env=os.environ.copy(),
+                               capture_output=True, text=True, check=True)
+    return float(risultato.stdout.split()[-1])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=4, help="Workers di Gunicorn")
+    parser.add_argument('-r', '--ripetizioni', type=int, default=3, help="Avvii per modalità (viene riportata la mediana)")
+    parser.add_argument('-d', '--durata', type=float, default=3, help="Secondi di carico prima della misura della memoria")
+    parser.add_argument('--membri', type=int, default=2000, help="Clienti sintetici nel Gestionale")
+    parser.add_argument('--mix', type=leggi_mix, default='valido=70,scaduto=10,sconosciuto=10,firma=10')
+    parser.add_argument('-o', '--output', default='-', help="File JSON del report, - per lo standard output")
+    args = parser.parse_args()
+
+    cartella = tempfile.TemporaryDirectory(prefix="worldfit_avvio_")
+    tessere, palestre, api_key = prepara_ambiente_locale(cartella.name, args.membri, 20, 0.2)
+    os.environ["CODA_SCRITTURE"] = "0"
+
+    report = {"workers": args.workers,
+              "import_api_server_s": statistics.median(tempo_import("api_server") for _ in range(args.ripetizioni)),
+              # Costo della tabella degli stati da Babel e dei fusi di pytz, prima eseguito all'import di privacy_modules
+              "babel_pytz_s": statistics.median(tempo_import("privacy_modules", "import pytz; privacy_modules.stato_a_sigla()")
+                                                - tempo_import("privacy_modules") for _ in range(args.ripetizioni))}
+    for preload in (False, True):
+        misure = [misura(preload, args, tessere, palestre, api_key) for _ in range(args.ripetizioni)]
+        modalita = "preload" if preload else "senza_preload"
+        report[modalita] = {chiave: round(statistics.median(m[chiave] for m in misure), 3)
+                            for chiave in misure[0] if chiave != "master"}
+        report[modalita]["master_pss_mb"] = round(statistics.median(m["master"]["pss_mb"] for m in misure), 1)
+        print(f"{modalita:>14}: prima risposta {report[modalita]['prima_risposta_s']:.2f} s, worker RSS "
+              f"{report[modalita]['worker_rss_mb']:.1f} MB (PSS {report[modalita]['worker_pss_mb']:.1f}, privata "
+              f"{report[modalita]['worker_privata_mb']:.1f}), PSS totale {report[modalita]['totale_pss_mb']:.1f} MB",
+              file=sys.stderr)
+    cartella.cleanup()
+
+    testo = json.dumps(report, indent=2)
+    if args.output == '-':
+        print(testo)
+    else:
+        with open(args.output, "w") as f:
+            f.write(testo + "\n")
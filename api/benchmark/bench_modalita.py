@@ -0,0 +1,106 @@
+'''
+Benchmark delle due modalità di servizio: sincrona (api_server.py con Gunicorn) ed asincrona (api_async.py
+con Uvicorn), con lo stesso numero di workers e lo stesso ambiente locale di client_poc.py. Il Gestionale è
+un database SQLite con DB_LATENZA_SIMULATA secondi di attesa per interrogazione e la cache delle tessere è
+disattivata, in modo che ogni passaggio attenda il Gestionale. Per ogni modalità la concorrenza viene
+aumentata a gradini; il report riporta throughput, p99, errori e memoria (RSS dell'albero di processi del
+server), ed il picco di richieste in volo: la concorrenza massima servita senza errori entro la soglia di p99.
+Esempio di lancio dalla cartella api:
+
+    python benchmark/bench_modalita.py --workers 2 --latenza 0.02 -c 8,32,128,256 -d 10
+'''
+import os, sys, argparse, json, tempfile, threading
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "external"))
+
+from client_poc import GeneratoreCarico, prepara_ambiente_locale, porta_libera, attendi_porta, avvia_server, leggi_mix
+
+def rss_albero(pid:int) -> int:
+    '''RSS totale in byte del processo indicato e dei suoi discendenti, letto da /proc'''
+    totale, da_visitare = 0, [pid]
+    while da_visitare:
+        corrente = da_visitare.pop()
+        try:
+            with open(f"/proc/{corrente}/status") as f:
+                totale += next(int(riga.split()[1]) * 1024 for riga in f if riga.startswith("VmRSS:"))
+            for task in os.listdir(f"/proc/{corrente}/task"):
+                with open(f"/proc/{corrente}/task/{task}/children") as f:
+                    da_visitare.extend(int(figlio) for figlio in f.read().split())
+        except (OSError, StopIteration):
+            continue # processo terminato durante la lettura
+    return totale
+
+class CampionatoreRSS(threading.Thread):
+    '''Thread che campiona l'RSS dell'albero di processi del server e ne conserva il massimo'''
+    def __init__(self, pid:int, intervallo:float = 0.2):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.intervallo = intervallo
+        self.massimo = 0
+        self.fermo = threading.Event()
+
+    def run(self):
+        while not self.fermo.wait(self.intervallo):
+            self.massimo = max(self.massimo, rss_albero(self.pid))
+
+def misura(modalita:str, args, tessere:dict, palestre:list, api_key:str) -> list:
+    '''Esegue i gradini di concorrenza su un server della modalità indicata e restituisce i risultati'''
+    porta = porta_libera()
+    processo = avvia_server(modalita, porta, args.workers)
+    gradini = []
+    try:
+        attendi_porta(porta)
+        rss_riposo = rss_albero(processo.pid)
+        for concorrenza in args.concorrenza:
+            campionatore = CampionatoreRSS(processo.pid)
+            campionatore.start()
+            report = GeneratoreCarico(f"http://127.0.0.1:{porta}", api_key, tessere, palestre, args.mix,
+                                      concorrenza, 0, args.durata, 0, 1, args.timeout).esegui()
+            campionatore.fermo.set()
+            campionatore.join()
+            gradini.append({"concorrenza": concorrenza,
+                            "richieste_s": report["throughput"]["richieste_s"],
+                            "p99_ms": report["latenza_ms"]["p99"],
+                            "errori": report["errori"]["eccezioni"] + report["errori"]["errori_http"],
+                            "rss_riposo_mb": round(rss_riposo / 2**20, 1),
+                            "rss_picco_mb": round(campionatore.massimo / 2**20, 1)})
+    finally:
+        processo.terminate()
+        processo.wait(30)
+    return gradini
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=2, help="Workers del server in entrambe le modalità")
+    parser.add_argument('--latenza', type=float, default=0.02, help="Secondi di latenza simulata per interrogazione")
+    parser.add_argument('-c', '--concorrenza', type=lambda s: [int(c) for c in s.split(",")], default="8,32,128,256",
+                        help="Gradini di richieste concorrenti, separati da virgola")
+    parser.add_argument('-d', '--durata', type=float, default=10, help="Secondi per gradino")
+    parser.add_argument('--timeout', type=float, default=10, help="Timeout delle richieste HTTP")
+    parser.add_argument('--soglia-p99', type=float, default=1000, help="p99 massimo (ms) per il picco in volo")
+    parser.add_argument('--membri', type=int, default=5000, help="Clienti sintetici nel Gestionale")
+    parser.add_argument('--mix', type=leggi_mix, default='valido=70,scaduto=10,sconosciuto=10,firma=10')
+    parser.add_argument('-o', '--output', default='-', help="File JSON del report, - per lo standard output")
+    args = parser.parse_args()
+
+    cartella = tempfile.TemporaryDirectory(prefix="worldfit_modalita_")
+    tessere, palestre, api_key = prepara_ambiente_locale(cartella.name, args.membri, 20, 0.2)
+    os.environ.update({"DB_LATENZA_SIMULATA": str(args.latenza), "CACHE_TESSERE": "0"})
+
+    report = {"workers": args.workers, "latenza_simulata_s": args.latenza, "soglia_p99_ms": args.soglia_p99}
+    for modalita in ("gunicorn", "asgi"):
+        gradini = misura(modalita, args, tessere, palestre, api_key)
+        servite = [g["concorrenza"] for g in gradini if g["errori"] == 0 and g["p99_ms"] is not None
+                   and g["p99_ms"] <= args.soglia_p99]
+        report[modalita] = {"gradini": gradini, "picco_in_volo": max(servite, default=0),
+                            "rss_picco_mb": max(g["rss_picco_mb"] for g in gradini)}
+        for g in gradini:
+            print(f"{modalita:>9} c={g['concorrenza']:<4} {g['richieste_s']:8.1f} req/s  p99 {g['p99_ms']} ms  "
+                  f"errori {g['errori']}  RSS {g['rss_picco_mb']} MB", file=sys.stderr)
+    cartella.cleanup()
+
+    testo = json.dumps(report, indent=2)
+    if args.output == '-':
+        print(testo)
+    else:
+        with open(args.output, "w") as f:
+            f.write(testo + "\n")
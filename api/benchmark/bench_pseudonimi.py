@@ -0,0 +1,57 @@
+'''
+Micro-benchmark della pseudonimizzazione: confronta il calcolo RSA "a freddo", la lettura dalla cache
+del processo e la ricerca nella tabella precalcolata. Non usa i segreti dell'API: genera una chiave
+RSA a 2048 bit ed un pad di prova. Esempio di lancio dalla cartella api:
+
+    python benchmark/bench_pseudonimi.py -n 20000
+'''
+import os, random, sys, tempfile, time, argparse
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from Crypto.PublicKey import RSA
+import privacy_modules
+from privacy_modules import calcola_pseudonimo, pseudonimizzatore, imposta_tabella_pseudonimi, CachePseudonimi
+from tabella_pseudonimi import TabellaPseudonimi, scrivi_tabella_pseudonimi
+
+def cronometra(funzione, smart_card_ids) -> float:
+    '''Restituisce i microsecondi medi per chiamata'''
+    inizio = time.perf_counter()
+    for smart_card_id in smart_card_ids:
+        funzione(smart_card_id)
+    return (time.perf_counter() - inizio) / len(smart_card_ids) * 1e6
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--numero', type=int, default=20000, help="Numero di Smart Card ID distinti")
+    args = parser.parse_args()
+
+    chiave = RSA.generate(2048).publickey()
+    pad = "PADDINGDIPROVA"
+    smart_card_ids = [f"{x:06X}" for x in random.sample(range(16**6), args.numero)]
+
+    risultati = {}
+    risultati["calcolo_rsa"] = cronometra(lambda s: calcola_pseudonimo(s, chiave, pad), smart_card_ids)
+
+    privacy_modules._cache_pseudonimi = CachePseudonimi(max_voci=args.numero)
+    for smart_card_id in smart_card_ids:
+        pseudonimizzatore(smart_card_id, chiave, pad)
+    risultati["cache"] = cronometra(lambda s: pseudonimizzatore(s, chiave, pad), smart_card_ids)
+
+    with tempfile.TemporaryDirectory() as cartella:
+        percorso = os.path.join(cartella, "pseudonimi.bin")
+        inizio = time.perf_counter()
+        scrivi_tabella_pseudonimi(smart_card_ids, chiave, pad, percorso)
+        costruzione = time.perf_counter() - inizio
+        tabella = TabellaPseudonimi(percorso, chiave, pad)
+        risultati["tabella"] = cronometra(lambda s: tabella.cerca(s, chiave, pad), smart_card_ids)
+        # pseudonimizzatore con cache vuota ma tabella impostata (es. primo accesso dopo l'avvio del worker)
+        privacy_modules._cache_pseudonimi = CachePseudonimi(max_voci=args.numero)
+        imposta_tabella_pseudonimi(tabella)
+        risultati["pseudonimizzatore_con_tabella"] = cronometra(lambda s: pseudonimizzatore(s, chiave, pad), smart_card_ids)
+        dimensione = os.path.getsize(percorso)
+        assert all(tabella.cerca(s, chiave, pad) == calcola_pseudonimo(s, chiave, pad) for s in smart_card_ids[:100])
+
+    print(f"Smart Card ID distinti: {args.numero}")
+    for nome, microsecondi in risultati.items():
+        print(f"{nome:>30}: {microsecondi:8.2f} µs/chiamata")
+    print(f"Tabella: {dimensione / 1024:.0f} KiB, costruita in {costruzione:.2f} s")
@@ -0,0 +1,125 @@
+'''
+Benchmark delle letture del Gestionale da più nodi (repliche_gestionale.py) con latenze simulate: copie
+SQLite dello stesso Gestionale sintetico fanno da principale e repliche, ed ognuna riceve una latenza
+casuale per interrogazione (base + coda lunga occasionale, vedi imposta_latenza_simulata). Confronta
+le latenze di verifica_accesso (p50, p95, p99, p99.9, massimo) ed errori di:
+- singolo: Gestionale sul solo nodo principale, senza scadenza (il comportamento precedente);
+- repliche: instradamento tra i nodi con scadenza, senza letture duplicate;
+- repliche_hedge: come sopra con le letture duplicate al percentile GS_HEDGE_PERCENTILE;
+- nodo_guasto: repliche_hedge con un nodo aggiuntivo irraggiungibile, che viene escluso;
+- nodo_bloccato: repliche_hedge con un nodo aggiuntivo che risponde dopo il doppio della scadenza.
+Esempio di lancio dalla cartella api:
+
+    python benchmark/bench_repliche.py --nodi 3 -c 8 -n 3000 --lento 0.2
+'''
+import os, random, shutil, sys, argparse, json, tempfile, threading, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "external"))
+
+def latenza_casuale(base:float, probabilita_coda:float, coda:float):
+    '''Latenza di un nodo: base con variazione esponenziale e, con la probabilità indicata, una pausa lunga'''
+    def latenza() -> float:
+        valore = random.expovariate(1 / base)
+        if random.random() < probabilita_coda:
+            valore += random.uniform(coda / 2, coda)
+        return valore
+    return latenza
+
+def carico(gestore, tessere:list, palestre:list, concorrenza:int, numero:int) -> tuple[list, int]:
+    '''Esegue "numero" verifiche da "concorrenza" thread e restituisce le latenze ordinate e gli errori'''
+    latenze, errori = [], [0]
+    lock = threading.Lock()
+    oggi = date.today()
+    def worker(quante:int):
+        for _ in range(quante):
+            inizio = time.perf_counter()
+            esito = gestore.verifica_accesso(random.choice(tessere), random.choice(palestre), oggi)
+            trascorso = time.perf_counter() - inizio
+            with lock:
+                latenze.append(trascorso)
+                errori[0] += esito is None
+    threads = [threading.Thread(target=worker, args=(numero // concorrenza,)) for _ in range(concorrenza)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sorted(latenze), errori[0]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nodi', type=int, default=3, help="Nodi del Gestionale (principale + repliche)")
+    parser.add_argument('-c', '--concorrenza', type=int, default=8, help="Thread che eseguono le verifiche")
+    parser.add_argument('-n', '--numero', type=int, default=3000, help="Verifiche per scenario")
+    parser.add_argument('--base', type=float, default=0.003, help="Latenza media dei nodi (secondi)")
+    parser.add_argument('--coda', type=float, default=0.3, help="Durata massima delle pause lunghe (secondi)")
+    parser.add_argument('--probabilita-coda', type=float, default=0.02, help="Probabilità di una pausa lunga")
+    parser.add_argument('--lento', type=float, default=0.2,
+                        help="Probabilità di pausa lunga del nodo principale (un nodo degradato)")
+    parser.add_argument('--deadline', type=float, default=1.0, help="Scadenza delle interrogazioni (GS_DEADLINE)")
+    parser.add_argument('--membri', type=int, default=5000, help="Clienti sintetici nel Gestionale")
+    parser.add_argument('-o', '--output', default='-', help="File JSON del report, - per lo standard output")
+    args = parser.parse_args()
+
+    cartella = tempfile.TemporaryDirectory(prefix="worldfit_repliche_")
+    # Pool abbastanza grande da non aggiungere attese per le connessioni (anche per le letture duplicate)
+    os.environ["DB_POOL_SIZE"] = str(args.concorrenza * 2)
+    os.environ["METRICHE_DIR"] = os.path.join(cartella.name, "metriche")
+    from client_poc import prepara_ambiente_locale, percentile
+    from datetime import date
+    from db_handler import Gestionale, ottieni_engine, imposta_latenza_simulata
+    from repliche_gestionale import GestionaleReplicato
+    from metriche import aggrega
+
+    tessere, palestre, _ = prepara_ambiente_locale(cartella.name, args.membri, 20, 0.2)
+    tessere = tessere["valido"] + tessere["scaduto"]
+    nodi = []
+    for i in range(args.nodi):
+        percorso = os.path.join(cartella.name, f"nodo{i}.sqlite3")
+        shutil.copy(os.path.join(cartella.name, "gestionale.sqlite3"), percorso)
+        nodi.append(f"sqlite:///{percorso}")
+        imposta_latenza_simulata(ottieni_engine(nodi[-1]),
+                                 latenza_casuale(args.base, args.lento if i == 0 else args.probabilita_coda, args.coda))
+    # Nodo irraggiungibile: la cartella del database non esiste
+    guasto = f"sqlite:///{os.path.join(cartella.name, 'assente', 'nodo.sqlite3')}"
+    # Nodo bloccato: risponde sempre dopo il doppio della scadenza
+    bloccato = os.path.join(cartella.name, "bloccato.sqlite3")
+    shutil.copy(os.path.join(cartella.name, "gestionale.sqlite3"), bloccato)
+    bloccato = f"sqlite:///{bloccato}"
+    imposta_latenza_simulata(ottieni_engine(bloccato), args.deadline * 2)
+
+    def esiti_nodi() -> dict:
+        return {f"{os.path.basename(dict(etichette)['nodo'])} {dict(etichette).get('esito', 'esclusione')}": valore
+                for (nome, etichette), valore in aggrega()["contatori"].items() if nome.startswith("worldfit_gestionale_")}
+
+    scenari = {
+        "singolo": Gestionale(nodi[0]),
+        "repliche": GestionaleReplicato(nodi[0], nodi[1:], deadline=args.deadline, hedge_percentile=0),
+        "repliche_hedge": GestionaleReplicato(nodi[0], nodi[1:], deadline=args.deadline),
+        "nodo_guasto": GestionaleReplicato(nodi[0], nodi[1:] + [guasto], deadline=args.deadline),
+        "nodo_bloccato": GestionaleReplicato(nodi[0], nodi[1:] + [bloccato], deadline=args.deadline),
+    }
+    report = {"nodi": args.nodi, "concorrenza": args.concorrenza, "verifiche": args.numero}
+    for nome, gestore in scenari.items():
+        contatori = esiti_nodi()
+        carico(gestore, tessere, palestre, args.concorrenza, args.concorrenza * 20) # riscaldamento
+        inizio = time.perf_counter()
+        latenze, errori = carico(gestore, tessere, palestre, args.concorrenza, args.numero)
+        trascorso = time.perf_counter() - inizio
+        report[nome] = {"p50_ms": percentile(latenze, 50) * 1000, "p95_ms": percentile(latenze, 95) * 1000,
+                        "p99_ms": percentile(latenze, 99) * 1000, "p999_ms": percentile(latenze, 99.9) * 1000,
+                        "max_ms": latenze[-1] * 1000, "errori": errori, "verifiche_s": len(latenze) / trascorso}
+        report[nome] = {chiave: round(valore, 2) for chiave, valore in report[nome].items()}
+        # Interrogazioni riuscite, duplicate, in errore o scadute ed esclusioni per nodo
+        report[nome]["nodi"] = {chiave: valore - contatori.get(chiave, 0) for chiave, valore in esiti_nodi().items()
+                                if valore > contatori.get(chiave, 0)}
+        print(f"{nome:>15}: p50 {report[nome]['p50_ms']:.1f} ms, p95 {report[nome]['p95_ms']:.1f}, "
+              f"p99 {report[nome]['p99_ms']:.1f}, p99.9 {report[nome]['p999_ms']:.1f}, max {report[nome]['max_ms']:.1f}, "
+              f"errori {errori}", file=sys.stderr)
+    cartella.cleanup()
+
+    testo = json.dumps(report, indent=2)
+    if args.output == '-':
+        print(testo)
+    else:
+        with open(args.output, "w") as f:
+            f.write(testo + "\n")
@@ -0,0 +1,57 @@
+'''
+Benchmark degli snapshot delle tessere per i tornelli: dimensione (anche compressa con gzip, come con la
+compressione HTTP), tempo di costruzione e di verifica, dimensione e tempo di calcolo del delta dopo una
+giornata di rinnovi, nuove iscrizioni e disdette, con clienti sintetici (nessun database). Esempio di
+lancio dalla cartella api:
+
+    python benchmark/bench_snapshot.py -n 1000000 --variazioni 0.01
+'''
+import os, random, sys, time, argparse, gzip
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from datetime import date, timedelta
+from snapshot_tessere import costruisci, calcola_delta, applica_delta, verifica
+
+CHIAVE = "chiave-di-prova"
+
+def cronometra(funzione, *argomenti):
+    inizio = time.perf_counter()
+    risultato = funzione(*argomenti)
+    return risultato, time.perf_counter() - inizio
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--numero', type=int, default=1000000, help="Clienti con un abbonamento valido")
+    parser.add_argument('--variazioni', type=float, default=0.01,
+                        help="Frazione di clienti rinnovati, iscritti e scaduti tra due snapshot (ciascuna)")
+    args = parser.parse_args()
+
+    oggi = date.today()
+    # ID distinti sui 2^24 possibili, come le Smart Card reali (6 cifre esadecimali)
+    ids = random.sample(range(1 << 24), int(args.numero * (1 + args.variazioni)))
+    attivi, nuovi = ids[:args.numero], ids[args.numero:]
+    scadenze = {f"{i:06X}": oggi + timedelta(days=random.randint(1, 365)) for i in attivi}
+
+    prima, tempo_costruzione = cronometra(costruisci, list(scadenze.items()), 1, oggi, CHIAVE)
+    _, tempo_verifica = cronometra(verifica, prima, CHIAVE)
+
+    cambiati = random.sample(list(scadenze), int(2 * args.numero * args.variazioni))
+    meta = len(cambiati) // 2
+    for smart_card_id in cambiati[:meta]:
+        scadenze[smart_card_id] += timedelta(days=365)
+    for smart_card_id in cambiati[meta:]:
+        del scadenze[smart_card_id]
+    scadenze.update({f"{i:06X}": oggi + timedelta(days=365) for i in nuovi})
+    dopo = costruisci(list(scadenze.items()), 2, oggi + timedelta(days=1), CHIAVE)
+
+    delta, tempo_delta = cronometra(calcola_delta, prima, dopo, CHIAVE)
+    applicato, tempo_applicazione = cronometra(applica_delta, prima, delta, CHIAVE)
+    assert applicato == dopo
+
+    print(f"Clienti: {args.numero:,}, variazioni: {meta:,} rinnovi, {len(cambiati) - meta:,} scadenze, {len(nuovi):,} iscrizioni")
+    print(f"Snapshot: {len(prima) / 2**20:.2f} MB ({len(prima) / args.numero:.2f} byte/cliente), "
+          f"gzip {len(gzip.compress(prima)) / 2**20:.2f} MB")
+    print(f"Costruzione: {tempo_costruzione:.2f} s, verifica della firma: {tempo_verifica * 1000:.1f} ms")
+    print(f"Delta: {len(delta) / 2**10:.1f} KB ({len(delta) / len(prima):.2%} dello snapshot), "
+          f"gzip {len(gzip.compress(delta)) / 2**10:.1f} KB")
+    print(f"Calcolo del delta: {tempo_delta:.2f} s, applicazione: {tempo_applicazione:.2f} s")
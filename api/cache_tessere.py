@@ -0,0 +1,272 @@
+'''
+Modulo Python contenente la cache locale delle tessere (SmartCard) e delle palestre, posta davanti
+al Database Gestionale. La cache è salvata in un file SQLite su /tmp in modo da essere condivisa da
+tutti i workers di Gunicorn dello stesso container, ha dimensione limitata (evizione LRU), scadenza
+delle voci (TTL), memorizza anche le tessere inesistenti (caching negativo) e, se il Gestionale non
+risponde, può servire voci scadute da non troppo tempo per non bloccare i tornelli.
+'''
+from db_handler import Gestionale
+from datetime import date
+from sys import stdout
+import json, logging, os, sqlite3, threading, time
+
+# Impostazione di Logging per stampare eventuali eccezioni nei Docker Logs
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler(stdout)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+logger.setLevel(logging.ERROR)
+
+CACHE_PATH = os.getenv("CACHE_TESSERE_PATH", "/tmp/worldfit_cache_tessere.sqlite3")
+CACHE_TTL = float(os.getenv("CACHE_TESSERE_TTL", "300"))                  # secondi di validità di una voce
+CACHE_TTL_NEGATIVO = float(os.getenv("CACHE_TESSERE_TTL_NEGATIVO", "60")) # secondi di validità di una tessera/palestra inesistente
+CACHE_STALE_MAX = float(os.getenv("CACHE_TESSERE_STALE_MAX", "3600"))     # secondi oltre il TTL in cui una voce può essere servita se il Gestionale non risponde (0 = mai)
+CACHE_MAX_VOCI = int(os.getenv("CACHE_TESSERE_MAX_VOCI", "100000"))
+# L'ultimo accesso di una voce (usato per l'evizione LRU) viene aggiornato al massimo una volta
+# per intervallo, per non trasformare ogni lettura in una scrittura
+INTERVALLO_LRU = 30
+# Il numero di voci viene controllato (e le voci in eccesso rimosse) ogni N scritture
+INTERVALLO_EVIZIONE = 100
+
+# Contatori del processo corrente, utili per dimensionare TTL e dimensione della cache
+_contatori = {"hit": 0, "hit_negativi": 0, "miss": 0, "stale": 0, "errori": 0, "evizioni": 0}
+_lock_contatori = threading.Lock()
+
+def _conta(nome:str, quanti:int = 1):
+    with _lock_contatori:
+        _contatori[nome] += quanti
+
+def statistiche_cache() -> dict:
+    '''Funzione che restituisce una copia dei contatori della cache del processo corrente'''
+    with _lock_contatori:
+        return dict(_contatori)
+
+class CacheTessere:
+    '''
+    Classe che espone lo stesso metodo verifica_accesso di Gestionale, rispondendo dalla cache
+    quando possibile e interrogando il Gestionale solo in caso di miss o voce scaduta
+    '''
+    def __init__(self, gestore:Gestionale, percorso:str = CACHE_PATH, ttl:float = CACHE_TTL,
+                 ttl_negativo:float = CACHE_TTL_NEGATIVO, stale_max:float = CACHE_STALE_MAX,
+                 max_voci:int = CACHE_MAX_VOCI):
+        self.gestore = gestore
+        self.percorso = percorso
+        self.ttl = ttl
+        self.ttl_negativo = ttl_negativo
+        self.stale_max = stale_max
+        self.max_voci = max_voci
+        # Le connessioni SQLite non possono essere condivise tra threads né tra processi:
+        # ne viene aperta una per thread, e riaperta se il pid cambia dopo una fork
+        self._locale = threading.local()
+        self._scritture = 0
+
+    def _connessione(self) -> sqlite3.Connection:
+        connessione = getattr(self._locale, "connessione", None)
+        if connessione is None or self._locale.pid != os.getpid():
+            connessione = sqlite3.connect(self.percorso, timeout=0.05, isolation_level=None)
+            connessione.execute("PRAGMA journal_mode=WAL")
+            connessione.execute("PRAGMA synchronous=OFF") # è una cache: perdere scritture è accettabile
+            connessione.execute("""CREATE TABLE IF NOT EXISTS Voci (
+                                    Chiave TEXT PRIMARY KEY,
+                                    Valore TEXT,
+                                    Salvato REAL NOT NULL,
+                                    UltimoAccesso REAL NOT NULL)""")
+            connessione.execute("CREATE INDEX IF NOT EXISTS IdxVociUltimoAccesso ON Voci (UltimoAccesso)")
+            self._locale.connessione = connessione
+            self._locale.pid = os.getpid()
+        return connessione
+
+    def _leggi(self, chiave:str, ora:float) -> tuple | None:
+        '''Restituisce la coppia (valore, istante di salvataggio) della voce, None se assente'''
+        try:
+            connessione = self._connessione()
+            riga = connessione.execute("SELECT Valore, Salvato, UltimoAccesso FROM Voci WHERE Chiave = ?",
+                                       (chiave,)).fetchone()
+            if riga is None:
+                return None
+            if ora - riga[2] > INTERVALLO_LRU:
+                connessione.execute("UPDATE Voci SET UltimoAccesso = ? WHERE Chiave = ?", (ora, chiave))
+            return json.loads(riga[0]), riga[1]
+        except Exception as e:
+            _conta("errori")
+            logger.error("Errore nella lettura della cache tessere: %s", str(e))
+            return None
+
+    def _scrivi(self, voci:dict, ora:float):
+        try:
+            connessione = self._connessione()
+            connessione.executemany("INSERT OR REPLACE INTO Voci (Chiave, Valore, Salvato, UltimoAccesso) VALUES (?, ?, ?, ?)",
+                                    [(chiave, json.dumps(valore), ora, ora) for chiave, valore in voci.items()])
+            self._scritture += 1
+            if self._scritture % INTERVALLO_EVIZIONE:
+                return
+            # Evizione LRU delle voci in eccesso
+            eccesso = connessione.execute("SELECT COUNT(*) FROM Voci").fetchone()[0] - self.max_voci
+            if eccesso > 0:
+                connessione.execute("DELETE FROM Voci WHERE Chiave IN "
+                                    "(SELECT Chiave FROM Voci ORDER BY UltimoAccesso LIMIT ?)", (eccesso,))
+                _conta("evizioni", eccesso)
+        except Exception as e:
+            _conta("errori")
+            logger.error("Errore nella scrittura della cache tessere: %s", str(e))
+
+    @staticmethod
+    def _negativa(valore) -> bool:
+        '''Una voce è negativa se la palestra o il cliente non esistono o se non c'è un abbonamento valido'''
+        return valore is None or (isinstance(valore, dict) and (valore["cliente"] is None or valore["scadenza"] is None))
+
+    def _fresca(self, voce:tuple, ora:float, margine:float = 0) -> bool:
+        '''Controlla che la voce non sia scaduta, con TTL ridotto per le voci negative'''
+        valore, salvato = voce
+        ttl = self.ttl_negativo if self._negativa(valore) else self.ttl
+        return ora - salvato <= ttl + margine
+
+    @staticmethod
+    def _esito(tessera:dict, palestra:list | None, giorno:date) -> Gestionale.EsitoAccesso:
+        '''Ricostruisce un EsitoAccesso a partire dalle voci in cache'''
+        cliente = None
+        if tessera["cliente"] is not None:
+            id_cliente, sesso, data_nascita = tessera["cliente"]
+            cliente = Gestionale.DatiCliente(id_cliente, sesso,
+                                             date.fromisoformat(data_nascita) if data_nascita else None)
+        # un abbonamento valido al momento del salvataggio resta valido fino alla sua scadenza
+        scadenza = date.fromisoformat(tessera["scadenza"]) if tessera["scadenza"] else None
+        if scadenza is not None and not giorno < scadenza:
+            scadenza = None
+        return Gestionale.EsitoAccesso(cliente,
+                                       Gestionale.DatiPalestra(*palestra) if palestra is not None else None,
+                                       scadenza)
+
+    def _servibili(self, tessera:tuple | None, palestra:tuple | None, ora:float, margine:float = 0) -> bool:
+        '''Controlla che le voci di tessera e palestra siano presenti e non scadute'''
+        return tessera is not None and palestra is not None \
+            and self._fresca(tessera, ora, margine) and self._fresca(palestra, ora, margine)
+
+    @staticmethod
+    def _voci(smart_card_id:str, palestra_id:int, esito:Gestionale.EsitoAccesso) -> dict:
+        '''Converte un EsitoAccesso del Gestionale nelle voci da salvare in cache'''
+        cliente = None
+        if esito.cliente is not None:
+            cliente = [esito.cliente.id, esito.cliente.sesso,
+                       esito.cliente.data_nascita.isoformat() if esito.cliente.data_nascita else None]
+        return {
+            f"tessera:{smart_card_id}": {"cliente": cliente,
+                                         "scadenza": esito.scadenza.isoformat() if esito.scadenza else None},
+            f"palestra:{palestra_id}": list(esito.palestra) if esito.palestra is not None else None}
+
+    def cerca(self, smart_card_id:str, palestra_id:int, giorno:date, stale:bool = False) -> Gestionale.EsitoAccesso:
+        '''
+            Restituisce l'esito dalla cache se le voci di tessera e palestra sono fresche (con stale=True,
+            se sono entro la finestra di stale), altrimenti None. Usata anche dalla modalità asincrona.
+        '''
+        ora = time.time()
+        tessera = self._leggi(f"tessera:{smart_card_id}", ora)
+        palestra = self._leggi(f"palestra:{palestra_id}", ora)
+        if not stale:
+            if self._servibili(tessera, palestra, ora):
+                _conta("hit_negativi" if self._negativa(tessera[0]) or self._negativa(palestra[0]) else "hit")
+                return self._esito(tessera[0], palestra[0], giorno)
+            _conta("miss")
+        elif self.stale_max > 0 and self._servibili(tessera, palestra, ora, self.stale_max):
+            _conta("stale")
+            return self._esito(tessera[0], palestra[0], giorno)
+        return None
+
+    def memorizza(self, smart_card_id:str, palestra_id:int, esito:Gestionale.EsitoAccesso):
+        '''Salva in cache l'esito restituito dal Gestionale'''
+        self._scrivi(self._voci(smart_card_id, palestra_id, esito), time.time())
+
+    def verifica_accesso(self, smart_card_id:str, palestra_id:int, giorno:date) -> Gestionale.EsitoAccesso:
+        '''
+            Funzione con la stessa interfaccia di Gestionale.verifica_accesso. Restituisce None solo se
+            il Gestionale è in errore e non ci sono voci in cache servibili secondo la politica di stale.
+        '''
+        esito = self.cerca(smart_card_id, palestra_id, giorno)
+        if esito is not None:
+            return esito
+
+        esito = self.gestore.verifica_accesso(smart_card_id, palestra_id, giorno)
+        if esito is None:
+            # Gestionale in errore: servo voci scadute se entro la finestra di stale
+            return self.cerca(smart_card_id, palestra_id, giorno, stale=True)
+
+        self.memorizza(smart_card_id, palestra_id, esito)
+        return esito
+
+    def verifica_accessi(self, richieste:list) -> list:
+        '''
+            Funzione con la stessa interfaccia di Gestionale.verifica_accessi: le richieste trovate in cache
+            vengono risolte localmente, le altre con un solo lotto sul Gestionale. Le voci in cache descrivono
+            la validità ad oggi, quindi le richieste di giorni precedenti (ingressi registrati offline) vengono
+            sempre inviate al Gestionale e non aggiornano la cache. Se il Gestionale è in errore, gli esiti
+            non servibili dalla cache valgono None.
+        '''
+        ora, oggi = time.time(), date.today()
+        esiti = [None] * len(richieste)
+        mancanti, in_cache = [], {}
+        for i, (smart_card_id, palestra_id, giorno) in enumerate(richieste):
+            if giorno != oggi:
+                mancanti.append(i)
+                continue
+            tessera = self._leggi(f"tessera:{smart_card_id}", ora)
+            palestra = self._leggi(f"palestra:{palestra_id}", ora)
+            if self._servibili(tessera, palestra, ora):
+                _conta("hit_negativi" if self._negativa(tessera[0]) or self._negativa(palestra[0]) else "hit")
+                esiti[i] = self._esito(tessera[0], palestra[0], giorno)
+            else:
+                mancanti.append(i)
+                in_cache[i] = (tessera, palestra)
+        if not mancanti:
+            return esiti
+
+        _conta("miss", len(mancanti))
+        risposte = self.gestore.verifica_accessi([richieste[i] for i in mancanti])
+        if risposte is None:
+            # Gestionale in errore: servo voci scadute se entro la finestra di stale
+            for i, (tessera, palestra) in in_cache.items():
+                if self.stale_max > 0 and self._servibili(tessera, palestra, ora, self.stale_max):
+                    _conta("stale")
+                    esiti[i] = self._esito(tessera[0], palestra[0], richieste[i][2])
+            return esiti
+
+        voci = {}
+        for i, esito in zip(mancanti, risposte):
+            esiti[i] = esito
+            if i in in_cache:
+                voci.update(self._voci(richieste[i][0], richieste[i][1], esito))
+        if voci:
+            self._scrivi(voci, ora)
+        return esiti
+
+    def invalida(self, smart_card_id:str | None = None):
+        '''
+            Hook di invalidazione: rimuove dalla cache la tessera indicata, o tutte le voci se
+            non viene indicata alcuna tessera (es. dopo modifiche massive sul Gestionale)
+        '''
+        try:
+            if smart_card_id is None:
+                self._connessione().execute("DELETE FROM Voci")
+            else:
+                self._connessione().execute("DELETE FROM Voci WHERE Chiave = ?", (f"tessera:{smart_card_id}",))
+        except Exception as e:
+            logger.error("Errore nell'invalidazione della cache tessere: %s", str(e))
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Gestione della cache tessere condivisa dai workers dell'API")
+    gruppo = parser.add_mutually_exclusive_group(required=True)
+    gruppo.add_argument('-i', '--invalida', metavar='SMARTCARD_ID',
+                        help="Rimuove dalla cache la Smart Card indicata")
+    gruppo.add_argument('-s', '--svuota', action='store_true',
+                        help="Rimuove tutte le voci dalla cache")
+    gruppo.add_argument('-c', '--conteggio', action='store_true',
+                        help="Mostra il numero di voci in cache")
+    args = parser.parse_args()
+
+    cache = CacheTessere(gestore=None)
+    if args.conteggio:
+        print(f"Voci in cache: {cache._connessione().execute('SELECT COUNT(*) FROM Voci').fetchone()[0]}")
+    else:
+        cache.invalida(None if args.svuota else args.invalida)
+        print("Cache invalidata")
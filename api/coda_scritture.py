@@ -0,0 +1,394 @@
+'''
+Modulo Python contenente la coda di scrittura differita (write-behind) per le tabelle Logs e Statistiche.
+Le richieste dei tornelli accodano i record e ricevono subito la risposta; un thread per worker svuota
+la coda scrivendo i record in batch (per dimensione o per tempo) con una transazione per batch.
+Se il Database Log & Statistiche non è raggiungibile, o se la coda è piena, i record vengono salvati
+in file di spill su disco e riscritti sul database appena possibile.
+Ogni record viene anche annotato in un giornale su disco prima di entrare nella coda in memoria: i file
+del giornale vengono svuotati quando tutti i loro record sono stati scritti (sul database o nello spill),
+mentre quelli di un processo terminato (es. worker ucciso) vengono recuperati come i file di spill.
+Le righe illeggibili di un file recuperato (es. l'ultima riga troncata dalla fine del processo) vengono
+saltate ed il file viene conservato con estensione .corrotto, per l'analisi manuale.
+Senza CODA_SCRITTURE_FSYNC il giornale protegge dalla fine del processo ma non da quella del sistema.
+'''
+from db_handler import LogsAndStats
+from datetime import date, datetime
+from sys import stdout
+import asyncio, atexit, glob, json, logging, os, queue, re, threading, time
+
+# Impostazione di Logging per stampare eventuali eccezioni nei Docker Logs
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler(stdout)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+logger.setLevel(logging.ERROR)
+
+DIMENSIONE_BATCH = int(os.getenv("CODA_SCRITTURE_BATCH", "200"))           # record massimi per transazione
+INTERVALLO_FLUSH = float(os.getenv("CODA_SCRITTURE_INTERVALLO", "0.5"))    # secondi massimi di permanenza in coda
+MAX_IN_CODA = int(os.getenv("CODA_SCRITTURE_MAX", "10000"))                # record massimi in memoria per worker
+ATTESA_CODA_PIENA = float(os.getenv("CODA_SCRITTURE_ATTESA", "0.05"))      # secondi di backpressure prima dello spill
+CARTELLA_SPILL = os.getenv("CODA_SCRITTURE_SPILL_DIR", "/tmp/worldfit_spill")
+GIORNALE = os.getenv("CODA_SCRITTURE_GIORNALE", "1") == "1"                # annota i record prima di accodarli
+GIORNALE_FSYNC = os.getenv("CODA_SCRITTURE_FSYNC", "0") == "1"             # fsync del giornale ad ogni record
+INTERVALLO_RECUPERO = 30 # secondi tra due tentativi di recupero dei file di spill
+RECORD_PER_GIORNALE = 10000 # record per file del giornale prima di passare al successivo
+# Nomi dei file recuperabili: spill-<pid>[-<n>].jsonl, giornale-<pid>-<n>.jsonl oppure recupero-<pid>-<n>.jsonl
+NOME_RECUPERABILE = re.compile(r"^(?:spill|giornale|recupero)-(\d+)(?:-\d+)?\.jsonl$")
+
+def _serializza(log:dict, stat:dict) -> str:
+    '''Converte una coppia di record in una riga JSON per il file di spill'''
+    return json.dumps({"log": {**log, "timestamp": log["timestamp"].isoformat()},
+                       "stat": {**stat, "data_ingresso": stat["data_ingresso"].isoformat()}})
+
+def _deserializza(riga:str) -> tuple[dict, dict]:
+    record = json.loads(riga)
+    record["log"]["timestamp"] = datetime.fromisoformat(record["log"]["timestamp"])
+    record["stat"]["data_ingresso"] = date.fromisoformat(record["stat"]["data_ingresso"])
+    return record["log"], record["stat"]
+
+def _leggi_record(percorso:str) -> tuple[list, int]:
+    '''Record di un file di spill o del giornale ed il numero di righe illeggibili, che vengono saltate'''
+    batch, illeggibili = [], 0
+    with open(percorso, errors="replace") as f:
+        for riga in f:
+            if not riga.strip():
+                continue
+            try:
+                batch.append(_deserializza(riga))
+            except (ValueError, KeyError, TypeError, AttributeError):
+                illeggibili += 1
+    return batch, illeggibili
+
+def _processo_attivo(pid:int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class CodaScritture:
+    '''
+    Classe che gestisce la coda di scrittura differita di un worker. Il thread di scrittura viene
+    avviato al primo record accodato, in modo che ogni processo (anche dopo una fork di Gunicorn)
+    abbia il proprio thread e la propria coda. Le voci della coda sono tuple (log, stat, giornale),
+    con il file del giornale in cui il record è annotato (None se non annotato).
+    '''
+    def __init__(self, magazziniere:LogsAndStats, dimensione_batch:int = DIMENSIONE_BATCH,
+                 intervallo:float = INTERVALLO_FLUSH, max_in_coda:int = MAX_IN_CODA,
+                 cartella_spill:str = CARTELLA_SPILL, giornale:bool = GIORNALE):
+        self.magazziniere = magazziniere
+        self.dimensione_batch = dimensione_batch
+        self.intervallo = intervallo
+        self.max_in_coda = max_in_coda
+        self.cartella_spill = cartella_spill
+        self.giornale = giornale
+        self._lock = threading.Lock()
+        self._pid = None
+        self._coda = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._ultimo_recupero = 0.0
+        self._azzera_giornale()
+
+    def _azzera_giornale(self):
+        '''Stato del giornale del processo corrente: file aperto e record in attesa per ogni file'''
+        self._lock_giornale = threading.Lock()
+        self._file_giornale = None
+        self._percorso_giornale = None
+        self._righe_giornale = 0
+        self._pendenti = {}
+
+    def _avvia(self):
+        '''Avvia coda e thread di scrittura nel processo corrente, se non già avviati'''
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._azzera_giornale()
+            self._coda = queue.Queue(maxsize=self.max_in_coda)
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._ciclo, name="coda-scritture", daemon=True)
+            self._thread.start()
+            atexit.register(self.chiudi)
+
+    def accoda(self, log:dict, stat:dict):
+        '''
+            Accoda un ingresso: log ha le chiavi dei parametri di LogsAndStats.insert_log,
+            stat quelle di LogsAndStats.insert_stats. Se la coda è piena la richiesta attende
+            al massimo ATTESA_CODA_PIENA secondi, poi il record viene salvato nel file di spill.
+        '''
+        if self._pid != os.getpid():
+            self._avvia()
+        voce = (log, stat, self._annota(log, stat))
+        try:
+            self._coda.put(voce, timeout=ATTESA_CODA_PIENA)
+        except queue.Full:
+            logger.error("Coda di scrittura piena, record salvato su disco")
+            self._salva_su_disco([voce])
+
+    def in_coda(self) -> int:
+        '''Numero di record in attesa di scrittura nel processo corrente'''
+        return self._coda.qsize() if self._pid == os.getpid() else 0
+
+    def _preleva_batch(self) -> list:
+        '''Attende il primo record e raccoglie i successivi fino a dimensione_batch o allo scadere dell'intervallo'''
+        try:
+            batch = [self._coda.get(timeout=self.intervallo)]
+        except queue.Empty:
+            return []
+        scadenza = time.monotonic() + self.intervallo
+        while len(batch) < self.dimensione_batch:
+            rimanente = scadenza - time.monotonic()
+            try:
+                batch.append(self._coda.get(timeout=rimanente) if rimanente > 0 else self._coda.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _scrivi(self, batch:list) -> bool:
+        '''Scrive sul database un batch di voci della coda o di record dello spill (tuple che iniziano con log e stat)'''
+        return self.magazziniere.insert_batch([voce[0] for voce in batch], [voce[1] for voce in batch])
+
+    def _ciclo(self):
+        while not (self._stop.is_set() and self._coda.empty()):
+            batch = self._preleva_batch()
+            if batch and self._scrivi(batch):
+                self._completati(batch)
+            elif batch:
+                self._salva_su_disco(batch)
+                # Database non disponibile: rimando il recupero dello spill al prossimo intervallo
+                self._ultimo_recupero = time.monotonic()
+                continue
+            if time.monotonic() - self._ultimo_recupero > INTERVALLO_RECUPERO:
+                self._ultimo_recupero = time.monotonic()
+                # Un errore del recupero non deve fermare il thread: la coda resterebbe senza scrittore
+                try:
+                    self.recupera_spill()
+                except Exception as e:
+                    logger.error("Errore nel recupero dei file di spill: %s", str(e))
+
+    def _annota(self, log:dict, stat:dict) -> str | None:
+        '''
+            Aggiunge il record al giornale del processo prima che entri nella coda e restituisce il file
+            in cui è annotato. In caso di errore il record prosegue solo in memoria (None).
+        '''
+        if not self.giornale:
+            return None
+        riga = _serializza(log, stat) + "\n"
+        try:
+            with self._lock_giornale:
+                if self._file_giornale is None or self._righe_giornale >= RECORD_PER_GIORNALE:
+                    self._ruota_giornale()
+                self._file_giornale.write(riga)
+                self._file_giornale.flush()
+                if GIORNALE_FSYNC:
+                    os.fsync(self._file_giornale.fileno())
+                self._righe_giornale += 1
+                self._pendenti[self._percorso_giornale] += 1
+                return self._percorso_giornale
+        except Exception as e:
+            logger.error("Errore nella scrittura del giornale della coda: %s", str(e))
+            return None
+
+    def _ruota_giornale(self):
+        '''Chiude il file corrente del giornale (eliminandolo se non ha record in attesa) ed apre il successivo'''
+        if self._file_giornale is not None:
+            self._file_giornale.close()
+            if self._pendenti[self._percorso_giornale] == 0:
+                self._elimina_giornale(self._percorso_giornale)
+        os.makedirs(self.cartella_spill, exist_ok=True)
+        self._percorso_giornale = os.path.join(self.cartella_spill, f"giornale-{os.getpid()}-{time.time_ns()}.jsonl")
+        self._file_giornale = open(self._percorso_giornale, "a")
+        self._righe_giornale = 0
+        self._pendenti[self._percorso_giornale] = 0
+
+    def _elimina_giornale(self, percorso:str):
+        del self._pendenti[percorso]
+        try:
+            os.remove(percorso)
+        except OSError as e:
+            logger.error("Errore nell'eliminazione del giornale %s: %s", percorso, str(e))
+
+    def _completati(self, batch:list):
+        '''
+            Segna come scritte (sul database o nello spill) le voci del batch: i file del giornale senza più
+            record in attesa vengono svuotati, se ancora in uso, o eliminati
+        '''
+        giornali = [voce[2] for voce in batch if voce[2] is not None]
+        if not giornali:
+            return
+        with self._lock_giornale:
+            for percorso in giornali:
+                self._pendenti[percorso] -= 1
+            for percorso in set(giornali):
+                if self._pendenti[percorso] > 0:
+                    continue
+                if percorso != self._percorso_giornale:
+                    self._elimina_giornale(percorso)
+                elif self._righe_giornale > 0:
+                    self._file_giornale.truncate(0)
+                    self._righe_giornale = 0
+
+    def _salva_su_disco(self, batch:list):
+        '''Salva le voci nello spill; solo se il salvataggio è riuscito il giornale può dimenticarle'''
+        if self._spill(batch):
+            self._completati(batch)
+
+    def _spill(self, batch:list) -> bool:
+        '''Salva i record in append nel file di spill del processo corrente'''
+        try:
+            os.makedirs(self.cartella_spill, exist_ok=True)
+            with self._lock, open(os.path.join(self.cartella_spill, f"spill-{os.getpid()}.jsonl"), "a") as f:
+                f.writelines(_serializza(voce[0], voce[1]) + "\n" for voce in batch)
+            return True
+        except Exception as e:
+            logger.critical("Errore nel salvataggio su disco di %s record: %s", len(batch), str(e))
+            return False
+
+    def _chiudi_giornale(self):
+        '''Chiude il file del giornale, eliminandolo se tutti i suoi record sono stati scritti'''
+        with self._lock_giornale:
+            if self._file_giornale is None:
+                return
+            self._file_giornale.close()
+            if self._pendenti[self._percorso_giornale] == 0:
+                self._elimina_giornale(self._percorso_giornale)
+            self._file_giornale = self._percorso_giornale = None
+
+    def recupera_spill(self):
+        '''
+            Riscrive sul database i record presenti nei file di spill del processo corrente e in quelli
+            (spill e giornali) lasciati da processi terminati. Ogni file viene prima rinominato, in modo che
+            un solo worker alla volta lo recuperi; se la scrittura fallisce il file torna tra quelli da recuperare.
+            I file con righe illeggibili vengono conservati come .corrotto dopo la scrittura delle altre righe;
+            gli altri file della cartella vengono ignorati.
+        '''
+        for percorso in glob.glob(os.path.join(self.cartella_spill, "*.jsonl")):
+            corrispondenza = NOME_RECUPERABILE.match(os.path.basename(percorso))
+            if corrispondenza is None:
+                continue
+            pid = int(corrispondenza.group(1))
+            if pid != os.getpid() and _processo_attivo(pid):
+                continue
+            with self._lock_giornale:
+                if percorso in self._pendenti:
+                    continue # giornale in uso nel processo corrente
+            in_recupero = os.path.join(self.cartella_spill, f"recupero-{os.getpid()}-{time.time_ns()}.jsonl")
+            with self._lock: # nessuno spill del processo corrente durante la rinomina
+                try:
+                    os.rename(percorso, in_recupero)
+                except OSError:
+                    continue # preso in carico da un altro worker
+
+            batch, illeggibili = _leggi_record(in_recupero)
+            scritto = all(self._scrivi(batch[i:i + self.dimensione_batch])
+                          for i in range(0, len(batch), self.dimensione_batch))
+            # Con più transazioni un fallimento a metà file fa riscrivere al successivo recupero anche i
+            # batch già salvati: insert_batch scarta i passaggi già registrati, senza duplicati
+            if scritto and illeggibili:
+                logger.error("%s righe illeggibili in %s, file conservato come .corrotto", illeggibili, percorso)
+                os.rename(in_recupero, f"{in_recupero[:-len('.jsonl')]}.corrotto")
+            elif scritto:
+                os.remove(in_recupero)
+            else:
+                os.rename(in_recupero, os.path.join(self.cartella_spill, f"spill-{os.getpid()}-{time.time_ns()}.jsonl"))
+                return
+
+    def chiudi(self, timeout:float = 10):
+        '''Svuota la coda sul database (o su disco) e ferma il thread: da richiamare alla chiusura del worker'''
+        if self._pid != os.getpid() or self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join(timeout)
+        # Record eventualmente rimasti (thread bloccato sul database oltre il timeout)
+        rimasti = []
+        while True:
+            try:
+                rimasti.append(self._coda.get_nowait())
+            except queue.Empty:
+                break
+        if rimasti:
+            self._salva_su_disco(rimasti)
+        self._chiudi_giornale()
+
+class CodaScrittureAsync(CodaScritture):
+    '''
+    Versione della coda per la modalità asincrona (vedi api_async.py): i record vengono accodati in una
+    asyncio.Queue e scritti da un task dell'event loop con LogsAndStatsAsync, senza attese per le richieste.
+    File di spill e recupero sono quelli di CodaScritture; il recupero, sincrono, viene eseguito in un thread.
+    '''
+    def __init__(self, magazziniere:LogsAndStats, magazziniere_async, **kwargs):
+        super().__init__(magazziniere, **kwargs)
+        self.magazziniere_async = magazziniere_async
+        self._task = None
+
+    def avvia_async(self):
+        '''Crea coda e task di scrittura nell'event loop corrente: da richiamare all'avvio dell'applicazione'''
+        self._pid = os.getpid()
+        self._azzera_giornale()
+        self._coda = asyncio.Queue(maxsize=self.max_in_coda)
+        self._stop = threading.Event()
+        self._task = asyncio.get_running_loop().create_task(self._ciclo_async(), name="coda-scritture")
+
+    def accoda(self, log:dict, stat:dict):
+        '''Accoda un ingresso senza attese: se la coda è piena (o non avviata) il record viene salvato nel file di spill'''
+        voce = (log, stat, None)
+        try:
+            if self._task is None or self._pid != os.getpid():
+                raise asyncio.QueueFull
+            voce = (log, stat, self._annota(log, stat))
+            self._coda.put_nowait(voce)
+        except asyncio.QueueFull:
+            logger.error("Coda di scrittura piena, record salvato su disco")
+            self._salva_su_disco([voce])
+
+    async def _preleva_batch_async(self) -> list:
+        '''Come _preleva_batch, con le attese sull'event loop'''
+        try:
+            batch = [await asyncio.wait_for(self._coda.get(), self.intervallo)]
+        except TimeoutError:
+            return []
+        scadenza = time.monotonic() + self.intervallo
+        while len(batch) < self.dimensione_batch:
+            rimanente = scadenza - time.monotonic()
+            try:
+                batch.append(await asyncio.wait_for(self._coda.get(), rimanente) if rimanente > 0 else self._coda.get_nowait())
+            except (TimeoutError, asyncio.QueueEmpty):
+                break
+        return batch
+
+    async def _ciclo_async(self):
+        while not (self._stop.is_set() and self._coda.empty()):
+            batch = await self._preleva_batch_async()
+            if batch and await self.magazziniere_async.insert_batch([voce[0] for voce in batch], [voce[1] for voce in batch]):
+                self._completati(batch)
+            elif batch:
+                self._salva_su_disco(batch)
+                self._ultimo_recupero = time.monotonic()
+                continue
+            if time.monotonic() - self._ultimo_recupero > INTERVALLO_RECUPERO:
+                self._ultimo_recupero = time.monotonic()
+                try:
+                    await asyncio.to_thread(self.recupera_spill)
+                except Exception as e:
+                    logger.error("Errore nel recupero dei file di spill: %s", str(e))
+
+    async def chiudi_async(self, timeout:float = 10):
+        '''Svuota la coda sul database (o su disco) e ferma il task: da richiamare alla chiusura dell'applicazione'''
+        if self._task is None:
+            return
+        self._stop.set()
+        try:
+            await asyncio.wait_for(self._task, timeout)
+        except TimeoutError:
+            pass # task cancellato da wait_for: i record rimasti vanno su disco
+        rimasti = []
+        while not self._coda.empty():
+            rimasti.append(self._coda.get_nowait())
+        if rimasti:
+            self._salva_su_disco(rimasti)
+        self._chiudi_giornale()
+        self._task = None
@@ -1,13 +1,18 @@
 '''Modulo Python contenente classi e metodi per l'interazione con il database gestionale ed il databse di logs e statistiche'''
 
-from sqlalchemy import create_engine, Integer, CHAR, String, Date, DateTime, ForeignKey, select, insert
+from sqlalchemy import create_engine, event, Engine, Integer, CHAR, String, Date, DateTime, ForeignKey, Index, select, insert, func, literal
 from sqlalchemy.orm import DeclarativeBase, Session, Mapped, mapped_column
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.types import TypeDecorator
-from sqlalchemy.dialects.mysql import BINARY
-from typing import Optional
-from datetime import date, datetime
+from sqlalchemy.dialects.mysql import BINARY, insert as mysql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from typing import Callable, Optional, NamedTuple
+from datetime import date, datetime, timezone
+from collections import Counter
+from metriche import cronometrato
 import uuid
 import logging
+import os, threading, time
 from sys import stdout
 
 # Impostazione di Logging per stampare eventuali eccezioni nei Docker Logs
@@ -18,12 +23,148 @@ handler.setFormatter(formatter)
 logger.addHandler(handler)
 logger.setLevel(logging.ERROR)
 
+# Parametri del pool di connessioni, uno per ogni database e per ogni worker di Gunicorn.
+# Il default di POOL_SIZE corrisponde ai threads per worker impostati in gunicorn.conf.py
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "2"))
+POOL_MAX_OVERFLOW = int(os.getenv("DB_POOL_MAX_OVERFLOW", "2"))
+POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))     # secondi di attesa massima per una connessione libera
+POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))     # secondi dopo cui una connessione viene riaperta
+POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "1") == "1"    # verifica la connessione prima di usarla
+# Solo per i test in locale su SQLite: secondi di attesa aggiunti ad ogni interrogazione, per simulare
+# un database remoto lento (es. il Gestionale) nei benchmark
+DB_LATENZA_SIMULATA = float(os.getenv("DB_LATENZA_SIMULATA", "0"))
+
+# Modalità di scrittura delle statistiche:
+# - "righe": una riga della tabella Statistiche per ogni ingresso (aggregate ogni notte dall'evento RollupStatistiche)
+# - "aggregate": incremento diretto dei contatori della tabella StatisticheAggregate
+MODALITA_STATISTICHE = os.getenv("STATISTICHE_MODALITA", "righe")
+
+class PoolCronometrato(QueuePool):
+    '''
+    QueuePool (https://docs.sqlalchemy.org/en/20/core/pooling.html) che misura quanto tempo le richieste
+    attendono per ottenere una connessione dal pool. Attese lunghe indicano che workers/threads
+    in gunicorn.conf.py sono sovradimensionati rispetto al pool (o viceversa)
+    '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._lock_attese = threading.Lock()
+        self.attese = 0
+        self.attesa_totale = 0.0
+        self.attesa_massima = 0.0
+
+    def _do_get(self):
+        inizio = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            attesa = time.perf_counter() - inizio
+            with self._lock_attese:
+                self.attese += 1
+                self.attesa_totale += attesa
+                self.attesa_massima = max(self.attesa_massima, attesa)
+
+# Registro degli engine del processo corrente, indicizzati per URI del database.
+# Gli engine (ed i relativi pool) non devono essere condivisi tra processi: dopo una fork
+# i figli scartano quelli ereditati e ne creano di nuovi al primo utilizzo.
+_ENGINES: dict[str, Engine] = {}
+_PID_ENGINES = os.getpid()
+_LOCK_ENGINES = threading.Lock()
+
+def reset_engine_dopo_fork():
+    '''
+        Funzione da richiamare nel processo figlio dopo una fork (hook post_fork di Gunicorn).
+        Abbandona gli engine ereditati senza chiudere le connessioni, che appartengono al padre:
+        https://docs.sqlalchemy.org/en/20/core/pooling.html#using-connection-pools-with-multiprocessing-or-os-fork
+    '''
+    global _PID_ENGINES
+    with _LOCK_ENGINES:
+        for engine in _ENGINES.values():
+            engine.dispose(close=False)
+        _ENGINES.clear()
+        _PID_ENGINES = os.getpid()
+
+def chiudi_engine():
+    '''
+        Funzione che chiude le connessioni degli engine del processo corrente. Con preload_app il master
+        di Gunicorn la richiama prima di creare i workers, per non tenere aperte connessioni inutilizzate
+    '''
+    with _LOCK_ENGINES:
+        for engine in _ENGINES.values():
+            engine.dispose()
+        _ENGINES.clear()
+
+def imposta_latenza_simulata(engine, latenza:float | Callable[[], float] = DB_LATENZA_SIMULATA):
+    '''
+        Funzione che, per un engine SQLite (sincrono o asincrono), aggiunge la latenza indicata ad ogni
+        interrogazione (SELECT). L'attesa avviene nel thread che esegue l'istruzione su SQLite, come
+        l'attesa della risposta di un database remoto. Le scritture sono escluse: SQLite le richiama
+        per ogni riga di un INSERT multi-riga, tenendo il database bloccato per gli altri processi.
+        latenza può essere anche una funzione richiamata ad ogni interrogazione (es. latenze casuali
+        con code lunghe per le repliche simulate di bench_repliche.py).
+    '''
+    if engine.dialect.name != "sqlite" or (not callable(latenza) and latenza <= 0):
+        return
+    def attendi(istruzione:str):
+        if istruzione.lstrip()[:6].upper() == "SELECT":
+            time.sleep(latenza() if callable(latenza) else latenza)
+    @event.listens_for(engine.sync_engine if hasattr(engine, "sync_engine") else engine, "connect")
+    def connessione(dbapi_connection, record):
+        if hasattr(dbapi_connection, "await_"): # aiosqlite: la connessione sqlite3 vive nel thread del driver
+            dbapi_connection.await_(dbapi_connection.driver_connection.set_trace_callback(attendi))
+        else:
+            dbapi_connection.set_trace_callback(attendi)
+
+def ottieni_engine(database_uri:str) -> Engine:
+    '''Funzione che restituisce l'engine del processo corrente per l'URI indicato, creandolo se necessario'''
+    if _PID_ENGINES != os.getpid():
+        reset_engine_dopo_fork()
+    engine = _ENGINES.get(database_uri)
+    if engine is None:
+        with _LOCK_ENGINES:
+            engine = _ENGINES.get(database_uri)
+            if engine is None:
+                # creazione dell'engine, la "Fabbrica" che crea le comunicazioni con il DB
+                # https://docs.sqlalchemy.org/en/20/orm/quickstart.html#create-an-engine
+                engine = create_engine(database_uri, echo=False,
+                                       poolclass=PoolCronometrato,
+                                       pool_size=POOL_SIZE,
+                                       max_overflow=POOL_MAX_OVERFLOW,
+                                       pool_timeout=POOL_TIMEOUT,
+                                       pool_recycle=POOL_RECYCLE,
+                                       pool_pre_ping=POOL_PRE_PING)
+                imposta_latenza_simulata(engine)
+                _ENGINES[database_uri] = engine
+    return engine
+
+def statistiche_pool() -> dict:
+    '''
+        Funzione che restituisce, per ogni engine del processo corrente, lo stato del pool ed i tempi
+        di attesa per ottenere una connessione. Le URI sono riportate senza password.
+    '''
+    statistiche = {}
+    for engine in list(_ENGINES.values()):
+        pool = engine.pool
+        if not isinstance(pool, PoolCronometrato):
+            continue
+        statistiche[engine.url.render_as_string(hide_password=True)] = {
+            "dimensione": pool.size(),
+            "in_uso": pool.checkedout(),
+            "overflow": pool.overflow(),
+            "attese": pool.attese,
+            "attesa_media": pool.attesa_totale / pool.attese if pool.attese else 0.0,
+            "attesa_massima": pool.attesa_massima}
+    return statistiche
+
 class DB_handler:
     """Classe base per l'interazione con un database generico"""
     def __init__(self,database_uri:str):
-        # creazione dell'engine, la "Fabbrica" che crea le comunicazioni con il DB
-        # https://docs.sqlalchemy.org/en/20/orm/quickstart.html#create-an-engine
-        self.engine = create_engine(database_uri, echo=False)
+        self.database_uri = database_uri
+
+    @property
+    def engine(self) -> Engine:
+        # L'engine non viene salvato nell'istanza: viene preso dal registro del processo, in modo
+        # da riutilizzare lo stesso pool di connessioni in tutte le richieste servite dal worker
+        return ottieni_engine(self.database_uri)
 
 class Base (DeclarativeBase):
     '''Classe base per i template di tabelle: https://docs.sqlalchemy.org/en/20/tutorial/metadata.html'''
@@ -51,11 +192,17 @@ class LogsAndStats(DB_handler):
         '''Mapped Class per interagire con la tabella dei logs'''
         __tablename__ = 'Logs'
 
+        # Su MySQL la tabella è partizionata per giorno, con chiave primaria (Id, Timestamp): vedi db/init/01-init.sql.
+        # IdxLogsSmartCardTimestamp è univoco: un passaggio reinviato (tornello offline, retry, recupero
+        # della coda di scrittura) non viene registrato due volte
         id: Mapped[int] = mapped_column("Id", Integer, primary_key=True, autoincrement=True)
-        smart_card_id: Mapped[str] = mapped_column("SmartCardId", String(1000))
+        smart_card_id: Mapped[str] = mapped_column("SmartCardId", CHAR(344))
         palestra_id: Mapped[int] = mapped_column("PalestraId", Integer)
         timestamp: Mapped[datetime] = mapped_column("Timestamp", DateTime)
 
+        __table_args__ = (Index("IdxLogsSmartCardTimestamp", "SmartCardId", "Timestamp", "PalestraId", unique=True),
+                          Index("IdxLogsPalestraTimestamp", "PalestraId", "Timestamp"))
+
         def __repr__(self) -> str:
             return f"<Log(id={self.id}, smart_card_id={self.smart_card_id}, palestra_id={self.palestra_id}, timestamp='{self.timestamp}')>"
     
@@ -75,14 +222,37 @@ class LogsAndStats(DB_handler):
             return f"<Stat(id={self.id}, sesso={self.sesso}, fascia_eta='{self.fascia_eta}', palestra_id='{self.palestra_id}'" \
                 f", data_ingresso={self.data_ingresso}, fascia_oraria='{self.fascia_oraria}')>"
     
+    class StatAggregata(Base):
+        '''
+        Mapped Class per interagire con la tabella delle statistiche aggregate: un contatore di ingressi
+        per ogni combinazione di giorno, palestra, fascia oraria, fascia di età e sesso
+        '''
+        __tablename__ = 'StatisticheAggregate'
+
+        data_ingresso: Mapped[date] = mapped_column("DataIngresso", Date, primary_key=True)
+        palestra_id: Mapped[int] = mapped_column("PalestraId", Integer, primary_key=True)
+        fascia_oraria: Mapped[str] = mapped_column("FasciaOraria", String(20), primary_key=True)
+        fascia_eta: Mapped[str] = mapped_column("FasciaEta", String(20), primary_key=True)
+        sesso: Mapped[str] = mapped_column("Sesso", CHAR(1), primary_key=True) # '' se non specificato
+        ingressi: Mapped[int] = mapped_column("Ingressi", Integer, default=0)
+
+        def __repr__(self) -> str:
+            return f"<StatAggregata(data_ingresso={self.data_ingresso}, palestra_id={self.palestra_id}, fascia_oraria='{self.fascia_oraria}'" \
+                f", fascia_eta='{self.fascia_eta}', sesso='{self.sesso}', ingressi={self.ingressi})>"
+
+    def __init__(self, database_uri:str, modalita_statistiche:str = MODALITA_STATISTICHE):
+        super().__init__(database_uri)
+        self.modalita_statistiche = modalita_statistiche
+
+    @cronometrato("worldfit_db_secondi", classe="LogsAndStats")
     def insert_log(self, smart_card_id:str, palestra_id:int, timestamp:datetime):
-        """Funzione per scrittura nella tabella 'Logs' del database"""
+        """Funzione per scrittura nella tabella 'Logs' del database (ignorata se il passaggio è già registrato)"""
         with self.engine.connect() as connection:
             try:
-                stmt = insert(self.Log).values(
-                    smart_card_id = smart_card_id,
-                    palestra_id = palestra_id,
-                    timestamp=timestamp)
+                stmt = self.stmt_insert_logs(connection.dialect.name, [{
+                    "smart_card_id": smart_card_id,
+                    "palestra_id": palestra_id,
+                    "timestamp": self.timestamp_log(timestamp)}])
                 connection.execute(stmt)
                 connection.commit()
                 logger.debug("Scrittura Tabella Log avvenuta con successo")
@@ -90,8 +260,13 @@ class LogsAndStats(DB_handler):
             except Exception as e:
                 logger.error("Errore durante l'inserimento riga in tabella Log: %s", str(e))
     
+    @cronometrato("worldfit_db_secondi", classe="LogsAndStats")
     def insert_stats(self, sesso:str, fascia_eta:str, palestra_id:int, data_ingresso:date, fascia_oraria:str):
-        """Funzione per scrittura nella tabella 'Statistiche' del database"""
+        """Funzione per scrittura nella tabella 'Statistiche' del database (o dei contatori aggregati)"""
+        if self.modalita_statistiche == "aggregate":
+            self.insert_batch([], [{"sesso": sesso, "fascia_eta": fascia_eta, "palestra_id": palestra_id,
+                                    "data_ingresso": data_ingresso, "fascia_oraria": fascia_oraria}])
+            return
         with self.engine.connect() as connection:
             try:
                 stmt = insert(self.Stat).values(
@@ -107,6 +282,112 @@ class LogsAndStats(DB_handler):
             except Exception as e:
                 logger.error("Errore durante l'inserimento riga in tabella Statistiche: %s", str(e))
 
+    @cronometrato("worldfit_db_secondi", classe="LogsAndStats")
+    def insert_batch(self, logs:list[dict], stats:list[dict]) -> bool:
+        """
+            Funzione per la scrittura di più righe nelle tabelle 'Logs' e 'Statistiche' con INSERT
+            multi-riga in un'unica transazione. I dizionari hanno come chiavi i parametri di insert_log
+            ed insert_stats; se logs non è vuota stats[i] è la statistica dell'ingresso logs[i].
+            I passaggi già registrati o ripetuti nel batch vengono scartati insieme alla loro statistica.
+            Restituisce False se la transazione è fallita (nessuna riga scritta).
+        """
+        try:
+            logs, stats = self.prepara_logs(logs, stats)
+            with Session(self.engine) as session, session.begin():
+                if logs:
+                    logs, stats = self._inserisci_logs(session, logs, stats)
+                if stats and self.modalita_statistiche == "aggregate":
+                    self._incrementa_aggregate(session, stats)
+                elif stats:
+                    # INSERT "bulk" ORM: https://docs.sqlalchemy.org/en/20/orm/queryguide/dml.html#orm-bulk-insert-statements
+                    session.execute(insert(self.Stat), stats)
+            logger.debug("Scrittura di %s Log e %s Statistiche avvenuta con successo", len(logs), len(stats))
+            return True
+        except Exception as e:
+            logger.error("Errore durante l'inserimento di un batch di Log e Statistiche: %s", str(e))
+            return False
+
+    def _inserisci_logs(self, session:Session, logs:list[dict], stats:list[dict]) -> tuple[list, list]:
+        '''
+            Scrive i Log con un INSERT multi-riga che ignora i passaggi già registrati e restituisce i Log
+            scritti con le loro statistiche. Se qualche passaggio è stato ignorato (un reinvio) l'INSERT
+            viene annullato e ripetuto riga per riga, per sapere quali statistiche scartare
+        '''
+        dialetto = session.get_bind().dialect.name
+        if len(logs) > 1:
+            savepoint = session.begin_nested()
+            if session.execute(self.stmt_insert_logs(dialetto, logs)).rowcount == len(logs):
+                savepoint.commit()
+                return logs, stats
+            savepoint.rollback()
+        scritti = [session.execute(self.stmt_insert_logs(dialetto, [log])).rowcount == 1 for log in logs]
+        return self.seleziona_scritti(logs, stats, scritti)
+
+    @staticmethod
+    def timestamp_log(timestamp:datetime) -> datetime:
+        '''Timestamp come viene salvato in Logs: UTC senza fuso orario, al secondo (la precisione della colonna)'''
+        if timestamp.tzinfo is not None:
+            timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+        return timestamp.replace(microsecond=0)
+
+    @classmethod
+    def prepara_logs(cls, logs:list[dict], stats:list[dict]) -> tuple[list, list]:
+        '''
+            Normalizza i timestamp dei Log di un batch con timestamp_log e scarta i passaggi ripetuti
+            (stessa SmartCard, palestra e secondo) insieme alla loro statistica (condiviso con la modalità asincrona)
+        '''
+        logs = [{**log, "timestamp": cls.timestamp_log(log["timestamp"])} for log in logs]
+        visti = set()
+        nuovi = []
+        for log in logs:
+            chiave = (log["smart_card_id"], log["palestra_id"], log["timestamp"])
+            nuovi.append(chiave not in visti)
+            visti.add(chiave)
+        return cls.seleziona_scritti(logs, stats, nuovi)
+
+    @staticmethod
+    def seleziona_scritti(logs:list[dict], stats:list[dict], scelti:list[bool]) -> tuple[list, list]:
+        '''Tiene i Log indicati da scelti e, se allineate ai Log, le loro statistiche'''
+        if len(stats) == len(logs):
+            stats = [stat for stat, scelto in zip(stats, scelti) if scelto]
+        return [log for log, scelto in zip(logs, scelti) if scelto], stats
+
+    @classmethod
+    def stmt_insert_logs(cls, dialetto:str, logs:list[dict]):
+        '''
+            INSERT multi-riga in Logs che ignora i passaggi già registrati (indice univoco
+            IdxLogsSmartCardTimestamp): il numero di righe scritte dice se qualcuno è stato ignorato
+        '''
+        return insert(cls.Log).prefix_with("OR IGNORE" if dialetto == "sqlite" else "IGNORE").values(logs)
+
+    def _incrementa_aggregate(self, session:Session, stats:list[dict]):
+        '''
+            Modalità "aggregate" di STATISTICHE_MODALITA: le statistiche prodotte dall'anonimizzatore non
+            vengono scritte come righe di Statistiche (una per ingresso) ma sommate ai contatori di
+            StatisticheAggregate, uno per giorno e combinazione di dimensioni. Le statistiche del batch
+            vengono prima contate per combinazione ed i contatori incrementati con un unico upsert multi-riga.
+            La soglia sui gruppi con pochi ingressi non è applicata qui ma in lettura (vista
+            StatisticheKAnonime e report.py).
+        '''
+        session.execute(self.stmt_incrementa_aggregate(session.get_bind().dialect.name, stats))
+
+    @classmethod
+    def stmt_incrementa_aggregate(cls, dialetto:str, stats:list[dict]):
+        '''Costruisce l'upsert di _incrementa_aggregate per il dialetto indicato (condiviso con la modalità asincrona)'''
+        conteggi = Counter((stat["data_ingresso"], stat["palestra_id"], stat["fascia_oraria"],
+                            stat["fascia_eta"], stat["sesso"] or "") for stat in stats)
+        # Chiavi in ordine per ridurre il rischio di deadlock tra upsert concorrenti di più workers
+        righe = [{"data_ingresso": chiave[0], "palestra_id": chiave[1], "fascia_oraria": chiave[2],
+                  "fascia_eta": chiave[3], "sesso": chiave[4], "ingressi": ingressi}
+                 for chiave, ingressi in sorted(conteggi.items())]
+        if dialetto == "mysql":
+            stmt = mysql_insert(cls.StatAggregata).values(righe)
+            return stmt.on_duplicate_key_update(Ingressi=cls.StatAggregata.ingressi + stmt.inserted.Ingressi)
+        # SQLite, per i test in locale
+        stmt = sqlite_insert(cls.StatAggregata).values(righe)
+        return stmt.on_conflict_do_update(index_elements=[colonna.name for colonna in cls.StatAggregata.__table__.primary_key],
+                                          set_={"Ingressi": cls.StatAggregata.ingressi + stmt.excluded.Ingressi})
+
 class Gestionale(DB_handler):
     '''Classe specifica per interagire con il DB Gestionale'''
 
@@ -126,6 +407,9 @@ class Gestionale(DB_handler):
         stato_residenza: Mapped[Optional[str]] = mapped_column("StatoResidenza", String(1000))
         smart_card_id: Mapped[Optional[str]] = mapped_column("SmartCardId", String(1000))
 
+        # Indice consigliato per la ricerca per SmartCardId (vedi db/gestionale/indici_consigliati.sql)
+        __table_args__ = (Index("IdxClientiSmartCardId", "SmartCardId", mysql_length=32),)
+
         def __repr__(self) -> str:
             return f"<Cliente(id={self.id}, cognome='{self.cognome}', nome='{self.nome}', sesso={self.sesso}, data_nascita={self.data_nascita}" \
                 f", luogo_nascita='{self.luogo_nascita}', stato_nascita='{self.stato_nascita}', indirizzo_residenza='{self.indirizzo_residenza}'" \
@@ -140,6 +424,9 @@ class Gestionale(DB_handler):
         valido_dal: Mapped[date] = mapped_column("ValidoDal", Date)
         valido_al: Mapped[date] = mapped_column("ValidoAl", Date)
 
+        # Indice consigliato per la verifica della validità degli abbonamenti di un cliente
+        __table_args__ = (Index("IdxAbbonamentiClienteValidita", "IdCliente", "ValidoDal", "ValidoAl"),)
+
         def __repr__(self) -> str:
             return f"<Abbonamento(id={self.id}, id_cliente={self.id_cliente}, valido_dal={self.valido_dal}, valido_al={self.valido_al})>"
 
@@ -155,7 +442,130 @@ class Gestionale(DB_handler):
 
         def __repr__(self) -> str:
             return f"<Palestra(id={self.id}, nome='{self.nome}', indirizzo='{self.indirizzo}', luogo='{self.luogo}', stato='{self.stato}')>"
-        
+
+    class DatiCliente(NamedTuple):
+        '''Sottoinsieme dei campi di un Cliente necessari all'anonimizzatore'''
+        id: int
+        sesso: Optional[str]
+        data_nascita: Optional[date]
+
+    class DatiPalestra(NamedTuple):
+        '''Sottoinsieme dei campi di una Palestra necessari all'anonimizzatore'''
+        id: int
+        stato: Optional[str]
+
+    class EsitoAccesso(NamedTuple):
+        '''
+        Risultato della verifica di un accesso: cliente e palestra sono None se non esistono,
+        scadenza è la data di fine dell'abbonamento valido (None se non ce ne sono di validi)
+        '''
+        cliente: Optional["Gestionale.DatiCliente"]
+        palestra: Optional["Gestionale.DatiPalestra"]
+        scadenza: Optional[date]
+
+    @cronometrato("worldfit_db_secondi", classe="Gestionale")
+    def verifica_accesso(self, smart_card_id:str, palestra_id:int, giorno:date) -> EsitoAccesso:
+        '''
+            Funzione che con una sola interrogazione verifica l'esistenza della palestra e del cliente
+            associato alla SmartCardID e cerca un abbonamento valido nel giorno indicato
+            (ValidoDal < giorno < ValidoAl). Restituisce None in caso di errore del DB Gestionale.
+        '''
+        try:
+            with self.engine.connect() as connection:
+                return self.esito_accesso(connection.execute(self.stmt_verifica_accesso(smart_card_id, palestra_id, giorno)).one())
+        except Exception as e:
+            logger.error("Errore nella verifica di un accesso sul DB Gestionale: %s", str(e))
+
+    @classmethod
+    def stmt_verifica_accesso(cls, smart_card_id:str, palestra_id:int, giorno:date):
+        '''Costruisce l'interrogazione di verifica_accesso (condivisa con la modalità asincrona)'''
+        # Subquery correlata al cliente: fine dell'abbonamento valido più lungo nel giorno indicato
+        scadenza = select(func.max(cls.Abbonamento.valido_al)).where(
+            cls.Abbonamento.id_cliente == cls.Cliente.id,
+            cls.Abbonamento.valido_dal < giorno,
+            cls.Abbonamento.valido_al > giorno).scalar_subquery()
+
+        # Cliente e palestra sono in LEFT JOIN su una riga fittizia, in modo da ottenere sempre
+        # una riga e distinguere un cliente inesistente da una palestra inesistente
+        riga = select(literal(1).label("riga")).subquery()
+        return select(
+            cls.Cliente.id.label("cliente_id"), cls.Cliente.sesso.label("sesso"),
+            cls.Cliente.data_nascita.label("data_nascita"),
+            cls.Palestra.id.label("palestra_id"), cls.Palestra.stato.label("stato"),
+            scadenza.label("scadenza")
+            ).select_from(riga
+            ).outerjoin(cls.Cliente, cls.Cliente.smart_card_id == smart_card_id
+            ).outerjoin(cls.Palestra, cls.Palestra.id == palestra_id
+            ).limit(1)
+
+    @classmethod
+    def esito_accesso(cls, risultato) -> EsitoAccesso:
+        '''Converte la riga restituita da stmt_verifica_accesso in un EsitoAccesso'''
+        cliente = None
+        if risultato.cliente_id is not None:
+            cliente = cls.DatiCliente(risultato.cliente_id, risultato.sesso, risultato.data_nascita)
+        palestra = None
+        if risultato.palestra_id is not None:
+            palestra = cls.DatiPalestra(risultato.palestra_id, risultato.stato)
+        return cls.EsitoAccesso(cliente, palestra, risultato.scadenza)
+
+    @cronometrato("worldfit_db_secondi", classe="Gestionale")
+    def verifica_accessi(self, richieste:list) -> list:
+        '''
+            Versione di verifica_accesso per un lotto di richieste, con una interrogazione per tabella invece
+            che una per richiesta. richieste è una lista di tuple (smart_card_id, palestra_id, giorno);
+            restituisce la lista degli EsitoAccesso nello stesso ordine, None in caso di errore del DB Gestionale.
+        '''
+        try:
+            with self.engine.connect() as connection:
+                righe = [connection.execute(stmt).all() for stmt in self.stmt_verifica_accessi(richieste)]
+            return self.esiti_accessi(richieste, *righe)
+        except Exception as e:
+            logger.error("Errore nella verifica di un lotto di accessi sul DB Gestionale: %s", str(e))
+
+    @classmethod
+    def stmt_verifica_accessi(cls, richieste:list) -> tuple:
+        '''
+            Costruisce le tre interrogazioni indipendenti di verifica_accessi (clienti, palestre ed abbonamenti),
+            che la modalità asincrona esegue in parallelo
+        '''
+        smart_card_ids = {smart_card_id for smart_card_id, _, _ in richieste}
+        palestra_ids = {palestra_id for _, palestra_id, _ in richieste}
+        giorni = [giorno for _, _, giorno in richieste]
+        clienti = select(cls.Cliente.smart_card_id, cls.Cliente.id, cls.Cliente.sesso,
+                         cls.Cliente.data_nascita).where(cls.Cliente.smart_card_id.in_(smart_card_ids))
+        palestre = select(cls.Palestra.id, cls.Palestra.stato).where(cls.Palestra.id.in_(palestra_ids))
+        # Abbonamenti dei clienti delle SmartCard che si sovrappongono all'intervallo dei giorni richiesti
+        abbonamenti = select(cls.Abbonamento.id_cliente, cls.Abbonamento.valido_dal, cls.Abbonamento.valido_al).join(
+            cls.Cliente, cls.Cliente.id == cls.Abbonamento.id_cliente).where(
+            cls.Cliente.smart_card_id.in_(smart_card_ids),
+            cls.Abbonamento.valido_dal < max(giorni),
+            cls.Abbonamento.valido_al > min(giorni))
+        return clienti, palestre, abbonamenti
+
+    @classmethod
+    def esiti_accessi(cls, richieste:list, righe_clienti, righe_palestre, righe_abbonamenti) -> list:
+        '''Calcola gli EsitoAccesso delle richieste dalle righe restituite da stmt_verifica_accessi'''
+        clienti, abbonamenti = {}, {}
+        for riga in righe_clienti:
+            # come in verifica_accesso viene considerato un solo cliente per SmartCardID
+            clienti.setdefault(riga[0], cls.DatiCliente(*riga[1:]))
+        palestre = {riga[0]: cls.DatiPalestra(*riga) for riga in righe_palestre}
+        for id_cliente, valido_dal, valido_al in righe_abbonamenti:
+            abbonamenti.setdefault(id_cliente, []).append((valido_dal, valido_al))
+
+        esiti = []
+        for smart_card_id, palestra_id, giorno in richieste:
+            cliente = clienti.get(smart_card_id)
+            scadenza = None
+            if cliente is not None:
+                # stessa regola di verifica_accesso: ValidoDal < giorno < ValidoAl, fine più lontana
+                scadenza = max((valido_al for valido_dal, valido_al in abbonamenti.get(cliente.id, ())
+                                if valido_dal < giorno < valido_al), default=None)
+            esiti.append(cls.EsitoAccesso(cliente, palestre.get(palestra_id), scadenza))
+        return esiti
+
+    @cronometrato("worldfit_db_secondi", classe="Gestionale")
     def select_client(self, smart_card_id:str) -> Cliente:
         '''Funzione che data una SmartCardID, restituisce il primo oggetto Cliente corrispondente'''
         try:
@@ -165,6 +575,7 @@ class Gestionale(DB_handler):
         except Exception as e:
             logger.error("Errore nel recupero di un Cliente dal DB Gestionale: %s", str(e))
 
+    @cronometrato("worldfit_db_secondi", classe="Gestionale")
     def select_abbonamenti(self, id_cliente:str) -> list:
         '''Funzione che dato un ID della tabella dei Clienti, recupera una lista di abbonamenti ad esso associati'''
         try:
@@ -174,6 +585,7 @@ class Gestionale(DB_handler):
         except Exception as e:
             logger.error("Errore nel recupero degli abbonamenti dal DB Gestionale: %s", str(e))
 
+    @cronometrato("worldfit_db_secondi", classe="Gestionale")
     def select_palestra(self, palestra_id:str) -> Palestra:
         '''Funzione che dato un ID di una palestra, restituisce il primo oggetto palestra corrispondente'''
         try:
@@ -181,4 +593,44 @@ class Gestionale(DB_handler):
                 stmt = select(self.Palestra).where(self.Palestra.id == palestra_id)
                 return session.scalar(stmt)
         except Exception as e:
-            logger.error("Errore nel recupero di una Palestra dal DB Gestionale: %s", str(e))
\ No newline at end of file
+            logger.error("Errore nel recupero di una Palestra dal DB Gestionale: %s", str(e))
+
+    @cronometrato("worldfit_db_secondi", classe="Gestionale")
+    def select_palestre(self) -> list:
+        '''Funzione che restituisce tutte le palestre, usata per caricare il RegistroPalestre'''
+        try:
+            with Session(self.engine) as session:
+                return session.execute(select(self.Palestra.id, self.Palestra.luogo, self.Palestra.stato)).all()
+        except Exception as e:
+            logger.error("Errore nel recupero delle Palestre dal DB Gestionale: %s", str(e))
+
+    @cronometrato("worldfit_db_secondi", classe="Gestionale")
+    def select_smartcard_attive(self, giorno:date) -> list:
+        '''Funzione che restituisce le SmartCardID dei clienti con un abbonamento valido nel giorno indicato'''
+        try:
+            with Session(self.engine) as session:
+                stmt = select(self.Cliente.smart_card_id).distinct().join(
+                    self.Abbonamento, self.Abbonamento.id_cliente == self.Cliente.id).where(
+                    self.Abbonamento.valido_dal < giorno,
+                    self.Abbonamento.valido_al > giorno,
+                    self.Cliente.smart_card_id.is_not(None))
+                return session.scalars(stmt).all()
+        except Exception as e:
+            logger.error("Errore nel recupero delle SmartCard attive dal DB Gestionale: %s", str(e))
+
+    @cronometrato("worldfit_db_secondi", classe="Gestionale")
+    def select_scadenze_attive(self, giorno:date) -> list:
+        '''
+            Funzione che restituisce le coppie (SmartCardID, scadenza) dei clienti con un abbonamento valido nel
+            giorno indicato, con la stessa regola di verifica_accesso (fine dell'abbonamento valido più lungo)
+        '''
+        try:
+            with Session(self.engine) as session:
+                stmt = select(self.Cliente.smart_card_id, func.max(self.Abbonamento.valido_al)).join(
+                    self.Abbonamento, self.Abbonamento.id_cliente == self.Cliente.id).where(
+                    self.Abbonamento.valido_dal < giorno,
+                    self.Abbonamento.valido_al > giorno,
+                    self.Cliente.smart_card_id.is_not(None)).group_by(self.Cliente.smart_card_id)
+                return session.execute(stmt).all()
+        except Exception as e:
+            logger.error("Errore nel recupero delle scadenze delle SmartCard attive dal DB Gestionale: %s", str(e))
@@ -0,0 +1,155 @@
+'''
+Modulo Python contenente le versioni asincrone (asyncio) dei metodi di db_handler usati per servire i tornelli,
+per la modalità di servizio ASGI (vedi api_async.py). Le interrogazioni e le mapped classes sono quelle di
+Gestionale e LogsAndStats; cambiano solo i driver (aiomysql, aiosqlite per i test in locale) e l'esecuzione:
+mentre una richiesta attende il database, lo stesso processo continua a servirne altre. Le verifiche degli
+accessi passano da RouterRepliche (vedi repliche_gestionale.py), con la stessa scadenza della modalità sincrona.
+'''
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine, AsyncSession
+from db_handler import Gestionale, LogsAndStats, imposta_latenza_simulata, MODALITA_STATISTICHE, \
+    POOL_MAX_OVERFLOW, POOL_TIMEOUT, POOL_RECYCLE, POOL_PRE_PING
+from repliche_gestionale import RouterRepliche, con_scadenza
+from metriche import cronometrato
+from datetime import date
+from sys import stdout
+import asyncio, logging, os
+
+# Impostazione di Logging per stampare eventuali eccezioni nei Docker Logs
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler(stdout)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+logger.setLevel(logging.ERROR)
+
+# Connessioni per database e per worker: un worker asincrono serve molte più richieste contemporanee
+# di un worker sincrono (2 threads), quindi il pool è più grande di quello di db_handler
+POOL_SIZE_ASYNC = int(os.getenv("DB_POOL_SIZE_ASYNC", "10"))
+
+# Driver asincrono corrispondente a quello sincrono indicato negli URI
+DRIVER_ASINCRONI = {"mysql+pymysql": "mysql+aiomysql", "mysql": "mysql+aiomysql", "sqlite": "sqlite+aiosqlite"}
+
+# Registro degli engine asincroni del processo corrente, come _ENGINES in db_handler. Gli engine
+# sono legati all'event loop in cui vengono usati la prima volta: uno per worker di Uvicorn.
+_ENGINES_ASYNC: dict[str, AsyncEngine] = {}
+_PID_ENGINES_ASYNC = os.getpid()
+
+def uri_asincrono(database_uri:str) -> str:
+    '''Funzione che converte un URI con driver sincrono (es. mysql+pymysql://) nell'equivalente asincrono'''
+    schema, separatore, resto = database_uri.partition("://")
+    return DRIVER_ASINCRONI.get(schema, schema) + separatore + resto
+
+def ottieni_engine_async(database_uri:str) -> AsyncEngine:
+    '''Funzione che restituisce l'engine asincrono del processo corrente per l'URI indicato, creandolo se necessario'''
+    global _PID_ENGINES_ASYNC
+    if _PID_ENGINES_ASYNC != os.getpid():
+        _ENGINES_ASYNC.clear()
+        _PID_ENGINES_ASYNC = os.getpid()
+    engine = _ENGINES_ASYNC.get(database_uri)
+    if engine is None:
+        # Nessun lock: gli engine vengono creati e usati solo dal thread dell'event loop
+        # https://docs.sqlalchemy.org/en/20/orm/extensions/asyncio.html
+        engine = create_async_engine(uri_asincrono(database_uri), echo=False,
+                                     pool_size=POOL_SIZE_ASYNC,
+                                     max_overflow=POOL_MAX_OVERFLOW,
+                                     pool_timeout=POOL_TIMEOUT,
+                                     pool_recycle=POOL_RECYCLE,
+                                     pool_pre_ping=POOL_PRE_PING)
+        imposta_latenza_simulata(engine)
+        _ENGINES_ASYNC[database_uri] = engine
+    return engine
+
+async def chiudi_engine_async():
+    '''Funzione che chiude le connessioni di tutti gli engine asincroni del processo: da richiamare alla chiusura del worker'''
+    for engine in list(_ENGINES_ASYNC.values()):
+        await engine.dispose()
+    _ENGINES_ASYNC.clear()
+
+class DB_handler_async:
+    """Classe base per l'interazione asincrona con un database generico"""
+    def __init__(self, database_uri:str):
+        self.database_uri = database_uri
+
+    @property
+    def engine(self) -> AsyncEngine:
+        return ottieni_engine_async(self.database_uri)
+
+class GestionaleAsync(DB_handler_async):
+    '''
+    Versione asincrona dei metodi di Gestionale usati per verificare gli accessi. Il nodo viene scelto dal
+    router indicato (es. quello di GestionaleReplicato, per condividerne lo stato dei nodi) o da uno nuovo
+    sul solo database_uri; ogni verifica ha la scadenza del router, anche come hint MAX_EXECUTION_TIME.
+    '''
+    def __init__(self, database_uri:str, router:RouterRepliche = None):
+        super().__init__(database_uri)
+        self.router = router or RouterRepliche([database_uri])
+
+    @cronometrato("worldfit_db_secondi", classe="GestionaleAsync")
+    async def verifica_accesso(self, smart_card_id:str, palestra_id:int, giorno:date) -> Gestionale.EsitoAccesso:
+        '''Come Gestionale.verifica_accesso: una sola interrogazione, None in caso di errore o scadenza del DB Gestionale'''
+        stmt = con_scadenza(Gestionale.stmt_verifica_accesso(smart_card_id, palestra_id, giorno), self.router.deadline)
+        async def lettura(database_uri):
+            async with ottieni_engine_async(database_uri).connect() as connection:
+                return (await connection.execute(stmt)).one()
+        try:
+            return Gestionale.esito_accesso(await self.router.esegui_async(lettura))
+        except Exception as e:
+            logger.error("Errore nella verifica di un accesso sul DB Gestionale: %s", str(e))
+
+    @cronometrato("worldfit_db_secondi", classe="GestionaleAsync")
+    async def verifica_accessi(self, richieste:list) -> list:
+        '''
+            Come Gestionale.verifica_accessi, ma le interrogazioni su clienti, palestre ed abbonamenti vengono
+            eseguite in parallelo su tre connessioni: il lotto attende il Gestionale una volta sola invece di tre
+        '''
+        stmts = [con_scadenza(stmt, self.router.deadline) for stmt in Gestionale.stmt_verifica_accessi(richieste)]
+        async def lettura(database_uri):
+            engine = ottieni_engine_async(database_uri)
+            async def esegui(stmt):
+                async with engine.connect() as connection:
+                    return (await connection.execute(stmt)).all()
+            return await asyncio.gather(*(esegui(stmt) for stmt in stmts))
+        try:
+            return Gestionale.esiti_accessi(richieste, *await self.router.esegui_async(lettura))
+        except Exception as e:
+            logger.error("Errore nella verifica di un lotto di accessi sul DB Gestionale: %s", str(e))
+
+class LogsAndStatsAsync(DB_handler_async):
+    '''Versione asincrona della scrittura in batch di LogsAndStats'''
+    def __init__(self, database_uri:str, modalita_statistiche:str = MODALITA_STATISTICHE):
+        super().__init__(database_uri)
+        self.modalita_statistiche = modalita_statistiche
+
+    @cronometrato("worldfit_db_secondi", classe="LogsAndStatsAsync")
+    async def insert_batch(self, logs:list[dict], stats:list[dict]) -> bool:
+        '''
+            Come LogsAndStats.insert_batch: un'unica transazione che scarta i passaggi già registrati
+            o ripetuti con le loro statistiche, False se fallita (nessuna riga scritta)
+        '''
+        try:
+            logs, stats = LogsAndStats.prepara_logs(logs, stats)
+            async with AsyncSession(self.engine) as session, session.begin():
+                if logs:
+                    logs, stats = await self._inserisci_logs(session, logs, stats)
+                if stats and self.modalita_statistiche == "aggregate":
+                    await session.execute(LogsAndStats.stmt_incrementa_aggregate(self.engine.dialect.name, stats))
+                elif stats:
+                    await session.execute(insert(LogsAndStats.Stat), stats)
+            logger.debug("Scrittura di %s Log e %s Statistiche avvenuta con successo", len(logs), len(stats))
+            return True
+        except Exception as e:
+            logger.error("Errore durante l'inserimento di un batch di Log e Statistiche: %s", str(e))
+            return False
+
+    async def _inserisci_logs(self, session:AsyncSession, logs:list[dict], stats:list[dict]) -> tuple[list, list]:
+        '''Come LogsAndStats._inserisci_logs: INSERT multi-riga, ripetuto riga per riga se qualche passaggio è già registrato'''
+        dialetto = self.engine.dialect.name
+        if len(logs) > 1:
+            savepoint = await session.begin_nested()
+            if (await session.execute(LogsAndStats.stmt_insert_logs(dialetto, logs))).rowcount == len(logs):
+                await savepoint.commit()
+                return logs, stats
+            await savepoint.rollback()
+        scritti = [(await session.execute(LogsAndStats.stmt_insert_logs(dialetto, [log]))).rowcount == 1 for log in logs]
+        return LogsAndStats.seleziona_scritti(logs, stats, scritti)
@@ -0,0 +1,253 @@
+'''
+Tabella generata da external/genera_fusi_stati.py: non modificare a mano.
+Fuso orario (IANA) per nome dello stato in italiano, in minuscolo (babel 2.18.0, pytz 2025.2).
+'''
+FUSO_PER_STATO = {
+    'afghanistan': 'Asia/Kabul',
+    'albania': 'Europe/Tirane',
+    'algeria': 'Africa/Algiers',
+    'andorra': 'Europe/Andorra',
+    'angola': 'Africa/Luanda',
+    'anguilla': 'America/Anguilla',
+    'antartide': 'Antarctica/McMurdo',
+    'antigua e barbuda': 'America/Antigua',
+    'arabia saudita': 'Asia/Riyadh',
+    'argentina': 'America/Argentina/Buenos_Aires',
+    'armenia': 'Asia/Yerevan',
+    'aruba': 'America/Aruba',
+    'australia': 'Australia/Lord_Howe',
+    'austria': 'Europe/Vienna',
+    'azerbaigian': 'Asia/Baku',
+    'bahamas': 'America/Nassau',
+    'bahrein': 'Asia/Bahrain',
+    'bangladesh': 'Asia/Dhaka',
+    'barbados': 'America/Barbados',
+    'belgio': 'Europe/Brussels',
+    'belize': 'America/Belize',
+    'benin': 'Africa/Porto-Novo',
+    'bermuda': 'Atlantic/Bermuda',
+    'bhutan': 'Asia/Thimphu',
+    'bielorussia': 'Europe/Minsk',
+    'bolivia': 'America/La_Paz',
+    'bosnia ed erzegovina': 'Europe/Sarajevo',
+    'botswana': 'Africa/Gaborone',
+    'brasile': 'America/Noronha',
+    'brunei': 'Asia/Brunei',
+    'bulgaria': 'Europe/Sofia',
+    'burkina faso': 'Africa/Ouagadougou',
+    'burundi': 'Africa/Bujumbura',
+    'cambogia': 'Asia/Phnom_Penh',
+    'camerun': 'Africa/Douala',
+    'canada': 'America/St_Johns',
+    'capo verde': 'Atlantic/Cape_Verde',
+    'caraibi olandesi': 'America/Kralendijk',
+    'cechia': 'Europe/Prague',
+    'ciad': 'Africa/Ndjamena',
+    'cile': 'America/Santiago',
+    'cina': 'Asia/Shanghai',
+    'cipro': 'Asia/Nicosia',
+    'città del vaticano': 'Europe/Vatican',
+    'colombia': 'America/Bogota',
+    'comore': 'Indian/Comoro',
+    'congo - kinshasa': 'Africa/Kinshasa',
+    'congo-brazzaville': 'Africa/Brazzaville',
+    'corea del nord': 'Asia/Pyongyang',
+    'corea del sud': 'Asia/Seoul',
+    'costa d’avorio': 'Africa/Abidjan',
+    'costa rica': 'America/Costa_Rica',
+    'croazia': 'Europe/Zagreb',
+    'cuba': 'America/Havana',
+    'curaçao': 'America/Curacao',
+    'danimarca': 'Europe/Copenhagen',
+    'dominica': 'America/Dominica',
+    'ecuador': 'America/Guayaquil',
+    'egitto': 'Africa/Cairo',
+    'el salvador': 'America/El_Salvador',
+    'emirati arabi uniti': 'Asia/Dubai',
+    'eritrea': 'Africa/Asmara',
+    'estonia': 'Europe/Tallinn',
+    'eswatini': 'Africa/Mbabane',
+    'etiopia': 'Africa/Addis_Ababa',
+    'figi': 'Pacific/Fiji',
+    'filippine': 'Asia/Manila',
+    'finlandia': 'Europe/Helsinki',
+    'francia': 'Europe/Paris',
+    'gabon': 'Africa/Libreville',
+    'gambia': 'Africa/Banjul',
+    'georgia': 'Asia/Tbilisi',
+    'georgia del sud e sandwich australi': 'Atlantic/South_Georgia',
+    'germania': 'Europe/Berlin',
+    'ghana': 'Africa/Accra',
+    'giamaica': 'America/Jamaica',
+    'giappone': 'Asia/Tokyo',
+    'gibilterra': 'Europe/Gibraltar',
+    'gibuti': 'Africa/Djibouti',
+    'giordania': 'Asia/Amman',
+    'grecia': 'Europe/Athens',
+    'grenada': 'America/Grenada',
+    'groenlandia': 'America/Nuuk',
+    'guadalupa': 'America/Guadeloupe',
+    'guam': 'Pacific/Guam',
+    'guatemala': 'America/Guatemala',
+    'guernsey': 'Europe/Guernsey',
+    'guinea': 'Africa/Conakry',
+    'guinea equatoriale': 'Africa/Malabo',
+    'guinea-bissau': 'Africa/Bissau',
+    'guyana': 'America/Guyana',
+    'guyana francese': 'America/Cayenne',
+    'haiti': 'America/Port-au-Prince',
+    'honduras': 'America/Tegucigalpa',
+    'india': 'Asia/Kolkata',
+    'indonesia': 'Asia/Jakarta',
+    'iran': 'Asia/Tehran',
+    'iraq': 'Asia/Baghdad',
+    'irlanda': 'Europe/Dublin',
+    'islanda': 'Atlantic/Reykjavik',
+    'isola christmas': 'Indian/Christmas',
+    'isola di man': 'Europe/Isle_of_Man',
+    'isola norfolk': 'Pacific/Norfolk',
+    'isole cayman': 'America/Cayman',
+    'isole cocos (keeling)': 'Indian/Cocos',
+    'isole cook': 'Pacific/Rarotonga',
+    'isole falkland': 'Atlantic/Stanley',
+    'isole fær øer': 'Atlantic/Faroe',
+    'isole marianne settentrionali': 'Pacific/Saipan',
+    'isole marshall': 'Pacific/Majuro',
+    'isole minori esterne degli stati uniti': 'Pacific/Midway',
+    'isole pitcairn': 'Pacific/Pitcairn',
+    'isole salomone': 'Pacific/Guadalcanal',
+    'isole turks e caicos': 'America/Grand_Turk',
+    'isole vergini americane': 'America/St_Thomas',
+    'isole vergini britanniche': 'America/Tortola',
+    'isole åland': 'Europe/Mariehamn',
+    'israele': 'Asia/Jerusalem',
+    'italia': 'Europe/Rome',
+    'jersey': 'Europe/Jersey',
+    'kazakistan': 'Asia/Almaty',
+    'kenya': 'Africa/Nairobi',
+    'kirghizistan': 'Asia/Bishkek',
+    'kiribati': 'Pacific/Tarawa',
+    'kuwait': 'Asia/Kuwait',
+    'laos': 'Asia/Vientiane',
+    'lesotho': 'Africa/Maseru',
+    'lettonia': 'Europe/Riga',
+    'libano': 'Asia/Beirut',
+    'liberia': 'Africa/Monrovia',
+    'libia': 'Africa/Tripoli',
+    'liechtenstein': 'Europe/Vaduz',
+    'lituania': 'Europe/Vilnius',
+    'lussemburgo': 'Europe/Luxembourg',
+    'macedonia del nord': 'Europe/Skopje',
+    'madagascar': 'Indian/Antananarivo',
+    'malawi': 'Africa/Blantyre',
+    'malaysia': 'Asia/Kuala_Lumpur',
+    'maldive': 'Indian/Maldives',
+    'mali': 'Africa/Bamako',
+    'malta': 'Europe/Malta',
+    'marocco': 'Africa/Casablanca',
+    'martinica': 'America/Martinique',
+    'mauritania': 'Africa/Nouakchott',
+    'mauritius': 'Indian/Mauritius',
+    'mayotte': 'Indian/Mayotte',
+    'messico': 'America/Mexico_City',
+    'micronesia': 'Pacific/Chuuk',
+    'moldavia': 'Europe/Chisinau',
+    'monaco': 'Europe/Monaco',
+    'mongolia': 'Asia/Ulaanbaatar',
+    'montenegro': 'Europe/Podgorica',
+    'montserrat': 'America/Montserrat',
+    'mozambico': 'Africa/Maputo',
+    'myanmar (birmania)': 'Asia/Yangon',
+    'namibia': 'Africa/Windhoek',
+    'nauru': 'Pacific/Nauru',
+    'nepal': 'Asia/Kathmandu',
+    'nicaragua': 'America/Managua',
+    'niger': 'Africa/Niamey',
+    'nigeria': 'Africa/Lagos',
+    'niue': 'Pacific/Niue',
+    'norvegia': 'Europe/Oslo',
+    'nuova caledonia': 'Pacific/Noumea',
+    'nuova zelanda': 'Pacific/Auckland',
+    'oman': 'Asia/Muscat',
+    'paesi bassi': 'Europe/Amsterdam',
+    'pakistan': 'Asia/Karachi',
+    'palau': 'Pacific/Palau',
+    'panama': 'America/Panama',
+    'papua nuova guinea': 'Pacific/Port_Moresby',
+    'paraguay': 'America/Asuncion',
+    'perù': 'America/Lima',
+    'polinesia francese': 'Pacific/Tahiti',
+    'polonia': 'Europe/Warsaw',
+    'portogallo': 'Europe/Lisbon',
+    'portorico': 'America/Puerto_Rico',
+    'qatar': 'Asia/Qatar',
+    'ras di hong kong': 'Asia/Hong_Kong',
+    'ras di macao': 'Asia/Macau',
+    'regno unito': 'Europe/London',
+    'repubblica centrafricana': 'Africa/Bangui',
+    'repubblica dominicana': 'America/Santo_Domingo',
+    'riunione': 'Indian/Reunion',
+    'romania': 'Europe/Bucharest',
+    'ruanda': 'Africa/Kigali',
+    'russia': 'Europe/Kaliningrad',
+    'sahara occidentale': 'Africa/El_Aaiun',
+    'saint kitts e nevis': 'America/St_Kitts',
+    'saint lucia': 'America/St_Lucia',
+    'saint martin': 'America/Marigot',
+    'saint vincent e grenadine': 'America/St_Vincent',
+    'saint-barthélemy': 'America/St_Barthelemy',
+    'saint-pierre e miquelon': 'America/Miquelon',
+    'samoa': 'Pacific/Apia',
+    'samoa americane': 'Pacific/Pago_Pago',
+    'san marino': 'Europe/San_Marino',
+    'sant’elena': 'Atlantic/St_Helena',
+    'senegal': 'Africa/Dakar',
+    'serbia': 'Europe/Belgrade',
+    'seychelles': 'Indian/Mahe',
+    'sierra leone': 'Africa/Freetown',
+    'singapore': 'Asia/Singapore',
+    'sint maarten': 'America/Lower_Princes',
+    'siria': 'Asia/Damascus',
+    'slovacchia': 'Europe/Bratislava',
+    'slovenia': 'Europe/Ljubljana',
+    'somalia': 'Africa/Mogadishu',
+    'spagna': 'Europe/Madrid',
+    'sri lanka': 'Asia/Colombo',
+    'stati uniti': 'America/New_York',
+    'sud sudan': 'Africa/Juba',
+    'sudafrica': 'Africa/Johannesburg',
+    'sudan': 'Africa/Khartoum',
+    'suriname': 'America/Paramaribo',
+    'svalbard e jan mayen': 'Arctic/Longyearbyen',
+    'svezia': 'Europe/Stockholm',
+    'svizzera': 'Europe/Zurich',
+    'são tomé e príncipe': 'Africa/Sao_Tome',
+    'tagikistan': 'Asia/Dushanbe',
+    'taiwan': 'Asia/Taipei',
+    'tanzania': 'Africa/Dar_es_Salaam',
+    'terre australi francesi': 'Indian/Kerguelen',
+    'territori palestinesi': 'Asia/Gaza',
+    'territorio britannico dell’oceano indiano': 'Indian/Chagos',
+    'thailandia': 'Asia/Bangkok',
+    'timor est': 'Asia/Dili',
+    'togo': 'Africa/Lome',
+    'tokelau': 'Pacific/Fakaofo',
+    'tonga': 'Pacific/Tongatapu',
+    'trinidad e tobago': 'America/Port_of_Spain',
+    'tunisia': 'Africa/Tunis',
+    'turchia': 'Europe/Istanbul',
+    'turkmenistan': 'Asia/Ashgabat',
+    'tuvalu': 'Pacific/Funafuti',
+    'ucraina': 'Europe/Simferopol',
+    'uganda': 'Africa/Kampala',
+    'ungheria': 'Europe/Budapest',
+    'uruguay': 'America/Montevideo',
+    'uzbekistan': 'Asia/Samarkand',
+    'vanuatu': 'Pacific/Efate',
+    'venezuela': 'America/Caracas',
+    'vietnam': 'Asia/Ho_Chi_Minh',
+    'wallis e futuna': 'Pacific/Wallis',
+    'yemen': 'Asia/Aden',
+    'zambia': 'Africa/Lusaka',
+    'zimbabwe': 'Africa/Harare',
+}
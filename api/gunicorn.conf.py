@@ -1,8 +1,65 @@
-import multiprocessing
+import multiprocessing, os, gc, sys
 
 bind = "0.0.0.0:8000" # Da cambiare porta 8000 con la porta 443 a progetto finito
 workers = multiprocessing.cpu_count() * 2 + 1 # Per Gunicorn documentation: workers = (2 × CPU cores) + 1.
 threads = 2 # Threads aggiunti nel caso il DB Gestionale impieghi tempo a rispondere
 worker_tmp_dir = "/tmp"
 log_file = "-"
-control_socket_disable = True
\ No newline at end of file
+control_socket_disable = True
+# Avvio rapido dei workers: l'applicazione (moduli, segreti, chiave RSA, registro delle palestre) viene
+# caricata una sola volta nel master e condivisa con i workers in copy-on-write. Disattivabile con
+# GUNICORN_PRELOAD=0, ad es. per ricaricare il codice riavviando i soli workers (segnale HUP)
+preload_app = os.getenv("GUNICORN_PRELOAD", "1") == "1"
+
+# Il pool di connessioni di ogni worker viene dimensionato sui threads, salvo diversa configurazione
+os.environ.setdefault("DB_POOL_SIZE", str(threads))
+
+def on_starting(server):
+    '''
+    Hook eseguito nel master prima di avviare i workers: se richiesto con PSEUDONIMI_TABELLA_AVVIO=1,
+    costruisce la tabella degli pseudonimi delle Smart Card attive nel percorso PSEUDONIMI_TABELLA
+    '''
+    if os.getenv("PSEUDONIMI_TABELLA_AVVIO") == "1" and os.getenv("PSEUDONIMI_TABELLA"):
+        import tabella_pseudonimi
+        try:
+            voci = tabella_pseudonimi.costruisci_da_gestionale(os.getenv("PSEUDONIMI_TABELLA"))
+            server.log.info("Tabella degli pseudonimi costruita: %s voci", voci)
+        except Exception as e:
+            server.log.error("Costruzione della tabella degli pseudonimi fallita: %s", e)
+        # Con preload_app l'applicazione è già stata importata prima di questo hook: apre ora la tabella
+        if "api_server" in sys.modules:
+            sys.modules["api_server"].caricaTabellaPseudonimi()
+
+def when_ready(server):
+    '''
+    Hook eseguito nel master prima di creare i workers. Con preload_app chiude le connessioni aperte durante
+    il caricamento e sposta gli oggetti già creati nella generazione permanente del garbage collector: le
+    raccolte dei workers non li visitano (scrivendo nelle loro intestazioni), quindi le pagine di memoria
+    copiate dai workers sono meno (https://docs.python.org/3/library/gc.html#gc.freeze)
+    '''
+    if preload_app:
+        import db_handler
+        db_handler.chiudi_engine()
+        gc.collect()
+        gc.freeze()
+
+def post_fork(server, worker):
+    '''
+    Hook eseguito nel worker appena creato: scarta eventuali engine SQLAlchemy ereditati dal master ed avvia
+    il listener interno delle metriche (METRICHE_BIND), aperto da un solo worker alla volta
+    '''
+    import db_handler, metriche
+    db_handler.reset_engine_dopo_fork()
+    if os.getenv("METRICHE", "1") == "1":
+        metriche.avvia_servizio()
+
+def worker_exit(server, worker):
+    '''
+    Hook eseguito alla chiusura del worker: riporta i tempi di attesa sul pool di connessioni ed i contatori
+    della cache, e salva le ultime metriche del worker (che verranno spostate nell'archivio delle metriche)
+    '''
+    import db_handler, cache_tessere, metriche
+    metriche.salva_fotografia()
+    for uri, statistiche in db_handler.statistiche_pool().items():
+        server.log.info("Pool %s (worker %s): %s", uri, worker.pid, statistiche)
+    server.log.info("Cache tessere (worker %s): %s", worker.pid, cache_tessere.statistiche_cache())
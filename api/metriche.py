@@ -0,0 +1,348 @@
+'''
+Modulo Python per le metriche del percorso di accesso: istogrammi dei tempi e contatori, registrati in
+memoria da ogni worker e aggregati tra tutti i workers di Gunicorn dello stesso container.
+Ogni worker salva periodicamente una fotografia delle proprie metriche in un file della cartella
+METRICHE_DIR; chi risponde alla richiesta GET /metrics del listener interno (METRICHE_BIND, separato dalla
+porta dei tornelli e non pubblicato da docker-compose.yml) unisce i file ed espone il totale nel formato
+testuale di Prometheus (https://prometheus.io/docs/instrumenting/exposition_formats/).
+Le metriche dei workers terminati vengono accumulate in un file di archivio, in modo che i contatori
+non diminuiscano quando Gunicorn ricrea un worker.
+'''
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from sys import stdout
+import fcntl, glob, inspect, json, logging, os, threading, time
+
+# Impostazione di Logging per stampare eventuali eccezioni nei Docker Logs
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler(stdout)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+logger.setLevel(logging.ERROR)
+
+METRICHE_DIR = os.getenv("METRICHE_DIR", "/tmp/worldfit_metriche")
+INTERVALLO_FOTOGRAFIA = float(os.getenv("METRICHE_INTERVALLO", "5")) # secondi tra due salvataggi delle metriche del worker
+METRICHE_BIND = os.getenv("METRICHE_BIND", "0.0.0.0:9100")            # indirizzo del listener interno delle metriche
+# Limiti superiori (in secondi) dei bucket degli istogrammi
+BUCKET = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+DESCRIZIONI = {
+    "worldfit_richieste_secondi": "Durata delle richieste dei tornelli per route ed esito",
+    "worldfit_fase_secondi": "Durata delle fasi del percorso di accesso",
+    "worldfit_db_secondi": "Durata delle chiamate ai database per classe e metodo",
+    "worldfit_passaggi_totale": "Passaggi ricevuti tramite /batch per esito (per / vedi worldfit_richieste_secondi_count)",
+    "worldfit_errori_totale": "Errori registrati nei log per modulo",
+    "worldfit_gestionale_nodi_totale": "Interrogazioni sui nodi del Gestionale per nodo ed esito (ok, errore, scadenza, duplicata)",
+    "worldfit_gestionale_esclusioni_totale": "Esclusioni temporanee dei nodi del Gestionale per errori o scadenze",
+    "worldfit_pseudonimi_totale": "Pseudonimi restituiti per origine (cache, tabella precalcolata, calcolo RSA)",
+}
+
+# Metriche del processo corrente: chiave (nome, etichette) -> contatori dei bucket + [somma, conteggio]
+_istogrammi = {}
+_contatori = {}
+_lock = threading.Lock()
+_pid = None
+# Funzioni che restituiscono metriche aggiuntive del processo (es. pool di connessioni, cache tessere)
+_raccoglitori = []
+# Indirizzo del listener delle metriche (None se il processo non deve servirle) ed eventuale server aperto
+_indirizzo_servizio = None
+_server = None
+
+def _etichette(etichette:dict) -> tuple:
+    return tuple(sorted(etichette.items()))
+
+def osserva(nome:str, secondi:float, **etichette):
+    '''Registra una durata nell'istogramma indicato'''
+    if _pid != os.getpid():
+        _avvia()
+    chiave = (nome, _etichette(etichette))
+    with _lock:
+        valori = _istogrammi.get(chiave)
+        if valori is None:
+            valori = _istogrammi[chiave] = [0] * (len(BUCKET) + 2)
+        for i, limite in enumerate(BUCKET):
+            if secondi <= limite:
+                valori[i] += 1
+                break
+        valori[-2] += secondi
+        valori[-1] += 1
+
+def incrementa(nome:str, quanti:float = 1, **etichette):
+    '''Incrementa il contatore indicato'''
+    if _pid != os.getpid():
+        _avvia()
+    chiave = (nome, _etichette(etichette))
+    with _lock:
+        _contatori[chiave] = _contatori.get(chiave, 0) + quanti
+
+class cronometro:
+    '''
+    Context manager che registra la durata del blocco nell'istogramma indicato, es:
+        with cronometro("worldfit_fase_secondi", fase="anonimizzatore"):
+    '''
+    __slots__ = ("nome", "etichette", "inizio")
+
+    def __init__(self, nome:str, **etichette):
+        self.nome = nome
+        self.etichette = etichette
+
+    def __enter__(self):
+        self.inizio = time.perf_counter()
+        return self
+
+    def __exit__(self, *eccezione):
+        osserva(self.nome, time.perf_counter() - self.inizio, **self.etichette)
+
+def cronometrato(nome:str, **etichette):
+    '''Decoratore che registra la durata di ogni chiamata della funzione (anche asincrona), con l'etichetta metodo'''
+    def decoratore(funzione):
+        if inspect.iscoroutinefunction(funzione):
+            @wraps(funzione)
+            async def cronometrata_async(*args, **kwargs):
+                inizio = time.perf_counter()
+                try:
+                    return await funzione(*args, **kwargs)
+                finally:
+                    osserva(nome, time.perf_counter() - inizio, metodo=funzione.__name__, **etichette)
+            return cronometrata_async
+
+        @wraps(funzione)
+        def cronometrata(*args, **kwargs):
+            inizio = time.perf_counter()
+            try:
+                return funzione(*args, **kwargs)
+            finally:
+                osserva(nome, time.perf_counter() - inizio, metodo=funzione.__name__, **etichette)
+        return cronometrata
+    return decoratore
+
+class ContatoreErrori(logging.Handler):
+    '''Handler di logging che conta i messaggi di errore di un modulo nella metrica worldfit_errori_totale'''
+    def __init__(self, modulo:str):
+        super().__init__(logging.ERROR)
+        self.modulo = modulo
+
+    def emit(self, record):
+        incrementa("worldfit_errori_totale", modulo=self.modulo)
+
+def conta_errori(*loggers:logging.Logger):
+    '''Aggiunge ai loggers indicati il conteggio degli errori'''
+    for logger_modulo in loggers:
+        logger_modulo.addHandler(ContatoreErrori(logger_modulo.name))
+
+def registra_raccoglitore(funzione):
+    '''
+        Registra una funzione richiamata ad ogni fotografia, che restituisce una lista di tuple
+        (nome, etichette, valore) con metriche del processo da esporre come valori istantanei
+    '''
+    _raccoglitori.append(funzione)
+
+def _avvia():
+    '''Avvia nel processo corrente il thread che salva periodicamente le metriche, se non già avviato'''
+    global _pid
+    with _lock:
+        if _pid == os.getpid():
+            return
+        # Dopo una fork le metriche ereditate appartengono al processo padre
+        _pid = os.getpid()
+        _istogrammi.clear()
+        _contatori.clear()
+    threading.Thread(target=_ciclo, name="metriche", daemon=True).start()
+
+def _dopo_fork():
+    '''
+        Eseguita nel figlio dopo una fork: il lock viene ricreato, perché il thread delle metriche del padre
+        (es. master di Gunicorn con preload_app) poteva detenerlo al momento della fork
+    '''
+    global _lock, _server
+    _lock = threading.Lock()
+    # Il thread del listener non esiste nel figlio: la copia del socket viene chiusa
+    if _server is not None:
+        _server.socket.close()
+        _server = None
+
+os.register_at_fork(after_in_child=_dopo_fork)
+
+def _ciclo():
+    import profilatore
+    while True:
+        time.sleep(INTERVALLO_FOTOGRAFIA)
+        try:
+            salva_fotografia()
+            profilatore.aggiorna()
+            _apri_listener()
+        except Exception as e:
+            logger.error("Errore nel salvataggio delle metriche del worker: %s", str(e))
+
+class _RichiestaMetriche(BaseHTTPRequestHandler):
+    '''Risponde a GET /metrics con le metriche aggregate di tutti i workers'''
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        try:
+            corpo = formato_prometheus().encode("utf-8")
+        except Exception as e:
+            logger.error("Errore nell'aggregazione delle metriche: %s", str(e))
+            self.send_error(500)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(corpo)))
+        self.end_headers()
+        self.wfile.write(corpo)
+
+    def log_message(self, formato, *args):
+        pass
+
+class _ServerMetriche(ThreadingHTTPServer):
+    daemon_threads = True
+    # Un solo processo del container alla volta tiene aperta la porta
+    allow_reuse_port = False
+
+def _apri_listener():
+    '''Apre il listener delle metriche se richiesto e non già aperto; se la porta è occupata riprova al ciclo successivo'''
+    global _server
+    if _indirizzo_servizio is None or _server is not None:
+        return
+    host, _, porta = _indirizzo_servizio.rpartition(":")
+    try:
+        server = _ServerMetriche((host, int(porta)), _RichiestaMetriche)
+    except OSError:
+        return
+    _server = server
+    threading.Thread(target=server.serve_forever, name="metriche-http", daemon=True).start()
+
+def avvia_servizio(indirizzo:str = METRICHE_BIND):
+    '''
+        Espone le metriche su un listener HTTP dedicato (GET /metrics), separato dalla porta dei tornelli.
+        Va richiamata in ogni worker: la porta viene aperta dal primo che ci riesce, gli altri riprovano ad ogni
+        fotografia e la riaprono se il worker che la teneva termina (es. quando Gunicorn lo ricrea).
+    '''
+    global _indirizzo_servizio
+    _indirizzo_servizio = indirizzo
+    if _pid != os.getpid():
+        _avvia()
+    _apri_listener()
+
+def _fotografia() -> dict:
+    with _lock:
+        fotografia = {"istogrammi": [[nome, dict(etichette), list(valori)] for (nome, etichette), valori in _istogrammi.items()],
+                      "contatori": [[nome, dict(etichette), valore] for (nome, etichette), valore in _contatori.items()],
+                      "valori": []}
+    for raccoglitore in _raccoglitori:
+        try:
+            fotografia["valori"].extend([nome, etichette, valore] for nome, etichette, valore in raccoglitore())
+        except Exception as e:
+            logger.error("Errore in un raccoglitore di metriche: %s", str(e))
+    return fotografia
+
+def salva_fotografia():
+    '''Salva in modo atomico le metriche del processo corrente nella cartella condivisa'''
+    os.makedirs(METRICHE_DIR, exist_ok=True)
+    percorso = os.path.join(METRICHE_DIR, f"metriche-{os.getpid()}.json")
+    with open(percorso + ".tmp", "w") as f:
+        json.dump(_fotografia(), f)
+    os.replace(percorso + ".tmp", percorso)
+
+def _unisci(totale:dict, fotografia:dict, con_valori:bool = True):
+    for nome, etichette, valori in fotografia["istogrammi"]:
+        chiave = (nome, _etichette(etichette))
+        presenti = totale["istogrammi"].setdefault(chiave, [0] * len(valori))
+        totale["istogrammi"][chiave] = [a + b for a, b in zip(presenti, valori)]
+    for nome, etichette, valore in fotografia["contatori"]:
+        chiave = (nome, _etichette(etichette))
+        totale["contatori"][chiave] = totale["contatori"].get(chiave, 0) + valore
+    if con_valori:
+        for nome, etichette, valore in fotografia["valori"]:
+            chiave = (nome, _etichette(etichette))
+            totale["valori"][chiave] = totale["valori"].get(chiave, 0) + valore
+
+def _processo_attivo(pid:int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def aggrega() -> dict:
+    '''
+        Unisce le metriche di tutti i workers. Le fotografie dei workers terminati vengono spostate
+        nell'archivio (solo istogrammi e contatori: i valori istantanei non hanno più significato).
+    '''
+    salva_fotografia()
+    totale = {"istogrammi": {}, "contatori": {}, "valori": {}}
+    percorso_archivio = os.path.join(METRICHE_DIR, "archivio.json")
+    with open(os.path.join(METRICHE_DIR, "metriche.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        archivio = {"istogrammi": {}, "contatori": {}, "valori": {}}
+        if os.path.exists(percorso_archivio):
+            with open(percorso_archivio) as f:
+                _unisci(archivio, json.load(f), False)
+        archivio_modificato = False
+        for percorso in glob.glob(os.path.join(METRICHE_DIR, "metriche-*.json")):
+            pid = int(os.path.basename(percorso).split("-")[1].split(".")[0])
+            try:
+                with open(percorso) as f:
+                    fotografia = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if _processo_attivo(pid):
+                _unisci(totale, fotografia)
+            else:
+                _unisci(archivio, fotografia, False)
+                os.remove(percorso)
+                archivio_modificato = True
+        if archivio_modificato:
+            with open(percorso_archivio + ".tmp", "w") as f:
+                json.dump({"istogrammi": [[n, dict(e), v] for (n, e), v in archivio["istogrammi"].items()],
+                           "contatori": [[n, dict(e), v] for (n, e), v in archivio["contatori"].items()],
+                           "valori": []}, f)
+            os.replace(percorso_archivio + ".tmp", percorso_archivio)
+    for tipo in ("istogrammi", "contatori"):
+        for chiave, valore in archivio[tipo].items():
+            if tipo == "contatori":
+                totale[tipo][chiave] = totale[tipo].get(chiave, 0) + valore
+            else:
+                presenti = totale[tipo].get(chiave, [0] * len(valore))
+                totale[tipo][chiave] = [a + b for a, b in zip(presenti, valore)]
+    return totale
+
+def _formatta_etichette(etichette:tuple, extra:tuple = ()) -> str:
+    coppie = list(etichette) + list(extra)
+    if not coppie:
+        return ""
+    testo = ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in coppie)
+    return "{" + testo + "}"
+
+def formato_prometheus() -> str:
+    '''Restituisce le metriche aggregate di tutti i workers nel formato testuale di Prometheus'''
+    totale = aggrega()
+    righe = []
+    tipi_scritti = set()
+    def intestazione(nome:str, tipo:str):
+        if nome not in tipi_scritti:
+            tipi_scritti.add(nome)
+            if nome in DESCRIZIONI:
+                righe.append(f"# HELP {nome} {DESCRIZIONI[nome]}")
+            righe.append(f"# TYPE {nome} {tipo}")
+
+    for (nome, etichette), valori in sorted(totale["istogrammi"].items()):
+        intestazione(nome, "histogram")
+        cumulato = 0
+        for limite, conteggio in zip(BUCKET, valori):
+            cumulato += conteggio
+            righe.append(f"{nome}_bucket{_formatta_etichette(etichette, (('le', limite),))} {cumulato}")
+        righe.append(f"{nome}_bucket{_formatta_etichette(etichette, (('le', '+Inf'),))} {valori[-1]}")
+        righe.append(f"{nome}_sum{_formatta_etichette(etichette)} {valori[-2]}")
+        righe.append(f"{nome}_count{_formatta_etichette(etichette)} {valori[-1]}")
+    for (nome, etichette), valore in sorted(totale["contatori"].items()):
+        intestazione(nome, "counter")
+        righe.append(f"{nome}{_formatta_etichette(etichette)} {valore}")
+    for (nome, etichette), valore in sorted(totale["valori"].items()):
+        intestazione(nome, "gauge")
+        righe.append(f"{nome}{_formatta_etichette(etichette)} {valore}")
+    return "\n".join(righe) + "\n"
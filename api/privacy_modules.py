@@ -4,11 +4,13 @@ La Presudonimizzazione è basata su RSA. Le funzioni qui contenute riguardano so
 """
 from Crypto.PublicKey import RSA
 from Crypto.Util.number import bytes_to_long, long_to_bytes
-from datetime import date, datetime
+from datetime import date, datetime, timezone
+from zoneinfo import ZoneInfo
 from sys import stdout
-from babel import Locale
-from pytz import country_timezones, timezone, utc
-import base64, logging
+from collections import OrderedDict
+from fusi_stati import FUSO_PER_STATO
+from metriche import incrementa
+import base64, logging, os, threading
 
 # Impostazione di Logging per stampare eventuali eccezioni nei Docker Logs
 logger = logging.getLogger(__name__)
@@ -20,8 +22,68 @@ logger.setLevel(logging.ERROR)
 
 FASCEETA = [(0,19),(20,29),(30,39),(40,49),(50,59),(60,200)]
 FASCEORARIE = [(7,12),(13,18),(19,24),(0,6)]
-# Creo un dizionario di sigle, derivanti dai nomi delle nazioni del mondo in italiano
-STATO_A_SIGLA = {stato.lower():sigla for sigla, stato in Locale("it").territories.items()}
+# Tabelle precalcolate: fascia di età per ogni età (da 0 a 200 anni) e fascia oraria per ogni ora del giorno
+FASCIA_PER_ETA = [next(f'{inizio}-{fine}' for inizio, fine in FASCEETA if inizio <= eta <= fine)
+                  for eta in range(FASCEETA[-1][1] + 1)]
+FASCIA_PER_ORA = [next(f'{inizio}-{fine}' for inizio, fine in FASCEORARIE if inizio <= ora <= fine)
+                  for ora in range(24)]
+# Sigle degli stati da Babel, caricate solo se uno stato non è nella tabella FUSO_PER_STATO (vedi stato_a_sigla)
+_STATO_A_SIGLA = None
+# Fusi orari già risolti, per nome dello stato in minuscolo
+_FUSI_PER_STATO = {}
+# Numero massimo di pseudonimi conservati nella cache di ogni worker
+PSEUDONIMI_CACHE_MAX = int(os.getenv("PSEUDONIMI_CACHE_MAX", "50000"))
+
+class CachePseudonimi:
+    '''
+    Cache LRU degli pseudonimi già calcolati, indicizzata per Smart Card ID. La cache è legata alla chiave
+    ed al pad con cui gli pseudonimi sono stati calcolati: se cambiano (rotazione della chiave) viene svuotata.
+    '''
+    def __init__(self, max_voci:int = PSEUDONIMI_CACHE_MAX):
+        self.max_voci = max_voci
+        self._voci = OrderedDict()
+        self._lock = threading.Lock()
+        self._encrypt_key = None
+        self._chiave = None
+
+    def _verifica_chiave(self, encrypt_key:RSA.RsaKey, pseudo_pad:str):
+        # n ed e di un RsaKey vengono convertiti in int ad ogni accesso: il confronto completo
+        # viene fatto solo se l'oggetto chiave è diverso dall'ultimo utilizzato
+        if encrypt_key is self._encrypt_key and pseudo_pad == self._chiave[2]:
+            return
+        chiave = (encrypt_key.n, encrypt_key.e, pseudo_pad)
+        if self._chiave != chiave:
+            self._voci.clear()
+            self._chiave = chiave
+        self._encrypt_key = encrypt_key
+
+    def leggi(self, smart_card_id:str, encrypt_key:RSA.RsaKey, pseudo_pad:str) -> str | None:
+        with self._lock:
+            self._verifica_chiave(encrypt_key, pseudo_pad)
+            pseudonimo = self._voci.get(smart_card_id)
+            if pseudonimo is not None:
+                self._voci.move_to_end(smart_card_id)
+            return pseudonimo
+
+    def scrivi(self, smart_card_id:str, pseudonimo:str, encrypt_key:RSA.RsaKey, pseudo_pad:str):
+        with self._lock:
+            self._verifica_chiave(encrypt_key, pseudo_pad)
+            self._voci[smart_card_id] = pseudonimo
+            if len(self._voci) > self.max_voci:
+                self._voci.popitem(last=False)
+
+_cache_pseudonimi = CachePseudonimi()
+# Tabella precalcolata opzionale (vedi tabella_pseudonimi.py), impostata con imposta_tabella_pseudonimi
+_tabella_pseudonimi = None
+
+def imposta_tabella_pseudonimi(tabella):
+    '''
+        Funzione che imposta la tabella di pseudonimi precalcolati consultata da pseudonimizzatore.
+        La tabella deve esporre il metodo cerca(smart_card_id, encrypt_key, pseudo_pad), che restituisce
+        None se l'ID non è presente o se la tabella è stata calcolata con un'altra chiave.
+    '''
+    global _tabella_pseudonimi
+    _tabella_pseudonimi = tabella
 
 def load_encrypt_key(key:str) -> RSA.RsaKey:
     """
@@ -33,22 +95,76 @@ def load_encrypt_key(key:str) -> RSA.RsaKey:
     )
     return encrypt_key
 
+def stato_a_sigla() -> dict:
+    '''
+        Funzione che restituisce il dizionario di sigle derivanti dai nomi delle nazioni del mondo in italiano,
+        costruito da Babel solo al primo utilizzo: i fusi orari degli stati noti sono già in fusi_stati.py
+    '''
+    global _STATO_A_SIGLA
+    if _STATO_A_SIGLA is None:
+        from babel import Locale
+        _STATO_A_SIGLA = {stato.lower():sigla for sigla, stato in Locale("it").territories.items()}
+    return _STATO_A_SIGLA
+
+def __getattr__(nome:str):
+    # privacy_modules.STATO_A_SIGLA resta disponibile (es. benchmark), caricato solo se utilizzato
+    if nome == "STATO_A_SIGLA":
+        return stato_a_sigla()
+    raise AttributeError(f"module {__name__!r} has no attribute {nome!r}")
+
+def fuso_orario(stato:str):
+    '''
+        Funzione che dato il nome (in italiano) di uno stato restituisce il suo fuso orario, o UTC se lo stato
+        non viene riconosciuto. Il risultato viene memorizzato: le ricerche successive sono in un dizionario.
+        Gli stati vengono cercati nella tabella statica FUSO_PER_STATO; Babel e pytz vengono caricati solo
+        per quelli assenti (es. tabella generata con versioni precedenti) o senza dati zoneinfo di sistema.
+    '''
+    chiave = (stato or "").lower()
+    tz = _FUSI_PER_STATO.get(chiave)
+    if tz is None:
+        try:
+            tz = ZoneInfo(FUSO_PER_STATO[chiave])
+        except Exception:
+            try:
+                from pytz import country_timezones, timezone as pytz_timezone
+                sigla = stato_a_sigla()[chiave]
+                nome_tz = country_timezones[sigla.lower()][0] # Prendo il primo fuso orario della lista per paese
+                tz = pytz_timezone(nome_tz)
+            except Exception:
+                logger.error("Errore nell'identificazione di una sigla per lo stato %s. Timezone impostata a UTC", stato)
+                tz = timezone.utc
+        _FUSI_PER_STATO[chiave] = tz
+    return tz
+
 def timezone_converter(timestamp:datetime, stato:str) -> datetime:
     '''
         Funzione che dato un timestamp con fuso orario utc, lo converte nel fuso orario corrispondete allo
         stato di provenienza del timestamp
     '''
-    try:
-        sigla = STATO_A_SIGLA[stato.lower()]
-        nome_tz = country_timezones[sigla.lower()][0] # Prendo il primo fuso orario della lista per paese
-        tz = timezone(nome_tz)
-    except:
-        logger.error("Errore nell'identificazione di una sigla per lo stato %s. Timezone impostata a UTC")
-        tz = utc
-
-    return timestamp.astimezone(tz)
+    return timestamp.astimezone(fuso_orario(stato))
 
 def pseudonimizzatore(smart_card_id: str, encrypt_key:RSA.RsaKey, pseudo_pad:str) -> str:
+    """
+        Funzione che dato un ID, chiave e padding, restituisce lo pseudonimo dell'ID (vedi calcola_pseudonimo).
+        Essendo gli pseudonimi deterministici, quelli già calcolati vengono letti dalla cache del processo
+        o dalla tabella precalcolata, se impostata.
+    """
+    pseudonimo = _cache_pseudonimi.leggi(smart_card_id, encrypt_key, pseudo_pad)
+    if pseudonimo is not None:
+        incrementa("worldfit_pseudonimi_totale", origine="cache")
+        return pseudonimo
+    origine = "tabella"
+    if _tabella_pseudonimi is not None:
+        pseudonimo = _tabella_pseudonimi.cerca(smart_card_id, encrypt_key, pseudo_pad)
+    if pseudonimo is None:
+        origine = "rsa"
+        pseudonimo = calcola_pseudonimo(smart_card_id, encrypt_key, pseudo_pad)
+    incrementa("worldfit_pseudonimi_totale", origine=origine)
+    if pseudonimo is not None:
+        _cache_pseudonimi.scrivi(smart_card_id, pseudonimo, encrypt_key, pseudo_pad)
+    return pseudonimo
+
+def calcola_pseudonimo(smart_card_id: str, encrypt_key:RSA.RsaKey, pseudo_pad:str) -> str:
     """
         Funzione che dato un ID, chiave e padding, pseudonimizza l'ID con cifratura asimmetrica RSA.
         La tipologia di RSA utilizzata è di tipo Raw RSA con padding preimpostato, per rendere gli
@@ -86,39 +202,27 @@ def anonimizzatore(dati: dict) -> dict:
         necessari per l'inserimento nella tabella Statistiche ed anonimizza le seguenti informazioni:
         - Data di nascita -> fascia di età
         - Timestamp di ingresso -> data e fascia oraria di ingresso
+        Restituisce sesso, fascia di età, palestra, data e fascia oraria di ingresso; il modo in cui
+        vengono memorizzati dipende da STATISTICHE_MODALITA (vedi LogsAndStats in db_handler).
     """
 
-    # creo data del compleanno con giorno e mese di nascita ed anno di oggi poi controllo: 
-    # se (data_oggi >= data_compleanno) allora (età = anno oggi - anno nascita)
-    # altrimenti (età = anno oggi - anno nascita - 1)
+    # età = anno oggi - anno nascita, meno 1 se quest'anno il compleanno non è ancora arrivato
+    # (il confronto tra coppie (mese, giorno) vale anche per i nati il 29 febbraio)
     oggi = date.today()
     data_nascita = dati['cliente'].data_nascita
-    compleanno = date(
-        year=oggi.year,
-        month=data_nascita.month,
-        day=data_nascita.day
-        )
-    if oggi >= compleanno:
-        eta = oggi.year - data_nascita.year
-    else:
-        eta = oggi.year - data_nascita.year - 1
-    
-    # determino la fascia di età
-    for fascia in FASCEETA:
-        if eta in range(fascia[0],fascia[1]+1):
-            fascia_eta = f'{fascia[0]}-{fascia[1]}'
-            break
+    eta = oggi.year - data_nascita.year - ((oggi.month, oggi.day) < (data_nascita.month, data_nascita.day))
+
+    # determino la fascia di età (età fuori dalle fasce ricondotte alla prima o all'ultima)
+    fascia_eta = FASCIA_PER_ETA[min(max(eta, 0), len(FASCIA_PER_ETA) - 1)]
     
-    # Converto il Timestamp in base al fuso orario dello stato in cui si trova la palestra
-    timestamp = timezone_converter(dati['timestamp'], dati['palestra'].stato)
+    # Converto il Timestamp in base al fuso orario dello stato in cui si trova la palestra.
+    # Le palestre del RegistroPalestre hanno già il fuso orario risolto
+    fuso = getattr(dati['palestra'], 'fuso', None) or fuso_orario(dati['palestra'].stato)
+    timestamp = dati['timestamp'].astimezone(fuso)
     data_ingresso = timestamp.date()
-    ora_ingresso = timestamp.time()
 
     # determino la fascia oraria di ingresso
-    for fascia in FASCEORARIE:
-        if ora_ingresso.hour in range(fascia[0],fascia[1]+1):
-            fascia_oraria = f'{fascia[0]}-{fascia[1]}'
-            break
+    fascia_oraria = FASCIA_PER_ORA[timestamp.hour]
 
     return {"sesso":dati["cliente"].sesso, "fascia_eta":fascia_eta, "palestra_id":dati["palestra"].id, 
             "data_ingresso":data_ingresso, "fascia_oraria":fascia_oraria}
@@ -0,0 +1,103 @@
+'''
+Modulo Python contenente un profilatore a campionamento, attivabile a runtime senza riavviare l'API.
+Quando esiste il file PROFILATORE_FLAG, ogni worker campiona periodicamente gli stack di tutti i suoi
+threads e salva i conteggi in PROFILATORE_DIR nel formato "folded" (uno stack per riga seguito dal
+numero di campioni), leggibile da flamegraph.pl o speedscope. Il controllo del file viene eseguito
+dal thread delle metriche (vedi metriche.py). Esempio dal container:
+
+    python profilatore.py attiva
+    python profilatore.py disattiva
+    python profilatore.py unisci -o /tmp/profilo.folded
+'''
+from collections import Counter
+from sys import stdout
+import glob, logging, os, sys, threading
+
+# Impostazione di Logging per stampare eventuali eccezioni nei Docker Logs
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler(stdout)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+logger.setLevel(logging.ERROR)
+
+PROFILATORE_FLAG = os.getenv("PROFILATORE_FLAG", "/tmp/worldfit_profilatore.attivo")
+PROFILATORE_DIR = os.getenv("PROFILATORE_DIR", "/tmp/worldfit_profili")
+PROFILATORE_INTERVALLO = float(os.getenv("PROFILATORE_INTERVALLO", "0.01")) # secondi tra due campioni
+# Threads di servizio esclusi dal campionamento
+THREADS_ESCLUSI = {"metriche", "profilatore"}
+
+_campioni = Counter()
+_lock = threading.Lock()
+_thread = None
+_stop = threading.Event()
+
+def _stack(frame) -> str:
+    '''Stack di un thread dalla radice alla funzione corrente, nel formato folded'''
+    funzioni = []
+    while frame is not None:
+        funzioni.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(funzioni))
+
+def _campiona(stop:threading.Event):
+    while not stop.wait(PROFILATORE_INTERVALLO):
+        esclusi = {thread.ident for thread in threading.enumerate() if thread.name in THREADS_ESCLUSI}
+        stacks = [_stack(frame) for ident, frame in sys._current_frames().items() if ident not in esclusi]
+        with _lock:
+            _campioni.update(stacks)
+
+def _salva():
+    os.makedirs(PROFILATORE_DIR, exist_ok=True)
+    percorso = os.path.join(PROFILATORE_DIR, f"profilo-{os.getpid()}.folded")
+    with _lock:
+        righe = [f"{stack} {conteggio}\n" for stack, conteggio in _campioni.items()]
+    with open(percorso + ".tmp", "w") as f:
+        f.writelines(righe)
+    os.replace(percorso + ".tmp", percorso)
+
+def aggiorna():
+    '''
+        Avvia o ferma il campionamento del processo corrente in base alla presenza del file
+        PROFILATORE_FLAG, e salva i campioni raccolti finora
+    '''
+    global _thread, _stop
+    attivo = os.path.exists(PROFILATORE_FLAG)
+    in_esecuzione = _thread is not None and _thread.is_alive()
+    if attivo and not in_esecuzione:
+        with _lock:
+            _campioni.clear()
+        _stop = threading.Event()
+        _thread = threading.Thread(target=_campiona, args=(_stop,), name="profilatore", daemon=True)
+        _thread.start()
+    elif not attivo and in_esecuzione:
+        _stop.set()
+        _thread.join()
+    if _campioni:
+        _salva()
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Gestione del profilatore a campionamento dei workers dell'API")
+    parser.add_argument('azione', choices=['attiva', 'disattiva', 'unisci'])
+    parser.add_argument('-o', '--output', default='-',
+                        help="[unisci] File in cui salvare i profili uniti di tutti i workers, - per lo standard output")
+    args = parser.parse_args()
+
+    match args.azione:
+        case 'attiva':
+            open(PROFILATORE_FLAG, "w").close()
+            print("Profilatore attivato: i workers iniziano a campionare entro qualche secondo")
+        case 'disattiva':
+            if os.path.exists(PROFILATORE_FLAG):
+                os.remove(PROFILATORE_FLAG)
+            print("Profilatore disattivato")
+        case 'unisci':
+            totale = Counter()
+            for percorso in glob.glob(os.path.join(PROFILATORE_DIR, "profilo-*.folded")):
+                with open(percorso) as f:
+                    for riga in f:
+                        stack, _, conteggio = riga.rstrip("\n").rpartition(" ")
+                        totale[stack] += int(conteggio)
+            uscita = sys.stdout if args.output == '-' else open(args.output, "w")
+            uscita.writelines(f"{stack} {conteggio}\n" for stack, conteggio in totale.most_common())
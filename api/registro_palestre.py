@@ -0,0 +1,91 @@
+'''
+Modulo Python contenente il registro delle palestre: le righe della tabella Palestre vengono caricate
+una volta in memoria, insieme al fuso orario già risolto dallo stato della palestra, e aggiornate
+periodicamente da un thread in background. Le ricerche per ID sono in un dizionario, senza accessi
+al Database Gestionale né risoluzioni di fusi orari per ogni ingresso.
+'''
+from db_handler import Gestionale
+from privacy_modules import fuso_orario
+from typing import NamedTuple
+from sys import stdout
+from datetime import tzinfo
+import logging, os, threading, time
+
+# Impostazione di Logging per stampare eventuali eccezioni nei Docker Logs
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler(stdout)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+logger.setLevel(logging.ERROR)
+
+INTERVALLO_AGGIORNAMENTO = float(os.getenv("REGISTRO_PALESTRE_INTERVALLO", "600")) # secondi tra due caricamenti
+# Una palestra non presente nel registro provoca al massimo un ricaricamento ogni N secondi
+INTERVALLO_MISS = 5
+
+class InfoPalestra(NamedTuple):
+    '''Dati di una palestra usati da check e anonimizzatore (stessi campi di Gestionale.DatiPalestra più il fuso orario)'''
+    id: int
+    stato: str
+    luogo: str
+    fuso: tzinfo
+
+class RegistroPalestre:
+    '''
+    Classe che mantiene in memoria le palestre del Gestionale. Il primo caricamento è sincrono, i successivi
+    vengono eseguiti da un thread avviato alla prima ricerca in ogni processo (anche dopo una fork di Gunicorn).
+    '''
+    def __init__(self, gestore:Gestionale, intervallo:float = INTERVALLO_AGGIORNAMENTO):
+        self.gestore = gestore
+        self.intervallo = intervallo
+        self._palestre = {}
+        self._lock = threading.Lock()
+        self._pid = None
+        self._ultimo_caricamento = 0.0
+        self.caricato = False
+        self.aggiorna()
+
+    def aggiorna(self) -> bool:
+        '''Ricarica le palestre dal Gestionale; in caso di errore viene mantenuto il registro precedente'''
+        self._ultimo_caricamento = time.monotonic()
+        righe = self.gestore.select_palestre()
+        if righe is None:
+            return False
+        # Il dizionario viene sostituito per intero: le ricerche concorrenti vedono il vecchio o il nuovo
+        self._palestre = {id_palestra: InfoPalestra(id_palestra, stato, luogo, fuso_orario(stato))
+                          for id_palestra, luogo, stato in righe}
+        self.caricato = True
+        return True
+
+    def _avvia(self):
+        '''Avvia il thread di aggiornamento nel processo corrente, se non già avviato'''
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._ciclo, name="registro-palestre", daemon=True).start()
+
+    def _ciclo(self):
+        while True:
+            time.sleep(self.intervallo)
+            try:
+                self.aggiorna()
+            except Exception as e:
+                logger.error("Errore nell'aggiornamento del registro delle palestre: %s", str(e))
+
+    def palestra(self, palestra_id:int) -> InfoPalestra | None:
+        '''
+            Restituisce la palestra indicata, None se non esiste. Una palestra assente provoca un
+            ricaricamento immediato (es. palestra appena aperta), limitato ad uno ogni INTERVALLO_MISS secondi.
+        '''
+        if self._pid != os.getpid():
+            self._avvia()
+        try:
+            palestra_id = int(palestra_id)
+        except (TypeError, ValueError):
+            return None
+        info = self._palestre.get(palestra_id)
+        if info is None and time.monotonic() - self._ultimo_caricamento > INTERVALLO_MISS:
+            self.aggiorna()
+            info = self._palestre.get(palestra_id)
+        return info
@@ -0,0 +1,346 @@
+'''
+Modulo Python per la lettura del DB Gestionale da più nodi: il principale e le repliche della regione.
+Le verifiche degli accessi (il percorso dei tornelli) vengono instradate da RouterRepliche:
+- scelta del nodo tra quelli disponibili confrontandone due a caso e preferendo quello con la latenza
+  media (EWMA) minore, pesata per le interrogazioni in corso;
+- scadenza massima per ogni interrogazione (GS_DEADLINE), oltre la quale la richiesta riceve un errore
+  invece di tenere occupato il thread del worker; su MySQL la stessa scadenza è indicata alle SELECT di
+  verifica con l'hint MAX_EXECUTION_TIME, così il server interrompe anche l'interrogazione abbandonata;
+- lettura duplicata (hedging) su un secondo nodo se il primo non ha risposto entro il percentile
+  GS_HEDGE_PERCENTILE delle latenze recenti, per al massimo la frazione GS_HEDGE_FRAZIONE delle letture;
+  un errore del primo nodo fa passare subito al successivo;
+- esclusione dei nodi dopo GS_ESPULSIONE_ERRORI errori o scadenze consecutive, per un tempo che raddoppia
+  ad ogni nuova esclusione (fino a GS_ESPULSIONE_MASSIMA); scaduto il tempo il nodo torna disponibile e
+  la prima interrogazione riuscita ne azzera gli errori.
+Le altre interrogazioni del Gestionale (palestre, tessere attive per cache e snapshot) usano l'engine del
+nodo migliore, senza duplicazioni. La modalità ASGI (vedi db_handler_async.py) usa lo stesso router con
+esegui_async: stessa scadenza, hint ed esclusione dei nodi, ma senza letture duplicate.
+'''
+from db_handler import Gestionale, ottieni_engine
+from metriche import cronometrato, incrementa
+from sqlalchemy import Engine
+from sqlalchemy.engine import make_url
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import deque
+from datetime import date
+from sys import stdout
+import asyncio, logging, math, os, random, threading, time
+
+# Impostazione di Logging per stampare eventuali eccezioni nei Docker Logs
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler(stdout)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+logger.setLevel(logging.ERROR)
+
+DEADLINE = float(os.getenv("GS_DEADLINE", "2"))                         # secondi massimi per interrogazione
+HEDGE_PERCENTILE = float(os.getenv("GS_HEDGE_PERCENTILE", "95"))        # 0 disattiva le letture duplicate
+HEDGE_MINIMO = float(os.getenv("GS_HEDGE_MINIMO", "0.005"))             # attesa minima prima della duplicazione
+HEDGE_FRAZIONE = float(os.getenv("GS_HEDGE_FRAZIONE", "0.1"))           # frazione massima di letture duplicate
+ESPULSIONE_ERRORI = int(os.getenv("GS_ESPULSIONE_ERRORI", "3"))
+ESPULSIONE_SECONDI = float(os.getenv("GS_ESPULSIONE_SECONDI", "5"))
+ESPULSIONE_MASSIMA = float(os.getenv("GS_ESPULSIONE_MASSIMA", "60"))
+THREADS = int(os.getenv("GS_THREADS", "16"))                            # thread per worker delle interrogazioni
+CAMPIONI_LATENZA = 512      # latenze recenti usate per il percentile delle letture duplicate
+PESO_EWMA = 0.2
+
+class ScadenzaSuperata(TimeoutError):
+    '''Nessun nodo del Gestionale ha risposto entro la scadenza dell'interrogazione'''
+
+def con_scadenza(stmt, deadline:float):
+    '''
+        Aggiunge alla SELECT l'hint MySQL con la scadenza indicata (in secondi): solo le verifiche degli accessi,
+        le letture complete delle tabelle (palestre, tessere attive) condividono l'engine senza limite
+    '''
+    return stmt.prefix_with(f"/*+ MAX_EXECUTION_TIME({int(deadline * 1000)}) */", dialect="mysql")
+
+class Nodo:
+    '''Stato di un nodo del Gestionale nel worker: latenza media, errori consecutivi ed esclusione'''
+    def __init__(self, database_uri:str):
+        self.database_uri = database_uri
+        self.nome = make_url(database_uri).render_as_string(hide_password=True)
+        self.latenza = 0.0          # EWMA delle latenze delle interrogazioni riuscite
+        self.in_corso = 0
+        self.errori = 0             # errori o scadenze consecutive
+        self.esclusioni = 0         # esclusioni consecutive, per il raddoppio del tempo di esclusione
+        self.escluso_fino = 0.0
+
+    def disponibile(self, ora:float) -> bool:
+        return ora >= self.escluso_fino
+
+    def costo(self) -> tuple:
+        # Prima i nodi senza errori recenti (un nodo in errore non ha latenze), poi per latenza e carico
+        return self.errori, self.latenza * (1 + self.in_corso)
+
+    def engine(self) -> Engine:
+        return ottieni_engine(self.database_uri)
+
+class RouterRepliche:
+    '''
+    Classe che esegue le letture sui nodi del Gestionale con scadenza, duplicazione ed esclusione dei nodi
+    lenti o in errore. Lo stato dei nodi è del processo; il pool di thread viene ricreato dopo una fork.
+    '''
+    def __init__(self, database_uris:list, deadline:float = DEADLINE, hedge_percentile:float = HEDGE_PERCENTILE,
+                 hedge_minimo:float = HEDGE_MINIMO, hedge_frazione:float = HEDGE_FRAZIONE, threads:int = THREADS):
+        self.nodi = [Nodo(uri) for uri in database_uris]
+        self.deadline = deadline
+        self.hedge_percentile = hedge_percentile
+        self.hedge_minimo = hedge_minimo
+        self.hedge_frazione = hedge_frazione
+        self.threads = threads
+        self._lock = threading.Lock()
+        self._latenze = deque(maxlen=CAMPIONI_LATENZA)   # latenze delle letture viste dal chiamante
+        self._ritardo_hedge = None  # percentile in cache, ricalcolato ogni CAMPIONI_LATENZA // 8 campioni
+        self._campioni = 0
+        self._letture = 0
+        self._duplicate = 0
+        self._pid = None
+        self._esecutore = None
+        self._abbandonate = set()   # interrogazioni asincrone annullate alla scadenza e non ancora concluse
+
+    def _ordine(self) -> list:
+        '''Nodi nell'ordine in cui interrogarli: prima il migliore tra due disponibili a caso, poi per costo'''
+        ora = time.monotonic()
+        disponibili = [nodo for nodo in self.nodi if nodo.disponibile(ora)]
+        if not disponibili:
+            # Tutti esclusi: si prova comunque il nodo che tornerà disponibile per primo
+            return sorted(self.nodi, key=lambda nodo: nodo.escluso_fino)
+        if len(disponibili) == 1:
+            return disponibili
+        primo = min(random.sample(disponibili, 2), key=Nodo.costo)
+        return [primo] + sorted((nodo for nodo in disponibili if nodo is not primo), key=Nodo.costo)
+
+    def engine(self) -> Engine:
+        '''Engine del nodo da usare per le interrogazioni senza scadenza né duplicazione'''
+        return self._ordine()[0].engine()
+
+    def ritardo_hedge(self) -> float | None:
+        '''Attesa prima della lettura duplicata: percentile delle latenze recenti (None se disattivata)'''
+        if self.hedge_percentile <= 0:
+            return None
+        with self._lock:
+            if self._ritardo_hedge is None:
+                if len(self._latenze) < 20:
+                    return self.deadline / 2
+                ordinate = sorted(self._latenze)
+                self._ritardo_hedge = ordinate[max(0, math.ceil(self.hedge_percentile / 100 * len(ordinate)) - 1)]
+            return max(self.hedge_minimo, self._ritardo_hedge)
+
+    def _registra_successo(self, nodo:Nodo, latenza:float, abbandonata:threading.Event):
+        with self._lock:
+            nodo.latenza = latenza if nodo.latenza == 0 else (1 - PESO_EWMA) * nodo.latenza + PESO_EWMA * latenza
+            if latenza <= self.deadline:
+                nodo.errori = 0
+                nodo.esclusioni = 0
+        if latenza <= self.deadline:
+            incrementa("worldfit_gestionale_nodi_totale", nodo=nodo.nome, esito="ok")
+        elif not abbandonata.is_set():
+            # Risposta arrivata dopo la scadenza (es. lettura superata da un duplicato): conta come errore
+            self._registra_errore(nodo, "scadenza", f"risposta dopo {latenza:.2f} secondi")
+
+    def _registra_lettura(self, latenza:float):
+        '''
+            Registra la latenza di una lettura vista dal chiamante. Il percentile per le letture duplicate usa
+            solo queste: le interrogazioni superate da un duplicato, sempre lente, lo farebbero crescere fino
+            a rendere inutile la duplicazione
+        '''
+        with self._lock:
+            self._latenze.append(latenza)
+            self._campioni += 1
+            if self._campioni % (CAMPIONI_LATENZA // 8) == 0:
+                self._ritardo_hedge = None
+
+    def _registra_errore(self, nodo:Nodo, esito:str, errore:str):
+        with self._lock:
+            nodo.errori += 1
+            escluso = nodo.errori >= ESPULSIONE_ERRORI and nodo.disponibile(time.monotonic())
+            if escluso:
+                durata = min(ESPULSIONE_MASSIMA, ESPULSIONE_SECONDI * 2 ** nodo.esclusioni)
+                nodo.esclusioni += 1
+                nodo.errori = ESPULSIONE_ERRORI - 1     # al rientro basta un errore per una nuova esclusione
+                nodo.escluso_fino = time.monotonic() + durata
+        incrementa("worldfit_gestionale_nodi_totale", nodo=nodo.nome, esito=esito)
+        if escluso:
+            incrementa("worldfit_gestionale_esclusioni_totale", nodo=nodo.nome)
+            logger.error("Nodo %s del Gestionale escluso per %s secondi dopo %s: %s", nodo.nome, durata, esito, errore)
+
+    def _esegui_su(self, nodo:Nodo, lettura, abbandonata:threading.Event):
+        '''
+            Esegue la lettura (funzione che riceve una connessione) sul nodo indicato. abbandonata viene impostato
+            da esegui alla scadenza, dopo aver già contato come scadute le letture ancora in corso
+        '''
+        inizio = time.perf_counter()
+        with self._lock:
+            nodo.in_corso += 1
+        try:
+            with nodo.engine().connect() as connection:
+                risultato = lettura(connection)
+        except Exception as e:
+            if not abbandonata.is_set():
+                self._registra_errore(nodo, "errore", str(e))
+            raise
+        finally:
+            with self._lock:
+                nodo.in_corso -= 1
+        self._registra_successo(nodo, time.perf_counter() - inizio, abbandonata)
+        return risultato
+
+    def _esecutore_processo(self) -> ThreadPoolExecutor:
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._esecutore = ThreadPoolExecutor(self.threads, thread_name_prefix="gestionale")
+                    self._pid = os.getpid()
+        return self._esecutore
+
+    def esegui(self, lettura):
+        '''
+            Esegue la lettura (funzione che riceve una connessione e restituisce il risultato) entro la scadenza,
+            duplicandola su un altro nodo se il primo è lento e passando al successivo se è in errore.
+            Solleva l'ultimo errore dei nodi o ScadenzaSuperata.
+        '''
+        esecutore = self._esecutore_processo()
+        inizio = time.monotonic()
+        scadenza = inizio + self.deadline
+        candidati = self._ordine()
+        ritardo = self.ritardo_hedge()
+        with self._lock:
+            self._letture += 1
+        in_corso = {}
+        abbandonata = threading.Event()
+        prossimo_invio = 0.0
+        ultimo_errore = None
+        while True:
+            ora = time.monotonic()
+            if candidati and not in_corso:
+                # Prima interrogazione, o nodo precedente in errore: il successivo viene interrogato subito
+                nodo = candidati.pop(0)
+                in_corso[esecutore.submit(self._esegui_su, nodo, lettura, abbandonata)] = nodo
+                prossimo_invio = ora + ritardo if ritardo is not None else scadenza
+            elif candidati and ritardo is not None and ora >= prossimo_invio:
+                if self._puo_duplicare():
+                    nodo = candidati.pop(0)
+                    in_corso[esecutore.submit(self._esegui_su, nodo, lettura, abbandonata)] = nodo
+                    prossimo_invio = ora + ritardo
+                    incrementa("worldfit_gestionale_nodi_totale", nodo=nodo.nome, esito="duplicata")
+                else:
+                    ritardo = None
+            elif not in_corso:
+                raise ultimo_errore
+            if ora >= scadenza:
+                break
+            attesa = scadenza - ora
+            if candidati and ritardo is not None:
+                attesa = min(attesa, max(0.0, prossimo_invio - ora))
+            completate, _ = wait(in_corso, timeout=attesa, return_when=FIRST_COMPLETED)
+            for futuro in completate:
+                in_corso.pop(futuro)
+                try:
+                    risultato = futuro.result()
+                except Exception as e:
+                    ultimo_errore = e
+                    continue
+                self._registra_lettura(time.monotonic() - inizio)
+                return risultato
+        # Scadenza superata: le interrogazioni in corso proseguono nel pool ma non vengono più attese
+        abbandonata.set()
+        for nodo in in_corso.values():
+            self._registra_errore(nodo, "scadenza", f"nessuna risposta entro {self.deadline} secondi")
+        raise ScadenzaSuperata(f"Nessun nodo del Gestionale ha risposto entro {self.deadline} secondi")
+
+    async def esegui_async(self, lettura):
+        '''
+            Versione di esegui per la modalità ASGI: lettura è una coroutine function che riceve l'URI del nodo.
+            Un nodo in errore fa passare al successivo; alla scadenza l'interrogazione in corso viene annullata
+            senza attenderne la conclusione.
+            Nessuna lettura duplicata: l'attesa non occupa thread. Solleva l'ultimo errore dei nodi o ScadenzaSuperata.
+        '''
+        inizio = time.monotonic()
+        scadenza = inizio + self.deadline
+        ultimo_errore = None
+        for nodo in self._ordine():
+            rimanente = scadenza - time.monotonic()
+            if rimanente <= 0:
+                break
+            inizio_nodo = time.perf_counter()
+            with self._lock:
+                nodo.in_corso += 1
+            interrogazione = asyncio.ensure_future(lettura(nodo.database_uri))
+            try:
+                completate, _ = await asyncio.wait({interrogazione}, timeout=rimanente)
+                if not completate:
+                    # Scadenza superata: l'interrogazione viene annullata ma non attesa, la chiusura della
+                    # connessione può dover aspettare la risposta del nodo
+                    interrogazione.cancel()
+                    self._abbandonate.add(interrogazione)
+                    interrogazione.add_done_callback(self._abbandonate.discard)
+                    self._registra_errore(nodo, "scadenza", f"nessuna risposta entro {self.deadline} secondi")
+                    break
+                risultato = interrogazione.result()
+            except asyncio.CancelledError:
+                interrogazione.cancel()
+                raise
+            except Exception as e:
+                self._registra_errore(nodo, "errore", str(e))
+                ultimo_errore = e
+                continue
+            finally:
+                with self._lock:
+                    nodo.in_corso -= 1
+            self._registra_successo(nodo, time.perf_counter() - inizio_nodo, threading.Event())
+            self._registra_lettura(time.monotonic() - inizio)
+            return risultato
+        else:
+            raise ultimo_errore
+        raise ScadenzaSuperata(f"Nessun nodo del Gestionale ha risposto entro {self.deadline} secondi")
+
+    def _puo_duplicare(self) -> bool:
+        with self._lock:
+            if self._duplicate >= self.hedge_frazione * self._letture:
+                return False
+            self._duplicate += 1
+            return True
+
+    def statistiche(self) -> dict:
+        '''Stato dei nodi nel worker corrente, per le metriche'''
+        ora = time.monotonic()
+        return {nodo.nome: {"disponibile": nodo.disponibile(ora), "latenza": nodo.latenza, "in_corso": nodo.in_corso}
+                for nodo in self.nodi}
+
+class GestionaleReplicato(Gestionale):
+    '''
+    Gestionale letto da più nodi tramite RouterRepliche: verifica_accesso e verifica_accessi hanno scadenza e
+    duplicazione, le altre interrogazioni usano l'engine del nodo migliore. database_uri resta quella del
+    principale, usata come identificativo (es. dalla cache delle tessere).
+    '''
+    def __init__(self, database_uri:str, repliche:list = (), **parametri_router):
+        super().__init__(database_uri)
+        self.router = RouterRepliche([database_uri, *repliche], **parametri_router)
+
+    def _con_scadenza(self, stmt):
+        '''Aggiunge alla SELECT l'hint MySQL con la scadenza del router (vedi con_scadenza)'''
+        return con_scadenza(stmt, self.router.deadline)
+
+    @property
+    def engine(self) -> Engine:
+        return self.router.engine()
+
+    @cronometrato("worldfit_db_secondi", classe="GestionaleReplicato")
+    def verifica_accesso(self, smart_card_id:str, palestra_id:int, giorno:date) -> Gestionale.EsitoAccesso:
+        '''Come Gestionale.verifica_accesso, sul nodo scelto dal router. Restituisce None in caso di errore o scadenza.'''
+        stmt = self._con_scadenza(self.stmt_verifica_accesso(smart_card_id, palestra_id, giorno))
+        try:
+            return self.esito_accesso(self.router.esegui(lambda connection: connection.execute(stmt).one()))
+        except Exception as e:
+            logger.error("Errore nella verifica di un accesso sul DB Gestionale: %s", str(e))
+
+    @cronometrato("worldfit_db_secondi", classe="GestionaleReplicato")
+    def verifica_accessi(self, richieste:list) -> list:
+        '''Come Gestionale.verifica_accessi, sul nodo scelto dal router. Restituisce None in caso di errore o scadenza.'''
+        stmts = [self._con_scadenza(stmt) for stmt in self.stmt_verifica_accessi(richieste)]
+        try:
+            righe = self.router.esegui(lambda connection: [connection.execute(stmt).all() for stmt in stmts])
+            return self.esiti_accessi(richieste, *righe)
+        except Exception as e:
+            logger.error("Errore nella verifica di un lotto di accessi sul DB Gestionale: %s", str(e))
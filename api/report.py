@@ -0,0 +1,443 @@
+'''
+Server di reportistica sulle statistiche anonime degli ingressi, separato dall'API dei tornelli: usa un
+utente del DB Log & Statistiche in sola lettura (vedi db/init/02-setup.sh) con un numero limitato di
+connessioni, in un container a parte, in modo che i report non sottraggano connessioni né CPU al percorso
+di accesso. Avvio (dalla cartella api):
+
+    gunicorn report:app --bind 0.0.0.0:8000 --workers 2
+
+Route (autenticate con l'header "Authorization: Bearer <token>", token nel segreto report_token):
+- GET /statistiche?dal=AAAA-MM-GG&al=AAAA-MM-GG[&raggruppa=palestra,fascia_eta,sesso,fascia_oraria][&palestra=1,2]
+  conteggi degli ingressi per periodo, raggruppati per le dimensioni indicate, in JSON;
+- GET /esportazione?dal=...&al=...[&palestra=...][&formato=csv|jsonl|parquet][&compressione=gzip]
+  tutte le combinazioni di dimensioni per periodo, in streaming (il file non viene costruito in memoria).
+
+I conteggi vengono letti dai contatori di StatisticheAggregate, che l'evento RollupStatistiche aggiorna
+ogni notte con i soli giorni conclusi, più le righe di Statistiche non ancora aggregate.
+
+Protezione dei conteggi: un report non deve permettere di ricavare, per differenza con altri report, un
+gruppo con meno di REPORT_K ingressi. Per questo
+- i conteggi sono pubblicati solo per periodi fissi ed allineati (REPORT_PERIODO: giorno, settimana ISO o
+  mese di calendario), uno per riga e mai sommati tra periodi: dal ed al devono essere inizio e fine di
+  un periodo, e gli intervalli sovrapposti danno le stesse righe;
+- solo i periodi chiusi (conclusi da REPORT_GIORNI_APERTI giorni: i tornelli possono reinviare passaggi
+  offline del giorno precedente), i cui conteggi non cambiano più tra una richiesta e l'altra;
+- il filtro per palestra seleziona righe, quindi richiede la palestra tra le dimensioni di raggruppamento;
+- in ogni periodo, i gruppi con meno di REPORT_K ingressi (soppressione primaria) e quelli necessari
+  perché nessuno di essi sia la sola incognita di una somma pubblicata (soppressione complementare)
+  vengono soppressi insieme per tutti i raggruppamenti possibili (vedi proteggi): ogni tabella pubblicata
+  è coerente con tutte le altre, qualunque sia il raggruppamento richiesto.
+REPORT_PERIODO non va cambiato dopo la pubblicazione dei report: periodi di granularità diverse
+permetterebbero di nuovo le differenze. La vista StatisticheKAnonime applica la sola soppressione primaria
+e non va quindi esposta al posto di queste route. I risultati protetti dei periodi vengono conservati in una cache
+in memoria: un report su un intervallo interroga il database solo per i periodi mancanti.
+'''
+from flask import Flask, request, jsonify, Response, stream_with_context
+from sqlalchemy import select, union_all, func, literal
+from db_handler import DB_handler, LogsAndStats
+from collections import Counter, OrderedDict, defaultdict
+from datetime import date, timedelta
+from itertools import combinations
+from sys import stdout
+import csv, hmac, io, json, logging, os, threading, time, zlib
+
+# Formato colonnare opzionale: senza pyarrow l'esportazione parquet non è disponibile
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Impostazione di Logging per stampare eventuali eccezioni nei Docker Logs
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler(stdout)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+logger.setLevel(logging.ERROR)
+
+K = int(os.getenv("REPORT_K", "5"))                                      # ingressi minimi per gruppo
+PERIODO = os.getenv("REPORT_PERIODO", "giorno")                          # granularità dei report: giorno, settimana o mese
+GIORNI_APERTI = int(os.getenv("REPORT_GIORNI_APERTI", "2"))              # giorni (da oggi) non ancora chiusi
+CACHE_TTL = float(os.getenv("REPORT_CACHE_TTL", "86400"))                # secondi di validità dei periodi in cache
+CACHE_VOCI = int(os.getenv("REPORT_CACHE_VOCI", "50000"))                # periodi (per raggruppamento) in cache
+MAX_GIORNI = int(os.getenv("REPORT_MAX_GIORNI", "1100"))                 # ampiezza massima di un intervallo
+TIMEOUT_MS = int(os.getenv("REPORT_TIMEOUT_MS", "30000"))                # tempo massimo di un'interrogazione di /statistiche
+RIGHE_PER_BLOCCO = int(os.getenv("REPORT_RIGHE_PER_BLOCCO", "5000"))     # righe lette e scritte per blocco nelle esportazioni
+
+# Dimensioni di raggruppamento, con lo stesso nome nei parametri, nelle colonne della sorgente e nei risultati.
+# "data" è l'inizio del periodo, sempre presente; le altre sono gli attributi dei gruppi
+DIMENSIONI = ("data", "palestra", "fascia_oraria", "fascia_eta", "sesso")
+ATTRIBUTI = DIMENSIONI[1:]
+PERIODI = ("giorno", "settimana", "mese")
+if PERIODO not in PERIODI:
+    raise ValueError(f"REPORT_PERIODO deve essere uno tra {', '.join(PERIODI)}")
+
+def prendisegreto(secretFile: str) -> str:
+    """Funzione che prende un segreto dalla cartella dei docker secrets"""
+    try:
+        with open(os.path.join(os.getenv("SECRETS_DIR", "/run/secrets"), secretFile), "r") as f:
+            return f.read().strip()
+    except Exception as e:
+        logger.critical("Errore nella lettura del segreto, eccezione: %s", str(e))
+
+class Reportistica(DB_handler):
+    '''Classe per le interrogazioni in sola lettura sulle statistiche del DB Log e statistiche'''
+
+    @staticmethod
+    def sorgente(dal:date, al:date, palestre:list | None = None):
+        '''
+            Subquery con un contatore per riga: i contatori di StatisticheAggregate più le righe di
+            Statistiche non ancora aggregate (contatore 1), con le stesse convenzioni di RollupStatistiche
+        '''
+        A, S = LogsAndStats.StatAggregata, LogsAndStats.Stat
+        aggregate = select(A.data_ingresso.label("data"), A.palestra_id.label("palestra"),
+                           A.fascia_oraria.label("fascia_oraria"), A.fascia_eta.label("fascia_eta"),
+                           A.sesso.label("sesso"), A.ingressi.label("ingressi")
+                           ).where(A.data_ingresso >= dal, A.data_ingresso <= al)
+        righe = select(S.data_ingresso, S.palestra_id, func.coalesce(S.fascia_oraria, ""),
+                       func.coalesce(S.fascia_eta, ""), func.coalesce(S.sesso, ""), literal(1)
+                       ).where(S.data_ingresso >= dal, S.data_ingresso <= al, S.palestra_id.is_not(None))
+        if palestre:
+            aggregate = aggregate.where(A.palestra_id.in_(palestre))
+            righe = righe.where(S.palestra_id.in_(palestre))
+        return union_all(aggregate, righe).subquery()
+
+    def conteggi(self, dal:date, al:date, dimensioni:tuple, palestre:list | None = None) -> dict | None:
+        '''
+            Ingressi per giorno e combinazione delle dimensioni indicate, senza soglie: restituisce
+            {giorno: {(valori delle dimensioni): ingressi}}, None in caso di errore
+        '''
+        sorgente = self.sorgente(dal, al, palestre)
+        colonne = [sorgente.c.data] + [sorgente.c[d] for d in dimensioni]
+        stmt = select(*colonne, func.sum(sorgente.c.ingressi)).group_by(*colonne).prefix_with(
+            f"/*+ MAX_EXECUTION_TIME({TIMEOUT_MS}) */", dialect="mysql")
+        try:
+            risultato = {}
+            with self.engine.connect() as connection:
+                for giorno, *valori, ingressi in connection.execute(stmt):
+                    risultato.setdefault(giorno, {})[tuple(valori)] = int(ingressi)
+            return risultato
+        except Exception as e:
+            logger.error("Errore nella lettura delle statistiche: %s", str(e))
+
+class CacheReport:
+    '''
+    Cache LRU in memoria dei conteggi protetti dei periodi chiusi, per periodo e raggruppamento: aggiungere
+    un periodo ad un intervallo già richiesto costa solo l'interrogazione di quel periodo
+    '''
+    def __init__(self, ttl:float = CACHE_TTL, voci:int = CACHE_VOCI):
+        self.ttl = ttl
+        self.voci = voci
+        self._giorni = OrderedDict()
+        self._lock = threading.Lock()
+        self.eventi = Counter()
+
+    def cerca(self, chiave:tuple):
+        with self._lock:
+            voce = self._giorni.get(chiave)
+            if voce is None or voce[0] < time.monotonic():
+                self.eventi["miss"] += 1
+                return None
+            self._giorni.move_to_end(chiave)
+            self.eventi["hit"] += 1
+            return voce[1]
+
+    def memorizza(self, chiave:tuple, conteggi:dict):
+        with self._lock:
+            self._giorni[chiave] = (time.monotonic() + self.ttl, conteggi)
+            self._giorni.move_to_end(chiave)
+            while len(self._giorni) > self.voci:
+                self._giorni.popitem(last=False)
+
+def inizio_periodo(giorno:date, periodo:str = PERIODO) -> date:
+    if periodo == "mese":
+        return giorno.replace(day=1)
+    if periodo == "settimana":
+        return giorno - timedelta(days=giorno.weekday())
+    return giorno
+
+def fine_periodo(giorno:date, periodo:str = PERIODO) -> date:
+    if periodo == "mese":
+        return (giorno.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
+    if periodo == "settimana":
+        return inizio_periodo(giorno, periodo) + timedelta(days=6)
+    return giorno
+
+def primo_giorno_aperto() -> date:
+    return date.today() - timedelta(days=GIORNI_APERTI - 1)
+
+def proteggi(conteggi:dict) -> tuple[dict, set]:
+    '''
+        Soppressione primaria e complementare dei conteggi di un periodo (chiavi: valori di tutti gli ATTRIBUTI).
+        Per ogni sottoinsieme di ATTRIBUTI (tupla di indici) calcola la tabella dei conteggi; ogni cella di una
+        tabella è la somma delle celle della tabella con un attributo in più che la estendono. Vengono soppresse
+        le celle con meno di K ingressi e, finché una di queste somme ha una sola cella soppressa (ricavabile
+        per differenza), la cella visibile più piccola tra gli addendi (o il totale, se non ce ne sono).
+        Restituisce le tabelle {sottoinsieme: {valori: ingressi}} e le celle soppresse (sottoinsieme, valori).
+    '''
+    sottoinsiemi = [s for n in range(len(ATTRIBUTI) + 1) for s in combinations(range(len(ATTRIBUTI)), n)]
+    tabelle = {}
+    for s in sottoinsiemi:
+        tabella = Counter()
+        for valori, ingressi in conteggi.items():
+            tabella[tuple(valori[i] for i in s)] += ingressi
+        tabelle[s] = tabella
+
+    somme = []                      # (totale, addendi) con celle (sottoinsieme, valori)
+    per_cella = defaultdict(list)   # somme in cui compare ogni cella
+    for s in sottoinsiemi:
+        for i in range(len(ATTRIBUTI)):
+            if i in s:
+                continue
+            esteso = tuple(sorted(s + (i,)))
+            posizione = esteso.index(i)
+            addendi = defaultdict(list)
+            for valori in tabelle[esteso]:
+                addendi[valori[:posizione] + valori[posizione + 1:]].append((esteso, valori))
+            for valori, celle in addendi.items():
+                for cella in [(s, valori)] + celle:
+                    per_cella[cella].append(len(somme))
+                somme.append(((s, valori), celle))
+
+    soppresse = {(s, valori) for s, tabella in tabelle.items() for valori, ingressi in tabella.items() if ingressi < K}
+    da_controllare = {somma for cella in soppresse for somma in per_cella[cella]}
+    while da_controllare:
+        totale, addendi = somme[da_controllare.pop()]
+        if (totale in soppresse) + sum(cella in soppresse for cella in addendi) != 1:
+            continue
+        visibili = [cella for cella in addendi if cella not in soppresse]
+        # A parità di ingressi la scelta dipende solo dai valori: lo stesso periodo è protetto sempre allo stesso modo
+        scelta = min(visibili, key=lambda cella: (tabelle[cella[0]][cella[1]], cella[1])) if visibili else totale
+        soppresse.add(scelta)
+        da_controllare.update(per_cella[scelta])
+    return tabelle, soppresse
+
+def periodi_protetti(lettore:Reportistica, dal:date, al:date, indici:tuple):
+    '''
+        Generatore dei periodi di [dal, al] con le celle pubblicabili del raggruppamento indicato (indici di
+        ATTRIBUTI) ed il numero di celle soppresse: tuple (inizio, {valori: ingressi}, soppresse). Legge
+        dal database tutte le palestre, circa quattro settimane alla volta (un mese con REPORT_PERIODO=mese);
+        solleva RuntimeError se il database non è disponibile.
+    '''
+    inizio = dal
+    while inizio <= al:
+        fine = min(al, fine_periodo(inizio + timedelta(days=27)))
+        letti = lettore.conteggi(inizio, fine, ATTRIBUTI)
+        if letti is None:
+            raise RuntimeError("database non disponibile")
+        per_periodo = defaultdict(Counter)
+        for giorno, conteggi in letti.items():
+            per_periodo[inizio_periodo(giorno)].update(conteggi)
+        periodo = inizio
+        while periodo <= fine:
+            tabelle, soppresse = proteggi(per_periodo.get(periodo, {}))
+            yield periodo, {valori: ingressi for valori, ingressi in tabelle[indici].items() if (indici, valori) not in soppresse}, \
+                sum(cella[0] == indici for cella in soppresse)
+            periodo = fine_periodo(periodo) + timedelta(days=1)
+        inizio = fine + timedelta(days=1)
+
+def statistiche(lettore:Reportistica, cache:CacheReport, dal:date, al:date, dimensioni:tuple,
+                palestre:list | None = None) -> tuple[list, int] | None:
+    '''
+        Conteggi protetti dei periodi di [dal, al] (allineati e chiusi, vedi leggiParametri) raggruppati per le
+        dimensioni indicate, dalla cache quando possibile. Restituisce le righe pubblicabili, selezionate per
+        palestra se indicato, ed il numero di gruppi soppressi.
+    '''
+    # "data" è sempre una dimensione: i periodi non vengono mai sommati
+    indici = tuple(i for i, attributo in enumerate(ATTRIBUTI) if attributo in dimensioni)
+    periodi = []
+    periodo = dal
+    while periodo <= al:
+        periodi.append(periodo)
+        periodo = fine_periodo(periodo) + timedelta(days=1)
+    per_periodo = {}
+    for periodo in periodi:
+        voce = cache.cerca((periodo, indici))
+        if voce is not None:
+            per_periodo[periodo] = voce
+
+    # Un'unica lettura per l'intervallo dei periodi mancanti
+    mancanti = [periodo for periodo in periodi if periodo not in per_periodo]
+    if mancanti:
+        try:
+            for periodo, pubblicabili, soppresse in periodi_protetti(lettore, mancanti[0], fine_periodo(mancanti[-1]), indici):
+                per_periodo[periodo] = (pubblicabili, soppresse)
+                cache.memorizza((periodo, indici), per_periodo[periodo])
+        except RuntimeError:
+            return None
+
+    nomi = ("data",) + tuple(ATTRIBUTI[i] for i in indici)
+    posizione_palestra = indici.index(0) if 0 in indici else None
+    righe, soppresse = [], 0
+    for periodo in periodi:
+        pubblicabili, soppresse_periodo = per_periodo[periodo]
+        soppresse += soppresse_periodo
+        for valori, ingressi in sorted(pubblicabili.items()):
+            if palestre and valori[posizione_palestra] not in palestre:
+                continue
+            riga = dict(zip(nomi, (periodo.isoformat(),) + valori))
+            riga["ingressi"] = ingressi
+            righe.append(riga)
+    return righe, soppresse
+
+def righe_esportazione(lettore:Reportistica, dal:date, al:date, palestre:list | None = None):
+    '''
+        Generatore delle combinazioni pubblicabili di tutte le dimensioni per periodo, in ordine di periodo e
+        palestra, protette come quelle di /statistiche e lette dal database un blocco di periodi alla volta
+    '''
+    try:
+        for periodo, pubblicabili, _ in periodi_protetti(lettore, dal, al, tuple(range(len(ATTRIBUTI)))):
+            for valori, ingressi in sorted(pubblicabili.items()):
+                if not palestre or valori[0] in palestre:
+                    yield (periodo, *valori, ingressi)
+    except RuntimeError as e:
+        # Risposta già iniziata: l'esportazione viene interrotta (file troncato) e l'errore registrato
+        logger.error("Errore durante l'esportazione delle statistiche: %s", str(e))
+        raise
+
+class _Tampone(io.RawIOBase):
+    '''File in sola scrittura da cui prelevare i byte già scritti, per il ParquetWriter in streaming'''
+    def __init__(self):
+        super().__init__()
+        self._parti = []
+        self._posizione = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, dati) -> int:
+        self._parti.append(bytes(dati))
+        self._posizione += len(dati)
+        return len(dati)
+
+    def tell(self) -> int:
+        return self._posizione
+
+    def preleva(self) -> bytes:
+        dati = b"".join(self._parti)
+        self._parti = []
+        return dati
+
+def esporta(righe, formato:str):
+    '''Generatore dei blocchi di byte del file di esportazione nel formato indicato'''
+    if formato == "parquet":
+        # Un row group di RIGHE_PER_BLOCCO righe alla volta, compresso con zstd
+        schema = pyarrow.schema([("data", pyarrow.date32()), ("palestra", pyarrow.int32()),
+                                 ("fascia_oraria", pyarrow.string()), ("fascia_eta", pyarrow.string()),
+                                 ("sesso", pyarrow.string()), ("ingressi", pyarrow.int64())])
+        tampone = _Tampone()
+        with pyarrow.parquet.ParquetWriter(tampone, schema, compression="zstd") as writer:
+            for blocco in _blocchi(righe):
+                writer.write_table(pyarrow.Table.from_pylist(blocco, schema=schema))
+                yield tampone.preleva()
+        yield tampone.preleva()
+        return
+    if formato == "csv":
+        yield (",".join(DIMENSIONI + ("ingressi",)) + "\n").encode("utf-8")
+    for blocco in _blocchi(righe):
+        testo = io.StringIO()
+        if formato == "csv":
+            csv.writer(testo, lineterminator="\n").writerows(riga.values() for riga in blocco)
+        else:
+            testo.writelines(json.dumps(riga, default=str) + "\n" for riga in blocco)
+        yield testo.getvalue().encode("utf-8")
+
+def _blocchi(righe):
+    '''Raggruppa le righe del database in liste di RIGHE_PER_BLOCCO dizionari'''
+    blocco = []
+    for riga in righe:
+        blocco.append(dict(zip(DIMENSIONI + ("ingressi",), (*riga[:-1], int(riga[-1])))))
+        if len(blocco) >= RIGHE_PER_BLOCCO:
+            yield blocco
+            blocco = []
+    if blocco:
+        yield blocco
+
+def comprimi(blocchi):
+    '''Comprime in gzip, blocco per blocco, i byte prodotti da esporta'''
+    compressore = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for blocco in blocchi:
+        compresso = compressore.compress(blocco)
+        if compresso:
+            yield compresso
+    yield compressore.flush()
+
+# Utente in sola lettura dedicato ai report (vedi db/init/02-setup.sh)
+DATABASE_LS_URI = os.getenv("DATABASE_LS_URI") or \
+    f"mysql+pymysql://{os.getenv('DB_REPORT_USER')}:{prendisegreto('db_ls_report_password')}@{os.getenv('DB_LS_HOST')}/{os.getenv('DB_LS_DATABASE')}"
+REPORT_TOKEN = prendisegreto("report_token")
+
+lettore = Reportistica(DATABASE_LS_URI)
+cache = CacheReport()
+
+app = Flask(__name__)
+
+def leggiParametri() -> tuple[date, date, list]:
+    '''
+        Legge e controlla intervallo e palestre della richiesta: l'intervallo deve iniziare e finire con un
+        periodo di REPORT_PERIODO e contenere solo periodi chiusi. Solleva ValueError se non validi.
+    '''
+    dal = date.fromisoformat(request.args.get("dal", ""))
+    al = date.fromisoformat(request.args.get("al", ""))
+    if not 0 <= (al - dal).days < MAX_GIORNI:
+        raise ValueError(f"l'intervallo deve avere al più {MAX_GIORNI} giorni, con dal non successivo ad al")
+    if dal != inizio_periodo(dal) or al != fine_periodo(al):
+        raise ValueError(f"dal ed al devono essere il primo e l'ultimo giorno di un periodo ({PERIODO})")
+    if al >= primo_giorno_aperto():
+        raise ValueError(f"al deve essere precedente al {primo_giorno_aperto().isoformat()}: i periodi successivi non sono chiusi")
+    palestre = [int(p) for p in request.args.get("palestra", "").split(",") if p]
+    return dal, al, palestre
+
+@app.before_request
+def autenticazione():
+    '''Tutte le route richiedono il token dei report (confronto a tempo costante)'''
+    intestazione = request.headers.get("Authorization", "")
+    if not REPORT_TOKEN or not hmac.compare_digest(intestazione.encode(), f"Bearer {REPORT_TOKEN}".encode()):
+        return jsonify({"errore": "non autorizzato"}), 401
+
+@app.route("/statistiche", methods=["GET"])
+def route_statistiche():
+    try:
+        dal, al, palestre = leggiParametri()
+        dimensioni = tuple(d for d in request.args.get("raggruppa", "palestra").split(",") if d)
+        if not set(dimensioni) <= set(DIMENSIONI) or len(set(dimensioni)) != len(dimensioni):
+            raise ValueError(f"raggruppa deve contenere dimensioni distinte tra {', '.join(DIMENSIONI)}")
+        if palestre and "palestra" not in dimensioni:
+            # La somma di un sottoinsieme di palestre, per differenza, isolerebbe una palestra
+            raise ValueError("il filtro palestra richiede palestra tra le dimensioni di raggruppa")
+    except ValueError as e:
+        return jsonify({"errore": str(e)}), 400
+
+    risultato = statistiche(lettore, cache, dal, al, dimensioni, palestre)
+    if risultato is None:
+        return jsonify({"errore": "database non disponibile"}), 503
+    righe, soppresse = risultato
+    return jsonify({"dal": dal.isoformat(), "al": al.isoformat(), "periodo": PERIODO,
+                    "raggruppa": ["data"] + [d for d in ATTRIBUTI if d in dimensioni], "k": K,
+                    "soppresse": soppresse, "righe": righe})
+
+@app.route("/esportazione", methods=["GET"])
+def route_esportazione():
+    formato = request.args.get("formato", "csv")
+    compressione = request.args.get("compressione")
+    try:
+        dal, al, palestre = leggiParametri()
+        if formato not in ("csv", "jsonl", "parquet"):
+            raise ValueError("formato deve essere csv, jsonl o parquet")
+        if formato == "parquet" and pyarrow is None:
+            raise ValueError("formato parquet non disponibile (pyarrow non installato)")
+        if compressione not in (None, "gzip"):
+            raise ValueError("compressione deve essere gzip")
+    except ValueError as e:
+        return jsonify({"errore": str(e)}), 400
+
+    blocchi = esporta(righe_esportazione(lettore, dal, al, palestre), formato)
+    nome = f"statistiche_{dal.isoformat()}_{al.isoformat()}.{formato}"
+    # Il parquet è già compresso per colonna
+    if compressione == "gzip" and formato != "parquet":
+        blocchi = comprimi(blocchi)
+        nome += ".gz"
+    tipi = {"csv": "text/csv", "jsonl": "application/x-ndjson", "parquet": "application/vnd.apache.parquet"}
+    return Response(stream_with_context(blocchi), mimetype="application/gzip" if nome.endswith(".gz") else tipi[formato],
+                    headers={"Content-Disposition": f'attachment; filename="{nome}"'})
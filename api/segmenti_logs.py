@@ -0,0 +1,293 @@
+'''
+Modulo Python con il formato dei segmenti dell'archivio freddo di Logs (vedi archivio_logs.py). Un segmento
+è un file immutabile con gli ingressi di un intervallo di giorni, ordinati per pseudonimo di SmartCard,
+timestamp ed Id, diviso in blocchi compressi con zlib e seguito da un indice sparso non compresso:
+
+    intestazione | blocco 0 | blocco 1 | ... | indice
+
+- intestazione (FORMATO_INTESTAZIONE): "WFLA", versione del formato, primo giorno ed ultimo giorno escluso
+  (ordinali di date), numero di righe e di blocchi, posizione dell'indice;
+- blocco: gli ingressi per colonne (pseudonimi distinti con il numero di ingressi di ognuno, secondi dal
+  primo giorno del segmento, palestre, Id), in modo che zlib comprima bene le colonne numeriche;
+- indice: una voce a lunghezza fissa per blocco (FORMATO_VOCE) con i prefissi del primo e dell'ultimo
+  pseudonimo, posizione, lunghezza, righe e CRC32 del blocco compresso.
+
+La ricerca di una tessera apre il file con mmap, esegue una ricerca binaria sull'indice e decomprime i soli
+blocchi che possono contenere lo pseudonimo (di norma uno): poche pagine lette per segmento. Il modulo usa
+la sola libreria standard, in modo da poter essere importato anche dagli strumenti in external/.
+'''
+from array import array
+from bisect import bisect_left
+from datetime import date, datetime, timedelta
+from itertools import accumulate
+import glob, hashlib, heapq, mmap, os, re, struct, sys, zlib
+
+MAGIC = b"WFLA"
+FORMATO = 1
+FORMATO_INTESTAZIONE = "<4sBIIQIQ"       # magic, formato, giorno_da, giorno_a, righe, blocchi, inizio_indice
+DIMENSIONE_INTESTAZIONE = struct.calcsize(FORMATO_INTESTAZIONE)
+LUNGHEZZA_PREFISSO = 16                  # caratteri di pseudonimo nell'indice (96 bit: nessuna collisione pratica)
+FORMATO_VOCE = f"<{LUNGHEZZA_PREFISSO}s{LUNGHEZZA_PREFISSO}sQIII"   # primo, ultimo, posizione, lunghezza, righe, crc32
+DIMENSIONE_VOCE = struct.calcsize(FORMATO_VOCE)
+LUNGHEZZA_PSEUDONIMO = 344               # base64 di 256 byte (chiave RSA a 2048 bit), come la colonna SmartCardId
+DIMENSIONE_BLOCCO = int(os.getenv("ARCHIVIO_DIMENSIONE_BLOCCO", "32768"))   # byte non compressi per blocco
+LIVELLO_COMPRESSIONE = int(os.getenv("ARCHIVIO_COMPRESSIONE", "6"))
+# Nome dei file: logs-<primo giorno>-<giorno successivo all'ultimo>.wfla
+NOME_SEGMENTO = re.compile(r"^logs-(\d{8})-(\d{8})\.wfla$")
+
+def nome_segmento(dal:date, al:date) -> str:
+    return f"logs-{dal:%Y%m%d}-{al:%Y%m%d}.wfla"
+
+def _in_little_endian(valori:array) -> bytes:
+    if sys.byteorder == "big":
+        valori = array(valori.typecode, valori)
+        valori.byteswap()
+    return valori.tobytes()
+
+def _da_little_endian(tipo:str, dati) -> array:
+    valori = array(tipo)
+    valori.frombytes(dati)
+    if sys.byteorder == "big":
+        valori.byteswap()
+    return valori
+
+def _chiave(pseudonimo:str) -> bytes:
+    '''Pseudonimo come bytes a lunghezza fissa, con lo stesso ordinamento della colonna SmartCardId (ascii_bin)'''
+    chiave = pseudonimo.encode("ascii")
+    if len(chiave) > LUNGHEZZA_PSEUDONIMO:
+        raise ValueError(f"Pseudonimo più lungo di {LUNGHEZZA_PSEUDONIMO} caratteri")
+    return chiave.ljust(LUNGHEZZA_PSEUDONIMO, b"\0")
+
+def _prefisso(chiave:bytes) -> bytes:
+    return chiave[:LUNGHEZZA_PREFISSO]
+
+class _Blocco:
+    '''Righe di un blocco in costruzione, già raggruppate per pseudonimo'''
+    def __init__(self):
+        self.pseudonimi, self.conteggi = [], array("I")
+        self.secondi, self.palestre, self.ids = array("I"), array("i"), array("Q")
+
+    def aggiungi(self, chiave:bytes, secondi:int, palestra_id:int, log_id:int):
+        if not self.pseudonimi or self.pseudonimi[-1] != chiave:
+            self.pseudonimi.append(chiave)
+            self.conteggi.append(0)
+        self.conteggi[-1] += 1
+        self.secondi.append(secondi)
+        self.palestre.append(palestra_id)
+        self.ids.append(log_id)
+
+    def dimensione(self) -> int:
+        return len(self.pseudonimi) * LUNGHEZZA_PSEUDONIMO + len(self.ids) * 20
+
+    def comprimi(self) -> bytes:
+        return zlib.compress(struct.pack("<II", len(self.pseudonimi), len(self.ids)) + b"".join(self.pseudonimi)
+                             + b"".join(_in_little_endian(colonna) for colonna in
+                                        (self.conteggi, self.secondi, self.palestre, self.ids)),
+                             LIVELLO_COMPRESSIONE)
+
+def scrivi_segmento(percorso:str, righe, dal:date, al:date) -> dict:
+    '''
+        Scrive un segmento con le righe (pseudonimo, palestra_id, timestamp, log_id) degli ingressi con timestamp
+        in [dal, al), già ordinate per pseudonimo, timestamp ed Id (come dall'indice IdxLogsSmartCardTimestamp).
+        Il file viene scritto accanto alla destinazione e rinominato solo quando è completo, poi reso di sola
+        lettura. Restituisce righe, blocchi, byte e SHA-256 del segmento. Solleva ValueError se le righe non
+        sono ordinate o sono fuori dall'intervallo.
+    '''
+    inizio = datetime.combine(dal, datetime.min.time())
+    limite = (al - dal).days * 86400
+    temporaneo = f"{percorso}.{os.getpid()}.tmp"
+    indice, totale, precedente = [], 0, None
+    try:
+        with open(temporaneo, "wb") as f:
+            f.write(b"\0" * DIMENSIONE_INTESTAZIONE)
+            blocco = _Blocco()
+
+            def chiudi_blocco():
+                dati = blocco.comprimi()
+                indice.append(struct.pack(FORMATO_VOCE, _prefisso(blocco.pseudonimi[0]), _prefisso(blocco.pseudonimi[-1]),
+                                          f.tell(), len(dati), len(blocco.ids), zlib.crc32(dati)))
+                f.write(dati)
+
+            for pseudonimo, palestra_id, timestamp, log_id in righe:
+                chiave = _chiave(pseudonimo)
+                secondi = int((timestamp - inizio).total_seconds())
+                if not 0 <= secondi < limite:
+                    raise ValueError(f"Ingresso {log_id} del {timestamp} fuori dall'intervallo del segmento")
+                if precedente is not None and (chiave, secondi, log_id) < precedente:
+                    raise ValueError(f"Ingresso {log_id} non ordinato per pseudonimo, timestamp ed Id")
+                # Uno pseudonimo può proseguire nel blocco successivo: l'indice ne tiene conto nella ricerca
+                if blocco.dimensione() >= DIMENSIONE_BLOCCO:
+                    chiudi_blocco()
+                    blocco = _Blocco()
+                blocco.aggiungi(chiave, secondi, palestra_id, log_id)
+                precedente = (chiave, secondi, log_id)
+                totale += 1
+            if blocco.ids:
+                chiudi_blocco()
+            inizio_indice = f.tell()
+            f.write(b"".join(indice))
+            f.seek(0)
+            f.write(struct.pack(FORMATO_INTESTAZIONE, MAGIC, FORMATO, dal.toordinal(), al.toordinal(),
+                                totale, len(indice), inizio_indice))
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(temporaneo, 0o444)
+        os.replace(temporaneo, percorso)
+    except BaseException:
+        if os.path.exists(temporaneo):
+            os.remove(temporaneo)
+        raise
+    return {"righe": totale, "blocchi": len(indice), "byte": os.path.getsize(percorso), "sha256": impronta(percorso)}
+
+def impronta(percorso:str) -> str:
+    '''SHA-256 del file, per verificare in seguito che il segmento non sia stato alterato'''
+    sha = hashlib.sha256()
+    with open(percorso, "rb") as f:
+        while dati := f.read(1 << 20):
+            sha.update(dati)
+    return sha.hexdigest()
+
+class Segmento:
+    '''Lettura di un segmento mappato in memoria'''
+    def __init__(self, percorso:str):
+        self.percorso = percorso
+        with open(percorso, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, formato, giorno_da, giorno_a, self.righe, self.blocchi, self._indice = \
+                struct.unpack_from(FORMATO_INTESTAZIONE, self._mm)
+            if magic != MAGIC or formato != FORMATO:
+                raise ValueError(f"{percorso} non è un segmento di Logs (formato {formato})")
+            if self._indice + self.blocchi * DIMENSIONE_VOCE != len(self._mm):
+                raise ValueError(f"{percorso} è troncato")
+        except (struct.error, ValueError):
+            self._mm.close()
+            raise
+        self.dal, self.al = date.fromordinal(giorno_da), date.fromordinal(giorno_a)
+        self._inizio = datetime.combine(self.dal, datetime.min.time())
+
+    def close(self):
+        self._mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *eccezione):
+        self.close()
+
+    def _voce(self, numero:int) -> tuple:
+        return struct.unpack_from(FORMATO_VOCE, self._mm, self._indice + numero * DIMENSIONE_VOCE)
+
+    def _ultimo(self, numero:int) -> bytes:
+        posizione = self._indice + numero * DIMENSIONE_VOCE + LUNGHEZZA_PREFISSO
+        return self._mm[posizione:posizione + LUNGHEZZA_PREFISSO]
+
+    def _blocco(self, numero:int) -> tuple:
+        '''Decomprime un blocco: pseudonimi distinti, ingressi per pseudonimo, secondi, palestre ed Id'''
+        _, _, posizione, lunghezza, righe, crc = self._voce(numero)
+        dati = self._mm[posizione:posizione + lunghezza]
+        if zlib.crc32(dati) != crc:
+            raise ValueError(f"Blocco {numero} di {self.percorso} danneggiato")
+        dati = zlib.decompress(dati)
+        distinti, righe = struct.unpack_from("<II", dati)
+        posizione = 8 + distinti * LUNGHEZZA_PSEUDONIMO
+        pseudonimi = dati[8:posizione]
+        colonne = []
+        for tipo, quanti in (("I", distinti), ("I", righe), ("i", righe), ("Q", righe)):
+            fine = posizione + quanti * array(tipo).itemsize
+            colonne.append(_da_little_endian(tipo, dati[posizione:fine]))
+            posizione = fine
+        return (pseudonimi, *colonne)
+
+    def _righe_blocco(self, numero:int, chiave:bytes | None = None):
+        pseudonimi, conteggi, secondi, palestre, ids = self._blocco(numero)
+        if chiave is None:
+            scelti = range(len(conteggi))
+        else:
+            # Ricerca in C tra gli pseudonimi a lunghezza fissa, invece di confrontarli uno ad uno
+            posizione = pseudonimi.find(chiave)
+            while posizione > 0 and posizione % LUNGHEZZA_PSEUDONIMO:
+                posizione = pseudonimi.find(chiave, posizione + 1)
+            scelti = [posizione // LUNGHEZZA_PSEUDONIMO] if posizione >= 0 else []
+        inizi = [0, *accumulate(conteggi)]
+        for i in scelti:
+            pseudonimo = pseudonimi[i * LUNGHEZZA_PSEUDONIMO:(i + 1) * LUNGHEZZA_PSEUDONIMO].rstrip(b"\0").decode("ascii")
+            for j in range(inizi[i], inizi[i + 1]):
+                yield pseudonimo, palestre[j], self._inizio + timedelta(seconds=secondi[j]), ids[j]
+
+    def righe_ordinate(self):
+        '''Tutti gli ingressi del segmento, nell'ordine di scrittura (per pseudonimo, timestamp ed Id)'''
+        for numero in range(self.blocchi):
+            yield from self._righe_blocco(numero)
+
+    def cerca(self, pseudonimo:str, dal:datetime | None = None, al:datetime | None = None):
+        '''Ingressi di uno pseudonimo, in ordine di tempo, con timestamp in [dal, al) se indicati'''
+        chiave = _chiave(pseudonimo)
+        prefisso = _prefisso(chiave)
+        # Primo blocco il cui ultimo pseudonimo non precede quello cercato (gli ultimi sono in ordine)
+        primo = bisect_left(range(self.blocchi), prefisso, key=self._ultimo)
+        for numero in range(primo, self.blocchi):
+            if self._voce(numero)[0] > prefisso:
+                break
+            for riga in self._righe_blocco(numero, chiave):
+                if (dal is None or riga[2] >= dal) and (al is None or riga[2] < al):
+                    yield riga
+
+def unisci_segmenti(percorso:str, segmenti:list[Segmento]) -> dict:
+    '''Scrive in un solo segmento gli ingressi di più segmenti (es. i giorni di un mese), senza caricarli in memoria'''
+    def ordine(riga:tuple) -> tuple:
+        return _chiave(riga[0]), riga[2], riga[3]
+    return scrivi_segmento(percorso, heapq.merge(*(s.righe_ordinate() for s in segmenti), key=ordine),
+                           min(s.dal for s in segmenti), max(s.al for s in segmenti))
+
+class Archivio:
+    '''
+        Insieme dei segmenti di una cartella. I segmenti vengono scelti dal nome del file, senza aprirli, e
+        quelli contenuti in un segmento più ampio (giorni già compattati in un mese) vengono ignorati.
+    '''
+    def __init__(self, cartella:str):
+        self.cartella = cartella
+        self._aperti = {}
+
+    def intervalli(self) -> dict:
+        '''Intervalli [dal, al) dei segmenti presenti, per percorso'''
+        trovati = {}
+        for percorso in glob.glob(os.path.join(self.cartella, "logs-*.wfla")):
+            if corrispondenza := NOME_SEGMENTO.match(os.path.basename(percorso)):
+                dal, al = (datetime.strptime(g, "%Y%m%d").date() for g in corrispondenza.groups())
+                trovati[percorso] = (dal, al)
+        return trovati
+
+    def segmenti(self, dal:date | None = None, al:date | None = None) -> list[str]:
+        '''Percorsi dei segmenti con ingressi in [dal, al), in ordine di tempo'''
+        intervalli = self.intervalli()
+        scelti = [percorso for percorso, (inizio, fine) in intervalli.items()
+                  if (dal is None or fine > dal) and (al is None or inizio < al)
+                  and not any(a <= inizio and fine <= b and (a, b) != (inizio, fine) for a, b in intervalli.values())]
+        return sorted(scelti, key=intervalli.get)
+
+    def apri(self, percorso:str) -> Segmento:
+        if percorso not in self._aperti:
+            self._aperti[percorso] = Segmento(percorso)
+        return self._aperti[percorso]
+
+    def close(self):
+        for segmento in self._aperti.values():
+            segmento.close()
+        self._aperti.clear()
+
+    def cerca(self, pseudonimo:str, dal:date | None = None, al:date | None = None):
+        '''Ingressi di uno pseudonimo in tutti i segmenti dell'intervallo, in ordine di tempo'''
+        inizio = datetime.combine(dal, datetime.min.time()) if dal else None
+        fine = datetime.combine(al, datetime.min.time()) if al else None
+        for percorso in self.segmenti(dal, al):
+            yield from self.apri(percorso).cerca(pseudonimo, inizio, fine)
+
+    def righe(self, dal:date | None = None, al:date | None = None):
+        '''Tutti gli ingressi dell'intervallo, segmento per segmento (ogni segmento è ordinato per pseudonimo)'''
+        inizio = datetime.combine(dal, datetime.min.time()) if dal else None
+        fine = datetime.combine(al, datetime.min.time()) if al else None
+        for percorso in self.segmenti(dal, al):
+            for riga in self.apri(percorso).righe_ordinate():
+                if (inizio is None or riga[2] >= inizio) and (fine is None or riga[2] < fine):
+                    yield riga
@@ -0,0 +1,223 @@
+'''
+Modulo Python per gli snapshot delle tessere valide, scaricati dai tornelli per decidere gli accessi anche
+senza rete (vedi client/script.js). Uno snapshot è la lista compatta, ordinata per Smart Card ID, delle
+tessere con un abbonamento valido e del giorno di scadenza, firmata con HMAC-SHA256 e la chiave API dei
+tornelli. Gli abbonamenti del Gestionale non sono legati ad una palestra: lo snapshot è unico per la catena.
+
+Gli snapshot vengono costruiti periodicamente da un solo worker alla volta (lock su file) nella cartella
+SNAPSHOT_DIR e identificati da una versione crescente. Un tornello che indica la propria versione riceve,
+se questa è ancora conservata, solo il delta verso l'ultima: voci aggiunte o con scadenza cambiata ed ID
+rimossi.
+
+Formati (interi dell'intestazione in little-endian, voci in big-endian):
+- snapshot: "WFSN", formato, versione, giorno di costruzione, numero di voci | voci da 5 byte: 3 byte di
+  Smart Card ID (6 cifre esadecimali) + 2 byte di scadenza (giorni dal 1970-01-01) | firma (32 byte)
+- delta: "WFSD", formato, versione di partenza, versione di arrivo, giorno di costruzione, voci aggiunte,
+  ID rimossi | voci aggiunte da 5 byte | ID rimossi da 3 byte | firma (32 byte)
+La firma è l'HMAC-SHA256 di tutti i byte precedenti. Un tornello accetta una tessera senza rete se è nello
+snapshot e la scadenza è successiva ad oggi (stessa regola di verifica_accesso: ValidoAl > giorno).
+'''
+from db_handler import Gestionale
+from datetime import date
+from hashlib import sha256
+from sys import stdout
+import fcntl, glob, hmac, logging, os, re, struct, threading, time
+
+# Impostazione di Logging per stampare eventuali eccezioni nei Docker Logs
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler(stdout)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+logger.setLevel(logging.ERROR)
+
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", "/tmp/worldfit_snapshot")
+INTERVALLO = float(os.getenv("SNAPSHOT_INTERVALLO", "300"))    # secondi tra due costruzioni
+CONSERVATI = int(os.getenv("SNAPSHOT_CONSERVATI", "48"))        # versioni conservate per i delta
+
+MAGIC_SNAPSHOT = b"WFSN"
+MAGIC_DELTA = b"WFSD"
+FORMATO = 1
+INTESTAZIONE_SNAPSHOT = struct.Struct("<4sBIHI")
+INTESTAZIONE_DELTA = struct.Struct("<4sBIIHII")
+BYTE_ID = 3
+BYTE_VOCE = BYTE_ID + 2
+BYTE_FIRMA = 32
+INIZIO_CONTENUTO = 9    # primo byte dopo magic, formato e versione dello snapshot
+ORDINALE_EPOCA = date(1970, 1, 1).toordinal()
+SCADENZA_MASSIMA = 0xFFFF   # giorni dal 1970-01-01 rappresentabili nei 2 byte di scadenza
+SMART_CARD_ID = re.compile(r"[0-9A-Fa-f]{6}")
+
+def firma(dati:bytes, chiave:str) -> bytes:
+    return hmac.new(key=chiave.encode('utf-8'), msg=dati, digestmod=sha256).digest()
+
+def verifica(dati:bytes, chiave:str) -> bytes | None:
+    '''Restituisce i dati senza firma se la firma è corretta, altrimenti None'''
+    if len(dati) < BYTE_FIRMA or not hmac.compare_digest(dati[-BYTE_FIRMA:], firma(dati[:-BYTE_FIRMA], chiave)):
+        return None
+    return dati[:-BYTE_FIRMA]
+
+def costruisci(righe, versione:int, giorno:date, chiave:str) -> bytes:
+    '''
+        Costruisce lo snapshot firmato dalle coppie (SmartCardID, scadenza). Gli ID che non sono 6 cifre
+        esadecimali vengono esclusi (per questi il tornello deve sempre interrogare l'API). Le scadenze oltre
+        i 2 byte della voce (dopo il 2149-06-06, es. 9999-12-31 per gli abbonamenti a vita) diventano l'ultimo
+        giorno rappresentabile
+    '''
+    # Ogni voce come 10 cifre esadecimali (ID + scadenza): in ordine alfabetico gli ID a lunghezza fissa sono
+    # in ordine numerico e, a parità di ID, l'ultima voce ha la scadenza maggiore
+    voci = sorted(f"{smart_card_id.upper()}{min(scadenza.toordinal() - ORDINALE_EPOCA, SCADENZA_MASSIMA):04X}"
+                  for smart_card_id, scadenza in righe if smart_card_id and SMART_CARD_ID.fullmatch(smart_card_id))
+    voci = [voce for voce, successiva in zip(voci, voci[1:] + [""]) if voce[:2 * BYTE_ID] != successiva[:2 * BYTE_ID]]
+    dati = INTESTAZIONE_SNAPSHOT.pack(MAGIC_SNAPSHOT, FORMATO, versione, giorno.toordinal() - ORDINALE_EPOCA, len(voci)) \
+        + bytes.fromhex("".join(voci))
+    return dati + firma(dati, chiave)
+
+def _voci(snapshot:bytes) -> dict:
+    '''Voci di uno snapshot (già verificato) come dizionario ID -> scadenza, entrambi in byte'''
+    voci = memoryview(snapshot)[INTESTAZIONE_SNAPSHOT.size:len(snapshot) - BYTE_FIRMA]
+    return {bytes(voci[i:i + BYTE_ID]): bytes(voci[i + BYTE_ID:i + BYTE_VOCE]) for i in range(0, len(voci), BYTE_VOCE)}
+
+def _insieme_voci(snapshot:bytes) -> set:
+    '''Voci (5 byte) di uno snapshot già verificato'''
+    voci = snapshot[INTESTAZIONE_SNAPSHOT.size:len(snapshot) - BYTE_FIRMA]
+    return {voci[i:i + BYTE_VOCE] for i in range(0, len(voci), BYTE_VOCE)}
+
+def calcola_delta(vecchio:bytes, nuovo:bytes, chiave:str) -> bytes:
+    '''Delta firmato che trasforma lo snapshot vecchio nel nuovo'''
+    _, _, da_versione, _, _ = INTESTAZIONE_SNAPSHOT.unpack_from(vecchio)
+    _, _, a_versione, giorno, _ = INTESTAZIONE_SNAPSHOT.unpack_from(nuovo)
+    voci_vecchie, voci_nuove = _insieme_voci(vecchio), _insieme_voci(nuovo)
+    # Voci nuove o con scadenza cambiata; delle voci sparite vengono rimossi gli ID non più presenti
+    aggiunte = sorted(voci_nuove - voci_vecchie)
+    rimosse = sorted({voce[:BYTE_ID] for voce in voci_vecchie - voci_nuove} - {voce[:BYTE_ID] for voce in aggiunte})
+    dati = INTESTAZIONE_DELTA.pack(MAGIC_DELTA, FORMATO, da_versione, a_versione, giorno, len(aggiunte), len(rimosse)) \
+        + b"".join(aggiunte) + b"".join(rimosse)
+    return dati + firma(dati, chiave)
+
+def applica_delta(snapshot:bytes, delta:bytes, chiave:str) -> bytes | None:
+    '''Applica un delta verificato allo snapshot (come fa il tornello); None se firma o versioni non corrispondono'''
+    dati = verifica(delta, chiave)
+    if dati is None:
+        return None
+    _, _, da_versione, a_versione, giorno, n_aggiunte, n_rimosse = INTESTAZIONE_DELTA.unpack_from(dati)
+    if INTESTAZIONE_SNAPSHOT.unpack_from(snapshot)[2] != da_versione:
+        return None
+    voci = _voci(snapshot)
+    inizio = INTESTAZIONE_DELTA.size
+    for i in range(inizio + n_aggiunte * BYTE_VOCE, inizio + n_aggiunte * BYTE_VOCE + n_rimosse * BYTE_ID, BYTE_ID):
+        voci.pop(dati[i:i + BYTE_ID], None)
+    for i in range(inizio, inizio + n_aggiunte * BYTE_VOCE, BYTE_VOCE):
+        voci[dati[i:i + BYTE_ID]] = dati[i + BYTE_ID:i + BYTE_VOCE]
+    nuovo = INTESTAZIONE_SNAPSHOT.pack(MAGIC_SNAPSHOT, FORMATO, a_versione, giorno, len(voci)) \
+        + b"".join(smart_card_id + voci[smart_card_id] for smart_card_id in sorted(voci))
+    return nuovo + firma(nuovo, chiave)
+
+class ArchivioSnapshot:
+    '''
+    Classe che costruisce e conserva gli snapshot nella cartella condivisa dai workers e prepara le risposte
+    ai tornelli. Il thread di costruzione viene avviato alla prima richiesta in ogni processo.
+    '''
+    def __init__(self, gestore:Gestionale, chiave:str, cartella:str = SNAPSHOT_DIR,
+                 intervallo:float = INTERVALLO, conservati:int = CONSERVATI):
+        self.gestore = gestore
+        self.chiave = chiave
+        self.cartella = cartella
+        self.intervallo = intervallo
+        self.conservati = conservati
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _percorso(self, versione:int) -> str:
+        return os.path.join(self.cartella, f"snapshot-{versione}.bin")
+
+    def versioni(self) -> list:
+        '''Versioni degli snapshot conservati, in ordine crescente'''
+        return sorted(int(os.path.basename(percorso)[9:-4])
+                      for percorso in glob.glob(os.path.join(self.cartella, "snapshot-*.bin")))
+
+    def aggiorna(self, forza:bool = False) -> int | None:
+        '''
+            Costruisce un nuovo snapshot se l'ultimo ha più di "intervallo" secondi e nessun altro worker lo sta
+            costruendo. Se le voci non sono cambiate la versione resta la stessa. Restituisce l'ultima versione.
+        '''
+        os.makedirs(self.cartella, exist_ok=True)
+        with open(os.path.join(self.cartella, "snapshot.lock"), "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None # costruzione in corso in un altro worker
+            versioni = self.versioni()
+            ultima = versioni[-1] if versioni else None
+            if ultima is not None and not forza and time.time() - os.path.getmtime(self._percorso(ultima)) < self.intervallo:
+                return ultima
+            oggi = date.today()
+            righe = self.gestore.select_scadenze_attive(oggi)
+            if righe is None:
+                return ultima
+            versione = max(int(time.time()), (ultima or 0) + 1)
+            dati = costruisci(righe, versione, oggi, self.chiave)
+            if ultima is not None:
+                with open(self._percorso(ultima), "rb") as f:
+                    precedente = f.read()
+                # Stesse voci e stesso giorno: la versione resta valida, ne viene solo rinnovata la data
+                if precedente[INIZIO_CONTENUTO:-BYTE_FIRMA] == dati[INIZIO_CONTENUTO:-BYTE_FIRMA]:
+                    os.utime(self._percorso(ultima))
+                    return ultima
+            temporaneo = f"{self._percorso(versione)}.{os.getpid()}.tmp"
+            with open(temporaneo, "wb") as f:
+                f.write(dati)
+            os.replace(temporaneo, self._percorso(versione))
+            # Pulizia delle versioni più vecchie e dei delta che le riguardano
+            for vecchia in (versioni + [versione])[:-self.conservati]:
+                for schema in (f"snapshot-{vecchia}.bin", f"delta-{vecchia}-*.bin", f"delta-*-{vecchia}.bin"):
+                    for percorso in glob.glob(os.path.join(self.cartella, schema)):
+                        os.remove(percorso)
+            return versione
+
+    def risposta(self, versione_tornello:int | None = None) -> tuple[bytes, str] | None:
+        '''
+            Dati da inviare al tornello: il delta dalla sua versione, se conservata (anche vuoto se è già
+            l'ultima), oppure lo snapshot completo. Restituisce (dati, tipo), None se non ci sono snapshot.
+        '''
+        if self._pid != os.getpid():
+            self._avvia()
+        versioni = self.versioni()
+        if not versioni:
+            return None
+        ultima = versioni[-1]
+        try:
+            with open(self._percorso(ultima), "rb") as f:
+                nuovo = f.read()
+            if versione_tornello not in versioni:
+                return nuovo, "snapshot"
+            percorso_delta = os.path.join(self.cartella, f"delta-{versione_tornello}-{ultima}.bin")
+            if os.path.exists(percorso_delta):
+                with open(percorso_delta, "rb") as f:
+                    return f.read(), "delta"
+            with open(self._percorso(versione_tornello), "rb") as f:
+                delta = calcola_delta(f.read(), nuovo, self.chiave)
+            temporaneo = f"{percorso_delta}.{os.getpid()}.tmp"
+            with open(temporaneo, "wb") as f:
+                f.write(delta)
+            os.replace(temporaneo, percorso_delta)
+            return delta, "delta"
+        except FileNotFoundError:
+            # Versione rimossa dalla pulizia durante la lettura: al prossimo tentativo si riparte dall'elenco
+            return None
+
+    def _avvia(self):
+        '''Avvia il thread di costruzione nel processo corrente, se non già avviato'''
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._ciclo, name="snapshot-tessere", daemon=True).start()
+
+    def _ciclo(self):
+        while True:
+            try:
+                self.aggiorna()
+            except Exception as e:
+                logger.error("Errore nella costruzione dello snapshot delle tessere: %s", str(e))
+            time.sleep(min(self.intervallo, 60))
@@ -0,0 +1,136 @@
+'''
+Modulo Python per la tabella precalcolata degli pseudonimi delle Smart Card attive.
+La tabella è un file binario compatto, ordinato per Smart Card ID, che viene mappato in memoria
+(mmap) e condiviso tra i workers: una ricerca binaria sostituisce la cifratura RSA per ogni ingresso.
+
+Formato del file:
+- intestazione: "WFPS", versione, impronta SHA-256 di chiave e pad, numero di voci, byte per pseudonimo
+- voci ordinate: 3 byte di Smart Card ID (6 cifre esadecimali) + pseudonimo cifrato in big-endian
+'''
+from Crypto.PublicKey import RSA
+from Crypto.Util.number import bytes_to_long, long_to_bytes
+from privacy_modules import calcola_pseudonimo
+from hashlib import sha256
+from sys import stdout
+import base64, logging, mmap, os, struct
+
+# Impostazione di Logging per stampare eventuali eccezioni nei Docker Logs
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler(stdout)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+logger.setLevel(logging.ERROR)
+
+MAGIC = b"WFPS"
+VERSIONE = 1
+INTESTAZIONE = struct.Struct("<4sB32sIH")
+BYTE_ID = 3
+
+def impronta_chiave(encrypt_key:RSA.RsaKey, pseudo_pad:str) -> bytes:
+    '''Impronta SHA-256 di chiave e pad, per riconoscere una tabella calcolata con un'altra chiave'''
+    return sha256(long_to_bytes(encrypt_key.n) + long_to_bytes(encrypt_key.e) + pseudo_pad.encode('utf-8')).digest()
+
+class TabellaPseudonimi:
+    '''Classe per la ricerca degli pseudonimi in una tabella precalcolata, mappata in memoria'''
+    def __init__(self, percorso:str, encrypt_key:RSA.RsaKey, pseudo_pad:str):
+        with open(percorso, "rb") as f:
+            self._mappa = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, versione, impronta, self.voci, self.byte_pseudonimo = INTESTAZIONE.unpack_from(self._mappa, 0)
+        if magic != MAGIC or versione != VERSIONE:
+            raise ValueError(f"{percorso} non è una tabella di pseudonimi valida")
+        if impronta != impronta_chiave(encrypt_key, pseudo_pad):
+            raise ValueError(f"La tabella {percorso} è stata calcolata con una chiave o un pad diversi")
+        self._encrypt_key = encrypt_key
+        self._chiave = (encrypt_key.n, encrypt_key.e, pseudo_pad)
+        self._byte_voce = BYTE_ID + self.byte_pseudonimo
+
+    def _stessa_chiave(self, encrypt_key:RSA.RsaKey, pseudo_pad:str) -> bool:
+        # Confronto completo (costoso: n ed e vengono convertiti in int) solo se l'oggetto chiave è diverso
+        if encrypt_key is not self._encrypt_key:
+            if (encrypt_key.n, encrypt_key.e) != self._chiave[:2]:
+                return False
+            self._encrypt_key = encrypt_key
+        return pseudo_pad == self._chiave[2]
+
+    def __len__(self) -> int:
+        return self.voci
+
+    def cerca(self, smart_card_id:str, encrypt_key:RSA.RsaKey, pseudo_pad:str) -> str | None:
+        '''Restituisce lo pseudonimo della Smart Card, None se assente o se chiave e pad non corrispondono'''
+        if not self._stessa_chiave(encrypt_key, pseudo_pad) or len(smart_card_id) != 2 * BYTE_ID:
+            return None
+        try:
+            chiave = bytes.fromhex(smart_card_id)
+        except ValueError:
+            return None
+        # Ricerca binaria sulle voci ordinate per ID
+        basso, alto = 0, self.voci
+        while basso < alto:
+            medio = (basso + alto) // 2
+            inizio = INTESTAZIONE.size + medio * self._byte_voce
+            corrente = self._mappa[inizio:inizio + BYTE_ID]
+            if corrente < chiave:
+                basso = medio + 1
+            elif corrente > chiave:
+                alto = medio
+            else:
+                cifrato = self._mappa[inizio + BYTE_ID:inizio + self._byte_voce]
+                # Stessa codifica di calcola_pseudonimo: intero senza zeri iniziali, in Base64 URL-safe
+                return base64.urlsafe_b64encode(cifrato.lstrip(b"\0")).decode('utf-8')
+        return None
+
+def scrivi_tabella_pseudonimi(smart_card_ids, encrypt_key:RSA.RsaKey, pseudo_pad:str, percorso:str) -> int:
+    '''
+        Funzione che calcola gli pseudonimi delle Smart Card indicate e li salva in una tabella.
+        Il file viene sostituito in modo atomico; restituisce il numero di voci scritte.
+    '''
+    byte_pseudonimo = encrypt_key.size_in_bytes()
+    voci = []
+    for smart_card_id in sorted({s.upper() for s in smart_card_ids if s}):
+        try:
+            chiave = bytes.fromhex(smart_card_id)
+        except ValueError:
+            chiave = b""
+        if len(chiave) != BYTE_ID:
+            logger.error("Smart Card ID non valido, esclusa dalla tabella: %s", smart_card_id)
+            continue
+        pseudonimo = calcola_pseudonimo(smart_card_id, encrypt_key, pseudo_pad)
+        if pseudonimo is not None:
+            cifrato = bytes_to_long(base64.urlsafe_b64decode(pseudonimo))
+            voci.append(chiave + cifrato.to_bytes(byte_pseudonimo, "big"))
+
+    temporaneo = f"{percorso}.{os.getpid()}.tmp"
+    with open(temporaneo, "wb") as f:
+        f.write(INTESTAZIONE.pack(MAGIC, VERSIONE, impronta_chiave(encrypt_key, pseudo_pad), len(voci), byte_pseudonimo))
+        f.writelines(voci)
+    os.replace(temporaneo, percorso)
+    return len(voci)
+
+def costruisci_da_gestionale(percorso:str) -> int:
+    '''Funzione che costruisce la tabella per le Smart Card con abbonamento valido oggi, usando i segreti dell'API'''
+    from api_server import DATABASE_GS_URI, ENCRYPTKEY, ENCRYPTPAD
+    from db_handler import Gestionale
+    from datetime import date
+    smart_card_ids = Gestionale(DATABASE_GS_URI).select_smartcard_attive(date.today())
+    if smart_card_ids is None:
+        raise RuntimeError("Impossibile recuperare le Smart Card attive dal DB Gestionale")
+    return scrivi_tabella_pseudonimi(smart_card_ids, ENCRYPTKEY, ENCRYPTPAD, percorso)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Costruzione della tabella precalcolata degli pseudonimi")
+    parser.add_argument('-o', '--output', required=True,
+                        help="Percorso del file della tabella, es: /tmp/pseudonimi.bin")
+    parser.add_argument('-f', '--file',
+                        help="File con una Smart Card ID per riga; se assente vengono lette dal DB Gestionale "
+                             "le Smart Card con abbonamento valido")
+    args = parser.parse_args()
+
+    if args.file:
+        from api_server import ENCRYPTKEY, ENCRYPTPAD
+        with open(args.file) as f:
+            voci = scrivi_tabella_pseudonimi((riga.strip() for riga in f), ENCRYPTKEY, ENCRYPTPAD, args.output)
+    else:
+        voci = costruisci_da_gestionale(args.output)
+    print(f"Tabella scritta in {args.output}: {voci} pseudonimi")
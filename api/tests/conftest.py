@@ -0,0 +1,44 @@
+'''
+Configurazione comune dei test, da lanciare dalla cartella principale del progetto:
+
+    python -m pytest -q
+
+I moduli dell'API vengono importati dalla cartella api, come nel container; le metriche dei processi di
+test vengono salvate in una cartella temporanea invece che in METRICHE_DIR.
+'''
+import os, shutil, sys, tempfile
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ["METRICHE_DIR"] = tempfile.mkdtemp(prefix="worldfit_test_metriche_")
+
+import pytest
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import Session
+
+@pytest.fixture
+def gestionale_sqlite(tmp_path):
+    '''
+        Gestionale SQLite con una palestra ed un cliente con abbonamento valido. Restituisce una funzione che
+        crea una copia del database (un nodo) e ne restituisce l'URI, più tessera e palestra del cliente.
+    '''
+    from db_handler import Base, Gestionale
+    originale = tmp_path / "gestionale.sqlite3"
+    engine = create_engine(f"sqlite:///{originale}")
+    Base.metadata.create_all(engine)
+    oggi = date.today()
+    with Session(engine) as session, session.begin():
+        session.execute(insert(Gestionale.Palestra), [{"id": 1, "nome": "WorldFit 1", "stato": "Italia"}])
+        session.execute(insert(Gestionale.Cliente), [{"id": 1, "nome": "Nome", "cognome": "Cognome", "sesso": "F",
+                                                      "data_nascita": date(1990, 5, 17), "smart_card_id": "00A1B2"}])
+        session.execute(insert(Gestionale.Abbonamento), [{"id_cliente": 1, "valido_dal": oggi - timedelta(days=30),
+                                                          "valido_al": oggi + timedelta(days=30)}])
+    engine.dispose()
+
+    copie = []
+    def nodo() -> str:
+        percorso = tmp_path / f"nodo{len(copie)}.sqlite3"
+        shutil.copy(originale, percorso)
+        copie.append(percorso)
+        return f"sqlite:///{percorso}"
+    return nodo, "00A1B2", 1
@@ -0,0 +1,132 @@
+import json, random
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import Session
+
+from antifrode import DistanzePalestre, FileAllerte, RegistroAllerte, RilevatoreFrodi, backfill
+from db_handler import Base, LogsAndStats
+from registro_palestre import InfoPalestra
+
+MILANO, ROMA, MONZA, SCONOSCIUTA = 1, 2, 3, 99
+COORDINATE = {MILANO: (45.4642, 9.1900), ROMA: (41.9028, 12.4964), MONZA: (45.5845, 9.2744)}
+TESSERA = "A" * 344
+ORE_10 = datetime(2026, 3, 2, 10, 0)
+
+class RegistroFinto:
+    '''Sostituto del RegistroPalestre senza Gestionale, come in bench_antifrode.py: le distanze usano le coordinate'''
+    def palestra(self, palestra_id:int):
+        return None
+
+@pytest.fixture
+def rilevatore():
+    return RilevatoreFrodi(DistanzePalestre(RegistroFinto(), COORDINATE), velocita_massima=200, max_ingressi=5, finestra=3600)
+
+def tipi(allerte:list) -> list:
+    return [allerta["tipo"] for allerta in allerte]
+
+def test_viaggio_impossibile(rilevatore):
+    assert rilevatore.elabora(1, TESSERA, MILANO, ORE_10) == []
+    allerte = rilevatore.elabora(2, TESSERA, ROMA, ORE_10 + timedelta(minutes=30))
+    assert tipi(allerte) == ["viaggio_impossibile"]
+    assert (allerte[0]["log_id"], allerte[0]["log_id_precedente"]) == (2, 1)
+    assert (allerte[0]["palestra_id"], allerte[0]["palestra_id_precedente"]) == (ROMA, MILANO)
+
+def test_viaggi_possibili(rilevatore):
+    assert rilevatore.elabora(1, TESSERA, MILANO, ORE_10) == []
+    # Monza è a 15 km da Milano: mezz'ora basta
+    assert rilevatore.elabora(2, TESSERA, MONZA, ORE_10 + timedelta(minutes=30)) == []
+    assert rilevatore.elabora(3, TESSERA, ROMA, ORE_10 + timedelta(hours=6)) == []
+    # Palestra non nota: nessuna distanza, nessuna allerta
+    assert rilevatore.elabora(4, TESSERA, SCONOSCIUTA, ORE_10 + timedelta(hours=6, minutes=1)) == []
+    # Un'altra tessera non eredita gli ingressi della prima
+    assert rilevatore.elabora(5, "B" * 344, MILANO, ORE_10 + timedelta(hours=6, minutes=5)) == []
+
+def test_viaggio_impossibile_fuori_ordine(rilevatore):
+    # Il passaggio di Milano, registrato offline, arriva dopo quello successivo di Roma
+    assert rilevatore.elabora(2, TESSERA, ROMA, ORE_10 + timedelta(minutes=30)) == []
+    allerte = rilevatore.elabora(1, TESSERA, MILANO, ORE_10)
+    assert tipi(allerte) == ["viaggio_impossibile"]
+    assert (allerte[0]["log_id_precedente"], allerte[0]["palestra_id_precedente"]) == (2, ROMA)
+    assert "30 minuti" in allerte[0]["dettagli"]
+
+def test_viaggio_impossibile_tra_due_ingressi_gia_visti(rilevatore):
+    assert rilevatore.elabora(1, TESSERA, MILANO, ORE_10) == []
+    assert rilevatore.elabora(3, TESSERA, MILANO, ORE_10 + timedelta(hours=8)) == []
+    # Un ingresso a Roma arrivato in ritardo, un'ora dopo il primo di Milano: confrontato con tutti i conservati
+    allerte = rilevatore.elabora(2, TESSERA, ROMA, ORE_10 + timedelta(hours=1))
+    assert tipi(allerte) == ["viaggio_impossibile"]
+    assert allerte[0]["log_id_precedente"] == 1
+
+def test_passaggio_duplicato_ignorato(rilevatore):
+    assert rilevatore.elabora(1, TESSERA, MILANO, ORE_10) == []
+    assert tipi(rilevatore.elabora(2, TESSERA, ROMA, ORE_10 + timedelta(minutes=30))) == ["viaggio_impossibile"]
+    # Lo stesso passaggio riletto (es. recupero di un file di spill) non genera nuove allerte
+    assert rilevatore.elabora(3, TESSERA, ROMA, ORE_10 + timedelta(minutes=30)) == []
+    assert rilevatore.elaborati == 2
+
+def test_troppi_ingressi(rilevatore):
+    for i in range(5):
+        assert rilevatore.elabora(i + 1, TESSERA, MILANO, ORE_10 + timedelta(minutes=5 * i)) == []
+    allerte = rilevatore.elabora(6, TESSERA, MILANO, ORE_10 + timedelta(minutes=25))
+    assert tipi(allerte) == ["troppi_ingressi"]
+    assert allerte[0]["log_id_precedente"] == 1
+    assert allerte[0]["palestra_id_precedente"] is None
+
+def test_ingressi_distribuiti_oltre_la_finestra(rilevatore):
+    for i in range(12):
+        assert rilevatore.elabora(i + 1, TESSERA, MILANO, ORE_10 + timedelta(minutes=13 * i)) == []
+
+@pytest.mark.parametrize("seme", range(5))
+def test_troppi_ingressi_fuori_ordine(rilevatore, seme):
+    ingressi = [(i + 1, ORE_10 + timedelta(minutes=5 * i)) for i in range(6)]
+    random.Random(seme).shuffle(ingressi)
+    allerte = [allerta for log_id, timestamp in ingressi for allerta in rilevatore.elabora(log_id, TESSERA, MILANO, timestamp)]
+    # Una sola allerta, sul sesto ingresso elaborato, qualunque sia l'ordine di arrivo
+    assert tipi(allerte) == ["troppi_ingressi"]
+    assert allerte[0]["log_id"] == ingressi[-1][0]
+    assert allerte[0]["log_id_precedente"] == 1
+
+def test_duplicati_non_contano_come_ingressi(rilevatore):
+    for i in range(5):
+        timestamp = ORE_10 + timedelta(minutes=5 * i)
+        assert rilevatore.elabora(2 * i + 1, TESSERA, MILANO, timestamp) == []
+        assert rilevatore.elabora(2 * i + 2, TESSERA, MILANO, timestamp) == []
+    assert rilevatore.elaborati == 5
+
+def test_tessere_meno_recenti_dimenticate():
+    rilevatore = RilevatoreFrodi(DistanzePalestre(RegistroFinto(), COORDINATE), max_tessere=2)
+    rilevatore.elabora(1, TESSERA, MILANO, ORE_10)
+    rilevatore.elabora(2, "B" * 344, MILANO, ORE_10)
+    rilevatore.elabora(3, "C" * 344, MILANO, ORE_10)
+    # La prima tessera è uscita dalla memoria: il confronto con Milano non è più possibile
+    assert rilevatore.elabora(4, TESSERA, ROMA, ORE_10 + timedelta(minutes=30)) == []
+
+def test_distanze_stimate_dal_registro():
+    class RegistroStati:
+        palestre = {1: InfoPalestra(1, "Italia", "Milano", None), 2: InfoPalestra(2, "Italia", "Milano", None),
+                    3: InfoPalestra(3, "Italia", "Roma", None), 4: InfoPalestra(4, "Francia", "Parigi", None)}
+        def palestra(self, palestra_id:int):
+            return self.palestre.get(palestra_id)
+    distanze = DistanzePalestre(RegistroStati())
+    assert [distanze.km(1, 1), distanze.km(1, 2), distanze.km(1, 3), distanze.km(1, 4), distanze.km(1, 5)] == \
+        [0.0, 5, 50, 500, None]
+
+def test_backfill_da_logs(tmp_path, rilevatore):
+    uri = f"sqlite:///{tmp_path / 'logs.sqlite3'}"
+    engine = create_engine(uri)
+    Base.metadata.create_all(engine, tables=[LogsAndStats.Log.__table__])
+    ingressi = [(1, TESSERA, MILANO, ORE_10), (2, "B" * 344, MILANO, ORE_10 + timedelta(minutes=1)),
+                # Passaggio offline scritto dopo, con Id maggiore ma timestamp precedente
+                (4, TESSERA, ROMA, ORE_10 - timedelta(minutes=20)), (3, TESSERA, MILANO, ORE_10 + timedelta(hours=9))]
+    with Session(engine) as session, session.begin():
+        session.execute(insert(LogsAndStats.Log), [{"id": i, "smart_card_id": s, "palestra_id": p, "timestamp": t}
+                                                   for i, s, p, t in ingressi])
+    engine.dispose()
+
+    destinazione = FileAllerte(str(tmp_path / "allerte.jsonl"))
+    assert backfill(rilevatore, RegistroAllerte(uri), destinazione, ORE_10 - timedelta(days=1), ORE_10 + timedelta(days=1)) == 1
+    with open(destinazione.percorso) as f:
+        allerte = [json.loads(riga) for riga in f]
+    assert [(a["tipo"], a["log_id"], a["log_id_precedente"]) for a in allerte] == [("viaggio_impossibile", 1, 4)]
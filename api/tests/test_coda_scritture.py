@@ -0,0 +1,66 @@
+import os, subprocess, sys, time
+from datetime import date, datetime
+
+import pytest
+from sqlalchemy import create_engine, func, select
+
+import coda_scritture
+from coda_scritture import CodaScritture, _serializza
+from db_handler import Base, LogsAndStats
+
+def record(i:int) -> tuple[dict, dict]:
+    return ({"smart_card_id": f"tessera-{i}", "palestra_id": 1, "timestamp": datetime(2026, 3, 2, 10, 0, i)},
+            {"sesso": "F", "fascia_eta": "26-35", "palestra_id": 1, "data_ingresso": date(2026, 3, 2), "fascia_oraria": "06-12"})
+
+def pid_terminato() -> int:
+    '''Pid di un processo già terminato, come quello di un worker ucciso'''
+    processo = subprocess.Popen([sys.executable, "-c", "pass"])
+    processo.wait()
+    return processo.pid
+
+@pytest.fixture
+def magazziniere(tmp_path):
+    uri = f"sqlite:///{tmp_path / 'logs_statistiche.sqlite3'}"
+    Base.metadata.create_all(create_engine(uri), tables=[LogsAndStats.Log.__table__, LogsAndStats.Stat.__table__])
+    return LogsAndStats(uri, "righe")
+
+def logs_scritti(magazziniere:LogsAndStats) -> int:
+    with magazziniere.engine.connect() as connection:
+        return connection.execute(select(func.count()).select_from(LogsAndStats.Log)).scalar()
+
+def test_giornale_troncato_recuperato(magazziniere, tmp_path):
+    cartella = tmp_path / "spill"
+    cartella.mkdir()
+    # Giornale di un worker ucciso durante la scrittura dell'ultima riga
+    righe = [_serializza(*record(i)) + "\n" for i in range(3)]
+    giornale = cartella / f"giornale-{pid_terminato()}-1.jsonl"
+    giornale.write_text("".join(righe) + righe[0][:40])
+    altro = cartella / "note-operatore.jsonl"
+    altro.write_text("non è un file della coda\n")
+
+    coda = CodaScritture(magazziniere, cartella_spill=str(cartella), giornale=False)
+    coda.recupera_spill()
+    assert logs_scritti(magazziniere) == 3
+    # Il file con la riga illeggibile viene conservato, non riletto ad ogni recupero
+    assert [nome for nome in os.listdir(cartella) if nome.endswith(".corrotto")] != []
+    assert not giornale.exists() and altro.exists()
+    coda.recupera_spill()
+    assert logs_scritti(magazziniere) == 3
+
+def test_errore_del_recupero_non_ferma_la_coda(magazziniere, tmp_path, monkeypatch):
+    monkeypatch.setattr(coda_scritture, "INTERVALLO_RECUPERO", 0)
+    coda = CodaScritture(magazziniere, intervallo=0.05, cartella_spill=str(tmp_path / "spill"))
+    errori = []
+    def recupero_fallito():
+        errori.append(1)
+        raise ValueError("file di spill illeggibile")
+    monkeypatch.setattr(coda, "recupera_spill", recupero_fallito)
+
+    coda.accoda(*record(1))
+    scadenza = time.monotonic() + 5
+    while not errori and time.monotonic() < scadenza:
+        time.sleep(0.01)
+    coda.accoda(*record(2))
+    coda.chiudi()
+    assert errori and coda._thread is not None
+    assert logs_scritti(magazziniere) == 2
@@ -0,0 +1,128 @@
+import asyncio, time
+from datetime import date
+
+import pytest
+from sqlalchemy import text
+
+import repliche_gestionale
+from db_handler import ottieni_engine, imposta_latenza_simulata
+from repliche_gestionale import GestionaleReplicato, RouterRepliche, ScadenzaSuperata
+
+def seleziona_uno(connection):
+    return connection.execute(text("SELECT 1")).scalar()
+
+def nodo_con_latenza(crea_nodo, latenze:dict, nome:str) -> str:
+    '''Copia del Gestionale con latenza simulata modificabile durante il test (latenze[nome], in secondi)'''
+    uri = crea_nodo()
+    latenze[nome] = 0.0
+    imposta_latenza_simulata(ottieni_engine(uri), lambda: latenze[nome])
+    return uri
+
+def test_scadenza_superata(gestionale_sqlite):
+    crea_nodo, smart_card_id, palestra_id = gestionale_sqlite
+    latenze = {}
+    gestore = GestionaleReplicato(nodo_con_latenza(crea_nodo, latenze, "principale"), deadline=0.1, hedge_percentile=0)
+    assert gestore.verifica_accesso(smart_card_id, palestra_id, date.today()).cliente.id == 1
+
+    latenze["principale"] = 0.5
+    inizio = time.monotonic()
+    with pytest.raises(ScadenzaSuperata):
+        gestore.router.esegui(seleziona_uno)
+    assert time.monotonic() - inizio < 0.3
+    # Verifica con scadenza superata: errore registrato e None, come un errore del database
+    assert gestore.verifica_accesso(smart_card_id, palestra_id, date.today()) is None
+    assert gestore.router.nodi[0].errori == 2
+
+def test_esclusione_e_rientro_del_nodo(gestionale_sqlite, monkeypatch):
+    monkeypatch.setattr(repliche_gestionale, "ESPULSIONE_SECONDI", 0.2)
+    crea_nodo, _, _ = gestionale_sqlite
+    latenze = {}
+    router = RouterRepliche([nodo_con_latenza(crea_nodo, latenze, "lento")], deadline=0.05, hedge_percentile=0)
+    nodo = router.nodi[0]
+
+    latenze["lento"] = 0.2
+    for _ in range(repliche_gestionale.ESPULSIONE_ERRORI):
+        with pytest.raises(ScadenzaSuperata):
+            router.esegui(seleziona_uno)
+    assert not nodo.disponibile(time.monotonic())
+    assert nodo.esclusioni == 1
+    assert nodo.escluso_fino - time.monotonic() == pytest.approx(0.2, abs=0.05)
+
+    # Al rientro basta un errore per una nuova esclusione, di durata doppia
+    time.sleep(0.25)
+    assert nodo.disponibile(time.monotonic())
+    with pytest.raises(ScadenzaSuperata):
+        router.esegui(seleziona_uno)
+    assert nodo.esclusioni == 2
+    assert nodo.escluso_fino - time.monotonic() == pytest.approx(0.4, abs=0.05)
+
+    # Scaduta l'esclusione, la prima interrogazione riuscita azzera errori ed esclusioni
+    latenze["lento"] = 0.0
+    time.sleep(0.45)
+    assert router.esegui(seleziona_uno) == 1
+    assert (nodo.errori, nodo.esclusioni) == (0, 0)
+
+def test_nodo_in_errore_interrogato_per_ultimo(gestionale_sqlite, tmp_path):
+    crea_nodo, _, _ = gestionale_sqlite
+    guasto = f"sqlite:///{tmp_path / 'assente' / 'nodo.sqlite3'}"
+    router = RouterRepliche([guasto, crea_nodo()], deadline=1, hedge_percentile=0)
+    router.nodi[1].latenza = 0.001
+    # Un errore del nodo guasto fa passare subito al successivo
+    assert router.esegui(seleziona_uno) == 1
+    assert router.nodi[0].errori == 1
+    for _ in range(10):
+        assert router._ordine()[0] is router.nodi[1]
+        assert router.esegui(seleziona_uno) == 1
+    assert router.nodi[0].errori == 1
+
+def router_con_nodo_lento(crea_nodo, **parametri) -> RouterRepliche:
+    '''Router con un primo nodo lento (0.5 s) ed un secondo immediato, con latenze recenti di 10 ms'''
+    latenze = {}
+    router = RouterRepliche([nodo_con_latenza(crea_nodo, latenze, "lento"), nodo_con_latenza(crea_nodo, latenze, "veloce")],
+                            deadline=2, **parametri)
+    latenze["lento"] = 0.5
+    # Costi iniziali: il nodo lento viene interrogato per primo
+    router.nodi[0].latenza, router.nodi[1].latenza = 0.001, 0.002
+    for _ in range(20):
+        router._registra_lettura(0.01)
+    return router
+
+def test_lettura_duplicata_sul_secondo_nodo(gestionale_sqlite):
+    crea_nodo, _, _ = gestionale_sqlite
+    router = router_con_nodo_lento(crea_nodo)
+    assert router.ritardo_hedge() == pytest.approx(0.01)
+    inizio = time.monotonic()
+    assert router.esegui(seleziona_uno) == 1
+    assert time.monotonic() - inizio < 0.3
+    assert router._duplicate == 1
+
+def test_lettura_non_duplicata_oltre_la_frazione(gestionale_sqlite):
+    crea_nodo, _, _ = gestionale_sqlite
+    router = router_con_nodo_lento(crea_nodo, hedge_frazione=0)
+    inizio = time.monotonic()
+    assert router.esegui(seleziona_uno) == 1
+    assert time.monotonic() - inizio >= 0.5
+    assert router._duplicate == 0
+
+def test_scadenza_della_verifica_asincrona(gestionale_sqlite):
+    from db_handler_async import GestionaleAsync, ottieni_engine_async, chiudi_engine_async
+    crea_nodo, smart_card_id, palestra_id = gestionale_sqlite
+    latenze = {"principale": 0.0}
+    uri = crea_nodo()
+    imposta_latenza_simulata(ottieni_engine_async(uri), lambda: latenze["principale"])
+    gestore = GestionaleAsync(uri, RouterRepliche([uri], deadline=0.1, hedge_percentile=0))
+
+    async def verifiche():
+        try:
+            assert (await gestore.verifica_accesso(smart_card_id, palestra_id, date.today())).cliente.id == 1
+            latenze["principale"] = 0.5
+            inizio = time.monotonic()
+            # Scadenza superata: None come un errore del database, senza attendere la risposta del nodo
+            assert await gestore.verifica_accesso(smart_card_id, palestra_id, date.today()) is None
+            assert await gestore.verifica_accessi([(smart_card_id, palestra_id, date.today())]) is None
+            assert time.monotonic() - inizio < 0.5
+        finally:
+            latenze["principale"] = 0.0
+            await chiudi_engine_async()
+    asyncio.run(verifiche())
+    assert gestore.router.nodi[0].errori == 2
@@ -0,0 +1,122 @@
+import base64, os, random
+from datetime import date, datetime, timedelta
+
+import pytest
+
+import segmenti_logs
+from segmenti_logs import Archivio, Segmento, nome_segmento, scrivi_segmento, unisci_segmenti
+
+PRIMO_GIORNO = date(2026, 3, 1)
+
+def pseudonimo_casuale(generatore:random.Random) -> str:
+    return base64.urlsafe_b64encode(generatore.randbytes(256)).decode()
+
+def ingressi_giorno(generatore:random.Random, pseudonimi:list, giorno:date, quanti:int, primo_id:int) -> list:
+    '''Ingressi (pseudonimo, palestra, timestamp, id) di un giorno, ordinati come li scrive l'archiviatore'''
+    mezzanotte = datetime.combine(giorno, datetime.min.time())
+    righe = [(generatore.choice(pseudonimi), generatore.randint(1, 50),
+              mezzanotte + timedelta(seconds=generatore.randrange(86400)), primo_id + i) for i in range(quanti)]
+    return sorted(righe, key=lambda riga: (riga[0], riga[2], riga[3]))
+
+@pytest.fixture
+def blocchi_piccoli(monkeypatch):
+    # Blocchi da pochi pseudonimi: le ricerche attraversano più blocchi e più voci dell'indice
+    monkeypatch.setattr(segmenti_logs, "DIMENSIONE_BLOCCO", 2048)
+
+def test_andata_e_ritorno(tmp_path, blocchi_piccoli):
+    generatore = random.Random(1)
+    pseudonimi = [pseudonimo_casuale(generatore) for _ in range(40)]
+    righe = ingressi_giorno(generatore, pseudonimi, PRIMO_GIORNO, 600, 1)
+    percorso = str(tmp_path / nome_segmento(PRIMO_GIORNO, PRIMO_GIORNO + timedelta(days=1)))
+
+    scritto = scrivi_segmento(percorso, righe, PRIMO_GIORNO, PRIMO_GIORNO + timedelta(days=1))
+    assert scritto["righe"] == len(righe) and scritto["blocchi"] > 1
+    assert scritto["sha256"] == segmenti_logs.impronta(percorso)
+    assert os.stat(percorso).st_mode & 0o777 == 0o444
+
+    with Segmento(percorso) as segmento:
+        assert (segmento.dal, segmento.al, segmento.righe) == (PRIMO_GIORNO, PRIMO_GIORNO + timedelta(days=1), len(righe))
+        assert list(segmento.righe_ordinate()) == righe
+        for pseudonimo in pseudonimi:
+            assert list(segmento.cerca(pseudonimo)) == [riga for riga in righe if riga[0] == pseudonimo]
+        assert list(segmento.cerca(pseudonimo_casuale(generatore))) == []
+        mezzogiorno = datetime.combine(PRIMO_GIORNO, datetime.min.time()) + timedelta(hours=12)
+        assert list(segmento.cerca(pseudonimi[0], dal=mezzogiorno)) == \
+            [riga for riga in righe if riga[0] == pseudonimi[0] and riga[2] >= mezzogiorno]
+
+def test_pseudonimo_su_piu_blocchi(tmp_path, blocchi_piccoli):
+    generatore = random.Random(2)
+    assiduo = pseudonimo_casuale(generatore)
+    # Un solo pseudonimo con molti ingressi riempie più blocchi: tutti vengono letti dalla ricerca
+    righe = ingressi_giorno(generatore, [assiduo], PRIMO_GIORNO, 300, 1)
+    percorso = str(tmp_path / "assiduo.wfla")
+    assert scrivi_segmento(percorso, righe, PRIMO_GIORNO, PRIMO_GIORNO + timedelta(days=1))["blocchi"] > 1
+    with Segmento(percorso) as segmento:
+        assert list(segmento.cerca(assiduo)) == righe
+
+@pytest.mark.parametrize("modifica", ["disordine", "fuori_intervallo"])
+def test_righe_non_valide(tmp_path, modifica):
+    generatore = random.Random(3)
+    righe = ingressi_giorno(generatore, [pseudonimo_casuale(generatore) for _ in range(5)], PRIMO_GIORNO, 20, 1)
+    if modifica == "disordine":
+        righe.reverse()
+    else:
+        righe.append((righe[-1][0], 1, datetime.combine(PRIMO_GIORNO + timedelta(days=1), datetime.min.time()), 99))
+    percorso = tmp_path / "errato.wfla"
+    with pytest.raises(ValueError):
+        scrivi_segmento(str(percorso), righe, PRIMO_GIORNO, PRIMO_GIORNO + timedelta(days=1))
+    # Nessun file, nemmeno temporaneo, resta nella cartella
+    assert os.listdir(tmp_path) == []
+
+def test_segmento_danneggiato_o_troncato(tmp_path):
+    generatore = random.Random(4)
+    pseudonimi = [pseudonimo_casuale(generatore) for _ in range(5)]
+    righe = ingressi_giorno(generatore, pseudonimi, PRIMO_GIORNO, 50, 1)
+    percorso = str(tmp_path / "segmento.wfla")
+    scrivi_segmento(percorso, righe, PRIMO_GIORNO, PRIMO_GIORNO + timedelta(days=1))
+    with open(percorso, "rb") as f:
+        dati = bytearray(f.read())
+
+    danneggiato, troncato = tmp_path / "danneggiato.wfla", tmp_path / "troncato.wfla"
+    dati_danneggiati = bytearray(dati)
+    dati_danneggiati[segmenti_logs.DIMENSIONE_INTESTAZIONE + 10] ^= 0xFF
+    danneggiato.write_bytes(bytes(dati_danneggiati))
+    troncato.write_bytes(bytes(dati[:-1]))
+
+    with Segmento(str(danneggiato)) as segmento, pytest.raises(ValueError, match="danneggiato"):
+        list(segmento.cerca(pseudonimi[0]))
+    with pytest.raises(ValueError, match="troncato"):
+        Segmento(str(troncato))
+
+def test_unione_dei_giorni_in_un_mese(tmp_path, blocchi_piccoli):
+    generatore = random.Random(5)
+    pseudonimi = [pseudonimo_casuale(generatore) for _ in range(30)]
+    cartella = tmp_path / "archivio"
+    cartella.mkdir()
+    tutte, log_id = [], 1
+    for giorno in (PRIMO_GIORNO + timedelta(days=n) for n in range(5)):
+        righe = ingressi_giorno(generatore, pseudonimi, giorno, 120, log_id)
+        log_id += len(righe)
+        tutte.extend(righe)
+        scrivi_segmento(str(cartella / nome_segmento(giorno, giorno + timedelta(days=1))), righe,
+                        giorno, giorno + timedelta(days=1))
+
+    archivio = Archivio(str(cartella))
+    giornalieri = archivio.segmenti()
+    assert len(giornalieri) == 5
+    fine = PRIMO_GIORNO + timedelta(days=5)
+    unito = str(cartella / nome_segmento(PRIMO_GIORNO, fine))
+    scritto = unisci_segmenti(unito, [archivio.apri(percorso) for percorso in giornalieri])
+    assert scritto["righe"] == len(tutte)
+
+    with Segmento(unito) as segmento:
+        assert (segmento.dal, segmento.al) == (PRIMO_GIORNO, fine)
+        assert list(segmento.righe_ordinate()) == sorted(tutte, key=lambda riga: (riga[0], riga[2], riga[3]))
+    # I segmenti giornalieri contenuti nel segmento unito vengono ignorati
+    assert archivio.segmenti() == [unito]
+    for pseudonimo in pseudonimi[:5]:
+        attese = sorted((riga for riga in tutte if riga[0] == pseudonimo), key=lambda riga: (riga[2], riga[3]))
+        assert list(archivio.cerca(pseudonimo)) == attese
+        secondo_giorno = [riga for riga in attese if riga[2].date() == PRIMO_GIORNO + timedelta(days=1)]
+        assert list(archivio.cerca(pseudonimo, PRIMO_GIORNO + timedelta(days=1), PRIMO_GIORNO + timedelta(days=2))) == secondo_giorno
+    archivio.close()
@@ -0,0 +1,116 @@
+import random
+from datetime import date, timedelta
+
+import pytest
+from sqlalchemy import insert, update
+from sqlalchemy.orm import Session
+
+import snapshot_tessere
+from db_handler import Gestionale, ottieni_engine
+from snapshot_tessere import ArchivioSnapshot, applica_delta, calcola_delta, costruisci, verifica
+
+CHIAVE = "chiave-di-prova"
+GIORNO = date(2026, 3, 1)
+
+def voci(snapshot:bytes) -> dict:
+    '''Voci di uno snapshot firmato come dizionario Smart Card ID -> scadenza'''
+    assert verifica(snapshot, CHIAVE) is not None
+    return {smart_card_id.hex().upper(): date.fromordinal(int.from_bytes(scadenza, "big") + snapshot_tessere.ORDINALE_EPOCA)
+            for smart_card_id, scadenza in snapshot_tessere._voci(snapshot).items()}
+
+def test_costruzione():
+    righe = [("00a1b2", date(2026, 4, 1)), ("00A1B2", date(2026, 5, 1)), ("FFFFFF", date(2026, 3, 2)),
+             ("12345", date(2026, 4, 1)), ("GGGGGG", date(2026, 4, 1)), (None, date(2026, 4, 1))]
+    snapshot = costruisci(righe, 7, GIORNO, CHIAVE)
+    # ID non validi esclusi, ID ripetuti con la scadenza maggiore
+    assert voci(snapshot) == {"00A1B2": date(2026, 5, 1), "FFFFFF": date(2026, 3, 2)}
+    assert snapshot_tessere.INTESTAZIONE_SNAPSHOT.unpack_from(snapshot)[2] == 7
+
+@pytest.mark.parametrize("quante", [1, 2, 3])
+def test_scadenze_oltre_i_due_byte(quante):
+    # Abbonamenti "a vita" (9999-12-31): un numero dispari di voci da 5 cifre renderebbe l'esadecimale non valido
+    ultimo_giorno = date(2149, 6, 6)
+    assert ultimo_giorno.toordinal() - snapshot_tessere.ORDINALE_EPOCA == snapshot_tessere.SCADENZA_MASSIMA
+    righe = [(f"00000{i}", date(9999, 12, 31)) for i in range(quante)] + [("C0FFEE", date(2026, 4, 1))]
+    snapshot = costruisci(righe, 1, GIORNO, CHIAVE)
+    assert voci(snapshot) == {**{f"00000{i}": ultimo_giorno for i in range(quante)}, "C0FFEE": date(2026, 4, 1)}
+
+@pytest.mark.parametrize("seme", range(5))
+def test_delta_andata_e_ritorno(seme):
+    generatore = random.Random(seme)
+    def scadenza() -> date:
+        return GIORNO + timedelta(days=generatore.randint(1, 400))
+    vecchie = {f"{generatore.randrange(16**6):06X}": scadenza() for _ in range(300)}
+    nuove = dict(vecchie)
+    for smart_card_id in generatore.sample(sorted(vecchie), 40):
+        del nuove[smart_card_id]
+    for smart_card_id in generatore.sample(sorted(nuove), 40):
+        nuove[smart_card_id] = scadenza()
+    nuove.update({f"{generatore.randrange(16**6):06X}": scadenza() for _ in range(40)})
+
+    vecchio = costruisci(vecchie.items(), 1, GIORNO, CHIAVE)
+    nuovo = costruisci(nuove.items(), 2, GIORNO + timedelta(days=1), CHIAVE)
+    delta = calcola_delta(vecchio, nuovo, CHIAVE)
+    assert len(delta) < len(nuovo)
+    assert applica_delta(vecchio, delta, CHIAVE) == nuovo
+    assert voci(applica_delta(vecchio, delta, CHIAVE)) == nuove
+
+def test_delta_vuoto():
+    snapshot = costruisci([("00A1B2", date(2026, 4, 1))], 3, GIORNO, CHIAVE)
+    delta = calcola_delta(snapshot, snapshot, CHIAVE)
+    assert applica_delta(snapshot, delta, CHIAVE) == snapshot
+
+def test_firma_non_valida_rifiutata():
+    vecchio = costruisci([("00A1B2", date(2026, 4, 1))], 1, GIORNO, CHIAVE)
+    nuovo = costruisci([("00A1B2", date(2026, 4, 1)), ("C0FFEE", date(2027, 1, 1))], 2, GIORNO, CHIAVE)
+    delta = calcola_delta(vecchio, nuovo, CHIAVE)
+
+    # Una tessera aggiunta da chi non conosce la chiave: qualunque byte alterato invalida la firma
+    for posizione in range(len(delta)):
+        alterato = bytearray(delta)
+        alterato[posizione] ^= 0x01
+        assert applica_delta(vecchio, bytes(alterato), CHIAVE) is None
+    assert applica_delta(vecchio, delta, "altra-chiave") is None
+    assert applica_delta(vecchio, delta[:-1], CHIAVE) is None
+    assert verifica(nuovo[:10], CHIAVE) is None
+    assert verifica(costruisci([("C0FFEE", date(2027, 1, 1))], 2, GIORNO, "altra-chiave"), CHIAVE) is None
+
+def test_delta_da_un_altra_versione_rifiutato():
+    vecchio = costruisci([("00A1B2", date(2026, 4, 1))], 1, GIORNO, CHIAVE)
+    nuovo = costruisci([("C0FFEE", date(2027, 1, 1))], 2, GIORNO, CHIAVE)
+    delta = calcola_delta(vecchio, nuovo, CHIAVE)
+    assert applica_delta(nuovo, delta, CHIAVE) is None
+
+def test_archivio_risposte_ai_tornelli(gestionale_sqlite, tmp_path):
+    crea_nodo, smart_card_id, _ = gestionale_sqlite
+    uri = crea_nodo()
+    archivio = ArchivioSnapshot(Gestionale(uri), CHIAVE, str(tmp_path / "snapshot"), intervallo=3600)
+    prima = archivio.aggiorna(forza=True)
+    assert archivio.aggiorna(forza=True) == prima    # stesse voci: stessa versione
+
+    with Session(ottieni_engine(uri)) as session, session.begin():
+        session.execute(insert(Gestionale.Cliente), [{"id": 2, "smart_card_id": "C0FFEE"}])
+        session.execute(insert(Gestionale.Abbonamento), [{"id_cliente": 2, "valido_dal": date.today() - timedelta(days=1),
+                                                          "valido_al": date.today() + timedelta(days=90)}])
+        session.execute(update(Gestionale.Abbonamento).where(Gestionale.Abbonamento.id_cliente == 1)
+                        .values(valido_al=date.today() + timedelta(days=60)))
+    # Una nuova versione nello stesso secondo della precedente è comunque successiva
+    dopo = archivio.aggiorna(forza=True)
+    assert dopo > prima
+    assert archivio.versioni() == [prima, dopo]
+
+    completo, tipo = archivio.risposta(None)
+    assert tipo == "snapshot"
+    assert voci(completo) == {smart_card_id: date.today() + timedelta(days=60), "C0FFEE": date.today() + timedelta(days=90)}
+    assert archivio.risposta(12345) == (completo, "snapshot")    # versione non conservata
+
+    with open(archivio._percorso(prima), "rb") as f:
+        vecchio = f.read()
+    delta, tipo = archivio.risposta(prima)
+    assert tipo == "delta"
+    assert applica_delta(vecchio, delta, CHIAVE) == completo
+    # Il delta viene conservato e riusato per gli altri tornelli
+    assert archivio.risposta(prima) == (delta, "delta")
+
+    vuoto, tipo = archivio.risposta(dopo)
+    assert tipo == "delta" and applica_delta(completo, vuoto, CHIAVE) == completo
@@ -1,11 +1,22 @@
 // Configurazione
 const API_ENDPOINT = 'http://127.0.0.1:8000';
 
+// Modalità offline: snapshot firmato delle tessere valide scaricato da /snapshot
+const SNAPSHOT_SYNC_INTERVAL = 5 * 60 * 1000; // 5 minuti
+// Oltre questo tempo dall'ultima sincronizzazione lo snapshot non viene più usato; coincide con
+// BATCH_SECONDI_OFFLINE dell'API, oltre il quale i passaggi offline non vengono più registrati
+const SNAPSHOT_MAX_AGE = 24 * 60 * 60 * 1000; // 24 ore
+const OFFLINE_BATCH_SIZE = 500; // BATCH_MAX_RECORD dell'API
+const OFFLINE_MAX_ENTRIES = 10000;
+
 let config = {
     gymId: '',
     apiKey: ''
 };
 
+let snapshot = null; // { versione, giorno, voci: Uint8Array, sincronizzato }
+let snapshotTimer = null;
+
 // ========================
 // UTILITY FUNCTIONS
 // ========================
@@ -44,6 +55,56 @@ async function generateHMAC(message, key) {
     }
 }
 
+/**
+ * Verifica la firma HMAC-SHA256 (ultimi 32 byte) di snapshot e delta e restituisce i dati senza firma
+ */
+async function verifySignedBlob(bytes, key) {
+    if (bytes.length < 32) {
+        throw new Error('Snapshot non valido: dati troppo corti');
+    }
+    const cryptoKey = await crypto.subtle.importKey(
+        'raw',
+        new TextEncoder().encode(key),
+        { name: 'HMAC', hash: 'SHA-256' },
+        false,
+        ['verify']
+    );
+    const data = bytes.subarray(0, bytes.length - 32);
+    const valid = await crypto.subtle.verify('HMAC', cryptoKey, bytes.subarray(bytes.length - 32), data);
+    if (!valid) {
+        throw new Error('Snapshot non valido: signature errata');
+    }
+    return data;
+}
+
+/**
+ * Conversioni base64 per salvare lo snapshot nel localStorage
+ */
+function bytesToBase64(bytes) {
+    let binary = '';
+    for (let i = 0; i < bytes.length; i += 0x8000) {
+        binary += String.fromCharCode.apply(null, bytes.subarray(i, i + 0x8000));
+    }
+    return btoa(binary);
+}
+
+function base64ToBytes(text) {
+    const binary = atob(text);
+    const bytes = new Uint8Array(binary.length);
+    for (let i = 0; i < binary.length; i++) {
+        bytes[i] = binary.charCodeAt(i);
+    }
+    return bytes;
+}
+
+/**
+ * Giorni dal 1970-01-01 della data locale di oggi (stessa unità delle scadenze dello snapshot)
+ */
+function todayDays() {
+    const now = new Date();
+    return Math.floor(Date.UTC(now.getFullYear(), now.getMonth(), now.getDate()) / 86400000);
+}
+
 /**
  * Valida ID SmartCard
  */
@@ -54,6 +115,303 @@ function validateSmartCardId(id) {
     return isValid;
 }
 
+// ========================
+// OFFLINE MODE
+// ========================
+
+/**
+ * ID SmartCard (3 byte) della voce che inizia all'offset indicato
+ */
+function entryId(bytes, offset) {
+    return (bytes[offset] << 16) | (bytes[offset + 1] << 8) | bytes[offset + 2];
+}
+
+/**
+ * Applica un delta alle voci ordinate dello snapshot: le voci aggiunte (5 byte) sostituiscono quelle
+ * con lo stesso ID, gli ID rimossi (3 byte) vengono eliminati. Il risultato resta ordinato.
+ */
+function applySnapshotDelta(entries, added, removed) {
+    const result = new Uint8Array(entries.length + added.length);
+    let i = 0, j = 0, k = 0, n = 0;
+    while (i < entries.length || j < added.length) {
+        const oldId = i < entries.length ? entryId(entries, i) : Infinity;
+        const newId = j < added.length ? entryId(added, j) : Infinity;
+        if (newId <= oldId) {
+            result.set(added.subarray(j, j + 5), n);
+            n += 5;
+            j += 5;
+            if (newId === oldId) {
+                i += 5; // scadenza aggiornata
+            }
+        } else {
+            while (k < removed.length && entryId(removed, k) < oldId) {
+                k += 3;
+            }
+            if (!(k < removed.length && entryId(removed, k) === oldId)) {
+                result.set(entries.subarray(i, i + 5), n);
+                n += 5;
+            }
+            i += 5;
+        }
+    }
+    return result.slice(0, n);
+}
+
+/**
+ * Legge la risposta di /snapshot (snapshot completo "WFSN" o delta "WFSD", vedi api/snapshot_tessere.py)
+ */
+async function readSnapshotResponse(bytes) {
+    const data = await verifySignedBlob(bytes, config.apiKey);
+    const view = new DataView(data.buffer, data.byteOffset, data.byteLength);
+    const magic = String.fromCharCode(data[0], data[1], data[2], data[3]);
+
+    if (magic === 'WFSN') {
+        const count = view.getUint32(11, true);
+        if (data.length !== 15 + count * 5) {
+            throw new Error('Snapshot non valido: lunghezza errata');
+        }
+        return { versione: view.getUint32(5, true), giorno: view.getUint16(9, true), voci: data.slice(15) };
+    }
+    if (magic === 'WFSD') {
+        const from = view.getUint32(5, true);
+        const added = view.getUint32(15, true);
+        const removed = view.getUint32(19, true);
+        if (!snapshot || snapshot.versione !== from || data.length !== 23 + added * 5 + removed * 3) {
+            throw new Error('Delta non applicabile allo snapshot corrente');
+        }
+        return {
+            versione: view.getUint32(9, true),
+            giorno: view.getUint16(13, true),
+            voci: applySnapshotDelta(snapshot.voci,
+                                     data.subarray(23, 23 + added * 5),
+                                     data.subarray(23 + added * 5))
+        };
+    }
+    throw new Error('Snapshot non valido: formato sconosciuto');
+}
+
+/**
+ * Carica lo snapshot salvato nel localStorage
+ */
+function loadSnapshot() {
+    try {
+        const saved = JSON.parse(localStorage.getItem('turnstileSnapshot'));
+        if (saved) {
+            snapshot = { ...saved, voci: base64ToBytes(saved.voci) };
+        }
+    } catch (error) {
+        console.error('Snapshot salvato non leggibile:', error);
+        snapshot = null;
+    }
+}
+
+/**
+ * Salva lo snapshot nel localStorage. Con molti clienti può superare lo spazio disponibile:
+ * in quel caso resta solo in memoria fino alla chiusura della pagina.
+ */
+function saveSnapshot() {
+    try {
+        localStorage.setItem('turnstileSnapshot', JSON.stringify({ ...snapshot, voci: bytesToBase64(snapshot.voci) }));
+    } catch (error) {
+        console.error('Snapshot non salvato nel localStorage:', error);
+        localStorage.removeItem('turnstileSnapshot');
+    }
+}
+
+/**
+ * Restituisce una funzione che esegue task una volta alla volta: le chiamate durante l'esecuzione
+ * (timer, evento online, salvataggio della configurazione) ricevono la stessa promise e fanno
+ * ripetere task una sola volta al termine, per esempio con la configurazione appena salvata
+ */
+function singleFlight(task) {
+    let running = null;
+    let again = false;
+    return () => {
+        if (running !== null) {
+            again = true;
+            return running;
+        }
+        running = (async () => {
+            do {
+                again = false;
+                await task();
+            } while (again);
+        })().finally(() => {
+            running = null;
+        });
+        return running;
+    };
+}
+
+/**
+ * Scarica da /snapshot il delta dalla versione posseduta (o lo snapshot completo) e
+ * reinvia i passaggi registrati offline
+ */
+const syncSnapshot = singleFlight(async () => {
+    if (!config || !config.gymId || !config.apiKey) {
+        return;
+    }
+    try {
+        const timestamp = Date.now().toString();
+        const versione = snapshot ? snapshot.versione : 0;
+        const signature = await generateHMAC('snapshot' + config.gymId + versione + timestamp, config.apiKey);
+
+        const response = await fetch(API_ENDPOINT + '/snapshot', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify({
+                IDPalestra: config.gymId,
+                Versione: versione,
+                Timestamp: timestamp,
+                Signature: signature
+            })
+        });
+        if (!response.ok) {
+            throw new Error(`Errore HTTP: ${response.status} ${response.statusText}`);
+        }
+
+        const updated = await readSnapshotResponse(new Uint8Array(await response.arrayBuffer()));
+        const changed = !snapshot || updated.versione !== snapshot.versione;
+        snapshot = { ...updated, sincronizzato: Date.now() };
+        if (changed) {
+            saveSnapshot();
+        } else {
+            // Stessa versione: aggiorno solo l'istante della sincronizzazione
+            const saved = JSON.parse(localStorage.getItem('turnstileSnapshot'));
+            if (saved) {
+                saved.sincronizzato = snapshot.sincronizzato;
+                localStorage.setItem('turnstileSnapshot', JSON.stringify(saved));
+            }
+        }
+    } catch (error) {
+        console.error('Sincronizzazione dello snapshot non riuscita:', error);
+        return;
+    }
+    await flushOfflineEntries();
+});
+
+/**
+ * Avvia la sincronizzazione periodica dello snapshot
+ */
+function startSnapshotSync() {
+    if (snapshotTimer === null) {
+        snapshotTimer = setInterval(syncSnapshot, SNAPSHOT_SYNC_INTERVAL);
+        window.addEventListener('online', syncSnapshot);
+    }
+    syncSnapshot();
+}
+
+/**
+ * Scadenza (giorni dal 1970-01-01) della SmartCard nello snapshot, con ricerca binaria; null se assente
+ */
+function findExpiry(smartCardId) {
+    if (!snapshot || !/^[0-9A-F]{6}$/.test(smartCardId)) {
+        return null;
+    }
+    const id = parseInt(smartCardId, 16);
+    const entries = snapshot.voci;
+    let low = 0;
+    let high = entries.length / 5 - 1;
+    while (low <= high) {
+        const middle = (low + high) >> 1;
+        const current = entryId(entries, middle * 5);
+        if (current === id) {
+            return (entries[middle * 5 + 3] << 8) | entries[middle * 5 + 4];
+        }
+        if (current < id) {
+            low = middle + 1;
+        } else {
+            high = middle - 1;
+        }
+    }
+    return null;
+}
+
+/**
+ * Passaggi consentiti offline, da reinviare a /batch con il flag Offline
+ */
+function readOfflineEntries() {
+    try {
+        return JSON.parse(localStorage.getItem('turnstileOffline')) || [];
+    } catch (error) {
+        return [];
+    }
+}
+
+function offlineEntryKey(entry) {
+    return entry.IDSmartCard + '|' + entry.IDPalestra + '|' + entry.Timestamp;
+}
+
+function queueOfflineEntry(record) {
+    const entries = readOfflineEntries();
+    entries.push(record);
+    localStorage.setItem('turnstileOffline', JSON.stringify(entries.slice(-OFFLINE_MAX_ENTRIES)));
+}
+
+const flushOfflineEntries = singleFlight(async () => {
+    let entries = readOfflineEntries();
+    while (entries.length > 0) {
+        const records = entries.slice(0, OFFLINE_BATCH_SIZE);
+        try {
+            const response = await fetch(API_ENDPOINT + '/batch', {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json',
+                },
+                body: JSON.stringify({ Records: records })
+            });
+            if (!response.ok) {
+                throw new Error(`Errore HTTP: ${response.status} ${response.statusText}`);
+            }
+        } catch (error) {
+            console.error('Reinvio dei passaggi offline non riuscito:', error);
+            return;
+        }
+        // Rileggo la coda e tolgo i passaggi inviati: durante l'invio possono esserne stati aggiunti
+        // altri, ed i più vecchi possono essere stati scartati oltre OFFLINE_MAX_ENTRIES
+        const sent = new Set(records.map(offlineEntryKey));
+        entries = readOfflineEntries().filter(entry => !sent.has(offlineEntryKey(entry)));
+        localStorage.setItem('turnstileOffline', JSON.stringify(entries));
+    }
+});
+
+/**
+ * Decide l'accesso senza API: la SmartCard deve essere nello snapshot, con scadenza successiva ad oggi,
+ * e lo snapshot deve essere stato sincronizzato da meno di SNAPSHOT_MAX_AGE. Il passaggio viene accodato
+ * con la firma dei record offline, calcolata su "offline" + IDSmartCard + IDPalestra + Timestamp
+ */
+async function offlineAccess(smartCardId, timestamp) {
+    if (!snapshot || Date.now() - snapshot.sincronizzato > SNAPSHOT_MAX_AGE) {
+        showStatus('❌ Errore: Impossibile connettersi al server e nessuno snapshot valido disponibile', 'error');
+        closeTurnstile();
+        return;
+    }
+
+    const expiry = findExpiry(smartCardId);
+    if (expiry !== null && expiry > todayDays()) {
+        const offlineSignature = await generateHMAC('offline' + smartCardId + config.gymId + timestamp, config.apiKey);
+        queueOfflineEntry({
+            IDSmartCard: smartCardId,
+            IDPalestra: config.gymId,
+            Timestamp: timestamp,
+            Signature: offlineSignature,
+            Offline: true
+        });
+        showStatus(`✅ ${'Accesso Consentito! Benvenuto! (offline)'}`, 'success');
+        openTurnstile();
+
+        setTimeout(() => {
+            closeTurnstile();
+            document.getElementById('smartCardId').value = '';
+        }, 5000);
+    } else {
+        showStatus(`🚫 Accesso Negato (offline)`, 'error');
+        closeTurnstile();
+    }
+}
+
 // ========================
 // UI FUNCTIONS
 // ========================
@@ -105,6 +463,9 @@ window.onload = function() {
     document.getElementById('configSection').classList.add('hidden');
     document.getElementById('accessSection').classList.remove('hidden');
     document.getElementById('displayGymId').textContent = config.gymId;
+
+    loadSnapshot();
+    startSnapshotSync();
 };
 
 /**
@@ -127,6 +488,10 @@ function saveConfig() {
     document.getElementById('accessSection').classList.remove('hidden');
     document.getElementById('displayGymId').textContent = config.gymId;
 
+    // Lo snapshot scaricato con un'altra chiave non sarebbe più verificabile
+    snapshot = null;
+    localStorage.removeItem('turnstileSnapshot');
+    startSnapshotSync();
 }
 
 /**
@@ -186,13 +551,24 @@ async function checkAccess() {
         };
 
         // Invia richiesta POST all'API
-        const response = await fetch(API_ENDPOINT, {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json',
-            },
-            body: JSON.stringify(requestData)
-        });
+        let response = null;
+        try {
+            response = await fetch(API_ENDPOINT, {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json',
+                },
+                body: JSON.stringify(requestData)
+            });
+        } catch (networkError) {
+            console.error('API non raggiungibile:', networkError);
+        }
+
+        // Server non raggiungibile o non disponibile: decisione con lo snapshot locale
+        if (response === null || response.status >= 500) {
+            await offlineAccess(smartCardId, timestamp);
+            return;
+        }
 
         if (!response.ok) {
             throw new Error(`Errore HTTP: ${response.status} ${response.statusText}`);
@@ -0,0 +1,11 @@
+-- Indici consigliati per il Database Gestionale esterno.
+-- Questo file NON viene eseguito in automatico: va applicato dagli amministratori del Gestionale.
+-- Permettono a Gestionale.verifica_accesso (api/db_handler.py) di risolvere cliente e
+-- abbonamento valido con ricerche sull'indice invece che con scansioni delle tabelle.
+USE WorldFit;
+
+-- Ricerca del cliente per SmartCardId (indice su prefisso: la colonna è VARCHAR(1000))
+CREATE INDEX `IdxClientiSmartCardId` ON `Clienti` (`SmartCardId`(32));
+
+-- Ricerca degli abbonamenti validi di un cliente in un giorno
+CREATE INDEX `IdxAbbonamentiClienteValidita` ON `Abbonamenti` (`IdCliente`, `ValidoDal`, `ValidoAl`);
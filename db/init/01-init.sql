@@ -1,11 +1,52 @@
 USE WorldFitLS;
 
--- Tabella Log
+-- Tabella Log, partizionata per giorno: la conservazione elimina partizioni intere invece di singole righe.
+-- SmartCardId è lo pseudonimo in base64 (chiave RSA a 2048 bit: al massimo 344 caratteri ASCII), in una
+-- colonna a lunghezza fissa con confronto binario. La chiave primaria deve contenere la colonna di
+-- partizionamento; gli indici secondari servono alle ricerche per tessera o per palestra in un intervallo
+-- di tempo (es. controlli antifrode), che leggono solo le partizioni dei giorni interessati.
+-- IdxLogsSmartCardTimestamp è univoco: l'API scrive con INSERT IGNORE ed un passaggio reinviato (tornello
+-- offline, retry, recupero della coda di scrittura) viene registrato una volta sola.
+-- La sola partizione iniziale "pfuturo" viene suddivisa in partizioni giornaliere da ManutenzionePartizioniLogs.
 CREATE TABLE `Logs` (
-    `Id` INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
-    `SmartCardId` VARCHAR(1000) NOT NULL,
+    `Id` BIGINT UNSIGNED NOT NULL AUTO_INCREMENT,
+    `SmartCardId` CHAR(344) CHARACTER SET ascii COLLATE ascii_bin NOT NULL,
     `PalestraId` INT NOT NULL,
-    `Timestamp` DATETIME NOT NULL
+    `Timestamp` DATETIME NOT NULL,
+    PRIMARY KEY (`Id`, `Timestamp`),
+    UNIQUE INDEX `IdxLogsSmartCardTimestamp` (`SmartCardId`, `Timestamp`, `PalestraId`),
+    INDEX `IdxLogsPalestraTimestamp` (`PalestraId`, `Timestamp`)
+)
+PARTITION BY RANGE (TO_DAYS(`Timestamp`)) (
+    PARTITION `pfuturo` VALUES LESS THAN MAXVALUE
+);
+
+-- Tabella Allerte del rilevatore di frodi (api/antifrode.py). L'indice univoco su tipo ed ingresso
+-- rende idempotenti le riletture di Logs all'avvio del rilevatore ed i backfill.
+CREATE TABLE `Allerte` (
+    `Id` BIGINT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY,
+    `Tipo` VARCHAR(30) NOT NULL,
+    `SmartCardId` CHAR(344) CHARACTER SET ascii COLLATE ascii_bin NOT NULL,
+    `LogId` BIGINT UNSIGNED NOT NULL,                 -- ingresso che ha generato l'allerta
+    `PalestraId` INT NOT NULL,
+    `Timestamp` DATETIME NOT NULL,
+    `LogIdPrecedente` BIGINT UNSIGNED DEFAULT NULL,   -- ingresso con cui è in conflitto
+    `PalestraIdPrecedente` INT DEFAULT NULL,
+    `Dettagli` VARCHAR(1000) DEFAULT NULL,
+    `Rilevata` DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE INDEX `IdxAllerteTipoLog` (`Tipo`, `LogId`),
+    INDEX `IdxAllerteSmartCardTimestamp` (`SmartCardId`, `Timestamp`)
+);
+
+-- Tabella dei giorni di Logs esportati nell'archivio freddo (api/archivio_logs.py) prima della scadenza:
+-- ManutenzionePartizioniLogs elimina le partizioni dei giorni registrati. Segmento è il file che contiene
+-- gli ingressi del giorno (NULL per i giorni senza ingressi), Sha256 la sua impronta.
+CREATE TABLE `ArchivioLogs` (
+    `Giorno` DATE NOT NULL PRIMARY KEY,
+    `Righe` BIGINT UNSIGNED NOT NULL,
+    `Segmento` VARCHAR(64) DEFAULT NULL,
+    `Sha256` CHAR(64) CHARACTER SET ascii DEFAULT NULL,
+    `Archiviato` DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
 );
 
 -- Tabella Statistiche
@@ -18,10 +59,114 @@ CREATE TABLE `Statistiche` (
     `FasciaOraria` VARCHAR(100) DEFAULT NULL
 );
 
--- Evento di Cancellazione Dati Trimestrale
+-- Tabella Statistiche Aggregate: un contatore di ingressi per ogni combinazione di dimensioni.
+-- La dimensione cresce con il numero di combinazioni distinte e non con il numero di ingressi.
+-- La chiave primaria inizia con la data: gli incrementi del giorno sono contigui ed i report per
+-- intervallo di date leggono solo la porzione di indice interessata.
+CREATE TABLE `StatisticheAggregate` (
+    `DataIngresso` DATE NOT NULL,
+    `PalestraId` INT NOT NULL,
+    `FasciaOraria` VARCHAR(20) NOT NULL,
+    `FasciaEta` VARCHAR(20) NOT NULL,
+    `Sesso` CHAR(1) NOT NULL DEFAULT '',      -- '' se il sesso non è specificato
+    `Ingressi` INT UNSIGNED NOT NULL DEFAULT 0,
+    PRIMARY KEY (`DataIngresso`, `PalestraId`, `FasciaOraria`, `FasciaEta`, `Sesso`)
+);
+
+-- Vista k-anonima delle statistiche aggregate: vengono escluse le combinazioni con meno di 5
+-- ingressi, che potrebbero ricondurre ad un singolo cliente
+CREATE VIEW `StatisticheKAnonime` AS
+SELECT `DataIngresso`, `PalestraId`, `FasciaOraria`, `FasciaEta`, `Sesso`, `Ingressi`
+FROM `StatisticheAggregate`
+WHERE `Ingressi` >= 5;
+
+-- Procedura di Rollup: sposta le righe di Statistiche dei giorni conclusi nei contatori di
+-- StatisticheAggregate, in un'unica transazione. Utilizzata sia dall'evento giornaliero
+-- (modalità "righe" dell'API) sia per migrare le righe già presenti.
+DELIMITER ;;
+CREATE PROCEDURE `RollupStatistiche`()
+BEGIN
+    DECLARE limite DATE DEFAULT CURDATE();
+    START TRANSACTION;
+    INSERT INTO `StatisticheAggregate` (`DataIngresso`, `PalestraId`, `FasciaOraria`, `FasciaEta`, `Sesso`, `Ingressi`)
+    SELECT * FROM (
+        SELECT `DataIngresso`, `PalestraId`, COALESCE(`FasciaOraria`, '') AS `FasciaOraria`,
+               COALESCE(`FasciaEta`, '') AS `FasciaEta`, COALESCE(`Sesso`, '') AS `Sesso`, COUNT(*) AS `Nuovi`
+        FROM `Statistiche`
+        WHERE `DataIngresso` < limite AND `PalestraId` IS NOT NULL
+        GROUP BY 1, 2, 3, 4, 5
+    ) AS `nuove`
+    ON DUPLICATE KEY UPDATE `Ingressi` = `StatisticheAggregate`.`Ingressi` + `nuove`.`Nuovi`;
+    DELETE FROM `Statistiche` WHERE `DataIngresso` < limite AND `PalestraId` IS NOT NULL;
+    COMMIT;
+END;;
+DELIMITER ;
+
+-- Procedura di manutenzione delle partizioni di Logs. Ogni partizione pAAAAMMGG contiene gli ingressi
+-- di un giorno; la partizione pfuturo raccoglie quelli oltre l'ultimo giorno creato (normalmente vuota).
+-- 1. crea le partizioni giornaliere fino a giorni_futuri giorni da oggi, suddividendo pfuturo
+--    (operazione immediata se pfuturo è vuota). Alla prima esecuzione parte dal limite di conservazione.
+-- 2. elimina le partizioni con soli ingressi più vecchi di mesi_conservazione mesi (DROP PARTITION:
+--    nessuna scansione né cancellazione riga per riga, nessun blocco sulle partizioni in scrittura),
+--    se il giorno è stato archiviato (tabella ArchivioLogs) oppure è scaduto da più di giorni_attesa
+--    giorni: senza archiviatore la conservazione si allunga al massimo di giorni_attesa giorni.
+DELIMITER ;;
+CREATE PROCEDURE `ManutenzionePartizioniLogs`(IN giorni_futuri INT, IN mesi_conservazione INT, IN giorni_attesa INT)
+BEGIN
+    DECLARE limite_conservazione INT DEFAULT TO_DAYS(DATE_SUB(CURDATE(), INTERVAL mesi_conservazione MONTH));
+    DECLARE ultimo INT;
+    DECLARE giorno DATE;
+    DECLARE nuove TEXT DEFAULT '';
+    DECLARE vecchie TEXT;
+
+    -- Limite superiore (TO_DAYS del giorno successivo) dell'ultima partizione giornaliera
+    SELECT MAX(CAST(`PARTITION_DESCRIPTION` AS UNSIGNED)) INTO ultimo
+    FROM INFORMATION_SCHEMA.PARTITIONS
+    WHERE `TABLE_SCHEMA` = DATABASE() AND `TABLE_NAME` = 'Logs' AND `PARTITION_NAME` <> 'pfuturo';
+    SET giorno = FROM_DAYS(COALESCE(ultimo, limite_conservazione));
+    WHILE giorno <= DATE_ADD(CURDATE(), INTERVAL giorni_futuri DAY) DO
+        SET nuove = CONCAT(nuove, 'PARTITION `p', DATE_FORMAT(giorno, '%Y%m%d'),
+                           '` VALUES LESS THAN (', TO_DAYS(giorno) + 1, '), ');
+        SET giorno = DATE_ADD(giorno, INTERVAL 1 DAY);
+    END WHILE;
+    IF nuove <> '' THEN
+        SET @istruzione = CONCAT('ALTER TABLE `Logs` REORGANIZE PARTITION `pfuturo` INTO (', nuove,
+                                 'PARTITION `pfuturo` VALUES LESS THAN MAXVALUE)');
+        PREPARE istruzione FROM @istruzione;
+        EXECUTE istruzione;
+        DEALLOCATE PREPARE istruzione;
+    END IF;
+
+    SELECT GROUP_CONCAT(CONCAT('`', `PARTITION_NAME`, '`')) INTO vecchie
+    FROM INFORMATION_SCHEMA.PARTITIONS
+    WHERE `TABLE_SCHEMA` = DATABASE() AND `TABLE_NAME` = 'Logs' AND `PARTITION_NAME` <> 'pfuturo'
+      AND CAST(`PARTITION_DESCRIPTION` AS UNSIGNED) <= limite_conservazione
+      AND (CAST(`PARTITION_DESCRIPTION` AS UNSIGNED) <= limite_conservazione - giorni_attesa
+           OR EXISTS (SELECT 1 FROM `ArchivioLogs`
+                      WHERE `Giorno` = FROM_DAYS(CAST(`PARTITION_DESCRIPTION` AS UNSIGNED) - 1)));
+    IF vecchie IS NOT NULL THEN
+        SET @istruzione = CONCAT('ALTER TABLE `Logs` DROP PARTITION ', vecchie);
+        PREPARE istruzione FROM @istruzione;
+        EXECUTE istruzione;
+        DEALLOCATE PREPARE istruzione;
+    END IF;
+END;;
+DELIMITER ;
+
+-- Partizioni iniziali: dal limite di conservazione a una settimana da oggi
+CALL `ManutenzionePartizioniLogs`(7, 3, 30);
+
+-- Evento di Cancellazione Dati Trimestrale e creazione delle partizioni dei prossimi giorni
 SET GLOBAL event_scheduler = ON;
 CREATE EVENT IF NOT EXISTS `Pulizia`
 ON SCHEDULE EVERY 1 DAY
 STARTS CURRENT_TIMESTAMP
 ON COMPLETION PRESERVE
-DO DELETE FROM `Logs` WHERE `Timestamp` < DATE_SUB(NOW(), INTERVAL 3 MONTH);
\ No newline at end of file
+DO CALL `ManutenzionePartizioniLogs`(7, 3, 30);
+
+-- Evento di Rollup giornaliero delle Statistiche
+CREATE EVENT IF NOT EXISTS `RollupGiornaliero`
+ON SCHEDULE EVERY 1 DAY
+STARTS CURRENT_DATE + INTERVAL 1 DAY + INTERVAL 10 MINUTE
+ON COMPLETION PRESERVE
+DO CALL `RollupStatistiche`();
\ No newline at end of file
@@ -3,6 +3,9 @@ set -e
 
 ROOT_PASSWORD=$(cat /run/secrets/db_ls_root_password)
 LOG_API_PASSWORD=$(cat /run/secrets/db_ls_api_password)
+ANTIFRODE_PASSWORD=$(cat /run/secrets/db_ls_antifrode_password)
+REPORT_PASSWORD=$(cat /run/secrets/db_ls_report_password)
+ARCHIVIO_PASSWORD=$(cat /run/secrets/db_ls_archivio_password)
 
 mysql -u root -p"$ROOT_PASSWORD" "$MYSQL_DATABASE" <<-EOSQL
 -- Creazione Utente API
@@ -11,6 +14,25 @@ CREATE USER IF NOT EXISTS '$MYSQL_API_USER'@'%' IDENTIFIED BY '$LOG_API_PASSWORD
 -- Assegnazione di soli privilegi di scrittura
 GRANT INSERT ON \`Logs\` TO '$MYSQL_API_USER'@'%';
 GRANT INSERT ON \`Statistiche\` TO '$MYSQL_API_USER'@'%';
+-- Gli incrementi dei contatori (INSERT ... ON DUPLICATE KEY UPDATE) richiedono anche
+-- la lettura e l'aggiornamento della sola colonna Ingressi
+GRANT INSERT, SELECT (\`Ingressi\`), UPDATE (\`Ingressi\`) ON \`StatisticheAggregate\` TO '$MYSQL_API_USER'@'%';
+
+-- Creazione Utente del rilevatore di frodi (api/antifrode.py): lettura degli ingressi e scrittura delle allerte
+CREATE USER IF NOT EXISTS '$MYSQL_ANTIFRODE_USER'@'%' IDENTIFIED BY '$ANTIFRODE_PASSWORD';
+GRANT SELECT ON \`Logs\` TO '$MYSQL_ANTIFRODE_USER'@'%';
+GRANT INSERT ON \`Allerte\` TO '$MYSQL_ANTIFRODE_USER'@'%';
+
+-- Creazione Utente del server di reportistica (api/report.py): sola lettura delle statistiche anonime,
+-- con poche connessioni contemporanee per non sottrarre risorse alle scritture dell'API
+CREATE USER IF NOT EXISTS '$MYSQL_REPORT_USER'@'%' IDENTIFIED BY '$REPORT_PASSWORD' WITH MAX_USER_CONNECTIONS 4;
+GRANT SELECT ON \`Statistiche\` TO '$MYSQL_REPORT_USER'@'%';
+GRANT SELECT ON \`StatisticheAggregate\` TO '$MYSQL_REPORT_USER'@'%';
+
+-- Creazione Utente dell'archiviatore (api/archivio_logs.py): lettura degli ingressi e registrazione dei giorni archiviati
+CREATE USER IF NOT EXISTS '$MYSQL_ARCHIVIO_USER'@'%' IDENTIFIED BY '$ARCHIVIO_PASSWORD';
+GRANT SELECT ON \`Logs\` TO '$MYSQL_ARCHIVIO_USER'@'%';
+GRANT SELECT, INSERT, UPDATE ON \`ArchivioLogs\` TO '$MYSQL_ARCHIVIO_USER'@'%';
 
 FLUSH PRIVILEGES;
 EOSQL
\ No newline at end of file
@@ -0,0 +1,62 @@
+-- Migrazione alle Statistiche Aggregate per un Database Log & Statistiche già inizializzato.
+-- Gli script in db/init vengono eseguiti solo alla creazione del volume: questo script va eseguito
+-- a mano come root, es:
+--   docker exec -i db_logs_stats sh -c 'mysql -u root -p"$(cat /run/secrets/db_ls_root_password)" WorldFitLS' < db/migrazioni/01-statistiche-aggregate.sql
+-- Al termine le righe di Statistiche dei giorni conclusi sono state spostate nei contatori.
+USE WorldFitLS;
+
+-- Tabella Statistiche Aggregate: un contatore di ingressi per ogni combinazione di dimensioni.
+-- La dimensione cresce con il numero di combinazioni distinte e non con il numero di ingressi.
+-- La chiave primaria inizia con la data: gli incrementi del giorno sono contigui ed i report per
+-- intervallo di date leggono solo la porzione di indice interessata.
+CREATE TABLE `StatisticheAggregate` (
+    `DataIngresso` DATE NOT NULL,
+    `PalestraId` INT NOT NULL,
+    `FasciaOraria` VARCHAR(20) NOT NULL,
+    `FasciaEta` VARCHAR(20) NOT NULL,
+    `Sesso` CHAR(1) NOT NULL DEFAULT '',      -- '' se il sesso non è specificato
+    `Ingressi` INT UNSIGNED NOT NULL DEFAULT 0,
+    PRIMARY KEY (`DataIngresso`, `PalestraId`, `FasciaOraria`, `FasciaEta`, `Sesso`)
+);
+
+-- Vista k-anonima delle statistiche aggregate: vengono escluse le combinazioni con meno di 5
+-- ingressi, che potrebbero ricondurre ad un singolo cliente
+CREATE VIEW `StatisticheKAnonime` AS
+SELECT `DataIngresso`, `PalestraId`, `FasciaOraria`, `FasciaEta`, `Sesso`, `Ingressi`
+FROM `StatisticheAggregate`
+WHERE `Ingressi` >= 5;
+
+-- Procedura di Rollup: sposta le righe di Statistiche dei giorni conclusi nei contatori di
+-- StatisticheAggregate, in un'unica transazione. Utilizzata sia dall'evento giornaliero
+-- (modalità "righe" dell'API) sia per migrare le righe già presenti.
+DELIMITER ;;
+CREATE PROCEDURE `RollupStatistiche`()
+BEGIN
+    DECLARE limite DATE DEFAULT CURDATE();
+    START TRANSACTION;
+    INSERT INTO `StatisticheAggregate` (`DataIngresso`, `PalestraId`, `FasciaOraria`, `FasciaEta`, `Sesso`, `Ingressi`)
+    SELECT * FROM (
+        SELECT `DataIngresso`, `PalestraId`, COALESCE(`FasciaOraria`, '') AS `FasciaOraria`,
+               COALESCE(`FasciaEta`, '') AS `FasciaEta`, COALESCE(`Sesso`, '') AS `Sesso`, COUNT(*) AS `Nuovi`
+        FROM `Statistiche`
+        WHERE `DataIngresso` < limite AND `PalestraId` IS NOT NULL
+        GROUP BY 1, 2, 3, 4, 5
+    ) AS `nuove`
+    ON DUPLICATE KEY UPDATE `Ingressi` = `StatisticheAggregate`.`Ingressi` + `nuove`.`Nuovi`;
+    DELETE FROM `Statistiche` WHERE `DataIngresso` < limite AND `PalestraId` IS NOT NULL;
+    COMMIT;
+END;;
+DELIMITER ;
+
+-- Evento di Rollup giornaliero delle Statistiche
+CREATE EVENT IF NOT EXISTS `RollupGiornaliero`
+ON SCHEDULE EVERY 1 DAY
+STARTS CURRENT_DATE + INTERVAL 1 DAY + INTERVAL 10 MINUTE
+ON COMPLETION PRESERVE
+DO CALL `RollupStatistiche`();
+
+GRANT INSERT, SELECT (`Ingressi`), UPDATE (`Ingressi`) ON `StatisticheAggregate` TO 'api'@'%';
+FLUSH PRIVILEGES;
+
+-- Rollup delle righe esistenti
+CALL `RollupStatistiche`();
@@ -0,0 +1,113 @@
+-- Migrazione alla tabella Logs partizionata per giorno per un Database Log & Statistiche già inizializzato.
+-- Gli script in db/init vengono eseguiti solo alla creazione del volume: questo script va eseguito
+-- a mano come root, es:
+--   docker exec -i db_logs_stats sh -c 'mysql -u root -p"$(cat /run/secrets/db_ls_root_password)" WorldFitLS' < db/migrazioni/02-logs-partizionate.sql
+-- La nuova tabella prende il posto di quella esistente con un'unica RENAME TABLE, quindi l'API può
+-- restare in funzione: gli ingressi successivi vengono scritti nella nuova tabella, mentre le righe
+-- ancora da conservare (ultimi 3 mesi) vengono copiate a blocchi. La tabella precedente resta con
+-- il nome LogsPrecedente e va eliminata a mano dopo le verifiche:
+--   DROP TABLE `LogsPrecedente`;
+USE WorldFitLS;
+
+-- Tabella Log partizionata (vedi db/init/01-init.sql)
+CREATE TABLE `LogsPartizionata` (
+    `Id` BIGINT UNSIGNED NOT NULL AUTO_INCREMENT,
+    `SmartCardId` CHAR(344) CHARACTER SET ascii COLLATE ascii_bin NOT NULL,
+    `PalestraId` INT NOT NULL,
+    `Timestamp` DATETIME NOT NULL,
+    PRIMARY KEY (`Id`, `Timestamp`),
+    INDEX `IdxLogsSmartCardTimestamp` (`SmartCardId`, `Timestamp`),
+    INDEX `IdxLogsPalestraTimestamp` (`PalestraId`, `Timestamp`)
+)
+PARTITION BY RANGE (TO_DAYS(`Timestamp`)) (
+    PARTITION `pfuturo` VALUES LESS THAN MAXVALUE
+);
+
+-- Procedura di manutenzione delle partizioni di Logs (identica a quella di db/init/01-init.sql)
+DELIMITER ;;
+CREATE PROCEDURE `ManutenzionePartizioniLogs`(IN giorni_futuri INT, IN mesi_conservazione INT)
+BEGIN
+    DECLARE limite_conservazione INT DEFAULT TO_DAYS(DATE_SUB(CURDATE(), INTERVAL mesi_conservazione MONTH));
+    DECLARE ultimo INT;
+    DECLARE giorno DATE;
+    DECLARE nuove TEXT DEFAULT '';
+    DECLARE vecchie TEXT;
+
+    -- Limite superiore (TO_DAYS del giorno successivo) dell'ultima partizione giornaliera
+    SELECT MAX(CAST(`PARTITION_DESCRIPTION` AS UNSIGNED)) INTO ultimo
+    FROM INFORMATION_SCHEMA.PARTITIONS
+    WHERE `TABLE_SCHEMA` = DATABASE() AND `TABLE_NAME` = 'Logs' AND `PARTITION_NAME` <> 'pfuturo';
+    SET giorno = FROM_DAYS(COALESCE(ultimo, limite_conservazione));
+    WHILE giorno <= DATE_ADD(CURDATE(), INTERVAL giorni_futuri DAY) DO
+        SET nuove = CONCAT(nuove, 'PARTITION `p', DATE_FORMAT(giorno, '%Y%m%d'),
+                           '` VALUES LESS THAN (', TO_DAYS(giorno) + 1, '), ');
+        SET giorno = DATE_ADD(giorno, INTERVAL 1 DAY);
+    END WHILE;
+    IF nuove <> '' THEN
+        SET @istruzione = CONCAT('ALTER TABLE `Logs` REORGANIZE PARTITION `pfuturo` INTO (', nuove,
+                                 'PARTITION `pfuturo` VALUES LESS THAN MAXVALUE)');
+        PREPARE istruzione FROM @istruzione;
+        EXECUTE istruzione;
+        DEALLOCATE PREPARE istruzione;
+    END IF;
+
+    SELECT GROUP_CONCAT(CONCAT('`', `PARTITION_NAME`, '`')) INTO vecchie
+    FROM INFORMATION_SCHEMA.PARTITIONS
+    WHERE `TABLE_SCHEMA` = DATABASE() AND `TABLE_NAME` = 'Logs' AND `PARTITION_NAME` <> 'pfuturo'
+      AND CAST(`PARTITION_DESCRIPTION` AS UNSIGNED) <= limite_conservazione;
+    IF vecchie IS NOT NULL THEN
+        SET @istruzione = CONCAT('ALTER TABLE `Logs` DROP PARTITION ', vecchie);
+        PREPARE istruzione FROM @istruzione;
+        EXECUTE istruzione;
+        DEALLOCATE PREPARE istruzione;
+    END IF;
+END;;
+
+-- Procedura temporanea di migrazione
+CREATE PROCEDURE `MigrazioneLogsPartizionata`()
+BEGIN
+    DECLARE limite DATETIME DEFAULT DATE_SUB(NOW(), INTERVAL 3 MONTH);
+    DECLARE inizio BIGINT;
+    DECLARE massimo BIGINT;
+
+    -- Pseudonimi più lunghi di 344 caratteri (chiave RSA oltre i 2048 bit) verrebbero troncati
+    IF EXISTS (SELECT 1 FROM `Logs` WHERE CHAR_LENGTH(`SmartCardId`) > 344) THEN
+        SIGNAL SQLSTATE '45000' SET MESSAGE_TEXT = 'Logs contiene pseudonimi oltre i 344 caratteri: migrazione annullata';
+    END IF;
+
+    -- Gli Id delle righe copiate restano invariati: i nuovi ingressi partono oltre l'ultimo Id esistente,
+    -- con un margine per quelli scritti nella vecchia tabella fino alla RENAME TABLE
+    SELECT COALESCE(MAX(`Id`), 0) INTO massimo FROM `Logs`;
+    SET @istruzione = CONCAT('ALTER TABLE `LogsPartizionata` AUTO_INCREMENT = ', massimo + 1000000);
+    PREPARE istruzione FROM @istruzione;
+    EXECUTE istruzione;
+    DEALLOCATE PREPARE istruzione;
+
+    RENAME TABLE `Logs` TO `LogsPrecedente`, `LogsPartizionata` TO `Logs`;
+    CALL `ManutenzionePartizioniLogs`(7, 3);
+
+    -- Copia a blocchi di Id, con una transazione breve per blocco
+    SELECT COALESCE(MIN(`Id`), 1), COALESCE(MAX(`Id`), 0) INTO inizio, massimo FROM `LogsPrecedente`;
+    WHILE inizio <= massimo DO
+        INSERT INTO `Logs` (`Id`, `SmartCardId`, `PalestraId`, `Timestamp`)
+        SELECT `Id`, `SmartCardId`, `PalestraId`, `Timestamp` FROM `LogsPrecedente`
+        WHERE `Id` >= inizio AND `Id` < inizio + 50000 AND `Timestamp` >= limite;
+        SET inizio = inizio + 50000;
+    END WHILE;
+END;;
+DELIMITER ;
+
+CALL `MigrazioneLogsPartizionata`();
+DROP PROCEDURE `MigrazioneLogsPartizionata`;
+
+-- Evento di Cancellazione Dati Trimestrale e creazione delle partizioni dei prossimi giorni
+DROP EVENT IF EXISTS `Pulizia`;
+CREATE EVENT `Pulizia`
+ON SCHEDULE EVERY 1 DAY
+STARTS CURRENT_TIMESTAMP
+ON COMPLETION PRESERVE
+DO CALL `ManutenzionePartizioniLogs`(7, 3);
+
+-- I privilegi sono legati al nome della tabella: l'utente dell'API può scrivere nella nuova Logs
+GRANT INSERT ON `Logs` TO 'api'@'%';
+FLUSH PRIVILEGES;
@@ -0,0 +1,33 @@
+#!/bin/sh
+# Migrazione per il rilevatore di frodi (api/antifrode.py) su un Database Log & Statistiche già inizializzato:
+# crea la tabella Allerte e l'utente antifrode. Richiede il segreto db_ls_antifrode_password montato nel
+# container del database (docker compose up -d worldfit_db dopo aver aggiornato docker-compose.yml).
+# Va eseguito nel container, es:
+#   docker exec -i db_logs_stats sh < db/migrazioni/03-allerte.sh
+set -e
+
+ROOT_PASSWORD=$(cat /run/secrets/db_ls_root_password)
+ANTIFRODE_PASSWORD=$(cat /run/secrets/db_ls_antifrode_password)
+
+mysql -u root -p"$ROOT_PASSWORD" WorldFitLS <<-EOSQL
+-- Tabella Allerte (vedi db/init/01-init.sql)
+CREATE TABLE IF NOT EXISTS \`Allerte\` (
+    \`Id\` BIGINT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY,
+    \`Tipo\` VARCHAR(30) NOT NULL,
+    \`SmartCardId\` CHAR(344) CHARACTER SET ascii COLLATE ascii_bin NOT NULL,
+    \`LogId\` BIGINT UNSIGNED NOT NULL,
+    \`PalestraId\` INT NOT NULL,
+    \`Timestamp\` DATETIME NOT NULL,
+    \`LogIdPrecedente\` BIGINT UNSIGNED DEFAULT NULL,
+    \`PalestraIdPrecedente\` INT DEFAULT NULL,
+    \`Dettagli\` VARCHAR(1000) DEFAULT NULL,
+    \`Rilevata\` DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE INDEX \`IdxAllerteTipoLog\` (\`Tipo\`, \`LogId\`),
+    INDEX \`IdxAllerteSmartCardTimestamp\` (\`SmartCardId\`, \`Timestamp\`)
+);
+
+CREATE USER IF NOT EXISTS 'antifrode'@'%' IDENTIFIED BY '$ANTIFRODE_PASSWORD';
+GRANT SELECT ON \`Logs\` TO 'antifrode'@'%';
+GRANT INSERT ON \`Allerte\` TO 'antifrode'@'%';
+FLUSH PRIVILEGES;
+EOSQL
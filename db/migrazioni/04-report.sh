@@ -0,0 +1,17 @@
+#!/bin/sh
+# Migrazione per il server di reportistica (api/report.py) su un Database Log & Statistiche già inizializzato:
+# crea l'utente report in sola lettura. Richiede il segreto db_ls_report_password montato nel container del
+# database (docker compose up -d worldfit_db dopo aver aggiornato docker-compose.yml).
+# Va eseguito nel container, es:
+#   docker exec -i db_logs_stats sh < db/migrazioni/04-report.sh
+set -e
+
+ROOT_PASSWORD=$(cat /run/secrets/db_ls_root_password)
+REPORT_PASSWORD=$(cat /run/secrets/db_ls_report_password)
+
+mysql -u root -p"$ROOT_PASSWORD" WorldFitLS <<-EOSQL
+CREATE USER IF NOT EXISTS 'report'@'%' IDENTIFIED BY '$REPORT_PASSWORD' WITH MAX_USER_CONNECTIONS 4;
+GRANT SELECT ON \`Statistiche\` TO 'report'@'%';
+GRANT SELECT ON \`StatisticheAggregate\` TO 'report'@'%';
+FLUSH PRIVILEGES;
+EOSQL
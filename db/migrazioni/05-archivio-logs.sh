@@ -0,0 +1,79 @@
+#!/bin/sh
+# Migrazione per l'archivio freddo di Logs (api/archivio_logs.py) su un Database Log & Statistiche già
+# inizializzato: crea la tabella ArchivioLogs e l'utente archivio, sostituisce ManutenzionePartizioniLogs
+# con la versione che attende l'archiviazione dei giorni scaduti ed aggiorna l'evento Pulizia. Richiede il
+# segreto db_ls_archivio_password montato nel container del database (docker compose up -d worldfit_db dopo
+# aver aggiornato docker-compose.yml). Va eseguito nel container, es:
+#   docker exec -i db_logs_stats sh < db/migrazioni/05-archivio-logs.sh
+set -e
+
+ROOT_PASSWORD=$(cat /run/secrets/db_ls_root_password)
+ARCHIVIO_PASSWORD=$(cat /run/secrets/db_ls_archivio_password)
+
+mysql -u root -p"$ROOT_PASSWORD" WorldFitLS <<-EOSQL
+-- Tabella ArchivioLogs (vedi db/init/01-init.sql)
+CREATE TABLE IF NOT EXISTS \`ArchivioLogs\` (
+    \`Giorno\` DATE NOT NULL PRIMARY KEY,
+    \`Righe\` BIGINT UNSIGNED NOT NULL,
+    \`Segmento\` VARCHAR(64) DEFAULT NULL,
+    \`Sha256\` CHAR(64) CHARACTER SET ascii DEFAULT NULL,
+    \`Archiviato\` DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Procedura di manutenzione delle partizioni di Logs (identica a quella di db/init/01-init.sql)
+DROP PROCEDURE IF EXISTS \`ManutenzionePartizioniLogs\`;
+DELIMITER ;;
+CREATE PROCEDURE \`ManutenzionePartizioniLogs\`(IN giorni_futuri INT, IN mesi_conservazione INT, IN giorni_attesa INT)
+BEGIN
+    DECLARE limite_conservazione INT DEFAULT TO_DAYS(DATE_SUB(CURDATE(), INTERVAL mesi_conservazione MONTH));
+    DECLARE ultimo INT;
+    DECLARE giorno DATE;
+    DECLARE nuove TEXT DEFAULT '';
+    DECLARE vecchie TEXT;
+
+    -- Limite superiore (TO_DAYS del giorno successivo) dell'ultima partizione giornaliera
+    SELECT MAX(CAST(\`PARTITION_DESCRIPTION\` AS UNSIGNED)) INTO ultimo
+    FROM INFORMATION_SCHEMA.PARTITIONS
+    WHERE \`TABLE_SCHEMA\` = DATABASE() AND \`TABLE_NAME\` = 'Logs' AND \`PARTITION_NAME\` <> 'pfuturo';
+    SET giorno = FROM_DAYS(COALESCE(ultimo, limite_conservazione));
+    WHILE giorno <= DATE_ADD(CURDATE(), INTERVAL giorni_futuri DAY) DO
+        SET nuove = CONCAT(nuove, 'PARTITION \`p', DATE_FORMAT(giorno, '%Y%m%d'),
+                           '\` VALUES LESS THAN (', TO_DAYS(giorno) + 1, '), ');
+        SET giorno = DATE_ADD(giorno, INTERVAL 1 DAY);
+    END WHILE;
+    IF nuove <> '' THEN
+        SET @istruzione = CONCAT('ALTER TABLE \`Logs\` REORGANIZE PARTITION \`pfuturo\` INTO (', nuove,
+                                 'PARTITION \`pfuturo\` VALUES LESS THAN MAXVALUE)');
+        PREPARE istruzione FROM @istruzione;
+        EXECUTE istruzione;
+        DEALLOCATE PREPARE istruzione;
+    END IF;
+
+    SELECT GROUP_CONCAT(CONCAT('\`', \`PARTITION_NAME\`, '\`')) INTO vecchie
+    FROM INFORMATION_SCHEMA.PARTITIONS
+    WHERE \`TABLE_SCHEMA\` = DATABASE() AND \`TABLE_NAME\` = 'Logs' AND \`PARTITION_NAME\` <> 'pfuturo'
+      AND CAST(\`PARTITION_DESCRIPTION\` AS UNSIGNED) <= limite_conservazione
+      AND (CAST(\`PARTITION_DESCRIPTION\` AS UNSIGNED) <= limite_conservazione - giorni_attesa
+           OR EXISTS (SELECT 1 FROM \`ArchivioLogs\`
+                      WHERE \`Giorno\` = FROM_DAYS(CAST(\`PARTITION_DESCRIPTION\` AS UNSIGNED) - 1)));
+    IF vecchie IS NOT NULL THEN
+        SET @istruzione = CONCAT('ALTER TABLE \`Logs\` DROP PARTITION ', vecchie);
+        PREPARE istruzione FROM @istruzione;
+        EXECUTE istruzione;
+        DEALLOCATE PREPARE istruzione;
+    END IF;
+END;;
+DELIMITER ;
+
+DROP EVENT IF EXISTS \`Pulizia\`;
+CREATE EVENT \`Pulizia\`
+ON SCHEDULE EVERY 1 DAY
+STARTS CURRENT_TIMESTAMP
+ON COMPLETION PRESERVE
+DO CALL \`ManutenzionePartizioniLogs\`(7, 3, 30);
+
+CREATE USER IF NOT EXISTS 'archivio'@'%' IDENTIFIED BY '$ARCHIVIO_PASSWORD';
+GRANT SELECT ON \`Logs\` TO 'archivio'@'%';
+GRANT SELECT, INSERT, UPDATE ON \`ArchivioLogs\` TO 'archivio'@'%';
+FLUSH PRIVILEGES;
+EOSQL
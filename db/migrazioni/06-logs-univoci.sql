@@ -0,0 +1,20 @@
+-- Migrazione all'indice univoco dei passaggi in Logs per un Database Log & Statistiche già inizializzato.
+-- Gli script in db/init vengono eseguiti solo alla creazione del volume: questo script va eseguito
+-- a mano come root, es:
+--   docker exec -i db_logs_stats sh -c 'mysql -u root -p"$(cat /run/secrets/db_ls_root_password)" WorldFitLS' < db/migrazioni/06-logs-univoci.sql
+-- I passaggi registrati più volte (stessa SmartCard, palestra e secondo) vengono ridotti ad una sola riga,
+-- quella con l'Id minore; le loro statistiche, già anonime, non possono essere corrette. L'API va
+-- aggiornata dopo la migrazione: la nuova versione scrive in Logs con INSERT IGNORE.
+USE WorldFitLS;
+
+DELETE `doppio` FROM `Logs` AS `doppio`
+JOIN `Logs` AS `primo`
+  ON `primo`.`SmartCardId` = `doppio`.`SmartCardId`
+ AND `primo`.`Timestamp` = `doppio`.`Timestamp`
+ AND `primo`.`PalestraId` = `doppio`.`PalestraId`
+ AND `primo`.`Id` < `doppio`.`Id`;
+
+-- Stesso nome e stesse colonne iniziali: le ricerche per tessera (antifrode, archivio) non cambiano
+ALTER TABLE `Logs`
+    DROP INDEX `IdxLogsSmartCardTimestamp`,
+    ADD UNIQUE INDEX `IdxLogsSmartCardTimestamp` (`SmartCardId`, `Timestamp`, `PalestraId`);
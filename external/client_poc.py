@@ -3,15 +3,35 @@ Modulo "proof of concept" di un client per testare la nostra API. Per il lancio
 necessari come parametri l'indirizzo ip dell'API con porta, l'id di una palestra ed uno smard card id.
 La API key verrà letta da un file al seguente percorso: "secrets/api_key.txt"
 
+Oltre alla singola richiesta (modalità "singola") lo script può generare carico sull'API:
+- "carico": invia passaggi firmati ad un'API già avviata, con un numero di richieste concorrenti ed
+  eventualmente un rate obiettivo, secondo un mix di passaggi validi, con abbonamento scaduto, con
+  SmartCard sconosciuta e con firma errata. Al termine stampa un report JSON con percentili di latenza,
+  throughput e tassi di errore.
+- "locale": come "carico", ma l'API viene avviata sulla macchina locale (in processo, con Gunicorn o in
+  modalità asincrona con Uvicorn)
+  con database SQLite popolati con clienti e palestre sintetici e segreti generati al momento.
+  Richiede le librerie dell'API (api/requirements.txt).
+
+Esempi:
+    python client_poc.py -i http://10.10.10.10:8000 -p 1 -s ABC123
+    python client_poc.py -m carico -i http://10.10.10.10:8000 --palestre 1,2 --valide ABC123 --scadute DEF456 -c 16 -d 30
+    python client_poc.py -m locale --membri 20000 -c 16 -d 20 -b 50 --gunicorn
+    python client_poc.py -m locale --membri 20000 -c 64 -d 20 --asgi
+
 Non aggiungo la libreria requests in requirements.txt, non so se serve all'API.
 Per il momento installatevela voi a mano se dovete fare del testing.
 '''
-import sys, argparse
-from datetime import datetime
+import sys, argparse, json, logging, math, os, random, secrets, socket, subprocess, tempfile, threading, time
+from datetime import datetime, date, timedelta
 from hashlib import sha256
 import hmac
 import requests
 
+CATEGORIE = ['valido', 'scaduto', 'sconosciuto', 'firma']
+CARTELLA_API = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "api")
+STATI_PALESTRE = ["Italia", "Francia", "Germania", "Spagna", "Portogallo", "Austria", "Paesi Bassi", "Grecia"]
+
 def prendisegreto(secretFile: str) -> str:
     """Funzione che prende un segreto dalla cartella secrets"""
     try:
@@ -20,27 +40,352 @@ def prendisegreto(secretFile: str) -> str:
     except Exception as e:
         sys.exit(f"Errore nella lettura del segreto, eccezione: {e}")
 
+def firma(api_key:str, dati:str) -> str:
+    '''Firma HMAC SHA-256, la stessa usata da API e tornelli'''
+    return hmac.new(key=api_key.encode('utf-8'), msg=dati.encode('utf-8'), digestmod=sha256).hexdigest()
+
+def leggi_mix(mix:str) -> dict:
+    '''Converte una stringa del tipo "valido=70,scaduto=10" nei pesi delle categorie di passaggi'''
+    pesi = {categoria: 0.0 for categoria in CATEGORIE}
+    for voce in mix.split(","):
+        categoria, peso = voce.split("=")
+        if categoria.strip() not in pesi:
+            raise argparse.ArgumentTypeError(f"Categoria sconosciuta nel mix: {categoria}. Categorie: {CATEGORIE}")
+        pesi[categoria.strip()] = float(peso)
+    if sum(pesi.values()) <= 0:
+        raise argparse.ArgumentTypeError("Il mix deve avere almeno un peso positivo")
+    return pesi
+
+def percentile(valori:list, p:float) -> float:
+    '''Percentile con il metodo nearest-rank su una lista già ordinata'''
+    if not valori:
+        return None
+    return valori[max(0, math.ceil(p / 100 * len(valori)) - 1)]
+
+class GeneratoreCarico:
+    '''
+    Classe che invia passaggi firmati all'API con "concorrenza" threads, ognuno con la propria sessione HTTP.
+    Con un rate obiettivo gli invii vengono distribuiti uniformemente nel tempo tra tutti i threads;
+    il test termina dopo "durata" secondi o dopo "richieste" richieste HTTP (il primo dei due).
+    '''
+    def __init__(self, indirizzo:str, api_key:str, tessere:dict, palestre:list, mix:dict,
+                 concorrenza:int = 8, rate:float = 0, durata:float = 10, richieste:int = 0,
+                 batch:int = 1, timeout:float = 10):
+        self.indirizzo = indirizzo.rstrip("/")
+        self.api_key = api_key
+        self.tessere = tessere
+        self.palestre = palestre
+        self.categorie = [c for c in CATEGORIE if mix[c] > 0]
+        self.pesi = [mix[c] for c in self.categorie]
+        self.concorrenza = concorrenza
+        self.rate = rate
+        self.durata = durata
+        self.richieste = richieste
+        self.batch = batch
+        self.timeout = timeout
+        conosciute = {t for lista in tessere.values() for t in lista}
+        self._sconosciute = [t for t in (f"{x:06X}" for x in random.sample(range(16**6), 2000)) if t not in conosciute]
+        self._lock = threading.Lock()
+        self._inviate = 0
+        self._prossimo_slot = 0.0
+
+    def _passaggio(self, categoria:str) -> tuple[dict, bool]:
+        '''Restituisce il corpo di un passaggio della categoria indicata e l'esito atteso'''
+        if categoria == 'sconosciuto':
+            smart_card_id = random.choice(self._sconosciute)
+        else:
+            smart_card_id = random.choice(self.tessere['scaduto' if categoria == 'scaduto' else 'valido'])
+        palestra_id = str(random.choice(self.palestre))
+        timestamp = int(datetime.now().timestamp() * 1000)
+        chiave = self.api_key + "errata" if categoria == 'firma' else self.api_key
+        return {"IDSmartCard": smart_card_id, "IDPalestra": palestra_id, "Timestamp": timestamp,
+                "Signature": firma(chiave, smart_card_id + palestra_id + str(timestamp))}, categoria == 'valido'
+
+    def _permesso(self, fine:float) -> bool:
+        '''Riserva la prossima richiesta: False se il test è terminato. Con un rate attende il proprio turno'''
+        with self._lock:
+            if self.richieste and self._inviate >= self.richieste:
+                return False
+            self._inviate += 1
+            attesa = 0.0
+            if self.rate > 0:
+                adesso = time.perf_counter()
+                self._prossimo_slot = max(self._prossimo_slot, adesso)
+                attesa = self._prossimo_slot - adesso
+                self._prossimo_slot += 1 / self.rate
+        if attesa > 0:
+            time.sleep(attesa)
+        return time.perf_counter() < fine
+
+    def _worker(self, fine:float, risultati:dict):
+        sessione = requests.Session()
+        while self._permesso(fine):
+            categorie = random.choices(self.categorie, self.pesi, k=self.batch)
+            passaggi = [self._passaggio(categoria) for categoria in categorie]
+            inizio = time.perf_counter()
+            try:
+                if self.batch == 1:
+                    risposta = sessione.post(url=self.indirizzo, json=passaggi[0][0], timeout=self.timeout)
+                else:
+                    risposta = sessione.post(url=f"{self.indirizzo}/batch", json={"Records": [p for p, _ in passaggi]},
+                                             timeout=self.timeout)
+                latenza = time.perf_counter() - inizio
+            except requests.RequestException:
+                risultati["eccezioni"] += 1
+                continue
+            risultati["latenze"].append(latenza)
+            if risposta.status_code != 200:
+                risultati["errori_http"] += 1
+                continue
+            corpo = risposta.json()
+            esiti = [corpo] if self.batch == 1 else corpo.get("risultati", [])
+            for (passaggio, atteso), categoria, esito in zip(passaggi, categorie, esiti):
+                conteggio = risultati["categorie"][categoria]
+                conteggio["inviati"] += 1
+                if esito.get("valido") != atteso:
+                    conteggio["inattesi"] += 1
+                if esito.get("signature") != firma(self.api_key, passaggio["IDSmartCard"] + str(passaggio["Timestamp"])):
+                    risultati["firme_risposta_errate"] += 1
+
+    def esegui(self) -> dict:
+        '''Esegue il test e restituisce il report'''
+        parziali = [{"latenze": [], "eccezioni": 0, "errori_http": 0, "firme_risposta_errate": 0,
+                     "categorie": {c: {"inviati": 0, "inattesi": 0} for c in self.categorie}}
+                    for _ in range(self.concorrenza)]
+        inizio = time.perf_counter()
+        fine = inizio + self.durata if self.durata else float("inf")
+        threads = [threading.Thread(target=self._worker, args=(fine, parziale), daemon=True) for parziale in parziali]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        trascorso = time.perf_counter() - inizio
+
+        latenze = sorted(l * 1000 for parziale in parziali for l in parziale["latenze"])
+        richieste = len(latenze) + sum(p["eccezioni"] for p in parziali)
+        categorie = {c: {chiave: sum(p["categorie"][c][chiave] for p in parziali) for chiave in ("inviati", "inattesi")}
+                     for c in self.categorie}
+        passaggi = sum(c["inviati"] for c in categorie.values())
+        errori = {chiave: sum(p[chiave] for p in parziali) for chiave in ("eccezioni", "errori_http", "firme_risposta_errate")}
+        return {
+            "durata_s": round(trascorso, 3),
+            "concorrenza": self.concorrenza,
+            "rate_obiettivo": self.rate or None,
+            "batch": self.batch,
+            "richieste": richieste,
+            "passaggi": passaggi,
+            "throughput": {"richieste_s": round(richieste / trascorso, 2), "passaggi_s": round(passaggi / trascorso, 2)},
+            "latenza_ms": {"media": round(sum(latenze) / len(latenze), 3) if latenze else None,
+                           **{f"p{p}": round(percentile(latenze, p), 3) if latenze else None for p in (50, 90, 95, 99)},
+                           "max": round(latenze[-1], 3) if latenze else None},
+            "errori": {**errori, "tasso_errori": round((errori["eccezioni"] + errori["errori_http"]) / richieste, 4) if richieste else None},
+            "categorie": {c: {**v, "tasso_inattesi": round(v["inattesi"] / v["inviati"], 4) if v["inviati"] else None}
+                          for c, v in categorie.items()},
+        }
+
+def prepara_ambiente_locale(cartella:str, membri:int, num_palestre:int, frazione_scaduti:float) -> tuple[dict, list, str]:
+    '''
+        Funzione che prepara in "cartella" i segreti ed i database SQLite (Gestionale e Log & Statistiche)
+        per l'esecuzione locale dell'API, popolando il Gestionale con palestre e clienti sintetici.
+        Imposta le variabili d'ambiente lette dall'API e restituisce tessere, palestre ed API key.
+    '''
+    sys.path.insert(0, CARTELLA_API)
+    from Crypto.PublicKey import RSA
+    from sqlalchemy import create_engine, insert
+    from sqlalchemy.orm import Session
+    from db_handler import Base, Gestionale
+
+    api_key = secrets.token_hex(32)
+    cartella_segreti = os.path.join(cartella, "secrets")
+    os.makedirs(cartella_segreti)
+    segreti = {"api_key": api_key, "pseudo_pad": secrets.token_hex(8),
+               "encrypt_key": RSA.generate(2048).publickey().export_key().decode('utf-8'),
+               "db_gs_api_user": "locale", "db_gs_api_password": "locale", "db_gs_ip": "locale",
+               "db_ls_api_password": "locale"}
+    for nome, valore in segreti.items():
+        with open(os.path.join(cartella_segreti, nome), "w") as f:
+            f.write(valore)
+
+    uri_gestionale = f"sqlite:///{os.path.join(cartella, 'gestionale.sqlite3')}"
+    uri_logs = f"sqlite:///{os.path.join(cartella, 'logs_statistiche.sqlite3')}"
+    oggi = date.today()
+    smart_card_ids = [f"{x:06X}" for x in random.sample(range(16**6), membri)]
+    scaduti = int(membri * frazione_scaduti)
+    tessere = {"valido": smart_card_ids[scaduti:], "scaduto": smart_card_ids[:scaduti]}
+    for uri in (uri_gestionale, uri_logs):
+        Base.metadata.create_all(create_engine(uri))
+    with Session(create_engine(uri_gestionale)) as session, session.begin():
+        session.execute(insert(Gestionale.Palestra), [
+            {"id": i, "nome": f"WorldFit {i}", "luogo": f"Città {i}", "stato": STATI_PALESTRE[i % len(STATI_PALESTRE)]}
+            for i in range(1, num_palestre + 1)])
+        session.execute(insert(Gestionale.Cliente), [
+            {"id": i, "nome": f"Nome{i}", "cognome": f"Cognome{i}", "sesso": random.choice("MF"),
+             "data_nascita": oggi - timedelta(days=random.randint(16 * 365, 80 * 365)), "smart_card_id": smart_card_id}
+            for i, smart_card_id in enumerate(smart_card_ids, start=1)])
+        session.execute(insert(Gestionale.Abbonamento), [
+            {"id_cliente": i,
+             "valido_dal": oggi - timedelta(days=400 if i <= scaduti else 30),
+             "valido_al": oggi - timedelta(days=35) if i <= scaduti else oggi + timedelta(days=335)}
+            for i in range(1, membri + 1)])
+
+    os.environ.update({
+        "SECRETS_DIR": cartella_segreti,
+        "DATABASE_GS_URI": uri_gestionale,
+        "DATABASE_LS_URI": uri_logs,
+        "CACHE_TESSERE_PATH": os.path.join(cartella, "cache_tessere.sqlite3"),
+        "CODA_SCRITTURE_SPILL_DIR": os.path.join(cartella, "spill"),
+        "METRICHE_DIR": os.path.join(cartella, "metriche"),
+        "METRICHE_BIND": f"127.0.0.1:{porta_libera()}",
+    })
+    return tessere, list(range(1, num_palestre + 1)), api_key
+
+def porta_libera() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def attendi_porta(porta:int, timeout:float = 30):
+    '''Attende che il server locale accetti connessioni'''
+    scadenza = time.monotonic() + timeout
+    while time.monotonic() < scadenza:
+        try:
+            socket.create_connection(("127.0.0.1", porta), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    sys.exit(f"Il server locale non risponde sulla porta {porta}")
+
+def avvia_server(modalita:str, porta:int, workers:int) -> subprocess.Popen:
+    '''Avvia l'API locale in un processo separato: "gunicorn" (api_server.py) o "asgi" (api_async.py con Uvicorn)'''
+    if modalita == "asgi":
+        comando = [sys.executable, "-m", "uvicorn", "api_async:app", "--host", "127.0.0.1", "--port", str(porta),
+                   "--workers", str(workers), "--no-access-log", "--log-level", "warning"]
+    else:
+        comando = [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py",
+                   "--bind", f"127.0.0.1:{porta}", "--workers", str(workers), "api_server:app"]
+    return subprocess.Popen(comando, cwd=CARTELLA_API, env=os.environ.copy())
+
+def conta_righe(uri:str) -> dict:
+    '''Numero di righe scritte dall'API nel database Log & Statistiche locale'''
+    from sqlalchemy import create_engine, inspect, text
+    engine = create_engine(uri)
+    with engine.connect() as connection:
+        return {tabella: connection.execute(text(f"SELECT COUNT(*) FROM {tabella}")).scalar()
+                for tabella in inspect(engine).get_table_names() if tabella in ("Logs", "Statistiche", "StatisticheAggregate")}
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument('-i','--indirizzo', required=True,
+    parser.add_argument('-m', '--mode', default='singola', choices=['singola', 'carico', 'locale'],
+                        help="singola: una richiesta; carico: test di carico su un'API avviata; "
+                             "locale: test di carico su un'API avviata in locale con database SQLite")
+    parser.add_argument('-i','--indirizzo',
                         help='Indirizzo IP e porta del container, es: 10.10.10.10:234')
-    parser.add_argument('-p', '--palestraId', required=True,
+    parser.add_argument('-p', '--palestraId',
                         help='Id della palestra')
-    parser.add_argument('-s', '--smartcardId', required=True,
+    parser.add_argument('-s', '--smartcardId',
                         help='Smard Card ID')
+    parser.add_argument('--palestre', default='',
+                        help="[carico] Id delle palestre separati da virgola, es: 1,2,3")
+    parser.add_argument('--valide', default='',
+                        help="[carico] Smart Card ID con abbonamento valido, separati da virgola")
+    parser.add_argument('--scadute', default='',
+                        help="[carico] Smart Card ID con abbonamento scaduto, separati da virgola")
+    parser.add_argument('--mix', type=leggi_mix, default='valido=70,scaduto=10,sconosciuto=10,firma=10',
+                        help="Pesi delle categorie di passaggi, es: valido=70,scaduto=10,sconosciuto=10,firma=10")
+    parser.add_argument('-c', '--concorrenza', type=int, default=8,
+                        help="Numero di richieste contemporanee")
+    parser.add_argument('-r', '--rate', type=float, default=0,
+                        help="Richieste al secondo obiettivo (0 = senza limite)")
+    parser.add_argument('-d', '--durata', type=float, default=10,
+                        help="Durata del test in secondi (0 = fino al numero di richieste)")
+    parser.add_argument('-n', '--richieste', type=int, default=0,
+                        help="Numero massimo di richieste HTTP (0 = fino alla durata)")
+    parser.add_argument('-b', '--batch', type=int, default=1,
+                        help="Passaggi per richiesta: con più di 1 viene usato l'endpoint /batch")
+    parser.add_argument('-o', '--output', default='-',
+                        help="File in cui salvare il report JSON, - per lo standard output")
+    parser.add_argument('--membri', type=int, default=10000,
+                        help="[locale] Numero di clienti sintetici")
+    parser.add_argument('--num-palestre', type=int, default=20,
+                        help="[locale] Numero di palestre sintetiche")
+    parser.add_argument('--frazione-scaduti', type=float, default=0.2,
+                        help="[locale] Frazione di clienti con abbonamento scaduto")
+    parser.add_argument('--gunicorn', action='store_true',
+                        help="[locale] Avvia l'API con Gunicorn invece che con il server di sviluppo in processo")
+    parser.add_argument('--asgi', action='store_true',
+                        help="[locale] Avvia l'API in modalità asincrona (api_async.py) con Uvicorn")
+    parser.add_argument('--workers', type=int, default=2,
+                        help="[locale] Numero di workers di Gunicorn o di Uvicorn")
     args = parser.parse_args()
+    if args.durata <= 0 and args.richieste <= 0:
+        parser.error("indicare una durata o un numero di richieste")
+    if args.gunicorn and args.asgi:
+        parser.error("indicare solo una tra --gunicorn e --asgi")
+
+    if args.mode == 'singola':
+        if not (args.indirizzo and args.palestraId and args.smartcardId):
+            parser.error("la modalità singola richiede --indirizzo, --palestraId e --smartcardId")
+        timestamp = int(datetime.now().timestamp() * 1000)
+        api_key = prendisegreto("api_key.txt")
+        dati = args.smartcardId + args.palestraId + str(timestamp)
+        signature = firma(api_key, dati)
+        body = {
+            "IDSmartCard":args.smartcardId,
+            "IDPalestra":args.palestraId,
+            "Timestamp":timestamp,
+            "Signature":signature
+        }
+
+        response = requests.post(url=f"{args.indirizzo}", json=body)
+        print(response.content)
+        sys.exit()
+
+    server, processo, cartella = None, None, None
+    if args.mode == 'carico':
+        if not (args.indirizzo and args.palestre and args.valide):
+            parser.error("la modalità carico richiede --indirizzo, --palestre e --valide")
+        tessere = {"valido": args.valide.split(","), "scaduto": [t for t in args.scadute.split(",") if t]}
+        if args.mix['scaduto'] > 0 and not tessere['scaduto']:
+            parser.error("il mix contiene passaggi scaduti: indicare --scadute")
+        palestre = args.palestre.split(",")
+        api_key = prendisegreto("api_key.txt")
+        indirizzo = args.indirizzo
+    else:
+        cartella = tempfile.TemporaryDirectory(prefix="worldfit_carico_")
+        tessere, palestre, api_key = prepara_ambiente_locale(cartella.name, args.membri, args.num_palestre,
+                                                             args.frazione_scaduti)
+        porta = porta_libera()
+        indirizzo = f"http://127.0.0.1:{porta}"
+        if args.gunicorn or args.asgi:
+            processo = avvia_server("asgi" if args.asgi else "gunicorn", porta, args.workers)
+        else:
+            from werkzeug.serving import make_server
+            import api_server
+            logging.getLogger("werkzeug").setLevel(logging.ERROR) # niente log per ogni richiesta
+            server = make_server("127.0.0.1", porta, api_server.app, threaded=True)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+        attendi_porta(porta)
+
+    try:
+        report = GeneratoreCarico(indirizzo, api_key, tessere, palestre, args.mix, args.concorrenza,
+                                  args.rate, args.durata, args.richieste, args.batch).esegui()
+    finally:
+        # Chiusura del server locale: la coda di scrittura viene svuotata prima di contare le righe
+        if server is not None:
+            server.shutdown()
+            if api_server.coda is not None:
+                api_server.coda.chiudi()
+        if processo is not None:
+            processo.terminate()
+            processo.wait(30)
+    if cartella is not None:
+        report["database_locale"] = conta_righe(os.environ["DATABASE_LS_URI"])
+        report["modalita"] = "gunicorn" if args.gunicorn else "asgi" if args.asgi else "in processo"
+        cartella.cleanup()
 
-    timestamp = int(datetime.now().timestamp() * 1000)
-    api_key = prendisegreto("api_key.txt")
-    dati = args.smartcardId + args.palestraId + str(timestamp)
-    signature = hmac.new(key=api_key.encode('utf-8'), msg=dati.encode('utf-8'), digestmod=sha256).hexdigest()
-    body = {
-        "IDSmartCard":args.smartcardId,
-        "IDPalestra":args.palestraId,
-        "Timestamp":timestamp,
-        "Signature":signature
-    }
-
-    response = requests.post(url=f"{args.indirizzo}", json=body)
-    print(response.content)
-    
\ No newline at end of file
+    testo = json.dumps(report, indent=2)
+    if args.output == '-':
+        print(testo)
+    else:
+        with open(args.output, "w") as f:
+            f.write(testo + "\n")
@@ -0,0 +1,39 @@
+'''
+Script che genera api/fusi_stati.py, la tabella statica dei fusi orari per nome (in italiano) dello stato
+usata da privacy_modules.fuso_orario. La tabella sostituisce, all'avvio dei workers dell'API, la lettura
+dei territori dal locale italiano di Babel ed i fusi orari di pytz: va rigenerata solo all'aggiornamento
+di babel o pytz in api/requirements.txt. Esempio di lancio dalla cartella external:
+
+    python genera_fusi_stati.py
+'''
+from babel import Locale
+from pytz import country_timezones
+import os, argparse
+
+CARTELLA_API = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "api")
+
+def genera() -> dict:
+    '''Stessa regola di privacy_modules.fuso_orario: primo fuso orario del paese, per nome dello stato in minuscolo'''
+    fusi = {}
+    for sigla, stato in Locale("it").territories.items():
+        fusi_paese = country_timezones.get(sigla.lower()) if sigla.isalpha() else None
+        if fusi_paese:
+            fusi[stato.lower()] = fusi_paese[0]
+    return fusi
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-o', '--output', default=os.path.join(CARTELLA_API, "fusi_stati.py"))
+    args = parser.parse_args()
+
+    import babel, pytz
+    fusi = genera()
+    with open(args.output, "w", encoding="utf-8") as f:
+        f.write("'''\n"
+                "Tabella generata da external/genera_fusi_stati.py: non modificare a mano.\n"
+                f"Fuso orario (IANA) per nome dello stato in italiano, in minuscolo (babel {babel.__version__}, pytz {pytz.__version__}).\n"
+                "'''\n"
+                "FUSO_PER_STATO = {\n")
+        f.writelines(f"    {stato!r}: {fuso!r},\n" for stato, fuso in sorted(fusi.items()))
+        f.write("}\n")
+    print(f"{len(fusi)} stati scritti in {args.output}")
@@ -1,13 +1,21 @@
 '''
-Modulo python esterno all'applicazione contenente funzioni per la generazione di chiavi RSA e per la
-re-identificazione di pseudonimi di Smart Card.
+Modulo python esterno all'applicazione contenente funzioni per la generazione di chiavi RSA, per la
+re-identificazione di pseudonimi di Smart Card e per la consultazione dell'archivio freddo di Logs
+(segmenti scritti da api/archivio_logs.py).
 '''
 
 import sys
 from Crypto.PublicKey import RSA
 from Crypto.Util.number import bytes_to_long, long_to_bytes
+from Crypto.Math.Numbers import Integer
+from multiprocessing import Pool
 import base64
 import argparse
+import csv, getpass, json, os, time
+from datetime import date
+
+# Formato dei segmenti dell'archivio di Logs (solo libreria standard)
+CARTELLA_API = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "api")
 
 def prendisegreto(secretFile: str) -> str:
     """Funzione che prende un segreto dalla cartella secrets"""
@@ -51,16 +59,164 @@ def re_identificazione(pseudo_id: str, decrypt_key: RSA.RsaKey, pseudo_pad:str)
         
     except Exception as e:
         return f"Errore decifratura: {str(e)}"
-    
+
+def pseudonimizzazione(smart_card_id: str, encrypt_key: RSA.RsaKey, pseudo_pad: str) -> str:
+    """Calcola lo pseudonimo di uno Smart Card ID come l'API (privacy_modules.calcola_pseudonimo)"""
+    plain_int = bytes_to_long((smart_card_id + pseudo_pad).encode('utf-8'))
+    if plain_int >= encrypt_key.n:
+        raise ValueError("Lo Smart Card ID è troppo lungo per la chiave scelta.")
+    return base64.urlsafe_b64encode(long_to_bytes(pow(plain_int, encrypt_key.e, encrypt_key.n))).decode('utf-8')
+
+def prepara_crt(decrypt_key: RSA.RsaKey) -> tuple:
+    """
+        Precalcola i parametri per la decifratura con il Teorema Cinese del Resto (CRT): due
+        esponenziazioni modulo p e q (a 1024 bit) al posto di una modulo n (a 2048 bit). Le
+        esponenziazioni usano gli interi di pycryptodome (GMP se disponibile), più veloci di pow().
+    """
+    p, q, d = int(decrypt_key.p), int(decrypt_key.q), int(decrypt_key.d)
+    return p, q, pow(q, -1, p), Integer(p), Integer(q), Integer(d % (p - 1)), Integer(d % (q - 1))
+
+def re_identificazione_crt(pseudo_id: str, crt: tuple, pseudo_pad: str) -> str:
+    """
+        Decifra lo pseudonimo con i parametri CRT di prepara_crt. A differenza di re_identificazione
+        solleva un'eccezione in caso di errore, in modo da poterlo riportare separatamente dal risultato.
+    """
+    p, q, qinv, p_gmp, q_gmp, dp_gmp, dq_gmp = crt
+    cypher_int = bytes_to_long(base64.urlsafe_b64decode(pseudo_id))
+
+    # Raw RSA Decryption con CRT: m = m2 + q * (qinv * (m1 - m2) mod p)
+    m1 = int(pow(Integer(cypher_int % p), dp_gmp, p_gmp))
+    m2 = int(pow(Integer(cypher_int % q), dq_gmp, q_gmp))
+    m_int = m2 + q * ((qinv * (m1 - m2)) % p)
+
+    plaintext = long_to_bytes(m_int)
+    if not plaintext.endswith(pseudo_pad.encode('utf-8')):
+        raise ValueError("Decifratura fallita o chiave errata")
+    return plaintext[:-len(pseudo_pad)].decode('utf-8')
+
+# Stato di ogni processo del pool: la chiave viene sbloccata una sola volta per processo
+_crt_worker = None
+_pad_worker = None
+
+def _inizializza_worker(chiave_pem: str, passphrase: str, pseudo_pad: str):
+    global _crt_worker, _pad_worker
+    _crt_worker = prepara_crt(RSA.import_key(extern_key=chiave_pem, passphrase=passphrase))
+    _pad_worker = pseudo_pad
+
+def _re_identifica_worker(pseudo_id: str) -> tuple[str, str | None, str | None]:
+    try:
+        return pseudo_id, re_identificazione_crt(pseudo_id, _crt_worker, _pad_worker), None
+    except Exception as e:
+        return pseudo_id, None, str(e)
+
+def _pseudonimi_unici(righe, contatori: dict):
+    """Generatore degli pseudonimi non ancora incontrati: ogni pseudonimo viene decifrato una sola volta"""
+    visti = set()
+    for riga in righe:
+        pseudo_id = riga.strip()
+        if not pseudo_id:
+            continue
+        contatori["letti"] += 1
+        if pseudo_id in visti:
+            contatori["duplicati"] += 1
+            continue
+        visti.add(pseudo_id)
+        yield pseudo_id
+
+def re_identificazione_batch(righe, uscita, formato: str, chiave_pem: str, passphrase: str,
+                             pseudo_pad: str, processi: int) -> dict:
+    """
+        Re-identifica in parallelo gli pseudonimi letti da righe (uno per riga) e scrive i risultati
+        su uscita in CSV o JSONL man mano che vengono calcolati. Restituisce i contatori dell'esecuzione.
+    """
+    contatori = {"letti": 0, "duplicati": 0, "decifrati": 0, "errori": 0}
+    scrittore = csv.writer(uscita) if formato == 'csv' else None
+    if scrittore is not None:
+        scrittore.writerow(["pseudonimo", "smart_card_id", "errore"])
+
+    inizio = time.perf_counter()
+    with Pool(processes=processi, initializer=_inizializza_worker,
+              initargs=(chiave_pem, passphrase, pseudo_pad)) as pool:
+        for pseudo_id, smart_card_id, errore in pool.imap(_re_identifica_worker,
+                                                          _pseudonimi_unici(righe, contatori),
+                                                          chunksize=64):
+            contatori["errori" if errore else "decifrati"] += 1
+            if scrittore is not None:
+                scrittore.writerow([pseudo_id, smart_card_id or "", errore or ""])
+            else:
+                uscita.write(json.dumps({"pseudonimo": pseudo_id, "smart_card_id": smart_card_id,
+                                         "errore": errore}) + "\n")
+    contatori["secondi"] = round(time.perf_counter() - inizio, 3)
+    contatori["pseudonimi_al_secondo"] = round((contatori["decifrati"] + contatori["errori"]) / contatori["secondi"], 1) \
+        if contatori["secondi"] else 0.0
+    return contatori
+
+def consulta_archivio(archivio, uscita, formato: str, pseudonimo: str | None = None, dal: date | None = None,
+                      al: date | None = None, palestra: int | None = None, crt: tuple | None = None,
+                      pseudo_pad: str | None = None) -> dict:
+    """
+        Scrive su uscita in CSV o JSONL gli ingressi archiviati di uno pseudonimo (tutti, se non indicato)
+        nell'intervallo [dal, al), eventualmente di una sola palestra. Con i parametri CRT gli pseudonimi
+        vengono re-identificati, una sola volta ciascuno. Restituisce i contatori dell'esecuzione.
+    """
+    contatori = {"ingressi": 0, "segmenti": len(archivio.segmenti(dal, al)), "re_identificati": 0}
+    colonne = ["pseudonimo"] + (["smart_card_id"] if crt else []) + ["palestra_id", "timestamp", "log_id"]
+    scrittore = csv.writer(uscita) if formato == 'csv' else None
+    if scrittore is not None:
+        scrittore.writerow(colonne)
+    identificati = {}
+    inizio = time.perf_counter()
+    righe = archivio.cerca(pseudonimo, dal, al) if pseudonimo else archivio.righe(dal, al)
+    for pseudo_id, palestra_id, timestamp, log_id in righe:
+        if palestra is not None and palestra_id != palestra:
+            continue
+        valori = [pseudo_id, palestra_id, timestamp.isoformat(), log_id]
+        if crt:
+            if pseudo_id not in identificati:
+                try:
+                    identificati[pseudo_id] = re_identificazione_crt(pseudo_id, crt, pseudo_pad)
+                    contatori["re_identificati"] += 1
+                except Exception as e:
+                    identificati[pseudo_id] = f"Errore decifratura: {str(e)}"
+            valori.insert(1, identificati[pseudo_id])
+        contatori["ingressi"] += 1
+        if scrittore is not None:
+            scrittore.writerow(valori)
+        else:
+            uscita.write(json.dumps(dict(zip(colonne, valori))) + "\n")
+    contatori["secondi"] = round(time.perf_counter() - inizio, 3)
+    return contatori
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('-m', '--mode', required=True, choices=['genera_chiavi','identifica'],
+    parser.add_argument('-m', '--mode', required=True, choices=['genera_chiavi','identifica','identifica_batch','archivio'],
                         help="""
                         Seleziona la modalità di esecuzione:
                         - 'genera_chiavi'-> Genera un nuovo paio di chiavi RSA partendo da una passphrase;
                         - 'identifica'-> richiama la funzione di re-identificazione per ottenere uno 
                                         Smart Card ID da uno pseudonimo;
+                        - 'identifica_batch'-> re-identifica in parallelo gli pseudonimi letti da file
+                                        o standard input (uno per riga);
+                        - 'archivio'-> cerca gli ingressi eliminati da Logs nei segmenti dell'archivio,
+                                        per pseudonimo o Smart Card ID, con re-identificazione opzionale;
                         """)
+    parser.add_argument('-i', '--input', default='-',
+                        help="[identifica_batch] File di pseudonimi, uno per riga ('-' per standard input)")
+    parser.add_argument('-o', '--output', default='-',
+                        help="[identifica_batch, archivio] File dei risultati ('-' per standard output)")
+    parser.add_argument('-f', '--formato', default='csv', choices=['csv', 'jsonl'],
+                        help="[identifica_batch, archivio] Formato dei risultati")
+    parser.add_argument('-p', '--processi', type=int, default=os.cpu_count(),
+                        help="[identifica_batch] Numero di processi di decifratura")
+    parser.add_argument('-a', '--archivio', default='archivio',
+                        help="[archivio] Cartella dei segmenti (volume logs_archivio del servizio worldfit_archivio)")
+    parser.add_argument('--pseudonimo', help="[archivio] Pseudonimo della tessera da cercare")
+    parser.add_argument('--smart-card', help="[archivio] Smart Card ID da cercare (pseudonimizzato con encrypt_key.txt)")
+    parser.add_argument('--dal', type=date.fromisoformat, help="[archivio] Primo giorno (AAAA-MM-GG)")
+    parser.add_argument('--al', type=date.fromisoformat, help="[archivio] Giorno successivo all'ultimo (AAAA-MM-GG)")
+    parser.add_argument('--palestra', type=int, help="[archivio] Solo gli ingressi di una palestra")
+    parser.add_argument('--identifica', action='store_true',
+                        help="[archivio] Re-identifica gli pseudonimi trovati (richiede la chiave di decifratura)")
     args = parser.parse_args()
     match args.mode:
         case 'genera_chiavi':
@@ -97,5 +253,53 @@ if __name__ == '__main__':
             
             print(f'ID originale: {id}')
 
+        case 'identifica_batch':
+            # La passphrase viene letta dal terminale: lo standard input può contenere gli pseudonimi
+            passphrase = getpass.getpass('Inserisci la passphrase per la chiave di decifratura: ')
+            chiave_pem = prendisegreto('decrypt_key.txt')
+            try:
+                RSA.import_key(extern_key=chiave_pem, passphrase=passphrase)
+            except Exception as e:
+                sys.exit(f'Impossibile sbloccare la chiave di decifratura: {str(e)}')
+
+            ingresso = sys.stdin if args.input == '-' else open(args.input, 'r')
+            uscita = sys.stdout if args.output == '-' else open(args.output, 'w', newline='')
+            try:
+                contatori = re_identificazione_batch(ingresso, uscita, args.formato, chiave_pem, passphrase,
+                                                     prendisegreto('pseudo_pad.txt'), args.processi)
+            finally:
+                if ingresso is not sys.stdin:
+                    ingresso.close()
+                if uscita is not sys.stdout:
+                    uscita.close()
+            print(json.dumps(contatori), file=sys.stderr)
+
+        case 'archivio':
+            sys.path.insert(0, CARTELLA_API)
+            from segmenti_logs import Archivio
+
+            pseudonimo = args.pseudonimo
+            if args.smart_card:
+                pseudonimo = pseudonimizzazione(args.smart_card, RSA.import_key(prendisegreto('encrypt_key.txt')),
+                                                prendisegreto('pseudo_pad.txt'))
+            crt = None
+            if args.identifica:
+                try:
+                    crt = prepara_crt(RSA.import_key(extern_key=prendisegreto('decrypt_key.txt'),
+                                                     passphrase=getpass.getpass('Inserisci la passphrase per la chiave di decifratura: ')))
+                except Exception as e:
+                    sys.exit(f'Impossibile sbloccare la chiave di decifratura: {str(e)}')
+
+            archivio = Archivio(args.archivio)
+            uscita = sys.stdout if args.output == '-' else open(args.output, 'w', newline='')
+            try:
+                contatori = consulta_archivio(archivio, uscita, args.formato, pseudonimo, args.dal, args.al,
+                                              args.palestra, crt, prendisegreto('pseudo_pad.txt') if crt else None)
+            finally:
+                archivio.close()
+                if uscita is not sys.stdout:
+                    uscita.close()
+            print(json.dumps(contatori), file=sys.stderr)
+
         case _:
             print('Funzionalità non valida')
\ No newline at end of file